@@ -30,15 +30,20 @@ authors and should not be interpreted as representing official policies, either
 or implied, of James Yates Farrimond.
 """
 
-import daemon
+import errno
 import pwd
 import optparse
 import os
-
-from lockfile.pidlockfile import PIDLockFile
+import signal
+import socket
+import traceback
 
 import memcache_logging as mc_log
+import memcache_asyncio
 import memcache_connection
+import memcache_proxy
+import memcache_warmup
+import memory_cache_shared
 
 def parse_command_line():
     """ parse the command line """
@@ -80,6 +85,138 @@ def parse_command_line():
                       action="store_true", default=False,
                       help="extremely verbose (also print internal state "
                       "transitions)")
+    parser.add_option("-c", "--connections", dest="connections", type="int", 
+                      default=1024, metavar="CONNECTIONS",
+                      help="max simultaneous connections (default: %default)")
+    parser.add_option("--idle-timeout", dest="idle_timeout", type="int", 
+                      default=0, metavar="SECONDS",
+                      help="close connections idle for more than SECONDS "
+                      "(default: %default, never)")
+    parser.add_option("-b", "--backlog", dest="backlog", type="int", 
+                      default=1024, metavar="BACKLOG",
+                      help="set the backlog queue limit (default: %default)")
+    parser.add_option("--max-accepts", dest="max_accepts", type="int", 
+                      metavar="COUNT",
+                      help="max connections accepted each time the "
+                      "listening socket is ready, pyev backend only "
+                      "(default: 16)")
+    parser.add_option("--workers", dest="workers", type="int", default=1,
+                      metavar="PROCESSES",
+                      help="fork this many servers, accepting on the same "
+                      "port and sharing the items in shared memory "
+                      "(default: %default)")
+    parser.add_option("-R", "--requests", dest="requests", type="int", 
+                      default=20, metavar="REQUESTS",
+                      help="maximum number of requests per event "
+                      "(default: %default)")
+    parser.add_option("--backend", dest="backend", type="choice",
+                      choices=["pyev", "asyncio", "uvloop"], default="pyev",
+                      metavar="BACKEND",
+                      help="event loop to use - one of pyev, asyncio, or "
+                      "uvloop (default: %default)")
+    parser.add_option("--drain-timeout", dest="drain_timeout", type="int", 
+                      default=10, metavar="SECONDS",
+                      help="on SIGTERM, give connections SECONDS to finish "
+                      "before closing them, SIGINT stops right away "
+                      "(default: %default)")
+    parser.add_option("--handoff", dest="handoff", default="", 
+                      metavar="PATH",
+                      help="take over the listening socket from the server "
+                      "waiting on the unix socket PATH, which then drains "
+                      "and exits, and wait there for our own replacement")
+    parser.add_option("--snapshot", dest="snapshot", default="", 
+                      metavar="FILE",
+                      help="load the items saved in FILE on startup, save "
+                      "them there on shutdown and on SIGUSR1")
+    parser.add_option("--oplog", dest="oplog", default="", metavar="FILE",
+                      help="log changes to FILE, replay them on startup, "
+                      "and compact them into the --snapshot file")
+    parser.add_option("--fsync-interval", dest="fsync_interval", 
+                      type="float", default=1.0, metavar="SECONDS",
+                      help="write and fsync the --oplog every SECONDS "
+                      "(default: %default)")
+    parser.add_option("--compact-size", dest="compact_size", 
+                      default="64m", metavar="SIZE",
+                      help="compact the --oplog once it grows past SIZE "
+                      "(default: %default)")
+    parser.add_option("--disk-dir", dest="disk_dir", default="", 
+                      metavar="DIR",
+                      help="keep values evicted from memory in segment "
+                      "files in DIR instead of dropping them")
+    parser.add_option("--disk-size", dest="disk_size", 
+                      default="1024m", metavar="SIZE",
+                      help="disk space to use in --disk-dir "
+                      "(default: %default)")
+    parser.add_option("--disk-min-value", dest="disk_min_value", 
+                      default="512", metavar="SIZE",
+                      help="smaller values are just dropped "
+                      "(default: %default)")
+    parser.add_option("--warmup-file", dest="warmup_file", default="", 
+                      metavar="FILE",
+                      help="load the items in the snapshot FILE while "
+                      "serving, keys clients set first are kept")
+    parser.add_option("--warmup-peer", dest="warmup_peer", default="", 
+                      metavar="HOST:PORT",
+                      help="load the items a running server has while "
+                      "serving, keys clients set first are kept")
+    parser.add_option("--proxy", dest="proxy", default="", 
+                      metavar="HOST:PORT,...",
+                      help="don't cache, pass each command on to the server "
+                      "that owns its key by consistent hashing")
+    parser.add_option("--proxy-pool", dest="proxy_pool", type="int", 
+                      default=2, metavar="CONNECTIONS",
+                      help="--proxy connections to each server "
+                      "(default: %default)")
+    parser.add_option("--proxy-max-pending", dest="proxy_max_pending", 
+                      type="int", default=memcache_proxy.DEFAULT_MAX_SLOTS, 
+                      metavar="REQUESTS",
+                      help="stop reading from a --proxy client with this "
+                      "many replies still to come (default: %default)")
+    parser.add_option("--proxy-max-unsent", dest="proxy_max_unsent", 
+                      type="int", default=memcache_proxy.DEFAULT_MAX_UNSENT, 
+                      metavar="BYTES",
+                      help="stop reading from --proxy clients while a "
+                      "server connection has more than this waiting to "
+                      "be written (default: %default)")
+    parser.add_option("--replicate", dest="replicate", default="", 
+                      metavar="HOST:PORT,...",
+                      help="send every change on to these servers, which "
+                      "then serve reads from the same items")
+    parser.add_option("--repl-backlog", dest="repl_backlog", 
+                      default="16m", metavar="SIZE",
+                      help="a --replicate server that falls SIZE behind "
+                      "starts over from the whole cache (default: %default)")
+    parser.add_option("--lease-time", dest="lease_time", type="int", 
+                      default=10, metavar="SECONDS",
+                      help="an lget miss leases the key to its client for "
+                      "SECONDS to refill it (default: %default)")
+    parser.add_option("--stale-time", dest="stale_time", type="int", 
+                      default=0, metavar="SECONDS",
+                      help="lget serves items for SECONDS after they "
+                      "expire while someone refills them (default: "
+                      "%default, off)")
+    parser.add_option("--read-through", dest="read_through", default=None,
+                      metavar="URL",
+                      help="fetch misses from a web server, GET URL with "
+                      "the key on the end, concurrent misses on a key "
+                      "share one fetch")
+    parser.add_option("--read-through-time", dest="read_through_time", 
+                      type="int", default=0, metavar="SECONDS",
+                      help="exptime for --read-through items "
+                      "(default: %default, never)")
+    parser.add_option("--read-through-threads", dest="read_through_threads",
+                      type="int", default=4, metavar="THREADS",
+                      help="--read-through fetches at a time "
+                      "(default: %default)")
+    # -I is already taken by --interface, so this only gets the long form
+    parser.add_option("--item-size", dest="item_size", 
+                      default="1m", metavar="SIZE",
+                      help="maximum size of an item, larger values are "
+                      "refused (default: %default, min: 1k, max: 128m)")
+    parser.add_option("--chunk-size", dest="chunk_size", 
+                      default="0", metavar="SIZE",
+                      help="store values larger than SIZE as SIZE-byte "
+                      "chunks (default: %default, off)")
 
     # WANT TO DO
     # parser.add_option("-U", "--udp-port", dest="udp_port", type="int", 
@@ -94,9 +231,6 @@ def parse_command_line():
     #                   metavar="MASK",
     #                   help="access mask for UNIT socket, in octal "
     #                   "(default %default)")
-    # parser.add_option("-c", "--connetions", dest="connections", type="int", 
-    #                   default=1024, metavar="CONNECTIONS",
-    #                   help="max simultaneous connections (default: 1024)")
 
     # MAYBE LATER
     # parser.add_option("-M", "--memory-error", dest="memory_error", 
@@ -112,16 +246,9 @@ def parse_command_line():
     # parser.add_option("-t", "--threads", dest="threads", type="int", 
     #                   default="4", metavar="THREADS",
     #                   help="number of threads to use (default: %default)")
-    # parser.add_option("-R", "--requests", dest="requests", type="int", 
-    #                   default=20, metavar="REQUESTS",
-    #                   help="Maximum number of requests per event "
-    #                   "(default: %default)")
     # parser.add_option("-C", "--disable-cas", dest="disable_cas", 
     #                   action="store_true", default=False,
     #                   help="Disable the use of CAS")
-    # parser.add_option("-b", "--backlog", dest="backlog", type="int", 
-    #                   default=1024, metavar="BACKLOG",
-    #                   help="Set the backlog queue limit (default: %default)")
     # parser.add_option("-B", "--binding", dest="binding", default="auto", 
     #                   metavar="PROTOCOL",
     #                   help="Binding protocol - one of ascii, binary, or "
@@ -144,14 +271,92 @@ def parse_command_line():
     # parser.add_option("-L", "--large-memory", dest="large_memory", 
     #                   action="store_true", default=False,
     #                   help="Try to use large memory pages (if available).")
-    # parser.add_option("-I", "--item-size", dest="item_size", 
-    #                   default="1mb", metavar="SIZE",
-    #                   help="Override the size of each slab page. Adjusts "
-    #                   "max item size (default: %default, min: 1k, max: 128m)")
 
     (options, args) = parser.parse_args()
+
+    try:
+        options.item_size = parse_size(options.item_size)
+        options.chunk_size = parse_size(options.chunk_size)
+        options.compact_size = parse_size(options.compact_size)
+        options.disk_size = parse_size(options.disk_size)
+        options.disk_min_value = parse_size(options.disk_min_value)
+        options.repl_backlog = parse_size(options.repl_backlog)
+    except ValueError:
+        parser.error("sizes must be a number optionally followed by k or m")
+    if options.item_size < 1024 or options.item_size > 128*1024*1024:
+        parser.error("item size must be between 1k and 128m")
+    options.warmup_source = None
+    if options.warmup_file and options.warmup_peer:
+        parser.error("only one of --warmup-file and --warmup-peer")
+    elif options.warmup_file:
+        options.warmup_source = memcache_warmup.file_records(
+            options.warmup_file)
+    elif options.warmup_peer:
+        host, _, port = options.warmup_peer.rpartition(":")
+        if not host or not port.isdigit():
+            parser.error("--warmup-peer needs HOST:PORT")
+        options.warmup_source = memcache_warmup.peer_records(
+            (host, int(port)))
+    try:
+        options.backends = parse_addresses(options.proxy)
+        options.followers = parse_addresses(options.replicate)
+    except ValueError:
+        parser.error("--proxy and --replicate need HOST:PORT,...")
+    if options.backends and options.backend != "pyev":
+        parser.error("--proxy only works with the pyev backend")
+    if options.backends and options.followers:
+        parser.error("a --proxy has nothing to --replicate")
+    if options.backends and options.read_through:
+        parser.error("a --proxy has no misses to --read-through")
+    if options.backends and (options.snapshot or options.oplog or 
+                             options.disk_dir):
+        parser.error("a --proxy has no items for --snapshot, --oplog or "
+                     "--disk-dir")
+    if options.backends and options.warmup_source is not None:
+        parser.error("a --proxy has no cache to --warmup-file or "
+                     "--warmup-peer")
+    if options.max_accepts is None:
+        options.max_accepts = 16
+    elif options.backend != "pyev":
+        parser.error("--max-accepts only works with the pyev backend")
+    if options.proxy_pool < 1:
+        parser.error("--proxy-pool needs at least one connection")
+    if options.proxy_max_pending < 1:
+        parser.error("--proxy-max-pending needs at least one request")
+    if options.oplog and not options.snapshot:
+        parser.error("--oplog needs a --snapshot to compact into")
+    if options.workers < 1:
+        parser.error("--workers needs at least one process")
+    if options.workers > 1 and (
+        options.backends or options.followers or options.read_through or
+        options.snapshot or options.disk_dir or options.handoff or
+        options.warmup_source is not None):
+        parser.error("--workers share their items in memory, without "
+                     "--proxy, --replicate, --read-through, --snapshot, "
+                     "--disk-dir, --handoff or warming up")
+
     return options, args
 
+def parse_addresses(addresses):
+    """ turn HOST:PORT,... into a list of (host, port) """
+    ret = []
+    for address in filter(None, addresses.split(",")):
+        host, _, port = address.rpartition(":")
+        if not host or not port.isdigit():
+            raise ValueError("not HOST:PORT: %r" % address)
+        ret.append((host, int(port)))
+    return ret
+
+def parse_size(size):
+    """ turn a size like 512, 64k or 1m into a byte count """
+    size = size.lower()
+    if size.endswith('k'):
+        return int(size[:-1])*1024
+    elif size.endswith('m'):
+        return int(size[:-1])*1024*1024
+    else:
+        return int(size)
+
 def setup_logging(options):
     """ figure out our logging level and initialize logging """
     if options.extremely_verbose:
@@ -164,8 +369,58 @@ def setup_logging(options):
         level = mc_log.LOGGING_NONE
     mc_log.initialize_logging(level)
 
+def create_server(options, cache=None, listener=None):
+    """ 
+    setup the server from the command line options, cache and 
+    listener are the ones the workers share, if forking 
+    """
+    kwargs = dict(
+        interface = options.interface, 
+        tcp_port = options.tcp_port, 
+        max_bytes = options.max_memory*1024*1024,
+        item_size_max = options.item_size,
+        chunk_size = options.chunk_size,
+        max_connections = options.connections,
+        idle_timeout = options.idle_timeout,
+        backlog = options.backlog,
+        max_requests = options.requests,
+        drain_timeout = options.drain_timeout,
+        handoff_path = options.handoff,
+        snapshot_path = options.snapshot,
+        oplog_path = options.oplog,
+        fsync_interval = options.fsync_interval,
+        compact_bytes = options.compact_size,
+        disk_dir = options.disk_dir,
+        disk_bytes = options.disk_size,
+        disk_min_bytes = options.disk_min_value,
+        warmup_source = options.warmup_source,
+        replicate_to = options.followers,
+        repl_backlog = options.repl_backlog,
+        lease_seconds = options.lease_time,
+        stale_seconds = options.stale_time,
+        loader_url = options.read_through,
+        loader_exptime = options.read_through_time,
+        loader_threads = options.read_through_threads,
+        listener = listener)
+    if cache is not None:
+        kwargs['cache'] = cache
+    if options.backends:
+        return memcache_proxy.ProxyServer(
+            options.backends, options.proxy_pool, options.proxy_max_pending,
+            options.proxy_max_unsent, max_accepts = options.max_accepts, 
+            **kwargs)
+    elif options.backend == "pyev":
+        return memcache_connection.Server(
+            max_accepts = options.max_accepts, **kwargs)
+    else:
+        return memcache_asyncio.AsyncioServer(
+            use_uvloop = (options.backend == "uvloop"), **kwargs)
+
 def run_as_daemon(options):
     """ run the cache in daemon mode """
+    # only needed here, so the rest runs without python-daemon
+    import daemon
+    from lockfile.pidlockfile import PIDLockFile
     if options.username:
         uid = pwd.getpwnam(options.username).pw_uid
     else:
@@ -176,19 +431,64 @@ def run_as_daemon(options):
     else:
         pidfile = None
     with daemon.DaemonContext(uid=uid, pidfile=pidfile):
-        server = memcache_connection.Server( 
-            interface = options.interface, 
-            tcp_port = options.tcp_port, 
-            max_bytes = options.max_memory*1024*1024)
-        server.start()
+        serve(options)
 
 def run_it(options):
     """ run the cache in normal mode """
-    server = memcache_connection.Server( 
-        interface = options.interface, 
-        tcp_port = options.tcp_port, 
-        max_bytes = options.max_memory*1024*1024)
-    server.start()
+    serve(options)
+
+def serve(options):
+    """ run one server, or the workers """
+    if options.workers > 1:
+        run_workers(options)
+    else:
+        create_server(options).start()
+
+def run_workers(options):
+    """ 
+    fork options.workers servers, accepting on one listening socket 
+    and sharing one memory_cache_shared.SharedMemcached, and wait for 
+    them, SIGTERM and SIGINT are passed on
+    """
+    cache = memory_cache_shared.SharedMemcached(
+        memcache_connection.ConnectionStats(), 
+        max_bytes = options.max_memory*1024*1024, 
+        item_size_max = options.item_size)
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((options.interface, options.tcp_port))
+    listener.listen(options.backlog)
+    pids = []
+    for _ in range(options.workers):
+        pid = os.fork()
+        if not pid:
+            status = 0
+            try:
+                create_server(options, cache, listener).start()
+            except Exception: # pylint: disable=W0703
+                traceback.print_exc()
+                status = 1
+            # none of the parent's cleanup, it's still running
+            os._exit(status) # pylint: disable=W0212
+        pids.append(pid)
+    listener.close()
+    def pass_on(signum, _):
+        """ tell the workers """
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, pass_on)
+    signal.signal(signal.SIGINT, pass_on)
+    for pid in pids:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except OSError as err:
+                if err.errno != errno.EINTR:
+                    raise
 
 def main():
     """ run the program """
@@ -0,0 +1,512 @@
+"""
+Handle connections using asyncio (or trollius, its python 2 backport,
+or uvloop) instead of pyev.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import signal
+
+try:
+    import asyncio
+except ImportError: # pragma: no cover
+    try:
+        # python 2
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+try:
+    import uvloop
+except ImportError: # pragma: no cover
+    uvloop = None
+
+import memcache_connection
+import memcache_engine
+import memcache_handoff
+import memcache_logging as mc_log
+import memcache_protocol
+import memcache_protocol_execute
+import memcache_protocol_parse
+import memory_cache_primitives
+
+class MemcachedProtocol(object):
+    """ 
+    connection from a client, drives the same MCProtocol state 
+    machine that MemcachedSocket does
+
+    asyncio only needs the protocol methods, so this doesn't subclass
+    asyncio.Protocol and can be unit tested without asyncio around
+    """
+    TOO_MANY = "ERROR Too many open connections\r\n"
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.protocol = None
+        self.logger = None
+        self.closed = False
+        self.paused = False
+        self.draining = False
+        self.reading = True
+
+        # for the server's idle list, see AsyncioServer.idle_cb
+        self.last_activity = 0
+        self.prev = None
+        self.next = None
+
+    def connection_made(self, transport):
+        """ a client connected, refuse it if there are too many """
+        address = transport.get_extra_info('peername')
+        self.transport = transport
+        self.logger = mc_log.MemcachedLogger(address)
+        self.protocol = memcache_protocol.MCProtocol(
+            self.server.stats, self.server.cache, address, 
+            self.server.max_requests)
+        self.protocol.on_push = self.push_ready
+        self.server.stats.connect()
+        if self.server.stats.curr_connections > self.server.max_connections:
+            self.server.stats.reject()
+            self.write(self.TOO_MANY)
+            self.close()
+        else:
+            self.server.connection_made(self)
+            self.logger.log_v("connection ready")
+
+    def connection_lost(self, _):
+        """ the client went away, or we hung up on it """
+        self.closed = True
+        self.protocol.close()
+        self.server.stats.disconnect()
+        self.server.connection_lost(self)
+        self.logger.log_v("connection closed")
+
+    def data_received(self, data):
+        """ input from the client """
+        self._process(memory_cache_primitives.to_str(data))
+
+    def eof_received(self):
+        """ the client hung up its side, so do we """
+        return False
+
+    def write(self, buf):
+        """ output for the client """
+        self.transport.write(memory_cache_primitives.to_bytes(buf))
+
+    def _process(self, buf):
+        """ 
+        hand input to the protocol and write any reply
+
+        if there were more commands than we handle per event, come 
+        back for the rest after the other connections get a turn
+        """
+        self.server.connection_active(self)
+        try:
+            reply = self.protocol.got_input(buf)
+        except memcache_protocol_parse.FatalProtocolException as err:
+            self.write(err.msg)
+            self.close()
+            return
+        except memcache_protocol_parse.ProtocolException as err:
+            reply = err.msg
+        except memcache_protocol_execute.QuitException:
+            self.close()
+            return
+        if reply:
+            self.write(reply)
+        if self.protocol.has_pending():
+            if not self.paused:
+                self.server.loop.call_soon(self.resume)
+        elif self.draining and not self.protocol.waiting():
+            self.close()
+        self._update_reading()
+
+    def _update_reading(self):
+        """ 
+        read only while the output keeps up, we aren't draining, no 
+        get is waiting on the loader, and the commands already read 
+        and any streamed reply are done with, so input can't pile up
+        """
+        protocol = self.protocol
+        reading = not (self.paused or self.draining or protocol.blocked() or
+                       protocol.has_pending())
+        if reading != self.reading:
+            self.reading = reading
+            if reading:
+                self.transport.resume_reading()
+            else:
+                self.transport.pause_reading()
+
+    def resume(self):
+        """ handle commands left over from an earlier event """
+        if not self.closed and not self.paused and self.protocol.has_pending():
+            self._process("")
+
+    def push_ready(self):
+        """ 
+        a watched key changed, write the invalidations soon, or the 
+        loader has a get's keys
+        """
+        self.server.loop.call_soon(self.write_pushed)
+
+    def write_pushed(self):
+        """ 
+        write the invalidations, unless the client isn't keeping up, 
+        they wait in the protocol until it does, then carry on with 
+        the commands if a get was waiting on the loader
+        """
+        if not self.closed and not self.paused and self.protocol.pushed:
+            self.write(self.protocol.pop_pushed())
+        self.resume()
+
+    def pause_writing(self):
+        """ too much output queued, stop reading until it drains """
+        self.paused = True
+        self._update_reading()
+
+    def resume_writing(self):
+        """ output drained, start reading again """
+        self.paused = False
+        self._update_reading()
+        if self.protocol.has_pending():
+            self.server.loop.call_soon(self.resume)
+        if self.protocol.pushed:
+            self.server.loop.call_soon(self.write_pushed)
+
+    def drain(self):
+        """ finish up what the client already sent, then hang up """
+        self.draining = True
+        self._update_reading()
+        if not (self.protocol.has_pending() or self.protocol.waiting()):
+            self.close()
+
+    def idle_kick(self):
+        """ the client has been quiet too long, hang up on it """
+        self.logger.log_v("connection idle too long")
+        self.close()
+
+    def close(self):
+        """ hang up, once anything written has gone out """
+        self.closed = True
+        self.transport.close()
+
+    def abort(self):
+        """ hang up now, throwing away anything not written yet """
+        self.closed = True
+        self.transport.abort()
+
+class ReplicaProtocol(object):
+    """
+    persistent connection to a follower, reconnecting after 
+    RETRY_SECONDS if it goes away
+
+    changes are written out once per loop iteration, so the ones 
+    made together go together, and not at all while the transport 
+    has too much queued already
+    """
+    RETRY_SECONDS = 1.0
+
+    def __init__(self, server, replicator, follower):
+        self.server = server
+        self.replicator = replicator
+        self.follower = follower
+        self.logger = mc_log.MemcachedLogger(follower.address)
+        self.transport = None
+        self.paused = False
+        self.flushing = False
+        self.stopped = False
+        follower.on_output = self.wake
+
+    def connect(self): # pragma: no cover
+        """ start connecting """
+        loop = self.server.loop
+        task = loop.create_task(loop.create_connection(
+                lambda: self, *self.follower.address))
+        task.add_done_callback(self._connect_done)
+
+    def _connect_done(self, task): # pragma: no cover
+        """ try again later if connecting failed """
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.log_v("follower connection failed: %s", 
+                              task.exception())
+            self.server.loop.call_later(self.RETRY_SECONDS, self.connect)
+
+    def connection_made(self, transport):
+        """ connected, bring the follower up to date """
+        self.transport = transport
+        self.logger.log_v("follower connected")
+        self.replicator.connected(self.follower)
+
+    def connection_lost(self, _):
+        """ the follower went away, it resyncs on the next connection """
+        self.transport = None
+        self.paused = False
+        self.follower.disconnected()
+        if not self.stopped:
+            self.logger.log_v("follower connection lost")
+            self.server.loop.call_later(self.RETRY_SECONDS, self.connect)
+
+    def data_received(self, data):
+        """ noreply commands, so nothing should come back """
+        pass
+
+    def eof_received(self):
+        """ the follower hung up, so do we """
+        return False
+
+    def wake(self):
+        """ there is something to write, write it soon """
+        if self.transport is not None and not self.paused and not self.flushing:
+            self.flushing = True
+            self.server.loop.call_soon(self.flush)
+
+    def flush(self):
+        """ write out what there is, until the transport has enough """
+        self.flushing = False
+        while self.transport is not None and not self.paused:
+            data = self.follower.data()
+            if not data:
+                break
+            self.transport.write(memory_cache_primitives.to_bytes(data))
+            self.follower.sent(len(data))
+
+    def pause_writing(self):
+        """ the follower is behind, leave the changes queued up """
+        self.paused = True
+
+    def resume_writing(self):
+        """ the follower caught up some """
+        self.paused = False
+        self.wake()
+
+    def close(self):
+        """ hang up for good """
+        self.stopped = True
+        if self.transport is not None:
+            self.transport.abort()
+
+# no coverage, same reason as memcache_connection.Server
+class AsyncioServer(memcache_handoff.Handoff): # pragma: no cover
+    """ 
+    handle incoming connections with an asyncio event loop, 
+    engine_options are for memcache_engine.Engine, listener as for
+    memcache_connection.Server
+    """
+    # pylint: disable=R0913
+    def __init__(self, interface="", tcp_port=11211, max_connections=1024, 
+                 idle_timeout=0, backlog=1024, 
+                 max_requests=memcache_protocol.MCProtocol.DEFAULT_MAX_REQUESTS,
+                 use_uvloop=False, drain_timeout=10, handoff_path=None,
+                 listener=None, **engine_options):
+        if asyncio is None:
+            raise ImportError("the asyncio backend needs asyncio or trollius")
+        if use_uvloop:
+            if uvloop is None:
+                raise ImportError("uvloop is not installed")
+            self.loop = uvloop.new_event_loop()
+        else:
+            self.loop = asyncio.new_event_loop()
+
+        self.address = (interface, tcp_port)
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.max_requests = max_requests
+        self.listener = None
+        # bound already, before forking
+        self.inherited = listener
+
+        # a replacement server connects here to take over the listener
+        self.handoff_path = handoff_path
+        self.handoff_sock = None
+
+        self.logger = mc_log.MemcachedLogger(self.address)
+        self.conns = set()
+        self.stats = memcache_connection.ConnectionStats()
+        # the loader's threads hand what they fetched back to the loop
+        self.engine = memcache_engine.Engine(
+            self.stats, self.logger, self.loop.call_soon_threadsafe, 
+            **engine_options)
+        self.cache = self.engine.cache
+        self.replicas = []
+        if self.engine.replicator is not None:
+            self.replicas = [ReplicaProtocol(self, self.engine.replicator, 
+                                             follower)
+                             for follower in 
+                             self.engine.replicator.followers]
+
+        # connections ordered by last activity, oldest at the tail, 
+        # so one timer covers all of them
+        self.idle_timeout = idle_timeout
+        self.idle_conns = memory_cache_primitives.LRU()
+        self.idle_timer = None
+
+        self.draining = False
+        self.drain_timeout = drain_timeout
+    # pylint: enable=R0913
+
+    def connection_made(self, conn):
+        """ a connection was accepted, watch it for idleness """
+        self.conns.add(conn)
+        if self.idle_timeout:
+            conn.last_activity = self.loop.time()
+            self.idle_conns.add(conn)
+            if self.idle_timer is None:
+                self.idle_timer = self.loop.call_later(self.idle_timeout, 
+                                                       self.idle_cb)
+
+    def connection_active(self, conn):
+        """ a connection did something, move it to the front of the idle list """
+        if self.idle_timeout:
+            conn.last_activity = self.loop.time()
+            self.idle_conns.reset(conn)
+
+    def connection_lost(self, conn):
+        """ a connection went away """
+        self.conns.discard(conn)
+        if self.idle_timeout:
+            self.idle_conns.remove(conn)
+        if self.draining and not self.conns:
+            self.loop.stop()
+
+    def idle_cb(self):
+        """ 
+        close connections that have been idle too long, then wait
+        until the oldest remaining one could be idle too long
+        """
+        self.idle_timer = None
+        now = self.loop.time()
+        conn = self.idle_conns.least()
+        while (conn is not None and 
+               conn.last_activity + self.idle_timeout <= now):
+            if conn.protocol.expecting():
+                self.connection_active(conn)
+            else:
+                self.stats.idle_kick()
+                self.idle_conns.remove(conn)
+                conn.idle_kick()
+            conn = self.idle_conns.least()
+        if conn is not None:
+            self.idle_timer = self.loop.call_later(
+                conn.last_activity + self.idle_timeout - now, self.idle_cb)
+
+    def start(self):
+        """ start the listening """
+        for sig in memcache_connection.STOPSIGNALS:
+            if sig == signal.SIGTERM:
+                self.loop.add_signal_handler(sig, self.drain)
+            else:
+                self.loop.add_signal_handler(sig, self.stop)
+        if self.engine.snapshots is not None:
+            self.loop.add_signal_handler(signal.SIGUSR1, 
+                                         self.engine.save_snapshot)
+        if self.engine.oplog is not None:
+            self.loop.call_later(self.engine.fsync_interval, self.compact_cb)
+        inherited = self.inherited
+        if inherited is None:
+            inherited = self.take_over()
+        if inherited is None:
+            create = self.loop.create_server(
+                lambda: MemcachedProtocol(self), 
+                self.address[0] or None, self.address[1], 
+                backlog=self.backlog, reuse_address=True)
+        else:
+            create = self.loop.create_server(
+                lambda: MemcachedProtocol(self), sock=inherited,
+                backlog=self.backlog)
+        self.listener = self.loop.run_until_complete(create)
+        if self.handoff_path:
+            self.handoff_sock = memcache_handoff.listen(self.handoff_path)
+            self.loop.add_reader(self.handoff_sock.fileno(), self.hand_off)
+        self.engine.start()
+        if self.engine.warmup is not None:
+            self.loop.call_soon(self.warmup_cb)
+        if self.replicas:
+            for replica in self.replicas:
+                replica.connect()
+            self.loop.call_later(0.01, self.replication_cb)
+        self.logger.log_v("server started")
+        self.loop.run_forever()
+        # however we stopped, drained or not
+        self.engine.close()
+
+    def warmup_cb(self):
+        """ load the next few batches of warmup items """
+        if self.engine.warmup.step():
+            self.loop.call_later(0.01, self.warmup_cb)
+
+    def replication_cb(self):
+        """ send resyncing followers their next batch """
+        self.engine.replicator.step()
+        self.loop.call_later(0.01, self.replication_cb)
+
+    def compact_cb(self):
+        """ 
+        compact the operation log if it has grown big enough, check 
+        on it about as often as it gets written
+        """
+        self.engine.compact()
+        self.loop.call_later(self.engine.fsync_interval, self.compact_cb)
+
+    def listening_socket(self):
+        """ the socket to hand off """
+        return self.listener.sockets[0]
+
+    def unwatch_handoff(self):
+        """ the handoff is over, one way or another """
+        self.loop.remove_reader(self.handoff_sock.fileno())
+
+    def drain(self):
+        """ 
+        stop accepting, let the connections finish the commands they 
+        already sent and write out the replies, then stop, or stop
+        anyway once the drain timeout is up
+        """
+        if self.draining:
+            return
+        self.draining = True
+        self.listener.close()
+        self.close_handoff()
+        self.loop.call_later(self.drain_timeout, self.stop)
+        self.logger.log_v("server draining")
+        for conn in list(self.conns):
+            conn.drain()
+        if not self.conns:
+            self.loop.stop()
+
+    def stop(self):
+        """ stop listening, and hang up on everyone """
+        self.listener.close()
+        self.close_handoff()
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        for conn in list(self.conns):
+            conn.abort()
+        for replica in self.replicas:
+            replica.close()
+        self.loop.stop()
+        self.logger.log_v("server stopped")
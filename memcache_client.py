@@ -0,0 +1,571 @@
+"""
+Client for memcached servers, keys spread over them by consistent hashing,
+requests pipelined over pooled connections.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import collections
+import errno
+import functools
+import re
+import select
+import socket
+
+try:
+    import Queue as queue
+except ImportError: # pragma: no cover
+    import queue
+
+import memcache_hashing
+import memory_cache_primitives
+
+class ClientException(Exception):
+    """ the server refused a command, msg is the error it sent """
+    def __init__(self, msg):
+        super(ClientException, self).__init__(msg)
+        self.msg = msg
+
+class ConnectionException(ClientException):
+    """ couldn't get a reply, the server is down or too slow """
+    pass
+
+class ClientProtocol(object):
+    """
+    client side of the text protocol for one connection
+
+    requests are pipelined, the replies come back in the same order, 
+    so each one goes to the callback at the head of the queue: a 
+    single line for most commands, or a list of (key, VALUE block) 
+    pairs for get and gets, None if the server failed, noreply 
+    requests have no callback
+
+    a reply nobody is waiting for means we're out of step with the
+    server, got_input raises socket.error so the connection is dropped
+    """
+    def __init__(self):
+        self.output = []
+        self.output_bytes = 0
+        self.waiting = collections.deque()
+        self.buf = ""
+        self.blocks = []
+
+    def send(self, data, multi, callback):
+        """ queue up a request """
+        self.output.append(data)
+        self.output_bytes += len(data)
+        if callback is not None:
+            self.waiting.append((multi, callback))
+
+    def pop_output(self):
+        """ what there is to write """
+        output = "".join(self.output)
+        self.output = []
+        self.output_bytes = 0
+        return output
+
+    def got_input(self, buf):
+        """ hand complete replies to their callbacks """
+        self.buf += buf
+        while self.waiting:
+            end = self.buf.find("\r\n")
+            if end < 0:
+                return
+            multi, callback = self.waiting[0]
+            line = self.buf[:end+2]
+            if not multi or line == "END\r\n":
+                self.buf = self.buf[end+2:]
+                self.waiting.popleft()
+                if multi:
+                    blocks, self.blocks = self.blocks, []
+                    callback(blocks)
+                else:
+                    callback(line)
+            elif line.startswith("VALUE "):
+                fields = line.split()
+                block_end = end + 2 + int(fields[3]) + 2
+                if len(self.buf) < block_end:
+                    return
+                self.blocks.append((fields[1], self.buf[:block_end]))
+                self.buf = self.buf[block_end:]
+            else:
+                # an error instead of values
+                self.buf = self.buf[end+2:]
+                self.waiting.popleft()
+                self.blocks = []
+                callback(None)
+        if self.buf:
+            raise socket.error(errno.EPROTO, "reply nobody asked for")
+
+    def fail(self):
+        """ the connection went away, fail everything outstanding """
+        waiting, self.waiting = self.waiting, collections.deque()
+        self.output = []
+        self.output_bytes = 0
+        self.buf = ""
+        self.blocks = []
+        for _, callback in waiting:
+            callback(None)
+
+def parse_value(block):
+    """ (flags, value, casunique) from a VALUE block, casunique None for get """
+    header, value = block.split("\r\n", 1)
+    fields = header.split()
+    casunique = None
+    if len(fields) > 4:
+        casunique = int(fields[4])
+    return fields[2], value[:-2], casunique
+
+class Connection(object):
+    """ a blocking connection to one server, every wait limited to timeout """
+    def __init__(self, address, timeout):
+        self.address = address
+        self.sock = socket.create_connection(address, timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.protocol = ClientProtocol()
+
+    def flush(self):
+        """ write out the requests queued up """
+        output = self.protocol.pop_output()
+        if output:
+            self.sock.sendall(memory_cache_primitives.to_bytes(output))
+
+    def wait(self):
+        """ read until every request queued up has its reply """
+        while self.protocol.waiting:
+            buf = self.sock.recv(65536)
+            if not buf:
+                raise socket.error(errno.ECONNRESET, "server hung up")
+            self.protocol.got_input(memory_cache_primitives.to_str(buf))
+
+    def stale(self):
+        """ 
+        did the server send something while nobody was waiting, or
+        hang up? either way the connection is no good
+        """
+        return bool(select.select([self.sock], [], [], 0)[0])
+
+    def close(self):
+        """ hang up, failing anything outstanding """
+        self.sock.close()
+        self.protocol.fail()
+
+class ConnectionPool(object):
+    """
+    up to size persistent connections to one server, made as they're 
+    needed, a thread asking for one when they're all in use waits up 
+    to timeout for one to come back
+    """
+    def __init__(self, address, size, timeout):
+        self.address = address
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(size)
+        for _ in range(size):
+            # None until it's first used
+            self.idle.put(None)
+
+    def get(self):
+        """ a connection of our own """
+        try:
+            conn = self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise ConnectionException("no connection to %s:%d free" % 
+                                      self.address)
+        if conn is not None and conn.stale():
+            conn.close()
+            conn = None
+        if conn is None:
+            try:
+                conn = Connection(self.address, self.timeout)
+            except socket.error as err:
+                self.idle.put(None)
+                raise ConnectionException("can't connect to %s:%d: %s" % 
+                                          (self.address + (err,)))
+        return conn
+
+    def put(self, conn):
+        """ done with a connection, None if it broke """
+        self.idle.put(conn)
+
+class Result(object): # pylint: disable=R0903
+    """ where a command's reply ends up """
+    __slots__ = ('value', 'error')
+
+    def __init__(self, value=None):
+        self.value = value
+        self.error = None
+
+STORE_RESULTS = {"STORED\r\n": True, "NOT_STORED\r\n": False, 
+                 "EXISTS\r\n": False, "NOT_FOUND\r\n": False}
+DELETE_RESULTS = {"DELETED\r\n": True, "NOT_FOUND\r\n": False}
+ERRORS = ("ERROR", "CLIENT_ERROR", "SERVER_ERROR")
+
+MAX_KEY_LENGTH = 250
+MAX_FLAGS = 2**32 - 1
+# whitespace would end the key early, a \r\n could start a command
+BAD_KEY_CHARS = re.compile("[\x00-\x20\x7f]")
+
+def check_key(key):
+    """ raise ValueError for a key the protocol can't carry """
+    if not isinstance(key, str):
+        raise ValueError("key must be a str, not %s" % type(key).__name__)
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise ValueError("key must be 1 to %d bytes" % MAX_KEY_LENGTH)
+    if BAD_KEY_CHARS.search(key):
+        raise ValueError("key can't contain whitespace or control "
+                         "characters: %r" % key)
+
+def check_flags(flags):
+    """ raise ValueError for flags the server won't take """
+    if (isinstance(flags, bool) or not isinstance(flags, 
+                                     memory_cache_primitives.INTEGER_TYPES) or
+        not 0 <= flags <= MAX_FLAGS):
+        raise ValueError("flags must be an int from 0 to %d" % MAX_FLAGS)
+
+def check_value(value):
+    """ raise ValueError for a value that isn't a str """
+    if not isinstance(value, str):
+        raise ValueError("value must be a str, not %s" % 
+                         type(value).__name__)
+
+class Pipeline(object):
+    """
+    commands queued up to go out together, each server gets all of 
+    its requests in one write, up to max_requests of them at a time, 
+    and the replies are read after they've all gone out
+
+    execute() returns the results in the order the commands were 
+    queued, raising the first error if there was one
+    """
+    def __init__(self, client):
+        self.client = client
+        self.requests = {}
+        self.results = []
+
+    def _request(self, server, data, callback=None):
+        """ a request for a server, callback is None for noreply """
+        self.requests.setdefault(server, []).append((data, False, callback))
+
+    def _result(self, value=None):
+        """ a command's place in the results """
+        result = Result(value)
+        self.results.append(result)
+        return result
+
+    def _line(self, result, results):
+        """ a callback that looks the reply line up in results """
+        def got(line):
+            """ the server answered """
+            if line is None:
+                result.error = ConnectionException("server failed")
+            elif line in results:
+                result.value = results[line]
+            else:
+                result.error = ClientException(line)
+        return got
+
+    # pylint: disable=R0913
+    def _store(self, verb, key, value, exptime, flags, noreply, 
+               casunique=None):
+        """ a storage command """
+        check_key(key)
+        check_flags(flags)
+        check_value(value)
+        cas = "" if casunique is None else " %d" % casunique
+        data = "%s %s %d %d %d%s%s\r\n%s\r\n" % (
+            verb, key, flags, exptime, len(value), cas, 
+            " noreply" if noreply else "", value)
+        result = self._result()
+        self._request(self.client.ring.get_server(key), data,
+                      None if noreply else 
+                      self._line(result, STORE_RESULTS))
+        return self
+
+    def set(self, key, value, exptime=0, flags=0, noreply=False):
+        """ store value under key """
+        return self._store("set", key, value, exptime, flags, noreply)
+
+    def add(self, key, value, exptime=0, flags=0, noreply=False):
+        """ store value under key if there's nothing there """
+        return self._store("add", key, value, exptime, flags, noreply)
+
+    def replace(self, key, value, exptime=0, flags=0, noreply=False):
+        """ store value under key if there's something there """
+        return self._store("replace", key, value, exptime, flags, noreply)
+
+    def append(self, key, value, exptime=0, flags=0, noreply=False):
+        """ add value to the end of what's under key """
+        return self._store("append", key, value, exptime, flags, noreply)
+
+    def prepend(self, key, value, exptime=0, flags=0, noreply=False):
+        """ add value to the start of what's under key """
+        return self._store("prepend", key, value, exptime, flags, noreply)
+
+    def cas(self, key, value, casunique, exptime=0, flags=0, noreply=False):
+        """ store value under key if nobody has since gets """
+        return self._store("cas", key, value, exptime, flags, noreply, 
+                           casunique)
+    # pylint: enable=R0913
+
+    def get_multi(self, keys, verb="get"):
+        """ 
+        {key: (flags, value, casunique)} for the keys that were found, 
+        one request per server
+        """
+        keys = list(keys)
+        for key in keys:
+            check_key(key)
+        result = self._result({})
+        def got(blocks):
+            """ one server's share came in """
+            if blocks is None:
+                result.error = ConnectionException("server failed")
+                return
+            for key, block in blocks:
+                result.value[key] = parse_value(block)
+        for server, server_keys in self.client.ring.split(keys):
+            self.requests.setdefault(server, []).append(
+                ("%s %s\r\n" % (verb, " ".join(server_keys)), True, got))
+        return self
+
+    def gets_multi(self, keys):
+        """ get_multi with the casuniques """
+        return self.get_multi(keys, "gets")
+
+    def delete(self, key, noreply=False):
+        """ delete key """
+        check_key(key)
+        result = self._result()
+        self._request(self.client.ring.get_server(key), 
+                      "delete %s%s\r\n" % (key, " noreply" if noreply else ""),
+                      None if noreply else 
+                      self._line(result, DELETE_RESULTS))
+        return self
+
+    def _incr(self, verb, key, delta, noreply):
+        """ incr or decr, the new value or None if key wasn't there """
+        check_key(key)
+        result = self._result()
+        def got(line):
+            """ the server answered """
+            if line is None:
+                result.error = ConnectionException("server failed")
+            elif line[:-2].isdigit():
+                result.value = int(line)
+            elif line != "NOT_FOUND\r\n":
+                result.error = ClientException(line)
+        self._request(self.client.ring.get_server(key), 
+                      "%s %s %d%s\r\n" % (verb, key, delta, 
+                                          " noreply" if noreply else ""),
+                      None if noreply else got)
+        return self
+
+    def incr(self, key, delta=1, noreply=False):
+        """ add delta to the number under key """
+        return self._incr("incr", key, delta, noreply)
+
+    def decr(self, key, delta=1, noreply=False):
+        """ take delta from the number under key """
+        return self._incr("decr", key, delta, noreply)
+
+    def _broadcast(self, data, parse):
+        """ a command for every server, {server: parse(reply line)} """
+        result = self._result({})
+        def got(server, line):
+            """ one server answered """
+            if line is None:
+                result.error = ConnectionException("server failed")
+            elif line.startswith(ERRORS):
+                result.error = ClientException(line)
+            else:
+                result.value[server] = parse(line)
+        for server in self.client.ring.servers:
+            self._request(server, data, functools.partial(got, server))
+        return self
+
+    def flush_all(self, delay=0):
+        """ expire everything on every server """
+        return self._broadcast("flush_all %d\r\n" % delay, 
+                               lambda line: line == "OK\r\n")
+
+    def version(self):
+        """ every server's version """
+        return self._broadcast("version\r\n", lambda line: line.split()[1])
+
+    def execute(self):
+        """ send everything, wait for the replies, return the results """
+        requests, self.requests = self.requests, {}
+        results, self.results = self.results, []
+        max_requests = self.client.max_requests
+        while requests:
+            conns = []
+            for server in list(requests):
+                batch = requests[server][:max_requests]
+                del requests[server][:max_requests]
+                if not requests[server]:
+                    del requests[server]
+                try:
+                    conn = self.client.pools[server].get()
+                except ConnectionException:
+                    for _, _, callback in batch:
+                        if callback is not None:
+                            callback(None)
+                    continue
+                for data, multi, callback in batch:
+                    conn.protocol.send(data, multi, callback)
+                conns.append(conn)
+            for conn in conns:
+                self._flush(conn)
+            for conn in conns:
+                self._wait(conn)
+            for conn in conns:
+                self.client.pools[conn.address].put(
+                    conn if conn.sock is not None else None)
+        for result in results:
+            if result.error is not None:
+                raise result.error
+        return [result.value for result in results]
+
+    @staticmethod
+    def _flush(conn):
+        """ write out a connection's requests, dropping it if that fails """
+        try:
+            conn.flush()
+        except socket.error:
+            conn.close()
+            conn.sock = None
+
+    @staticmethod
+    def _wait(conn):
+        """ read a connection's replies, dropping it if that fails """
+        if conn.sock is None:
+            return
+        try:
+            conn.wait()
+        except socket.error:
+            conn.close()
+            conn.sock = None
+
+class Client(object):
+    """
+    client for a set of memcached servers, each key goes to the 
+    server that owns it on a ketama ring, the same one the proxy uses
+
+    every wait, for a connection, a connect, a write or a reply, is 
+    limited to timeout seconds, ConnectionException if it runs out, 
+    ClientException if the server refuses a command, ValueError for a
+    key, flags or value that would break the protocol
+
+    safe to share between threads, each takes its own connections 
+    from the pools, pipeline() queues up commands to send together
+    """
+    # pylint: disable=R0913
+    def __init__(self, servers, pool_size=4, timeout=1.0, max_requests=100,
+                 points_per_server=160):
+        self.ring = memcache_hashing.Ring(servers, points_per_server)
+        self.pools = dict((server, ConnectionPool(server, pool_size, 
+                                                  timeout))
+                          for server in self.ring.servers)
+        self.max_requests = max_requests
+    # pylint: enable=R0913
+
+    def pipeline(self):
+        """ a Pipeline to queue commands up in """
+        return Pipeline(self)
+
+    def get(self, key):
+        """ the value under key, None if there isn't one """
+        found = self.get_multi([key])
+        if key in found:
+            return found[key]
+        return None
+
+    def get_multi(self, keys):
+        """ {key: value} for the keys that were found """
+        found = Pipeline(self).get_multi(keys).execute()[0]
+        return dict((key, value) for key, (_, value, _) in found.items())
+
+    def gets(self, key):
+        """ (value, casunique) for key, None if there isn't one """
+        found = Pipeline(self).gets_multi([key]).execute()[0]
+        if key in found:
+            _, value, casunique = found[key]
+            return value, casunique
+        return None
+
+    def set(self, key, value, exptime=0, flags=0, noreply=False):
+        """ store value under key, True if it was stored """
+        return Pipeline(self).set(key, value, exptime, flags, 
+                                  noreply).execute()[0]
+
+    def add(self, key, value, exptime=0, flags=0, noreply=False):
+        """ store value under key if there's nothing there """
+        return Pipeline(self).add(key, value, exptime, flags, 
+                                  noreply).execute()[0]
+
+    def replace(self, key, value, exptime=0, flags=0, noreply=False):
+        """ store value under key if there's something there """
+        return Pipeline(self).replace(key, value, exptime, flags, 
+                                      noreply).execute()[0]
+
+    def append(self, key, value, noreply=False):
+        """ add value to the end of what's under key """
+        return Pipeline(self).append(key, value, 
+                                     noreply=noreply).execute()[0]
+
+    def prepend(self, key, value, noreply=False):
+        """ add value to the start of what's under key """
+        return Pipeline(self).prepend(key, value, 
+                                      noreply=noreply).execute()[0]
+
+    # pylint: disable=R0913
+    def cas(self, key, value, casunique, exptime=0, flags=0, noreply=False):
+        """ store value under key if nobody has since gets """
+        return Pipeline(self).cas(key, value, casunique, exptime, flags, 
+                                  noreply).execute()[0]
+    # pylint: enable=R0913
+
+    def delete(self, key, noreply=False):
+        """ delete key, True if it was there """
+        return Pipeline(self).delete(key, noreply).execute()[0]
+
+    def incr(self, key, delta=1, noreply=False):
+        """ add delta to the number under key, the new number """
+        return Pipeline(self).incr(key, delta, noreply).execute()[0]
+
+    def decr(self, key, delta=1, noreply=False):
+        """ take delta from the number under key, the new number """
+        return Pipeline(self).decr(key, delta, noreply).execute()[0]
+
+    def flush_all(self, delay=0):
+        """ expire everything on every server, {server: True if OK} """
+        return Pipeline(self).flush_all(delay).execute()[0]
+
+    def version(self):
+        """ {server: version} """
+        return Pipeline(self).version().execute()[0]
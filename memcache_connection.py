@@ -31,20 +31,27 @@ or implied, of James Yates Farrimond.
 """
 import errno
 import os
-import pyev
 import socket
 import signal
 import time
 import weakref
 
+try:
+    import pyev
+except ImportError: # pragma: no cover
+    pyev = None # only Server needs it, see memcache_asyncio otherwise
+
+import memcache_engine
+import memcache_handoff
 import memcache_logging as mc_log
 import memcache_protocol
 import memcache_protocol_execute
 import memcache_protocol_parse
-import memory_cache
+import memory_cache_primitives
 
 STOPSIGNALS = (signal.SIGINT, signal.SIGTERM)
 NONBLOCKING = (errno.EAGAIN, errno.EWOULDBLOCK)
+OUT_OF_FDS = (errno.EMFILE, errno.ENFILE)
 
 class ConnectionStats(memcache_protocol.ProtocolStats):
     """ collect statistics for a connection """
@@ -57,6 +64,20 @@ class ConnectionStats(memcache_protocol.ProtocolStats):
         self.curr_connections = 0
         self.total_connections = 0
         self.connection_structures = 0
+        self.listen_disabled_num = 0
+        self.rejected_connections = 0
+        self.idle_kicks = 0
+        self.accept_events = 0
+        self.accepts_max_event = 0
+        self.accept_budget_hits = 0
+        self.warmup_items = 0
+        self.warmup_skipped = 0
+        self.warmup_bytes = 0
+        self.warmup_started = 0
+        self.warmup_finished = 0
+        self.repl_bytes = 0
+        self.repl_resyncs = 0
+        self.repl_overflows = 0
 
     def connect(self):
         """ comeone has connected """
@@ -69,10 +90,63 @@ class ConnectionStats(memcache_protocol.ProtocolStats):
         self.curr_connections -= 1
         self.connection_structures -= 1
 
+    def listen_disabled(self):
+        """ too many connections, stopped accepting new ones """
+        self.listen_disabled_num += 1
+
+    def reject(self):
+        """ too many connections, hung up on a new one """
+        self.rejected_connections += 1
+
+    def accepted(self, count, budget_hit):
+        """ the listening socket woke us up and we accepted count connections """
+        self.accept_events += 1
+        if count > self.accepts_max_event:
+            self.accepts_max_event = count
+        if budget_hit:
+            self.accept_budget_hits += 1
+
+    def idle_kick(self):
+        """ an idle connection was closed """
+        self.idle_kicks += 1
+
+    def warmup_start(self):
+        """ started loading items from a dump or a peer """
+        self.warmup_started = time.time()
+
+    def warmed(self, items, skipped, add_bytes):
+        """ a batch of items was loaded, skipping some """
+        self.warmup_items += items
+        self.warmup_skipped += skipped
+        self.warmup_bytes += add_bytes
+
+    def warmup_finish(self):
+        """ everything has been loaded """
+        self.warmup_finished = time.time()
+
+    def _warmup_seconds(self):
+        """ how long loading took, or has taken so far """
+        if not self.warmup_started:
+            return 0.0
+        return (self.warmup_finished or time.time()) - self.warmup_started
+
+    def replicated(self, count):
+        """ bytes of changes were written to a follower """
+        self.repl_bytes += count
+
+    def repl_resync(self):
+        """ a follower started over from the whole cache """
+        self.repl_resyncs += 1
+
+    def repl_overflow(self):
+        """ a follower fell too far behind and its changes were dropped """
+        self.repl_overflows += 1
+
     def dump(self, command):
         """ dump the collected statistics """
         ret_super = super(ConnectionStats, self).dump(command)
         now_time = int(time.time())
+        warmup_seconds = self._warmup_seconds()
         rusage_user, rusage_system, _, _, _ = os.times()
         ret = [('pid', os.getpid()),
                ('uptime', now_time - self.start_time),
@@ -83,8 +157,23 @@ class ConnectionStats(memcache_protocol.ProtocolStats):
                ('curr_connections', self.curr_connections),
                ('total_connections', self.total_connections),
                ('connection_structures', self.connection_structures),
-               ('threads', 1),
-               ('conn_yields', 0)]
+               ('listen_disabled_num', self.listen_disabled_num),
+               ('rejected_connections', self.rejected_connections),
+               ('idle_kicks', self.idle_kicks),
+               ('accept_events', self.accept_events),
+               ('accepts_max_event', self.accepts_max_event),
+               ('accept_budget_hits', self.accept_budget_hits),
+               ('warmup_items', self.warmup_items),
+               ('warmup_skipped', self.warmup_skipped),
+               ('warmup_bytes', self.warmup_bytes),
+               ('warmup_seconds', "%.3f" % warmup_seconds),
+               ('warmup_items_per_sec', 
+                int(self.warmup_items / warmup_seconds) 
+                if warmup_seconds else 0),
+               ('repl_bytes', self.repl_bytes),
+               ('repl_resyncs', self.repl_resyncs),
+               ('repl_overflows', self.repl_overflows),
+               ('threads', 1)]
         ret_super.extend(ret)
         return ret_super
 
@@ -100,16 +189,28 @@ class MemcachedSocket(object):
     FINISHED = 2
     OK = 3
     QUIT = 4
+    # stop reading, a get is waiting on the loader, push_ready says 
+    # when it can go on, or a proxy client is too far ahead of the 
+    # backends, see memcache_proxy.ProxyProtocol.blocked
+    WAITING = 5
+
+    # what speaks the protocol, a subclass can bring its own
+    PROTOCOL = memcache_protocol.MCProtocol
 
-    def __init__(self, sock, address, stats, cache):
+    # pylint: disable=R0913
+    def __init__(self, sock, address, stats, cache, 
+                 max_requests=memcache_protocol.MCProtocol.DEFAULT_MAX_REQUESTS):
         self.logger = mc_log.MemcachedLogger(address)
-        self.protocol = memcache_protocol.MCProtocol(stats, cache, address)
+        self.protocol = self.PROTOCOL(stats, cache, address, max_requests)
         self.reply = ""
+        self.closing = False
+        self.closed = False
         self.sock = sock
         self.sock.setblocking(0)
         self.stats = stats
         self.stats.connect()
         self.logger.log_v("socket ready")
+    # pylint: enable=R0913
 
     def handle_error(self, msg, exc_info=True):
         """ log the error and close the connection """
@@ -119,10 +220,42 @@ class MemcachedSocket(object):
 
     def close(self):
         """ close the socket and record it """
+        if self.closed:
+            return
+        self.closed = True
+        self.protocol.close()
         self.sock.close()
         self.stats.disconnect()
         self.logger.log_v("socket closed")
 
+    def _process(self, buf):
+        """ 
+        hand input to the protocol and queue up any reply 
+
+        FINISHED means there is something to write, or commands 
+        still waiting to be handled, WAITING that there's nothing to 
+        do until the loader has a get's keys
+        """
+        try:
+            reply = self.protocol.got_input(buf)
+        except memcache_protocol_parse.FatalProtocolException as err:
+            self.reply += err.msg
+            self.closing = True
+            return self.FINISHED
+        except memcache_protocol_parse.ProtocolException as err:
+            self.reply += err.msg
+            return self.FINISHED
+        except memcache_protocol_execute.QuitException:
+            self.close()
+            return self.QUIT
+        if reply:
+            self.reply += reply
+        if self.reply or self.protocol.has_pending():
+            return self.FINISHED
+        if self.protocol.blocked():
+            return self.WAITING
+        return self.CONTINUE
+
     def handle_read(self):
         """ 
         read data from the socket
@@ -130,7 +263,8 @@ class MemcachedSocket(object):
         will probably call this multiple times per message if the message
         is larger than the tcp packet size
 
-        if there is a reply, buffer it for later sending
+        if there is a reply, buffer it for later sending, noreply
+        commands leave nothing to send so we keep reading
         """
         try:
             buf = self.sock.recv(4096)
@@ -139,28 +273,27 @@ class MemcachedSocket(object):
                 self.handle_error(
                     "socket error reading from {0}".format(self.sock))
                 return self.ERROR
+            return self.CONTINUE
 
         if buf:
-            try:
-                self.reply = self.protocol.got_input(buf)
-                if self.reply is not None:
-                    return self.FINISHED
-            except memcache_protocol_parse.ProtocolException, err:
-                self.reply = err.msg
-                return self.FINISHED
-            except memcache_protocol_execute.QuitException:
-                self.close()
-                return self.QUIT
+            return self._process(buf)
         else:
             self.handle_error("socket connection closed by peer", False)
             return self.ERROR
-        return self.CONTINUE
 
     def handle_write(self):
         """ 
         write data to the socket 
 
         data is save from a previous call to handle_read
+
+        if the last read had more commands than we handle per event,
+        handle the next batch once the reply is out, this gives the 
+        other connections a turn in between
+
+        if the client broke the protocol badly, or we are draining,
+        hang up once everything is out, including replies still to 
+        come from the loader
         """
         try:
             sent = self.sock.send(self.reply)
@@ -171,24 +304,74 @@ class MemcachedSocket(object):
                 return self.ERROR
         else:
             self.reply = self.reply[sent:]
+            if not self.reply and self.protocol.pushed:
+                self.reply = self.protocol.pop_pushed()
+                return self.OK
             if not self.reply:
+                if self.protocol.has_pending():
+                    ret = self._process("")
+                    if ret == self.QUIT:
+                        return self.QUIT
+                    elif ret == self.FINISHED:
+                        return self.OK
+                if self.closing and not self.protocol.waiting():
+                    self.close()
+                    return self.QUIT
+                if self.protocol.blocked():
+                    return self.WAITING
                 return self.FINISHED
         return self.OK
 
+    def push_ready(self):
+        """ 
+        invalidations came in for a watched key, or a get's keys came
+        in from the loader, FINISHED if there is something to write or
+        the commands can go on
+
+        while a reply is still going out they wait in the protocol, 
+        so a client that doesn't keep up can't make us buffer forever
+        """
+        if not self.reply:
+            self.reply = self.protocol.pop_pushed()
+        if self.reply or self.protocol.has_pending():
+            return self.FINISHED
+        return self.CONTINUE
+
+    def drain(self):
+        """ 
+        finish the commands already received, then hang up
+
+        return True if there is still something to write
+        """
+        self.closing = True
+        return bool(self.reply or self.protocol.has_pending() or 
+                    self.protocol.waiting())
+
 # we don't do coverage for this since it's a pain to do a unit
 # test for... much easier to test by running the cache and
 # hitting it a bit
 class MemcachedConnection(object): # pragma: no cover
     """ connection from a client to this server """
-    # pylint: disable=R0913
-    def __init__(self, sock, address, loop, stats, cache):
+    SOCKET = MemcachedSocket
+
+    def __init__(self, sock, address, server):
         # pylint: disable=W0212
         self.logger = mc_log.MemcachedLogger(address)
-        self.socket = MemcachedSocket(sock, address, stats, cache)
-        self.watcher = pyev.Io(sock._sock, pyev.EV_READ, loop, self.io_cb)
+        self.server = server
+        self.socket = self.SOCKET(sock, address, server.stats, 
+                                  server.cache, server.max_requests)
+        self.watcher = pyev.Io(sock._sock, pyev.EV_READ, server.loop, 
+                               self.io_cb)
         self.watcher.start()
+        self.socket.protocol.on_push = self.push_ready
+
+        # for the server's idle list, see Server.idle_cb
+        self.last_activity = server.loop.now()
+        self.prev = None
+        self.next = None
+
         self.logger.log_v("connection ready")
-    # pylint: enable=R0913,W0212
+    # pylint: enable=W0212
 
     def reset(self, events):
         """ change from read to write or vice-versa """
@@ -198,47 +381,245 @@ class MemcachedConnection(object): # pragma: no cover
 
     def io_cb(self, watcher, revents):
         """ callback for when the socket is ready to read/write io """
+        self.server.connection_active(self)
         if revents & pyev.EV_READ:
             ret = self.socket.handle_read()
             if ret == self.socket.FINISHED:
                 self.reset(pyev.EV_WRITE)
+            elif ret == self.socket.WAITING:
+                self.watcher.stop()
             elif ret == self.socket.ERROR or ret == self.socket.QUIT:
                 self.close()
         else:
             ret = self.socket.handle_write()
             if ret == self.socket.FINISHED:
                 self.reset(pyev.EV_READ)
-            elif ret == self.socket.ERROR:
+            elif ret == self.socket.WAITING:
+                self.watcher.stop()
+            elif ret == self.socket.ERROR or ret == self.socket.QUIT:
                 self.close()
 
+    def idle_kick(self):
+        """ the client has been quiet too long, hang up on it """
+        self.logger.log_v("connection idle too long")
+        self.close()
+
+    def push_ready(self):
+        """ 
+        a watched key changed, write the invalidations, or the loader
+        has a get's keys
+        """
+        if self.watcher is None:
+            return
+        if self.socket.push_ready() == self.socket.FINISHED:
+            self.reset(pyev.EV_WRITE)
+
+    def drain(self):
+        """ finish up what the client already sent, then hang up """
+        if self.watcher is None:
+            return
+        if self.socket.drain():
+            self.reset(pyev.EV_WRITE)
+        else:
+            self.close()
+
     def close(self):
         """ shut it down """
+        if self.watcher is None:
+            return
+        self.socket.close()
         self.watcher.stop()
         self.watcher = None
+        self.server.connection_closed(self)
         self.logger.log_v("connection closed")
 
 # no coverage, same reason as above
-class Server(object): # pragma: no cover
-    """ handle incoming connections """
-    def __init__(self, interface="", tcp_port=11211, max_bytes=1024*1024*1024):
-        self.loop = pyev.default_loop()
-        self.watchers = [pyev.Signal(sig, self.loop, self.signal_cb)
-                         for sig in STOPSIGNALS]
+class ReplicaConnection(object): # pragma: no cover
+    """ 
+    persistent connection to a follower, reconnecting after 
+    RETRY_SECONDS if it goes away
+    """
+    RETRY_SECONDS = 1.0
+
+    def __init__(self, replicator, follower, loop):
+        self.replicator = replicator
+        self.follower = follower
+        self.loop = loop
+        self.logger = mc_log.MemcachedLogger(follower.address)
+        self.sock = None
+        self.watcher = None
+        self.connecting = False
+        self.writing = False
+        self.retry_timer = pyev.Timer(self.RETRY_SECONDS, 0.0, loop, 
+                                      self.retry_cb)
+        follower.on_output = self.wake
 
+    def start(self):
+        """ start connecting, it's done once we can write """
         self.sock = socket.socket()
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        address = (interface, tcp_port)
-        self.sock.bind(address)
         self.sock.setblocking(0)
+        self.sock.connect_ex(self.follower.address)
+        self.connecting = True
+        self.writing = True
         # pylint: disable=W0212
-        self.watchers.append(
-            pyev.Io(self.sock._sock, pyev.EV_READ, self.loop, self.io_cb))
+        self.watcher = pyev.Io(self.sock._sock, pyev.EV_READ | pyev.EV_WRITE,
+                               self.loop, self.io_cb)
         # pylint: enable=W0212
+        self.watcher.start()
 
+    def wake(self):
+        """ there is something to write """
+        if self.watcher is not None and not self.writing:
+            self.writing = True
+            self.watcher.stop()
+            self.watcher.set(self.sock, pyev.EV_READ | pyev.EV_WRITE)
+            self.watcher.start()
+
+    def io_cb(self, watcher, revents):
+        """ the follower hung up, or is ready for more """
+        try:
+            if revents & pyev.EV_READ and not self.sock.recv(4096):
+                raise socket.error(errno.ECONNRESET, "follower hung up")
+            if revents & pyev.EV_WRITE:
+                if self.connecting:
+                    err = self.sock.getsockopt(socket.SOL_SOCKET, 
+                                               socket.SO_ERROR)
+                    if err:
+                        raise socket.error(err, os.strerror(err))
+                    self.connecting = False
+                    self.logger.log_v("follower connected")
+                    self.replicator.connected(self.follower)
+                data = self.follower.data()
+                if data:
+                    self.follower.sent(self.sock.send(data))
+                if not self.follower.data():
+                    self.writing = False
+                    watcher.stop()
+                    watcher.set(self.sock, pyev.EV_READ)
+                    watcher.start()
+        except socket.error as err:
+            if err.args[0] not in NONBLOCKING:
+                self.logger.log_v("follower connection failed", 
+                                  exc_info=True)
+                self.close()
+                self.retry_timer.start()
+
+    def retry_cb(self, watcher, revents):
+        """ try the follower again """
+        self.start()
+
+    def close(self):
+        """ drop the connection, the follower resyncs on the next one """
+        self.retry_timer.stop()
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+            self.sock.close()
+            self.sock = None
+        self.follower.disconnected()
+
+# no coverage, same reason as above
+class Server(memcache_handoff.Handoff): # pragma: no cover
+    """ 
+    handle incoming connections, engine_options are for 
+    memcache_engine.Engine
+
+    listener is a socket already bound, one made before forking, to 
+    accept on instead of binding interface and tcp_port
+    """
+    CONNECTION = MemcachedConnection
+
+    # pylint: disable=R0913
+    def __init__(self, interface="", tcp_port=11211, max_connections=1024, 
+                 idle_timeout=0, backlog=1024, max_accepts=16, 
+                 max_requests=memcache_protocol.MCProtocol.DEFAULT_MAX_REQUESTS,
+                 drain_timeout=10, handoff_path=None, listener=None,
+                 **engine_options):
+        if pyev is None:
+            raise ImportError("the pyev backend needs pyev")
+        self.loop = pyev.default_loop()
+        self.watchers = [pyev.Signal(sig, self.loop, self.signal_cb)
+                         for sig in STOPSIGNALS]
+
+        address = (interface, tcp_port)
         self.logger = mc_log.MemcachedLogger(address)
         self.conns = weakref.WeakValueDictionary()
         self.stats = ConnectionStats()
-        self.cache = memory_cache.Memcached(self.stats, max_bytes=max_bytes)
+        # the loader's threads wake the loop to hand over what they fetched
+        fetched = pyev.Async(self.loop, self.fetched_cb)
+        self.engine = memcache_engine.Engine(
+            self.stats, self.logger, lambda _: fetched.send(), 
+            **engine_options)
+        self.cache = self.engine.cache
+        if self.engine.fetch is not None:
+            self.watchers.append(fetched)
+        if self.engine.snapshots is not None:
+            self.watchers.append(pyev.Signal(signal.SIGUSR1, self.loop, 
+                                             self.snapshot_cb))
+        if self.engine.oplog is not None:
+            # the log compacts into the snapshot, check on it about as
+            # often as it gets written
+            interval = self.engine.fsync_interval
+            self.watchers.append(pyev.Timer(interval, interval, self.loop, 
+                                            self.compact_cb))
+        if self.engine.warmup is not None:
+            self.watchers.append(pyev.Timer(0.0, 0.01, self.loop, 
+                                            self.warmup_cb))
+        self.replicas = []
+        if self.engine.replicator is not None:
+            self.replicas = [ReplicaConnection(self.engine.replicator, 
+                                               follower, self.loop)
+                             for follower in 
+                             self.engine.replicator.followers]
+            self.watchers.append(pyev.Timer(0.01, 0.01, self.loop, 
+                                            self.replication_cb))
+
+        # a replacement server connects to handoff_path to take over 
+        # self.sock
+        self.handoff_path = handoff_path
+        self.handoff_sock = None
+        if listener is None:
+            listener = self.take_over()
+        if listener is None:
+            self.sock = socket.socket()
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind(address)
+        else:
+            # taken over from the server we're replacing
+            self.sock = listener
+        self.sock.setblocking(0)
+        # pylint: disable=W0212
+        self.listen_watcher = pyev.Io(self.sock._sock, pyev.EV_READ, 
+                                      self.loop, self.io_cb)
+        # pylint: enable=W0212
+        self.watchers.append(self.listen_watcher)
+        if handoff_path:
+            self.handoff_sock = memcache_handoff.listen(handoff_path)
+            # pylint: disable=W0212
+            self.handoff_watcher = pyev.Io(self.handoff_sock._sock, 
+                                           pyev.EV_READ, self.loop, 
+                                           self.handoff_cb)
+            # pylint: enable=W0212
+            self.watchers.append(self.handoff_watcher)
+
+        self.max_connections = max_connections
+        self.listen_disabled = False
+        self.backlog = backlog
+        self.max_accepts = max_accepts
+        self.max_requests = max_requests
+
+        # connections ordered by last activity, oldest at the tail, 
+        # so one timer covers all of them
+        self.idle_timeout = idle_timeout
+        self.idle_conns = memory_cache_primitives.LRU()
+        self.idle_timer = pyev.Timer(idle_timeout, 0.0, self.loop, 
+                                     self.idle_cb)
+
+        self.draining = False
+        self.stopped = False
+        self.drain_timer = pyev.Timer(drain_timeout, 0.0, self.loop, 
+                                      self.drain_cb)
+    # pylint: enable=R0913
 
     def handle_error(self, msg, exc_info=True):
         """ log it and shut down """
@@ -247,44 +628,191 @@ class Server(object): # pragma: no cover
         self.stop()
 
     def signal_cb(self, watcher, revents):
-        """ we got signals, all of which mean to stop """
-        self.stop()
+        """ 
+        we got signals, all of which mean to stop, SIGTERM means 
+        finish what we're doing first
+        """
+        if watcher.signum == signal.SIGTERM:
+            self.drain()
+        else:
+            self.stop()
+
+    def snapshot_cb(self, watcher, revents):
+        """ SIGUSR1, save a snapshot """
+        self.engine.save_snapshot()
+
+    def warmup_cb(self, watcher, revents):
+        """ load the next few batches of warmup items """
+        if not self.engine.warmup.step():
+            watcher.stop()
+
+    def replication_cb(self, watcher, revents):
+        """ send resyncing followers their next batch """
+        self.engine.replicator.step()
+
+    def fetched_cb(self, watcher, revents):
+        """ the loader's threads fetched some keys """
+        self.engine.fetch.deliver()
+
+    def compact_cb(self, watcher, revents):
+        """ compact the operation log if it has grown big enough """
+        self.engine.compact()
+
+    def connection_active(self, conn):
+        """ a connection did something, move it to the front of the idle list """
+        if self.idle_timeout:
+            conn.last_activity = self.loop.now()
+            self.idle_conns.reset(conn)
+
+    def disable_listen(self):
+        """ stop accepting until a connection goes away """
+        self.listen_watcher.stop()
+        self.listen_disabled = True
+        self.stats.listen_disabled()
+        self.logger.log_v("too many connections, not accepting")
+
+    def connection_closed(self, conn):
+        """ a connection went away, start accepting again if we stopped """
+        if self.idle_timeout:
+            self.idle_conns.remove(conn)
+        if self.stopped:
+            return
+        elif self.draining:
+            if not self.stats.curr_connections:
+                self.stop()
+        elif (self.listen_disabled and 
+              self.stats.curr_connections < self.max_connections):
+            self.listen_disabled = False
+            self.listen_watcher.start()
+            self.logger.log_v("server accepting connections again")
+
+    def idle_cb(self, watcher, revents):
+        """ 
+        close connections that have been idle too long, then wait
+        until the oldest remaining one could be idle too long
+        """
+        now = self.loop.now()
+        conn = self.idle_conns.least()
+        while (conn is not None and 
+               conn.last_activity + self.idle_timeout <= now):
+            if conn.socket.protocol.expecting():
+                self.connection_active(conn)
+            else:
+                self.stats.idle_kick()
+                conn.idle_kick()
+            conn = self.idle_conns.least()
+        if conn is not None:
+            self.idle_timer.set(conn.last_activity + self.idle_timeout - now,
+                                0.0)
+            self.idle_timer.start()
+
+    def new_connection(self, sock, address):
+        """ setup a connection, and watch it for idleness """
+        conn = self.CONNECTION(sock, address, self)
+        self.conns[address] = conn
+        if self.idle_timeout:
+            self.idle_conns.add(conn)
+            if not self.idle_timer.active:
+                self.idle_timer.set(self.idle_timeout, 0.0)
+                self.idle_timer.start()
 
     def io_cb(self, watcher, revents):
         """ 
         we got some activity on our port
 
-        always someone trying to connect, so setup a connection
+        always someone trying to connect, so setup a connection, 
+        unless there are too many, then stop listening until some 
+        go away (like memcached's maxconns)
+
+        only accept max_accepts per wakeup so a reconnect storm can't 
+        starve the connections we already have, the watcher is level 
+        triggered so we'll get called again for the rest
         """
+        accepted = 0
         try:
-            while True:
+            while accepted < self.max_accepts:
+                if self.stats.curr_connections >= self.max_connections:
+                    self.disable_listen()
+                    break
                 try:
                     sock, address = self.sock.accept()
                 except socket.error as err:
                     if err.args[0] in NONBLOCKING:
                         break
+                    elif err.args[0] in OUT_OF_FDS:
+                        self.disable_listen()
+                        break
                     else:
                         raise
                 else:
-                    self.conns[address] = MemcachedConnection(
-                        sock, address, self.loop, self.stats, self.cache)
+                    self.new_connection(sock, address)
+                    accepted += 1
         except Exception: # pylint: disable=W0703
             self.handle_error("server error accepting a connection")
+        self.stats.accepted(accepted, accepted >= self.max_accepts)
+
+    def handoff_cb(self, watcher, revents):
+        """ a replacement server wants the listening socket """
+        self.hand_off()
+
+    def listening_socket(self):
+        """ the socket to hand off """
+        return self.sock
+
+    def unwatch_handoff(self):
+        """ the handoff is over, one way or another """
+        self.handoff_watcher.stop()
 
     def start(self):
         """ start the listening """
-        self.sock.listen(socket.SOMAXCONN)
+        self.sock.listen(self.backlog)
+        self.engine.start()
+        for replica in self.replicas:
+            replica.start()
         for watcher in self.watchers:
             watcher.start()
         self.logger.log_v("server started")
         self.loop.start()
 
+    def drain(self):
+        """ 
+        stop accepting, let the connections finish the commands they 
+        already sent and write out the replies, then stop, or stop
+        anyway once the drain timeout is up
+        """
+        if self.draining:
+            return
+        self.draining = True
+        self.listen_watcher.stop()
+        self.sock.close()
+        self.close_handoff()
+        self.drain_timer.start()
+        self.logger.log_v("server draining")
+        for conn in self.conns.values():
+            conn.drain()
+        if not self.stats.curr_connections:
+            self.stop()
+
+    def drain_cb(self, watcher, revents):
+        """ took too long to drain """
+        self.logger.log_v("server drain timed out")
+        self.stop()
+
     def stop(self):
-        """ stop listening """
+        """ stop listening, and hang up on everyone """
+        if self.stopped:
+            return
+        self.stopped = True
         self.loop.stop(pyev.EVBREAK_ALL)
         self.sock.close()
+        self.close_handoff()
+        self.idle_timer.stop()
+        self.drain_timer.stop()
         while self.watchers:
             self.watchers.pop().stop()
         for conn in self.conns.values():
             conn.close()
+        for replica in self.replicas:
+            replica.close()
+        self.engine.close()
         self.logger.log_v("server stopped")
@@ -0,0 +1,519 @@
+"""
+Embedded mode, the memcached engine called directly from Python, with
+no protocol or sockets in between, and a listener for the network too.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import collections
+import socket
+import threading
+
+try:
+    import Queue as queue
+except ImportError: # pragma: no cover
+    import queue
+
+import memcache_connection
+import memcache_logging as mc_log
+import memcache_protocol
+import memcache_protocol_execute
+import memcache_protocol_parse
+import memory_cache
+import memory_cache_primitives
+import memory_cache_sharded
+
+# same limits as the text protocol, so anything stored here can be 
+# read over the network too
+MAX_KEY_LENGTH = 250
+MAX_FLAGS = memcache_protocol_parse.MAX_FLAGS
+
+# a value with its flags and casunique, from gets
+Item = collections.namedtuple("Item", "value flags casunique")
+
+def check_key(key):
+    """ raise TypeError or ValueError for a key the protocol can't carry """
+    if not isinstance(key, str):
+        raise TypeError("key must be a str, not %s" % type(key).__name__)
+    if not key or len(key) > MAX_KEY_LENGTH:
+        raise ValueError("key must be 1 to %d bytes" % MAX_KEY_LENGTH)
+    if key.split() != [key]:
+        raise ValueError("key can't contain whitespace: %r" % key)
+
+class Unlocked(object):
+    """ stands in for the lock when the engine has locks of its own """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+class EmbeddedCache(object):
+    """
+    the memcached engine as a thread-safe Python API, plain ints for
+    flags, exptime and deltas, str keys and values, and batch calls 
+    that take the lock once for the whole batch
+
+    with shards, the items are spread over that many 
+    memory_cache_sharded shards, each behind its own lock, instead of
+    one engine behind one lock, so threads working different keys 
+    mostly don't wait on each other
+
+    with expire_interval, a thread deletes expired items a batch of
+    expire_batch keys at a time, so memory comes back without anyone
+    having to read them
+
+    listen() also serves the same items to the network, see Listener
+    """
+    # pylint: disable=R0913
+    def __init__(self, max_items=memory_cache.DEFAULT_MAX_ITEMS,
+                 max_bytes=memory_cache.DEFAULT_MAX_BYTES,
+                 item_size_max=memory_cache.DEFAULT_ITEM_SIZE_MAX,
+                 chunk_size=0, expire_interval=None, expire_batch=1000,
+                 shards=None):
+        # connection stats too, in case there is a listener
+        self.stats = memcache_connection.ConnectionStats()
+        # for the listener and the expiry keys, and the engine unless 
+        # it's sharded
+        self.lock = threading.RLock()
+        self.sharded = shards is not None
+        if self.sharded:
+            self.memcached = memory_cache_sharded.ShardedMemcached(
+                self.stats, shards, max_items=max_items, 
+                max_bytes=max_bytes, item_size_max=item_size_max, 
+                chunk_size=chunk_size)
+            self.engine_lock = Unlocked()
+        else:
+            self.memcached = memory_cache.Memcached(
+                self.stats, max_items=max_items, max_bytes=max_bytes, 
+                item_size_max=item_size_max, chunk_size=chunk_size)
+            self.engine_lock = self.lock
+        self.listener = None
+        self.expire_batch = expire_batch
+        self.expire_keys = []
+        self.stopping = threading.Event()
+        self.expirer = None
+        if expire_interval is not None:
+            self.expirer = threading.Thread(target=self._expire_loop, 
+                                            args=(expire_interval,),
+                                            name="embedded cache expiry")
+            self.expirer.daemon = True
+            self.expirer.start()
+    # pylint: enable=R0913
+
+    def _check_value(self, value):
+        """ raise TypeError or ValueError for a value we can't store """
+        if not isinstance(value, str):
+            raise TypeError("value must be a str, not %s" % 
+                            type(value).__name__)
+        if len(value) > self.memcached.item_size_max:
+            raise ValueError("value is over item_size_max")
+
+    @staticmethod
+    def _flags(flags):
+        """ flags as the engine keeps them """
+        if not isinstance(flags, memory_cache_primitives.INTEGER_TYPES):
+            raise TypeError("flags must be an int")
+        if not 0 <= flags <= MAX_FLAGS:
+            raise ValueError("flags must be 0 to %d" % MAX_FLAGS)
+        return str(flags)
+
+    def _store(self, method, key, value, exptime, flags):
+        """ 
+        one of the storage commands, did it store? exptime and flags 
+        None keep what the item had
+        """
+        check_key(key)
+        self._check_value(value)
+        if flags is not None:
+            flags = self._flags(flags)
+        if exptime is not None:
+            exptime = int(exptime)
+        with self.engine_lock:
+            ret = method(key, flags, exptime, value)
+        if ret == memory_cache.Memcached.TOO_LARGE:
+            raise ValueError("value would be over item_size_max")
+        return ret == memory_cache.Memcached.STORED
+
+    def set(self, key, value, exptime=0, flags=0):
+        """ store value under key """
+        return self._store(self.memcached.set, key, value, exptime, flags)
+
+    def add(self, key, value, exptime=0, flags=0):
+        """ store value only if there is nothing under key, did it? """
+        return self._store(self.memcached.add, key, value, exptime, flags)
+
+    def replace(self, key, value, exptime=0, flags=0):
+        """ store value only if there is something under key, did it? """
+        return self._store(self.memcached.replace, key, value, exptime, 
+                           flags)
+
+    def append(self, key, value):
+        """ 
+        add value to the end of what's under key, if anything is, 
+        ValueError if that makes it too large
+        """
+        return self._store(self.memcached.append, key, value, None, None)
+
+    def prepend(self, key, value):
+        """ 
+        add value to the start of what's under key, if anything is, 
+        ValueError if that makes it too large
+        """
+        return self._store(self.memcached.prepend, key, value, None, None)
+
+    # pylint: disable=R0913
+    def cas(self, key, value, casunique, exptime=0, flags=0):
+        """ store value if key hasn't changed since gets, did it? """
+        check_key(key)
+        self._check_value(value)
+        flags = self._flags(flags)
+        with self.engine_lock:
+            return self.memcached.cas(key, flags, int(exptime), 
+                                      int(casunique), value) == \
+                memory_cache.Memcached.STORED
+    # pylint: enable=R0913
+
+    def set_multi(self, mapping, exptime=0, flags=0):
+        """ store every key: value in mapping """
+        flags = self._flags(flags)
+        items = []
+        for key, value in mapping.items():
+            check_key(key)
+            self._check_value(value)
+            items.append((key, flags, int(exptime), value))
+        with self.engine_lock:
+            self.memcached.set_multi(items)
+
+    def get(self, key, default=None):
+        """ the value under key, default if there isn't one """
+        check_key(key)
+        with self.engine_lock:
+            for _, value, _ in self.memcached.get_multi([key]):
+                return value
+        return default
+
+    def get_multi(self, keys):
+        """ {key: value} for the keys that were found """
+        for key in keys:
+            check_key(key)
+        with self.engine_lock:
+            return dict((key, value) for key, value, _ 
+                        in self.memcached.get_multi(keys))
+
+    def gets(self, key):
+        """ the Item under key, None if there isn't one """
+        return self.gets_multi([key]).get(key)
+
+    def gets_multi(self, keys):
+        """ {key: Item} for the keys that were found """
+        for key in keys:
+            check_key(key)
+        with self.engine_lock:
+            return dict((key, Item(value, int(flags), casunique)) 
+                        for key, value, flags, casunique 
+                        in self.memcached.gets_multi(keys))
+
+    def delete(self, key):
+        """ delete key, was it there? """
+        check_key(key)
+        with self.engine_lock:
+            return self.memcached.delete(key) == \
+                memory_cache.Memcached.DELETED
+
+    def delete_multi(self, keys):
+        """ delete several keys, return the ones that were there """
+        for key in keys:
+            check_key(key)
+        with self.engine_lock:
+            return [key for key, ret in self.memcached.delete_multi(keys)
+                    if ret == memory_cache.Memcached.DELETED]
+
+    def touch(self, key, exptime):
+        """ give key a new exptime, was it there? """
+        return bool(self.touch_multi([key], exptime))
+
+    def touch_multi(self, keys, exptime):
+        """ give several keys a new exptime, return the ones that were there """
+        for key in keys:
+            check_key(key)
+        with self.engine_lock:
+            return [key for key, ret 
+                    in self.memcached.touch_multi(keys, int(exptime))
+                    if ret == memory_cache.Memcached.TOUCHED]
+
+    def _count(self, method, key, delta):
+        """ incr or decr, raising ValueError if the value isn't a number """
+        check_key(key)
+        if delta < 0:
+            raise ValueError("delta can't be negative")
+        with self.engine_lock:
+            ret, value = method(key, int(delta))
+        if ret == memory_cache.Memcached.NOT_NUMBER:
+            raise ValueError("value under %r isn't a number" % key)
+        elif ret == memory_cache.Memcached.NOT_FOUND:
+            return None
+        return int(value)
+
+    def incr(self, key, delta=1):
+        """ add delta to the number under key, the result or None """
+        return self._count(self.memcached.increment, key, delta)
+
+    def decr(self, key, delta=1):
+        """ subtract delta from the number under key, the result or None """
+        return self._count(self.memcached.decrement, key, delta)
+
+    def flush_all(self, delay=0):
+        """ expire everything, after delay seconds """
+        with self.engine_lock:
+            self.memcached.flush(int(delay))
+
+    def __len__(self):
+        """ how many items, expired ones included until they're noticed """
+        if self.sharded:
+            return self.memcached.item_count()
+        with self.engine_lock:
+            return self.memcached.cache.item_count
+
+    def get_stats(self):
+        """ {name: value} of the same stats the stats command shows """
+        with self.engine_lock:
+            return dict(self.memcached.stats(""))
+
+    def expire(self):
+        """ 
+        delete the expired items among the next expire_batch keys, 
+        working through a copy of the keys taken when the last one 
+        ran out, return how many went
+        """
+        with self.lock:
+            if not self.expire_keys:
+                if self.sharded:
+                    self.expire_keys = self.memcached.keys()
+                else:
+                    self.expire_keys = list(
+                        self.memcached.cache.the_cache.keys())
+            batch = self.expire_keys[-self.expire_batch:]
+            del self.expire_keys[-self.expire_batch:]
+            if not self.sharded:
+                return self.memcached.cache.expire_multi(batch)
+        return self.memcached.expire_multi(batch)
+
+    def _expire_loop(self, interval):
+        """ the expiry thread, a batch every interval until closed """
+        while not self.stopping.wait(interval):
+            self.expire()
+
+    def listen(self, interface="127.0.0.1", tcp_port=0, backlog=1024,
+               max_requests=memcache_protocol.MCProtocol.DEFAULT_MAX_REQUESTS):
+        """ serve the items to the network too, return the address """
+        if self.listener is not None:
+            raise ValueError("already listening")
+        self.listener = Listener(self, (interface, tcp_port), backlog, 
+                                 max_requests)
+        return self.listener.address
+
+    def close(self):
+        """ stop the expiry thread and the listener, the items stay """
+        self.stopping.set()
+        if self.expirer is not None:
+            self.expirer.join()
+            self.expirer = None
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+class Listener(object):
+    """
+    the network side of an EmbeddedCache, a thread accepting and two
+    for each connection, one reading and handling commands, one 
+    writing the replies and pushed invalidations
+
+    commands are handled holding the cache's lock, so they take 
+    turns with the Python callers
+
+    meant for tests and a few local clients, not heavy traffic, 
+    that's what the real servers are for
+    """
+    def __init__(self, cache, address, backlog, max_requests):
+        self.cache = cache
+        self.max_requests = max_requests
+        self.logger = mc_log.MemcachedLogger(address)
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(backlog)
+        self.address = self.sock.getsockname()
+        self.conns = set()
+        self.thread = threading.Thread(target=self._accept, 
+                                       name="embedded cache listener")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _accept(self):
+        """ the accepting thread, until the socket is closed """
+        listener = self.sock
+        while True:
+            try:
+                sock, address = listener.accept()
+            except socket.error:
+                return
+            with self.cache.lock:
+                self.cache.stats.connect()
+                self.conns.add(ListenerConnection(self, sock, address))
+
+    def connection_closed(self, conn):
+        """ a connection went away """
+        with self.cache.lock:
+            if conn in self.conns:
+                self.conns.discard(conn)
+                self.cache.stats.disconnect()
+
+    def close(self):
+        """ stop accepting, and hang up on everyone """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.thread.join()
+        with self.cache.lock:
+            conns = list(self.conns)
+        for conn in conns:
+            conn.close()
+        for conn in conns:
+            conn.join()
+        self.logger.log_v("listener stopped")
+
+class ListenerProtocol(memcache_protocol.MCProtocol):
+    """ 
+    an MCProtocol whose invalidations can be pushed from any thread 
+    while the writer pops them, without the engine's lock
+    """
+    def __init__(self, *args):
+        super(ListenerProtocol, self).__init__(*args)
+        self.push_lock = threading.Lock()
+
+    def push(self, line):
+        """ a watched key changed, from whichever thread changed it """
+        with self.push_lock:
+            super(ListenerProtocol, self).push(line)
+
+    def pop_pushed(self):
+        """ the invalidations to write """
+        with self.push_lock:
+            return super(ListenerProtocol, self).pop_pushed()
+
+class ListenerConnection(object):
+    """ one network connection to an EmbeddedCache """
+    def __init__(self, listener, sock, address):
+        self.listener = listener
+        self.sock = sock
+        self.lock = listener.cache.engine_lock
+        self.protocol = ListenerProtocol(
+            listener.cache.stats, listener.cache.memcached, address, 
+            listener.max_requests)
+        self.protocol.on_push = self.push_ready
+        # replies, and None for "something was pushed", closing last
+        self.output = queue.Queue()
+        self.closing = object()
+        self.reader = threading.Thread(target=self._read, 
+                                       name="embedded cache reader")
+        self.reader.daemon = True
+        self.writer = threading.Thread(target=self._write, 
+                                       name="embedded cache writer")
+        self.writer.daemon = True
+        self.reader.start()
+        self.writer.start()
+
+    def push_ready(self):
+        """ an invalidation came in, from whichever thread changed the key """
+        self.output.put(None)
+
+    def _handle(self, buf):
+        """ handle the commands in buf, return True to hang up """
+        while True:
+            with self.lock:
+                try:
+                    reply = self.protocol.got_input(buf)
+                except memcache_protocol_parse.FatalProtocolException as err:
+                    self.output.put(err.msg)
+                    return True
+                except memcache_protocol_parse.ProtocolException as err:
+                    reply = err.msg
+                except memcache_protocol_execute.QuitException:
+                    return True
+                pending = self.protocol.has_pending()
+            if reply:
+                self.output.put(reply)
+            if not pending:
+                return False
+            buf = ""
+
+    def _read(self):
+        """ the reading thread, until the other end or the listener hangs up """
+        try:
+            while True:
+                buf = memory_cache_primitives.to_str(self.sock.recv(65536))
+                if not buf or self._handle(buf):
+                    break
+        except socket.error:
+            pass
+        with self.lock:
+            self.protocol.close()
+        self.output.put(self.closing)
+
+    def _write(self):
+        """ the writing thread, until the reader is done """
+        try:
+            while True:
+                output = self.output.get()
+                if output is self.closing:
+                    break
+                elif output is None:
+                    with self.lock:
+                        output = self.protocol.pop_pushed()
+                if output:
+                    self.sock.sendall(
+                        memory_cache_primitives.to_bytes(output))
+        except socket.error:
+            pass
+        self.close()
+        self.listener.connection_closed(self)
+
+    def close(self):
+        """ hang up, the threads finish on their own """
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def join(self):
+        """ wait for the threads to finish """
+        self.reader.join()
+        self.writer.join()
@@ -0,0 +1,157 @@
+"""
+The cache a server serves and everything wired around it, built the same
+way whichever event loop the server runs on.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memcache_replication
+import memcache_warmup
+import memory_cache
+import memory_cache_disk
+import memory_cache_loader
+import memory_cache_oplog
+import memory_cache_snapshot
+
+class Engine(object):
+    """
+    a memory_cache.Memcached with the disk tier, snapshot and 
+    operation log, warmup, replication and read-through loader the 
+    options ask for
+
+    the server runs the parts that need its event loop: it calls 
+    warmup.step() and replicator.step() now and then, save_snapshot()
+    on SIGUSR1, compact() every fsync_interval if there's an oplog, 
+    connects replicator.followers, calls hand_off() once a 
+    replacement has its listening socket, and close() once it stops
+
+    wake(deliver) has to get deliver() called on the loop's thread, 
+    the loader's threads call it once they have fetched something
+
+    cache is an engine made already, a 
+    memory_cache_shared.SharedMemcached made before forking, to use 
+    instead of a new Memcached, then the memory options and the ones
+    for the parts above are left alone
+    """
+    # pylint: disable=R0902,R0913,R0914
+    def __init__(self, stats, logger, wake, max_bytes=1024*1024*1024,
+                 item_size_max=memory_cache.DEFAULT_ITEM_SIZE_MAX, 
+                 chunk_size=0, snapshot_path=None, oplog_path=None, 
+                 fsync_interval=1.0, compact_bytes=64*1024*1024,
+                 disk_dir=None, disk_bytes=1024*1024*1024, disk_min_bytes=512,
+                 warmup_source=None, replicate_to=(), 
+                 repl_backlog=16*1024*1024, 
+                 lease_seconds=memory_cache.DEFAULT_LEASE_SECONDS,
+                 stale_seconds=0, loader_url=None, loader_exptime=0, 
+                 loader_threads=4, cache=None):
+        self.logger = logger
+        self.fsync_interval = fsync_interval
+        self.disk = None
+        if disk_dir:
+            self.disk = memory_cache_disk.DiskTier(
+                stats, disk_dir, disk_bytes, min_bytes=disk_min_bytes)
+        # misses fetched from a web server on threads
+        self.fetch = None
+        loader = None
+        if loader_url:
+            self.fetch = memory_cache_loader.ThreadedFetch(
+                memory_cache_loader.http_get(loader_url), wake, 
+                loader_threads)
+            loader = memory_cache_loader.Loader(self.fetch, loader_exptime)
+        if cache is not None:
+            cache.set_stats(stats)
+            self.cache = cache
+        else:
+            self.cache = memory_cache.Memcached(stats, max_bytes=max_bytes,
+                                                item_size_max=item_size_max,
+                                                chunk_size=chunk_size,
+                                                disk=self.disk,
+                                                lease_seconds=lease_seconds,
+                                                stale_seconds=stale_seconds,
+                                                loader=loader)
+
+        # load before taking over from the server we're replacing, 
+        # it keeps serving in the meantime
+        self.snapshots = None
+        self.oplog = None
+        if snapshot_path:
+            if oplog_path:
+                self.oplog = memory_cache_oplog.OperationLog(
+                    oplog_path, fsync_interval, compact_bytes)
+            self.snapshots = memory_cache_snapshot.Snapshots(
+                self.cache.cache, snapshot_path, self.oplog)
+            logger.log_v("loaded %s items from snapshot", 
+                         self.snapshots.load())
+            self.cache.oplog = self.oplog
+
+        # loads while we serve, a batch at a time
+        self.warmup = None
+        if warmup_source is not None:
+            self.warmup = memcache_warmup.Warmup(self.cache.cache, stats, 
+                                                 warmup_source)
+            self.cache.warmup = self.warmup
+
+        # changes go out to the followers as they happen, resyncs a 
+        # batch at a time
+        self.replicator = None
+        if replicate_to:
+            self.replicator = memcache_replication.Replicator(
+                self.cache.cache, stats, replicate_to, repl_backlog)
+            self.cache.replication = self.replicator
+    # pylint: enable=R0902,R0913,R0914
+
+    def start(self):
+        """ the server is about to serve """
+        if self.warmup is not None:
+            self.warmup.start()
+
+    def save_snapshot(self):
+        """ save a snapshot without holding up the connections """
+        if self.snapshots.save_in_background():
+            self.logger.log_v("saving snapshot")
+        else:
+            self.logger.log_v("already saving snapshot")
+
+    def compact(self):
+        """ compact the operation log if it has grown big enough """
+        if self.snapshots.maybe_compact():
+            self.logger.log_v("compacting operation log")
+
+    def hand_off(self):
+        """ the replacement server owns the snapshot and log now """
+        if self.snapshots is not None:
+            self.snapshots.hand_off()
+
+    def close(self):
+        """ the server stopped, drained or not """
+        if self.fetch is not None:
+            self.fetch.close()
+        if self.snapshots is not None:
+            self.snapshots.save()
+        if self.disk is not None:
+            self.disk.close()
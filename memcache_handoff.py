@@ -0,0 +1,164 @@
+"""
+Hand the listening socket from a running server to its replacement,
+so a restart never leaves the port without a listener.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import errno
+import os
+import select
+import socket
+
+try:
+    from _multiprocessing import recvfd, sendfd # pylint: disable=F0401
+except ImportError: # pragma: no cover
+    # python 3 moved passing fds to multiprocessing.reduction
+    from multiprocessing import reduction
+
+    def sendfd(sock_fd, fd):
+        """ send fd over the unix socket sock_fd """
+        with socket.fromfd(sock_fd, socket.AF_UNIX, 
+                           socket.SOCK_STREAM) as sock:
+            reduction.sendfds(sock, [fd])
+
+    def recvfd(sock_fd):
+        """ receive an fd over the unix socket sock_fd """
+        with socket.fromfd(sock_fd, socket.AF_UNIX, 
+                           socket.SOCK_STREAM) as sock:
+            return reduction.recvfds(sock, 1)[0]
+
+# nobody listening on the handoff path, so there's nothing to take over
+NO_SERVER = (errno.ENOENT, errno.ECONNREFUSED)
+
+def listen(path):
+    """ 
+    listen on a unix socket at path for a replacement server, 
+    taking the path over from any old socket file left there
+    """
+    try:
+        os.unlink(path)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    sock.setblocking(0)
+    return sock
+
+def send_listener(handoff_sock, listener):
+    """
+    a replacement server connected to handoff_sock, pass it the 
+    listening socket's fd (SCM_RIGHTS), return whether it got sent
+    """
+    try:
+        sock, _ = handoff_sock.accept()
+    except socket.error as err:
+        if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return False
+        raise
+    try:
+        # sendfd doesn't cope with non-blocking sockets, one byte 
+        # into an empty buffer won't block anyway
+        sock.setblocking(1)
+        # the message holds its own reference to the socket, so it 
+        # stays open for the other side once we close ours
+        sendfd(sock.fileno(), listener.fileno())
+    finally:
+        sock.close()
+    return True
+
+def take_listener(path, timeout=5.0):
+    """
+    get the listening socket from the server handing off at path,
+    None if there isn't one
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path)
+        except socket.error as err:
+            if err.args[0] in NO_SERVER:
+                return None
+            raise
+        # recvfd doesn't cope with non-blocking sockets, so do the 
+        # waiting here
+        sock.setblocking(1)
+        if not select.select([sock], [], [], timeout)[0]:
+            raise socket.timeout("no listening socket from %s" % path)
+        fd = recvfd(sock.fileno())
+    finally:
+        sock.close()
+    listener = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    os.close(fd)
+    return listener
+
+class Handoff(object):
+    """
+    the handoff for a server, which sets handoff_path (None for no 
+    handoff), handoff_sock (listen(handoff_path) once it's serving), 
+    logger and engine (a memcache_engine.Engine), and brings 
+    listening_socket(), unwatch_handoff() to stop watching 
+    handoff_sock, and drain()
+    """
+    def take_over(self):
+        """ the listening socket of the server we're replacing, if any """
+        if not self.handoff_path:
+            return None
+        return take_listener(self.handoff_path)
+
+    def hand_off(self):
+        """ 
+        a replacement server wants the listening socket, hand it over,
+        then drain, it accepts from here on so nobody gets refused
+        """
+        try:
+            if not send_listener(self.handoff_sock, 
+                                 self.listening_socket()):
+                return
+        except socket.error:
+            self.logger.log_v("listening socket handoff failed", 
+                              exc_info=True)
+            return
+        # the replacement has the path now, so leave the file alone
+        self.unwatch_handoff()
+        self.handoff_sock.close()
+        self.handoff_sock = None
+        self.logger.log_v("listening socket handed off")
+        self.engine.hand_off()
+        self.drain()
+
+    def close_handoff(self):
+        """ stop waiting for a replacement server """
+        if self.handoff_sock is not None:
+            self.unwatch_handoff()
+            self.handoff_sock.close()
+            self.handoff_sock = None
+            os.unlink(self.handoff_path)
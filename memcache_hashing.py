@@ -0,0 +1,91 @@
+"""
+Consistent hashing of keys onto servers, the same way ketama does it, so
+clients and the proxy agree on where each key lives.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import bisect
+import hashlib
+import struct
+
+import memory_cache_primitives
+
+# each md5 gives four points
+POINT_HASH = struct.Struct("<IIII")
+KEY_HASH = struct.Struct("<I")
+
+def key_hash(key):
+    """ where a key falls on the ring """
+    digest = hashlib.md5(memory_cache_primitives.to_bytes(key)).digest()
+    return KEY_HASH.unpack_from(digest)[0]
+
+class Ring(object):
+    """
+    ketama continuum, each server gets points_per_server points on a 
+    ring of 32-bit hashes and a key belongs to the first server point 
+    at or after its own hash
+
+    adding or removing a server only moves the keys next to its 
+    points, about 1/n of them
+    """
+    def __init__(self, servers, points_per_server=160):
+        self.servers = list(servers)
+        points = []
+        for server in self.servers:
+            name = "%s:%d" % server
+            for i in range(points_per_server // 4):
+                digest = hashlib.md5(memory_cache_primitives.to_bytes(
+                        "%s-%d" % (name, i))).digest()
+                for point in POINT_HASH.unpack(digest):
+                    points.append((point, server))
+        points.sort()
+        self.points = [point for point, _ in points]
+        self.point_servers = [server for _, server in points]
+
+    def get_server(self, key):
+        """ the server a key lives on """
+        index = bisect.bisect_left(self.points, key_hash(key))
+        if index == len(self.points):
+            index = 0
+        return self.point_servers[index]
+
+    def split(self, keys):
+        """ 
+        group keys by server, return (server, keys) pairs with the
+        servers and the keys for each in the order they first appear
+        """
+        by_server = {}
+        order = []
+        for key in keys:
+            server = self.get_server(key)
+            if server not in by_server:
+                by_server[server] = []
+                order.append(server)
+            by_server[server].append(key)
+        return [(server, by_server[server]) for server in order]
@@ -42,6 +42,11 @@ LOGGING_DESCRIPTIONS = {
     30: 'VERBOSE',
     40: 'NONE'}
 
+try:
+    STRING_TYPES = basestring
+except NameError: # pragma: no cover
+    STRING_TYPES = str
+
 mc_log_level = LOGGING_NONE # pylint: disable=C0103
 
 def initialize_logging(level):
@@ -71,7 +76,7 @@ def _msg_replace(msg):
     """
     replace \r\n with string representation
     """
-    if isinstance(msg, basestring):
+    if isinstance(msg, STRING_TYPES):
         return msg.replace('\r', '\\r').replace('\n', '\\n')
     else:
         return msg
@@ -0,0 +1,239 @@
+"""
+Near cache, a small in-process cache in front of memcache_client for the
+hottest keys, kept fresh by invalidations the servers push.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import collections
+import socket
+import threading
+import time
+
+import memcache_logging as mc_log
+import memory_cache_invalidation
+import memory_cache_primitives
+
+class Watcher(object):
+    """
+    a thread holding a watch connection to one server, invalidating 
+    near cache keys as the server says they change
+
+    while it's not connected the near cache doesn't cache anything, 
+    it can't know what changed in the meantime
+    """
+    def __init__(self, near_cache, address, prefixes, timeout, 
+                 retry_seconds):
+        self.near_cache = near_cache
+        self.address = address
+        self.prefixes = prefixes
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self.logger = mc_log.MemcachedLogger(address)
+        self.sock = None
+        self.connected = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, 
+                                       name="near cache watcher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        """ the thread, watch until stopped, reconnecting as needed """
+        while not self.stopping.is_set():
+            try:
+                self._watch()
+            except (socket.error, IOError):
+                self.logger.log_v("watch connection failed", exc_info=True)
+            if self.connected:
+                self.connected = False
+                self.near_cache.watching_stopped()
+            self.stopping.wait(self.retry_seconds)
+
+    def _watch(self):
+        """ connect, watch, and invalidate until the connection goes """
+        self.sock = socket.create_connection(self.address, self.timeout)
+        try:
+            self.sock.sendall(memory_cache_primitives.to_bytes(
+                "watch %s\r\n" % " ".join(self.prefixes)))
+            reader = self.sock.makefile("rb")
+            if memory_cache_primitives.to_str(reader.readline()) != "OK\r\n":
+                raise IOError("watch refused")
+            # invalidations only come when something changes
+            self.sock.settimeout(None)
+            self.connected = True
+            self.near_cache.watching_started()
+            while True:
+                line = memory_cache_primitives.to_str(reader.readline())
+                if not line:
+                    return
+                elif line == memory_cache_invalidation.INVALIDATE_ALL:
+                    self.near_cache.clear()
+                elif line.startswith("INVALIDATE "):
+                    self.near_cache.invalidate(line[11:-2])
+        finally:
+            self.sock.close()
+
+    def stop(self):
+        """ hang up and stop the thread """
+        self.stopping.set()
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.thread.join()
+
+class NearCache(object):
+    """
+    up to max_items values kept in process for ttl seconds, in front 
+    of a memcache_client.Client, only for keys starting with one of 
+    prefixes (every key if there are none)
+
+    each server pushes an invalidation when one of those keys changes,
+    so a value is only stale for as long as that takes to arrive, ttl 
+    bounds it when something else goes wrong
+
+    misses are cached too, and any invalidation that arrives while a
+    value is being fetched keeps that fetch out of the near cache, it 
+    might be from before the change
+
+    safe to share between threads
+    """
+    # pylint: disable=R0913
+    def __init__(self, client, max_items=1000, ttl=1.0, prefixes=(), 
+                 retry_seconds=1.0):
+        self.client = client
+        self.max_items = max_items
+        self.ttl = ttl
+        self.prefixes = tuple(prefixes) or ("",)
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # bumped by every invalidation
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.unwatched = len(client.ring.servers)
+        self.watchers = [Watcher(self, server, prefixes, 
+                                 client.pools[server].timeout, 
+                                 retry_seconds)
+                         for server in client.ring.servers]
+    # pylint: enable=R0913
+
+    def watching_started(self):
+        """ a watcher connected, from its thread """
+        with self.lock:
+            self.unwatched -= 1
+            self.items.clear()
+            self.version += 1
+
+    def watching_stopped(self):
+        """ a watcher lost its connection, from its thread """
+        with self.lock:
+            self.unwatched += 1
+            self.items.clear()
+            self.version += 1
+
+    def watching(self):
+        """ is every server's watcher connected, so we can cache? """
+        return self.unwatched == 0
+
+    def invalidate(self, key):
+        """ forget key """
+        with self.lock:
+            self.items.pop(key, None)
+            self.version += 1
+            self.invalidations += 1
+
+    def clear(self):
+        """ forget everything """
+        with self.lock:
+            self.items.clear()
+            self.version += 1
+            self.invalidations += 1
+
+    def _fill(self, found, version):
+        """ remember fetched values, unless something changed meanwhile """
+        expires = time.time() + self.ttl
+        items = self.items
+        with self.lock:
+            if version != self.version or self.unwatched:
+                return
+            for key, value in found.items():
+                items.pop(key, None)
+                items[key] = (value, expires)
+            while len(items) > self.max_items:
+                items.popitem(last=False)
+
+    def get_multi(self, keys):
+        """ {key: value} for the keys that were found """
+        values = {}
+        missing = []
+        now = time.time()
+        with self.lock:
+            version = self.version
+            for key in keys:
+                entry = self.items.get(key)
+                if entry is not None and entry[1] > now:
+                    self.hits += 1
+                    if entry[0] is not None:
+                        values[key] = entry[0]
+                else:
+                    missing.append(key)
+            self.misses += len(missing)
+        if missing:
+            found = self.client.get_multi(missing)
+            values.update(found)
+            self._fill(dict((key, found.get(key)) for key in missing 
+                            if key.startswith(self.prefixes)), version)
+        return values
+
+    def get(self, key):
+        """ the value under key, None if there isn't one """
+        return self.get_multi([key]).get(key)
+
+    def set(self, key, value, exptime=0, flags=0):
+        """ store value under key, the invalidation comes back to us too """
+        try:
+            return self.client.set(key, value, exptime, flags)
+        finally:
+            self.invalidate(key)
+
+    def delete(self, key):
+        """ delete key """
+        try:
+            return self.client.delete(key)
+        finally:
+            self.invalidate(key)
+
+    def close(self):
+        """ stop watching """
+        for watcher in self.watchers:
+            watcher.stop()
@@ -29,10 +29,13 @@ The views and conclusions contained in the software and documentation are those
 authors and should not be interpreted as representing official policies, either expressed
 or implied, of James Yates Farrimond.
 """
+import types
+
 import memcache_logging as mc_log
 import memcache_protocol_execute as mp_execute
 import memcache_protocol_parse as mp_parse
 import memory_cache
+import memory_cache_invalidation
 
 class ProtocolStats(memory_cache.MemcachedStats):
     """ protocol-related statistics """
@@ -42,6 +45,7 @@ class ProtocolStats(memory_cache.MemcachedStats):
         self.version = mp_execute.VERSION
         self.bytes_read = 0
         self.bytes_written = 0
+        self.conn_yields = 0
 
     def read_bytes(self, count):
         """ bytes were read, presumably from socket """
@@ -51,15 +55,44 @@ class ProtocolStats(memory_cache.MemcachedStats):
         """ bytes ready to be written """
         self.bytes_written += count
 
+    def conn_yield(self):
+        """ a connection used up its requests for this event """
+        self.conn_yields += 1
+
     def dump(self, command):
         """ dump our values for output """
         ret_super = super(ProtocolStats, self).dump(command)
         ret = [('bytes_read', self.bytes_read),
                ('bytes_written', self.bytes_written),
+               ('conn_yields', self.conn_yields),
                ('version', self.version)]
         ret_super.extend(ret)
         return ret_super
 
+# one lookup per command gets the parser and both executors
+DISPATCH = dict((verb, (parser, mp_execute.COMMANDS[verb],
+                        mp_execute.QUIET_COMMANDS.get(
+                            verb, mp_execute.COMMANDS[verb])))
+                for verb, parser in mp_parse.COMMANDS.items())
+
+def parse_command(command_string):
+    """ 
+    parse a command and attach the handler that will execute it 
+
+    noreply commands get a handler that doesn't build a reply
+    """
+    command_info = command_string.split()
+    try:
+        parser, handler, quiet_handler = DISPATCH[command_info[0]]
+    except (IndexError, KeyError):
+        raise mp_parse.ProtocolException("ERROR\r\n")
+    command = parser(command_info)
+    if command.noreply:
+        command.handler = quiet_handler
+    else:
+        command.handler = handler
+    return command
+
 class MCProtocol(object): # pylint: disable=R0903
     """
     State machine to handle the memcached protocol, taking the 
@@ -69,30 +102,172 @@ class MCProtocol(object): # pylint: disable=R0903
     STATE_N_SEARCH = 1
     STATE_BODY = 2
     STATE_DONE = 3
+    STATE_SWALLOW = 4
+
+    TOO_LARGE = "SERVER_ERROR object too large for cache\r\n"
+    LINE_TOO_LONG = "CLIENT_ERROR line too long\r\n"
+    MALFORMED = "CLIENT_ERROR malformed request\r\n"
+    BAD_DATA_CHUNK = "CLIENT_ERROR bad data chunk\r\n"
+
+    # same as memcached, with extra room for multigets
+    MAX_LINE_BYTES = 2048
+    MAX_GET_LINE_BYTES = 64*1024
 
-    def __init__(self, stats, memcached, address):
+    DEFAULT_MAX_REQUESTS = 20
+
+    # a watcher this far behind just gets told to drop everything
+    MAX_PUSHED = 10000
+
+    # the commands whose misses go through a read-through loader
+    LOADS = frozenset(['get', 'gets'])
+
+    def __init__(self, stats, memcached, address, 
+                 max_requests=DEFAULT_MAX_REQUESTS):
         self.logger = mc_log.MemcachedLogger(address)
         self.logger.log_vvv("entering R_SEARCH state")
         self.state = self.STATE_R_SEARCH
         self.stats = stats
         self.memcached = memcached
         self.buf = ""
+        self.line = []
+        self.line_bytes = 0
+        self.body = []
+        self.body_bytes = 0
+        self.swallow_bytes = 0
         self.command = None
+        # what to raise for a bad command, once it's fully read
+        self.error = None
+        self.max_requests = max_requests
+        self.pending = ""
+        # the rest of a reply that goes out a piece per event
+        self.stream = None
+        # invalidations for the keys this connection watches, 
+        # on_push is called when the first one comes in
+        self.watching = False
+        self.pushed = []
+        self.on_push = None
+        # a get waiting on the loader, on_push is called when it can
+        # go ahead, see Memcached.load
+        self.loading = None
+        self.loaded = False
+
+    def has_pending(self):
+        """ 
+        is there more to do without more input, commands not handled 
+        yet or more of a streamed reply, nothing until a get waiting 
+        on the loader has its keys
+        """
+        if self.loading is not None:
+            return self.loaded
+        return bool(self.pending) or self.stream is not None
+
+    def waiting(self):
+        """ is a get waiting on the loader? """
+        return self.loading is not None
+
+    def expecting(self):
+        """ 
+        is the client quiet because it's waiting on us, for 
+        invalidations or a get's keys? it isn't idle then
+        """
+        return self.watching or self.waiting()
+
+    def blocked(self):
+        """ 
+        is a get still waiting on the loader for its keys? read no 
+        more input until it isn't, or it piles up in self.pending
+        """
+        return self.loading is not None and not self.loaded
+
+    def _loaded(self):
+        """ the keys a get was waiting on are in """
+        self.loaded = True
+        if self.on_push is not None:
+            self.on_push()
+
+    def _next_piece(self):
+        """ the next piece of a streamed reply """
+        try:
+            piece = next(self.stream)
+        except StopIteration:
+            self.stream = None
+            return ""
+        self.stats.write_bytes(len(piece))
+        return piece
+
+    def _watch(self, prefixes):
+        """ watch command, invalidations go out through push """
+        self.memcached.watch(self, prefixes)
+        self.watching = True
+        return "OK\r\n"
+
+    def push(self, line):
+        """ a watched key changed, queue the line for on_push """
+        pushed = self.pushed
+        if pushed and pushed[-1] is memory_cache_invalidation.INVALIDATE_ALL:
+            return
+        if len(pushed) >= self.MAX_PUSHED:
+            del pushed[:]
+            line = memory_cache_invalidation.INVALIDATE_ALL
+        pushed.append(line)
+        if len(pushed) == 1 and self.on_push is not None:
+            self.on_push()
+
+    def pop_pushed(self):
+        """ the invalidations to write """
+        output = "".join(self.pushed)
+        self.pushed = []
+        self.stats.write_bytes(len(output))
+        return output
+
+    def close(self):
+        """ the connection is gone, stop watching """
+        if self.watching:
+            self.memcached.unwatch(self)
+            self.watching = False
+
+    def _check_line_length(self, line_bytes):
+        """
+        refuse command lines that are too long, so a client that never 
+        sends \r can't make us buffer forever
+        """
+        if line_bytes > self.MAX_LINE_BYTES:
+            line = "".join(self.line)
+            if (line_bytes > self.MAX_GET_LINE_BYTES or
+                not (line.startswith('get ') or line.startswith('gets '))):
+                raise mp_parse.FatalProtocolException(self.LINE_TOO_LONG)
+            self.line = [line]
 
     def _state_r_search(self, buf):
         """
         search for \r part or \r\n that ends command part of command string
+
+        only the new input is searched, what came before is already 
+        known not to have a \r in it
         """
         delimiter = buf.find('\r')
         if delimiter > -1:
-            command_string = self.buf + buf[:delimiter]
+            self.line.append(buf[:delimiter])
+            self._check_line_length(self.line_bytes + delimiter)
+            command_string = "".join(self.line)
+            self.line = []
+            self.line_bytes = 0
             buf = buf[delimiter+1:] # skip the \r
             self.logger.log_vv("command string = '%s'", command_string)
             self.logger.log_vvv("entering N_SEARCH state")
             self.state = self.STATE_N_SEARCH
-            self.command = mp_parse.parse_command(command_string)
+            try:
+                self.command = parse_command(command_string)
+            except mp_parse.FatalProtocolException:
+                raise
+            except mp_parse.ProtocolException as err:
+                self.command = mp_parse.MCCommand(
+                    in_bytes=mp_parse.data_bytes(command_string))
+                self.error = err.msg
         else:
-            self.buf += buf
+            self.line.append(buf)
+            self.line_bytes += len(buf)
+            self._check_line_length(self.line_bytes)
             buf = ""
         return buf
 
@@ -102,61 +277,195 @@ class MCProtocol(object): # pylint: disable=R0903
 
         have to do this in separate state since \r and \n could be
         split up by TCP
+
+        values bigger than the item size limit never get buffered,
+        they get swallowed instead, as is the data block of a command
+        that didn't parse, a data block is always read, even an empty
+        one
         """
+        self.buf = ""
         if buf[0] != '\n':
-            raise mp_parse.ProtocolException('Malformed request')
+            # what follows is the next command
+            self.error = self.MALFORMED
+            in_bytes = None
         else:
             buf = buf[1:]
-            self.buf = ""
-            if int(self.command.bytes) > 0:
-                self.logger.log_vvv("entering BODY_SEARCH state")
-                self.state = self.STATE_BODY
-            else:
-                self.logger.log_vvv("entering DONE state")
-                self.state = self.STATE_DONE
+            in_bytes = self.command.bytes
+        if in_bytes is None:
+            self.logger.log_vvv("entering DONE state")
+            self.state = self.STATE_DONE
+        elif (in_bytes > self.memcached.item_size_max or 
+              self.error is not None):
+            self.swallow_bytes = in_bytes + 2
+            self.logger.log_vvv("entering SWALLOW state")
+            self.state = self.STATE_SWALLOW
+        else:
+            self.logger.log_vvv("entering BODY_SEARCH state")
+            self.state = self.STATE_BODY
         return buf
 
     def _state_body(self, buf):
         """
         get the body of the request, the value portion
+
+        pieces are collected in a list and only joined once the
+        whole body has arrived, anything after the body is left
+        for the next command
         """
-        self.buf += buf
-        buf = ""
-        if len(self.buf) > int(self.command.bytes) + 2:
-            raise mp_parse.ProtocolException('Malformed request')
-        elif len(self.buf) == int(self.command.bytes) + 2:
-            if self.buf[-2] != '\r' or self.buf[-1] != '\n':
-                raise mp_parse.ProtocolException('Malformed request')
-            else:
-                self.buf = self.buf[:int(self.command.bytes)]
-                self.logger.log_vv("body = '%s'", self.buf)
-                self.logger.log_vvv("entering DONE state")
-                self.state = self.STATE_DONE
+        in_bytes = self.command.bytes
+        needed = in_bytes + 2 - self.body_bytes
+        self.body.append(buf[:needed])
+        self.body_bytes += min(len(buf), needed)
+        buf = buf[needed:]
+        if self.body_bytes == in_bytes + 2:
+            self.buf = "".join(self.body)
+            self.body = []
+            self.body_bytes = 0
+            if self.buf[-2:] != '\r\n':
+                self.error = self.BAD_DATA_CHUNK
+            self.buf = self.buf[:in_bytes]
+            self.logger.log_vv("body = '%s'", self.buf)
+            self.logger.log_vvv("entering DONE state")
+            self.state = self.STATE_DONE
         return buf
 
+    def _state_swallow(self, buf):
+        """
+        throw away the body of a request that is too large to store
+        """
+        swallowed = min(len(buf), self.swallow_bytes)
+        self.swallow_bytes -= swallowed
+        buf = buf[swallowed:]
+        if not self.swallow_bytes:
+            self.logger.log_vvv("entering DONE state")
+            self.state = self.STATE_DONE
+        return buf
+
+    def _execute(self):
+        """ run the command we just finished parsing """
+        command = self.command
+        if (command.bytes is not None and 
+            command.bytes > self.memcached.item_size_max):
+            retval = command.reply(self.TOO_LARGE)
+        elif (command.command in self.LOADS and 
+              self.memcached.loader is not None and
+              self.memcached.load(command.keys, self._loaded)):
+            # runs again once the misses are in
+            self.loading = command
+            retval = ""
+        else:
+            retval = command.handler(command, self.memcached, self.buf)
+            if isinstance(retval, types.GeneratorType):
+                self.stream = retval
+                retval = self._next_piece()
+            elif isinstance(retval, mp_execute.Watch):
+                retval = self._watch(retval.prefixes)
+        self.buf = ""
+        self.state = self.STATE_R_SEARCH
+        if retval:
+            self.stats.write_bytes(len(retval))
+            self.logger.log_vv("response = '%s'", retval)
+        self.logger.log_vvv("entering R_SEARCH state")
+        return retval
+
+    def _finish_load(self):
+        """ run the get that was waiting on the loader """
+        command = self.loading
+        self.loading = None
+        self.loaded = False
+        retval = command.handler(command, self.memcached, "")
+        self.stats.write_bytes(len(retval))
+        self.logger.log_vv("response = '%s'", retval)
+        return retval
+
+    def _reset(self):
+        """ forget the command in progress after a protocol error """
+        self.logger.log_vvv("entering R_SEARCH state")
+        self.state = self.STATE_R_SEARCH
+        self.buf = ""
+        self.line = []
+        self.line_bytes = 0
+        self.body = []
+        self.body_bytes = 0
+        self.swallow_bytes = 0
+        self.error = None
+
     def got_input(self, buf):
         """ 
-        state machine for parsing a command from TCP input
+        state machine for parsing commands from TCP input
 
-        return output when got full command 
+        handles as many pipelined commands as it is given, up to 
+        max_requests, anything left over waits in self.pending and 
+        gets handled by the next call (which may pass an empty buf)
+
+        a streamed reply goes out a piece per call, and the commands
+        after it wait until it's done, the same for a get waiting on 
+        the loader, the call after on_push finishes it, and while 
+        blocked() says so
+
+        a bad command raises ProtocolException, with the replies to 
+        the commands before it, those after it wait in self.pending,
+        a FatalProtocolException means hang up
+
+        return the output of all the commands handled, an empty 
+        string if they were all noreply, None if no command was 
+        finished
         """
         self.stats.read_bytes(len(buf))
-        while buf:
-            if self.state == self.STATE_R_SEARCH:
-                buf = self._state_r_search(buf)
-            elif self.state == self.STATE_N_SEARCH:
-                buf = self._state_n_search(buf)
-            elif self.state == self.STATE_BODY:
-                buf = self._state_body(buf)
-
-        if self.state == self.STATE_DONE:
-            retval = mp_execute.execute_command(
-                self.command, self.memcached, self.buf)
-            self.buf = ""
-            self.state = self.STATE_R_SEARCH
-            self.stats.write_bytes(len(retval))
-            self.logger.log_vv("response = '%s'", retval)
-            self.logger.log_vvv("entering R_SEARCH state")
-            return retval
+        if self.pending:
+            buf = self.pending + buf
+            self.pending = ""
+        replies = []
+        handled = 0
+        if self.stream is not None:
+            replies.append(self._next_piece())
+            handled += 1
+            if self.stream is not None:
+                self.pending = buf
+                return replies[0]
+        if self.loading is not None:
+            if not self.loaded:
+                self.pending = buf
+                return None
+            replies.append(self._finish_load())
+            handled += 1
+        try:
+            while buf:
+                if self.state == self.STATE_R_SEARCH:
+                    buf = self._state_r_search(buf)
+                elif self.state == self.STATE_N_SEARCH:
+                    buf = self._state_n_search(buf)
+                elif self.state == self.STATE_BODY:
+                    buf = self._state_body(buf)
+                elif self.state == self.STATE_SWALLOW:
+                    buf = self._state_swallow(buf)
+
+                if self.state == self.STATE_DONE:
+                    if self.error is not None:
+                        # the commands after it go on next call
+                        self.pending = buf
+                        error = mp_parse.ProtocolException(self.error)
+                        self._reset()
+                        raise error
+                    retval = self._execute()
+                    if retval:
+                        replies.append(retval)
+                    handled += 1
+                    if (self.stream is not None or self.loading is not None or
+                        self.blocked()):
+                        self.pending = buf
+                        break
+                    if handled >= self.max_requests and buf:
+                        self.pending = buf
+                        self.stats.conn_yield()
+                        break
+        except mp_parse.ProtocolException as err:
+            # don't lose the replies to the commands before the bad one
+            self._reset()
+            err.msg = "".join(replies) + err.msg
+            raise
+
+        if handled:
+            return "".join(replies)
         else:
             return None
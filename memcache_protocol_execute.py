@@ -32,13 +32,16 @@ The views and conclusions contained in the software and documentation are those
 authors and should not be interpreted as representing official policies, either expressed
 or implied, of James Yates Farrimond.
 """
-VERSION = "0.1"
+try:
+    from urllib import quote
+except ImportError: # pragma: no cover
+    from urllib.parse import quote
 
-class ExecuteException(Exception):
-    """ problem executing """
-    def __init__(self, msg):
-        super(ExecuteException, self).__init__(self)
-        self.msg = msg
+import memory_cache_leases
+
+VERSION = "0.1"
+# lget and lset on an engine that has no leases
+NO_LEASES = "SERVER_ERROR leases not supported\r\n"
 
 class QuitException(Exception):
     """ quit command received """
@@ -46,6 +49,14 @@ class QuitException(Exception):
         super(QuitException, self).__init__(self)
         self.msg = msg
 
+class Watch(object): # pylint: disable=R0903
+    """ 
+    reply to a watch command, the protocol subscribes its connection
+    to changes to keys starting with prefixes
+    """
+    def __init__(self, prefixes):
+        self.prefixes = prefixes
+
 COMMANDS = {}
 
 def set_it(command, memcached, buf):
@@ -95,6 +106,8 @@ def prepend(command, memcached, buf):
         return "STORED\r\n"
     elif ret == memcached.NOT_STORED:
         return "NOT_STORED\r\n"
+    elif ret == memcached.TOO_LARGE:
+        return "SERVER_ERROR object too large for cache\r\n"
 
 COMMANDS['prepend'] = prepend
 
@@ -105,34 +118,76 @@ def append(command, memcached, buf):
         return "STORED\r\n"
     elif ret == memcached.NOT_STORED:
         return "NOT_STORED\r\n"
+    elif ret == memcached.TOO_LARGE:
+        return "SERVER_ERROR object too large for cache\r\n"
 
 COMMANDS['append'] = append
 
 def get(command, memcached, _):
     """ get command """
-    items = memcached.get(command.keys)
-    ret_buf = ""
-    for key, value, flags in items:
-        ret_buf += "VALUE %s %s %s\r\n" % (key, flags, len(value))
-        ret_buf += value + "\r\n"
-    ret_buf += "END\r\n"
-    return ret_buf
+    ret = []
+    for key, value, flags in memcached.get_multi(command.keys):
+        ret.append("VALUE %s %s %d\r\n%s\r\n" % (key, flags, 
+                                                   len(value), value))
+    ret.append("END\r\n")
+    return "".join(ret)
 
 COMMANDS['get'] = get
 
 def gets(command, memcached, _):
     """ gets command """
-    items = memcached.gets(command.keys)
-    ret_buf = ""
-    for key, value, flags, casunique in items:
-        ret_buf += "VALUE %s %s %s %s\r\n" % (key, flags, 
-                                              len(value), casunique)
-        ret_buf += value + "\r\n"
-    ret_buf += "END\r\n"
-    return ret_buf
+    ret = []
+    for key, value, flags, casunique in memcached.gets_multi(command.keys):
+        ret.append("VALUE %s %s %d %s\r\n%s\r\n" % (key, flags, len(value),
+                                                      casunique, value))
+    ret.append("END\r\n")
+    return "".join(ret)
 
 COMMANDS['gets'] = gets
 
+def lget(command, memcached, _):
+    """ 
+    lget command, a get that hands out a lease on the first miss, 
+    see memory_cache_leases: a hit is a VALUE as for get, a miss a 
+    LEASE <key> <token> line for whoever should refill it, a STALE 
+    block (like a VALUE) if there's a stale value, and a WAIT <key> 
+    line if there's neither, an engine without leases has 
+    lease_get_multi None
+    """
+    if memcached.lease_get_multi is None:
+        return NO_LEASES
+    ret = []
+    for key, state, value, flags, token in \
+            memcached.lease_get_multi(command.keys):
+        if state == memory_cache_leases.HIT:
+            ret.append("VALUE %s %s %d\r\n%s\r\n" % (key, flags, 
+                                                       len(value), value))
+            continue
+        if state == memory_cache_leases.LEASED:
+            ret.append("LEASE %s %d\r\n" % (key, token))
+        if value is not None:
+            ret.append("STALE %s %s %d\r\n%s\r\n" % (key, flags, 
+                                                       len(value), value))
+        elif state == memory_cache_leases.WAIT:
+            ret.append("WAIT %s\r\n" % key)
+    ret.append("END\r\n")
+    return "".join(ret)
+
+COMMANDS['lget'] = lget
+
+def lset(command, memcached, buf):
+    """ lset command, a set with the token from lget """
+    if memcached.lease_set is None:
+        return NO_LEASES
+    ret = memcached.lease_set(command.key, command.flags, command.exptime,
+                              command.casunique, buf)
+    if ret == memcached.STORED:
+        return "STORED\r\n"
+    else:
+        return "NOT_STORED\r\n"
+
+COMMANDS['lset'] = lset
+
 def delete(command, memcached, _):
     """ delete command """
     ret = memcached.delete(command.key)
@@ -198,8 +253,122 @@ def version(_, ___, ____):
 
 COMMANDS['version'] = version
 
-def execute_command(command, memcached, buf):
-    """ execute the command """
-    if command.command not in COMMANDS:
-        raise ExecuteException("ERROR bad command")
-    return command.reply(COMMANDS[command.command](command, memcached, buf))
+def verbosity(_, ___, ____):
+    """ verbosity command, accepted but ignored """
+    return "OK\r\n"
+
+COMMANDS['verbosity'] = verbosity
+
+def lru_crawler(command, memcached, _):
+    """ 
+    lru_crawler metadump command, the reply is a generator of pieces 
+    that the protocol sends one per event
+    """
+    return _metadump(memcached.metadump(command.key))
+
+def _metadump(items):
+    """ format metadump lines, a batch each time the engine yields None """
+    lines = []
+    for item in items:
+        if item is None:
+            yield "".join(lines)
+            lines = []
+        else:
+            key, exptime, last_access, casunique, flags, size = item
+            lines.append("key=%s exp=%d la=%d cas=%d flags=%s size=%d\r\n" %
+                         (quote(key, ''), exptime or -1, last_access,
+                          casunique, flags, size))
+    lines.append("END\r\n")
+    yield "".join(lines)
+
+COMMANDS['lru_crawler'] = lru_crawler
+
+def watch(command, _, __):
+    """ watch command, see MCProtocol._watch """
+    return Watch(command.keys)
+
+COMMANDS['watch'] = watch
+
+# noreply versions of the commands that take noreply, these just do
+# the engine work and skip building a reply nobody will see
+QUIET_COMMANDS = {}
+
+def set_quiet(command, memcached, buf):
+    """ set command, noreply """
+    memcached.set(command.key, command.flags, command.exptime, buf)
+    return ""
+
+QUIET_COMMANDS['set'] = set_quiet
+
+def cas_quiet(command, memcached, buf):
+    """ cas command, noreply """
+    memcached.cas(command.key, command.flags, 
+                  command.exptime, command.casunique, buf)
+    return ""
+
+QUIET_COMMANDS['cas'] = cas_quiet
+
+def lset_quiet(command, memcached, buf):
+    """ lset command, noreply """
+    if memcached.lease_set is not None:
+        memcached.lease_set(command.key, command.flags, command.exptime,
+                            command.casunique, buf)
+    return ""
+
+QUIET_COMMANDS['lset'] = lset_quiet
+
+def add_quiet(command, memcached, buf):
+    """ add command, noreply """
+    memcached.add(command.key, command.flags, command.exptime, buf)
+    return ""
+
+QUIET_COMMANDS['add'] = add_quiet
+
+def replace_quiet(command, memcached, buf):
+    """ replace command, noreply """
+    memcached.replace(command.key, command.flags, command.exptime, buf)
+    return ""
+
+QUIET_COMMANDS['replace'] = replace_quiet
+
+def prepend_quiet(command, memcached, buf):
+    """ prepend command, noreply """
+    memcached.prepend(command.key, command.flags, command.exptime, buf)
+    return ""
+
+QUIET_COMMANDS['prepend'] = prepend_quiet
+
+def append_quiet(command, memcached, buf):
+    """ append command, noreply """
+    memcached.append(command.key, command.flags, command.exptime, buf)
+    return ""
+
+QUIET_COMMANDS['append'] = append_quiet
+
+def delete_quiet(command, memcached, _):
+    """ delete command, noreply """
+    memcached.delete(command.key)
+    return ""
+
+QUIET_COMMANDS['delete'] = delete_quiet
+
+def incr_quiet(command, memcached, _):
+    """ incr command, noreply """
+    memcached.increment(command.key, command.value)
+    return ""
+
+QUIET_COMMANDS['incr'] = incr_quiet
+
+def decr_quiet(command, memcached, _):
+    """ decr command, noreply """
+    memcached.decrement(command.key, command.value)
+    return ""
+
+QUIET_COMMANDS['decr'] = decr_quiet
+
+def flush_all_quiet(command, memcached, _):
+    """ flush_all command, noreply """
+    memcached.flush(command.delay)
+    return ""
+
+QUIET_COMMANDS['flush_all'] = flush_all_quiet
@@ -36,34 +36,37 @@ class ProtocolException(Exception):
         super(ProtocolException, self).__init__(self)
         self.msg = msg
 
+class FatalProtocolException(ProtocolException):
+    """ 
+    Exception thrown when the input can't be recovered from, the 
+    connection should send the message and hang up 
+    """
+    pass
+
 class MCCommand(object): # pylint: disable=R0902,R0903
-    """ parsed memcached command """
+    """ 
+    parsed memcached command 
+
+    numbers are already converted, flags stay a string since that
+    is how they are stored, bytes is None for commands without a 
+    data block
+    """
+    __slots__ = ('command', 'key', 'flags', 'exptime', 'bytes', 'noreply',
+                 'casunique', 'keys', 'value', 'delay', 'stats_command',
+                 'handler')
+
     def __init__(self, # pylint: disable=R0913
                  command = '',
                  key = '',
                  flags = '0',
-                 exptime = '0',
-                 in_bytes = '0',
+                 exptime = 0,
+                 in_bytes = None,
                  noreply = False,
-                 casunique = '',
+                 casunique = 0,
                  keys = None,
-                 value = '0',
-                 delay = '0',
+                 value = 0,
+                 delay = 0,
                  stats_command = ''):
-
-        if len(flags) > 1:
-            raise ProtocolException("CLIENT_ERROR bad flags\r\n")
-
-        if (not flags.isdigit() or not exptime.isdigit() or
-            not in_bytes.isdigit() or not delay.isdigit() or
-            not value.isdigit()):
-            raise ProtocolException("CLIENT_ERROR bad argument\r\n")
-
-        if (stats_command and 
-            stats_command not in ["settings", "items", "sizes", "slabs"]):
-            raise ProtocolException(
-                "CLIENT_ERROR invalid statistic requested\r\n")
-
         self.command = command
         self.key = key
         self.flags = flags
@@ -75,6 +78,7 @@ class MCCommand(object): # pylint: disable=R0902,R0903
         self.delay = delay
         self.stats_command = stats_command
         self.value = value
+        self.handler = None
 
     def reply(self, reply_val):
         """ nothing if noreply set, otherwise command reply """
@@ -88,6 +92,22 @@ def check_command_length(command_info, length):
     if len(command_info) < length:
         raise ProtocolException('CLIENT_ERROR not enough arguments\r\n')
 
+def check_flags(flags):
+    """ make sure the flags fit in 32 bits, as memcached's do """
+    if not flags.isdigit():
+        raise ProtocolException("CLIENT_ERROR bad argument\r\n")
+    elif int(flags) > MAX_FLAGS:
+        raise ProtocolException("CLIENT_ERROR bad flags\r\n")
+    return str(int(flags))
+
+def to_int(field):
+    """ convert a numeric argument, once """
+    if not field.isdigit():
+        raise ProtocolException("CLIENT_ERROR bad argument\r\n")
+    return int(field)
+
+MAX_FLAGS = 2**32 - 1
+
 COMMANDS = {}
 
 def set_et_al(command_info):
@@ -95,9 +115,9 @@ def set_et_al(command_info):
     check_command_length(command_info, 5)
     return MCCommand(command = command_info[0],
                      key = command_info[1],
-                     flags = command_info[2],
-                     exptime = command_info[3],
-                     in_bytes = command_info[4],
+                     flags = check_flags(command_info[2]),
+                     exptime = to_int(command_info[3]),
+                     in_bytes = to_int(command_info[4]),
                      noreply = (len(command_info) == 6 and 
                                 command_info[5] == 'noreply'))
 
@@ -112,15 +132,45 @@ def cas(command_info):
     check_command_length(command_info, 6)
     return MCCommand(command = command_info[0],
                      key = command_info[1],
-                     flags = command_info[2],
-                     exptime = command_info[3],
-                     in_bytes = command_info[4],
-                     casunique = command_info[5],
+                     flags = check_flags(command_info[2]),
+                     exptime = to_int(command_info[3]),
+                     in_bytes = to_int(command_info[4]),
+                     casunique = to_int(command_info[5]),
                      noreply = (len(command_info) == 7 and 
                                 command_info[6] == 'noreply'))
 
 COMMANDS['cas'] = cas
 
+def lset(command_info):
+    """ parse lset command, the lease token goes in casunique """
+    check_command_length(command_info, 6)
+    return MCCommand(command = command_info[0],
+                     key = command_info[1],
+                     flags = check_flags(command_info[2]),
+                     exptime = to_int(command_info[3]),
+                     in_bytes = to_int(command_info[4]),
+                     casunique = to_int(command_info[5]),
+                     noreply = (len(command_info) == 7 and 
+                                command_info[6] == 'noreply'))
+
+COMMANDS['lset'] = lset
+
+# the commands with a data block, its length the fifth field
+DATA_COMMANDS = frozenset(['set', 'add', 'replace', 'prepend', 'append', 
+                           'cas', 'lset'])
+
+def data_bytes(command_string):
+    """ 
+    the length of the data block a command line that didn't parse 
+    says follows, None if there's none or it can't be read, so the 
+    block can be skipped rather than read as commands
+    """
+    command_info = command_string.split()
+    if (len(command_info) > 4 and command_info[0] in DATA_COMMANDS and
+        command_info[4].isdigit()):
+        return int(command_info[4])
+    return None
+
 def get(command_info):
     """ parse get and gets commands """
     check_command_length(command_info, 2)
@@ -129,6 +179,7 @@ def get(command_info):
 
 COMMANDS['get'] = get
 COMMANDS['gets'] = get
+COMMANDS['lget'] = get
 
 def delete(command_info):
     """ parse delete command """
@@ -145,7 +196,7 @@ def incr(command_info):
     check_command_length(command_info, 3)
     return MCCommand(command = command_info[0],
                      key = command_info[1],
-                     value = command_info[2],
+                     value = to_int(command_info[2]),
                      noreply = (len(command_info) == 4 and 
                                 command_info[3] == 'noreply'))
 
@@ -155,6 +206,9 @@ COMMANDS['decr'] = incr
 def stats(command_info):
     """ parse stats commands """
     if len(command_info) > 1:
+        if command_info[1] not in ["settings", "items", "sizes", "slabs"]:
+            raise ProtocolException(
+                "CLIENT_ERROR invalid statistic requested\r\n")
         return MCCommand(command = command_info[0],
                          stats_command = command_info[1])
     else:
@@ -170,7 +224,7 @@ def flush_all(command_info):
                              noreply = True)
         else:
             return MCCommand(command = command_info[0],
-                             delay = command_info[1],
+                             delay = to_int(command_info[1]),
                              noreply = (len(command_info) == 3 and 
                                         command_info[2] == 'noreply'))
     else:
@@ -186,10 +240,22 @@ COMMANDS['version'] = simple
 COMMANDS['verbosity'] = simple
 COMMANDS['quit'] = simple
 
-def parse_command(command_string):
-    """ parse all commands """
-    command_info = command_string.split()
-    if command_info[0] not in COMMANDS:
-        raise ProtocolException("ERROR\r\n")
-    else:
-        return COMMANDS[command_info[0]](command_info)
+def lru_crawler(command_info):
+    """ 
+    parse lru_crawler command, only metadump, with an optional key 
+    prefix after the class (which has to be all, there's only one)
+    """
+    check_command_length(command_info, 3)
+    if command_info[1] != 'metadump' or command_info[2] != 'all':
+        raise ProtocolException("CLIENT_ERROR bad command line format\r\n")
+    return MCCommand(command = command_info[0],
+                     key = command_info[3] if len(command_info) > 3 else '')
+
+COMMANDS['lru_crawler'] = lru_crawler
+
+def watch(command_info):
+    """ parse watch command, the key prefixes to watch, none for all """
+    return MCCommand(command = command_info[0],
+                     keys = command_info[1:])
+
+COMMANDS['watch'] = watch
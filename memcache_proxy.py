@@ -0,0 +1,424 @@
+"""
+Proxy mode, pass commands on to a pool of servers, each key going to the
+server that owns it by consistent hashing.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import collections
+import socket
+
+try:
+    import pyev
+except ImportError: # pragma: no cover
+    pyev = None # only the connections need it
+
+import memcache_client
+import memcache_connection
+import memcache_hashing
+import memcache_logging as mc_log
+import memcache_protocol
+import memcache_protocol_execute as mp_execute
+import memcache_protocol_parse as mp_parse
+import memory_cache
+
+BACKEND_ERROR = "SERVER_ERROR backend unavailable\r\n"
+NOT_SUPPORTED = "SERVER_ERROR not supported by proxy\r\n"
+
+class Slot(object): # pylint: disable=R0903
+    """ where a command's reply goes, in the order the commands came """
+    __slots__ = ('reply', 'protocol')
+
+    def __init__(self, protocol):
+        self.reply = None
+        self.protocol = protocol
+
+    def finish(self, reply):
+        """ the reply is in """
+        self.reply = reply
+        self.protocol.slot_done()
+
+class MultiGet(object):
+    """ a get split across backends, put back together in key order """
+    def __init__(self, command, slot, parts):
+        self.command = command
+        self.slot = slot
+        self.parts = parts
+        self.blocks = {}
+
+    def got(self, blocks):
+        """ one backend's share is in, misses if it failed """
+        if blocks is not None:
+            self.blocks.update(blocks)
+        self.parts -= 1
+        if not self.parts:
+            found = self.blocks
+            reply = [found[key] for key in self.command.keys if key in found]
+            reply.append("END\r\n")
+            self.slot.finish("".join(reply))
+
+class Broadcast(object): # pylint: disable=R0903
+    """ a command every backend gets, OK once they all say so """
+    def __init__(self, command, slot, parts):
+        self.command = command
+        self.slot = slot
+        self.parts = parts
+        self.failed = False
+
+    def got(self, line):
+        """ one backend answered """
+        if line != "OK\r\n":
+            self.failed = True
+        self.parts -= 1
+        if not self.parts:
+            self.slot.finish(self.command.reply(
+                BACKEND_ERROR if self.failed else "OK\r\n"))
+
+# how far a client can get ahead of the backends before we stop 
+# reading from it
+DEFAULT_MAX_SLOTS = 1024
+DEFAULT_MAX_UNSENT = 1024 * 1024
+
+STORAGE = frozenset(['set', 'add', 'replace', 'prepend', 'append'])
+LOCAL = frozenset(['version', 'verbosity', 'stats'])
+
+class Router(object):
+    """
+    stands in for the memcached engine in proxy mode, sending each 
+    command on to the backend that owns its key
+
+    connect(server) makes a backend connection, anything with a 
+    send(data, multi, callback) like memcache_client.ClientProtocol's 
+    and a queued() byte count of what it hasn't written yet, pool_size 
+    of them per backend are used in turn
+
+    a client connection stops reading once it has max_slots replies 
+    still to come, or any backend connection has more than max_unsent 
+    bytes it couldn't write yet, see ProxyProtocol.blocked
+    """
+    # pylint: disable=R0913
+    def __init__(self, stats, servers, connect, pool_size=2, 
+                 item_size_max=memory_cache.DEFAULT_ITEM_SIZE_MAX,
+                 max_slots=DEFAULT_MAX_SLOTS, max_unsent=DEFAULT_MAX_UNSENT):
+        self._stats = stats
+        self.item_size_max = item_size_max
+        self.max_slots = max_slots
+        self.max_unsent = max_unsent
+        self.ring = memcache_hashing.Ring(servers)
+        self.pools = dict((server, [connect(server) 
+                                    for _ in range(pool_size)])
+                          for server in self.ring.servers)
+        self.turns = dict((server, 0) for server in self.ring.servers)
+    # pylint: enable=R0913
+
+    def backend(self, server):
+        """ the next connection in a backend's pool """
+        pool = self.pools[server]
+        turn = self.turns[server]
+        self.turns[server] = (turn + 1) % len(pool)
+        return pool[turn]
+
+    def congested(self):
+        """ is a backend connection too far behind with its writes? """
+        max_unsent = self.max_unsent
+        for pool in self.pools.values():
+            for conn in pool:
+                if conn.queued() > max_unsent:
+                    return True
+        return False
+
+    def stats(self, sub):
+        """ stats command, the proxy's own """
+        return self._stats.dump(sub)
+
+    def _one(self, command, slot, data):
+        """ send to the backend for command's key, pass the reply back """
+        def got(line):
+            """ the backend answered """
+            slot.finish(command.reply(BACKEND_ERROR if line is None 
+                                      else line))
+        server = self.ring.get_server(command.key)
+        self.backend(server).send(data, False, got)
+
+    def route(self, command, buf, slot):
+        """ 
+        send a command on, the reply ends up in slot
+
+        noreply isn't passed on, so every request gets a reply and 
+        the pipeline stays in step, the reply just isn't sent back
+        """
+        verb = command.command
+        if verb == 'get' or verb == 'gets':
+            parts = self.ring.split(command.keys)
+            multi = MultiGet(command, slot, len(parts))
+            for server, keys in parts:
+                self.backend(server).send("%s %s\r\n" % (verb, " ".join(keys)),
+                                          True, multi.got)
+        elif verb in STORAGE:
+            self._one(command, slot, "%s %s %s %d %d\r\n%s\r\n" % (
+                    verb, command.key, command.flags, command.exptime, 
+                    command.bytes, buf))
+        elif verb == 'cas':
+            self._one(command, slot, "cas %s %s %d %d %d\r\n%s\r\n" % (
+                    command.key, command.flags, command.exptime, 
+                    command.bytes, command.casunique, buf))
+        elif verb == 'delete':
+            self._one(command, slot, "delete %s\r\n" % command.key)
+        elif verb == 'incr' or verb == 'decr':
+            self._one(command, slot, "%s %s %s\r\n" % (verb, command.key, 
+                                                       command.value))
+        elif verb == 'flush_all':
+            broadcast = Broadcast(command, slot, len(self.ring.servers))
+            for server in self.ring.servers:
+                self.backend(server).send("flush_all %d\r\n" % command.delay,
+                                          False, broadcast.got)
+        elif verb in LOCAL:
+            slot.finish(command.reply(
+                    mp_execute.COMMANDS[verb](command, self, buf)))
+        elif verb == 'quit':
+            raise mp_execute.QuitException("quit command received")
+        else:
+            slot.finish(NOT_SUPPORTED)
+
+class ProxyProtocol(memcache_protocol.MCProtocol):
+    """
+    MCProtocol that routes commands instead of executing them
+
+    replies come back in their own time, so each command gets a slot
+    and replies go out once every command before them has one too,
+    on_ready is called when that happens outside of got_input
+
+    while blocked, the commands already read wait in self.pending and
+    nothing more is read, a reply coming in calls on_ready so the 
+    connection can look again
+    """
+    def __init__(self, stats, router, address, 
+                 max_requests=memcache_protocol.MCProtocol.DEFAULT_MAX_REQUESTS):
+        super(ProxyProtocol, self).__init__(stats, router, address, 
+                                            max_requests)
+        self.slots = collections.deque()
+        self.on_ready = None
+        self.in_input = False
+
+    def _execute(self):
+        """ send the command we just finished parsing on its way """
+        command = self.command
+        slot = Slot(self)
+        self.slots.append(slot)
+        if (command.bytes is not None and 
+            command.bytes > self.memcached.item_size_max):
+            slot.finish(command.reply(self.TOO_LARGE))
+        else:
+            self.memcached.route(command, self.buf, slot)
+        self.buf = ""
+        self.state = self.STATE_R_SEARCH
+        self.logger.log_vvv("entering R_SEARCH state")
+        return ""
+
+    def slot_done(self):
+        """ a reply came in, see if it can go out """
+        if (not self.in_input and self.on_ready is not None and 
+            self.slots[0].reply is not None):
+            self.on_ready()
+
+    def waiting(self):
+        """ are there replies still to come from the backends? """
+        return bool(self.slots)
+
+    def blocked(self):
+        """ 
+        too many replies still to come, or a backend too far behind? 
+        only while there are replies to come, one of them unblocks us
+        """
+        slots = self.slots
+        router = self.memcached
+        return bool(slots) and (len(slots) >= router.max_slots or 
+                                router.congested())
+
+    def has_pending(self):
+        """ commands still to handle, once we aren't blocked """
+        return (not self.blocked() and 
+                super(ProxyProtocol, self).has_pending())
+
+    def output(self):
+        """ the replies that are ready to go out, in order """
+        replies = []
+        slots = self.slots
+        while slots and slots[0].reply is not None:
+            replies.append(slots.popleft().reply)
+        output = "".join(replies)
+        if output:
+            self.stats.write_bytes(len(output))
+            self.logger.log_vv("response = '%s'", output)
+        return output
+
+    def got_input(self, buf):
+        """ 
+        parse and route commands, return the replies ready so far
+
+        protocol errors take a slot too, so they come back in order
+        """
+        if self.blocked():
+            self.stats.read_bytes(len(buf))
+            self.pending += buf
+            return self.output()
+        self.in_input = True
+        try:
+            super(ProxyProtocol, self).got_input(buf)
+        except mp_parse.FatalProtocolException as err:
+            slot = Slot(self)
+            self.slots.append(slot)
+            slot.finish(err.msg)
+            err.msg = self.output()
+            raise
+        except mp_parse.ProtocolException as err:
+            slot = Slot(self)
+            self.slots.append(slot)
+            slot.finish(err.msg)
+        finally:
+            self.in_input = False
+        return self.output()
+
+class ProxySocket(memcache_connection.MemcachedSocket):
+    """ a client connection in proxy mode """
+    PROTOCOL = ProxyProtocol
+
+    def ready(self):
+        """ 
+        replies came in from the backends, FINISHED if there is 
+        something to write or commands we stopped for can go on, QUIT 
+        if we are closing and that was the last of them
+        """
+        self.reply += self.protocol.output()
+        if self.reply or self.protocol.has_pending():
+            return self.FINISHED
+        if self.closing and not self.protocol.waiting():
+            self.close()
+            return self.QUIT
+        return self.CONTINUE
+
+# no coverage, same reason as memcache_connection.MemcachedConnection
+class BackendConnection(object): # pragma: no cover
+    """ a pooled, pipelined connection to a backend """
+    def __init__(self, address, loop):
+        self.address = address
+        self.loop = loop
+        self.logger = mc_log.MemcachedLogger(address)
+        self.protocol = memcache_client.ClientProtocol()
+        self.sock = None
+        self.watcher = None
+        self.unsent = ""
+
+    def queued(self):
+        """ bytes of requests not written yet """
+        return len(self.unsent) + self.protocol.output_bytes
+
+    def send(self, data, multi, callback):
+        """ queue a request, connecting first if need be """
+        if self.sock is None:
+            self._connect()
+        self.protocol.send(data, multi, callback)
+        self.watcher.stop()
+        self.watcher.set(self.sock, pyev.EV_READ | pyev.EV_WRITE)
+        self.watcher.start()
+
+    def _connect(self):
+        """ start connecting, it's done once we can write """
+        self.sock = socket.socket()
+        self.sock.setblocking(0)
+        self.sock.connect_ex(self.address)
+        self.watcher = pyev.Io(self.sock, pyev.EV_READ | pyev.EV_WRITE, 
+                               self.loop, self.io_cb)
+        self.watcher.start()
+
+    def io_cb(self, watcher, revents):
+        """ the backend is ready to read or write """
+        try:
+            if revents & pyev.EV_READ:
+                buf = self.sock.recv(65536)
+                if not buf:
+                    raise socket.error("backend hung up")
+                self.protocol.got_input(buf)
+            if revents & pyev.EV_WRITE:
+                self.unsent += self.protocol.pop_output()
+                if self.unsent:
+                    sent = self.sock.send(self.unsent)
+                    self.unsent = self.unsent[sent:]
+                if not self.unsent:
+                    watcher.stop()
+                    watcher.set(self.sock, pyev.EV_READ)
+                    watcher.start()
+        except socket.error as err:
+            if err.args[0] not in memcache_connection.NONBLOCKING:
+                self.logger.log_v("backend connection failed", 
+                                  exc_info=True)
+                self._fail()
+
+    def _fail(self):
+        """ drop the connection, the next request reconnects """
+        self.watcher.stop()
+        self.watcher = None
+        self.sock.close()
+        self.sock = None
+        self.unsent = ""
+        self.protocol.fail()
+
+# no coverage, same reason as memcache_connection.MemcachedConnection
+class ProxyConnection(memcache_connection.MemcachedConnection): # pragma: no cover
+    """ connection from a client to the proxy """
+    SOCKET = ProxySocket
+
+    def __init__(self, sock, address, server):
+        super(ProxyConnection, self).__init__(sock, address, server)
+        self.socket.protocol.on_ready = self.ready
+
+    def ready(self):
+        """ replies came in from the backends """
+        if self.watcher is None:
+            return
+        ret = self.socket.ready()
+        if ret == self.socket.FINISHED:
+            self.reset(pyev.EV_WRITE)
+        elif ret == self.socket.QUIT:
+            self.close()
+
+# no coverage, same reason as memcache_connection.Server
+class ProxyServer(memcache_connection.Server): # pragma: no cover
+    """ a Server that passes commands on to backends """
+    CONNECTION = ProxyConnection
+
+    def __init__(self, backends, pool_size=2, max_slots=DEFAULT_MAX_SLOTS,
+                 max_unsent=DEFAULT_MAX_UNSENT, **kwargs):
+        super(ProxyServer, self).__init__(**kwargs)
+        self.cache = Router(self.stats, backends, 
+                            lambda server: BackendConnection(server, 
+                                                             self.loop),
+                            pool_size, 
+                            kwargs.get('item_size_max', 
+                                       memory_cache.DEFAULT_ITEM_SIZE_MAX),
+                            max_slots, max_unsent)
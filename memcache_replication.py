@@ -0,0 +1,202 @@
+"""
+Replicate changes to follower servers, so losing a server doesn't mean
+losing what it had cached.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import collections
+
+import memory_cache_primitives
+
+# resync items sent per follower per step
+RESYNC_BATCH = 200
+
+class Follower(object):
+    """
+    the changes one follower has still to be sent, as noreply 
+    commands so nothing comes back and they can go out as fast as
+    the follower takes them
+
+    the connection to it calls data() for the next chunk to write 
+    and sent() with how much of it went, on_output is called when 
+    there is more to write
+    """
+    WRITE_BYTES = 256*1024
+
+    def __init__(self, address, stats):
+        self.address = address
+        self.stats = stats
+        self.output = collections.deque()
+        self.backlog = 0
+        # a chunk we started writing has to be finished, whatever 
+        # else gets dropped
+        self.started = False
+        self.connected = False
+        # keys still to send while resyncing, None when not
+        self.resync_keys = None
+        self.on_output = None
+
+    def queue(self, data):
+        """ add a command for the follower """
+        self.output.append(data)
+        self.backlog += len(data)
+        if self.on_output is not None:
+            self.on_output()
+
+    def data(self):
+        """ the next chunk to write, small commands joined up """
+        output = self.output
+        if len(output) > 1 and len(output[0]) < self.WRITE_BYTES:
+            pieces = []
+            size = 0
+            while output and size < self.WRITE_BYTES:
+                piece = output.popleft()
+                pieces.append(piece)
+                size += len(piece)
+            output.appendleft("".join(pieces))
+        if output:
+            return output[0]
+        return ""
+
+    def sent(self, count):
+        """ count bytes of the chunk from data() were written """
+        self.backlog -= count
+        self.stats.replicated(count)
+        piece = self.output.popleft()
+        self.started = count < len(piece)
+        if self.started:
+            self.output.appendleft(piece[count:])
+
+    def clear(self):
+        """ drop what hasn't been written, except a started chunk """
+        kept = self.output[0] if self.started else ""
+        self.output.clear()
+        self.backlog = 0
+        self.resync_keys = None
+        if kept:
+            self.queue(kept)
+
+    def disconnected(self):
+        """ the connection went away, the next one starts over """
+        self.started = False
+        self.connected = False
+        self.clear()
+
+class Replicator(object):
+    """
+    send the changes made through memory_cache.Memcached on to 
+    followers, it calls stored, deleted, touched and flushed the 
+    same as it does an OperationLog
+
+    a follower that just connected, or that fell more than 
+    max_backlog bytes behind, gets a flush_all and then every item 
+    in the cache as it is now, a batch per step() so the clients 
+    don't wait, with changes made meanwhile queued up behind
+
+    followers are ordinary servers, so they serve reads, as long as 
+    nothing else writes to them they stay the same as the primary
+    """
+    def __init__(self, cache, stats, addresses, max_backlog=16*1024*1024):
+        self.cache = cache
+        self.stats = stats
+        self.max_backlog = max_backlog
+        self.followers = [Follower(address, stats) for address in addresses]
+
+    def _queue(self, data):
+        """ send a command to every connected follower """
+        for follower in self.followers:
+            if not follower.connected:
+                continue
+            follower.queue(data)
+            if follower.backlog > self.max_backlog:
+                self.stats.repl_overflow()
+                self.resync(follower)
+
+    def stored(self, item):
+        """ an item was set to what it is now """
+        value = item.value
+        self._queue("set %s %s %d %d noreply\r\n%s\r\n" % (
+                item.key, item.flags, item.exptime, len(value), value))
+
+    def deleted(self, key):
+        """ a key was deleted """
+        self._queue("delete %s noreply\r\n" % key)
+
+    def touched(self, item):
+        """ an item got a new exptime, sent whole, there is no touch """
+        self.stored(item)
+
+    def flushed(self, exptime):
+        """ everything in the cache expires at exptime """
+        delay = max(0, exptime - memory_cache_primitives.int_time())
+        self._queue("flush_all %d noreply\r\n" % delay)
+
+    def connected(self, follower):
+        """ a connection to a follower is up, bring it up to date """
+        follower.connected = True
+        self.resync(follower)
+
+    def resync(self, follower):
+        """ start a follower over from the cache as it is now """
+        self.stats.repl_resync()
+        follower.clear()
+        follower.queue("flush_all noreply\r\n")
+        follower.resync_keys = iter(list(self.cache.the_cache.keys()))
+
+    def _resync_batch(self, follower):
+        """ send the next batch of items, return False once they're all sent """
+        the_cache = self.cache.the_cache
+        now = memory_cache_primitives.int_time()
+        count = 0
+        for key in follower.resync_keys:
+            item = the_cache.get(key)
+            if item is None or item.has_expired(now):
+                continue
+            value = item.value
+            follower.queue("set %s %s %d %d noreply\r\n%s\r\n" % (
+                    key, item.flags, item.exptime, len(value), value))
+            count += 1
+            if count == RESYNC_BATCH:
+                return True
+        follower.resync_keys = None
+        return False
+
+    def step(self):
+        """ 
+        send resyncing followers another batch, if they've taken most 
+        of the last one, return True if any are still resyncing
+        """
+        resyncing = False
+        for follower in self.followers:
+            if follower.resync_keys is None:
+                continue
+            if (follower.backlog > self.max_backlog // 2 or 
+                self._resync_batch(follower)):
+                resyncing = True
+        return resyncing
@@ -0,0 +1,215 @@
+"""
+Fill a new server's cache from a dump file or a running peer while it
+serves, so it doesn't start out missing everything.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import socket
+import threading
+import time
+
+try:
+    import Queue as queue
+    from urllib import unquote
+except ImportError: # pragma: no cover
+    import queue
+    from urllib.parse import unquote
+
+import memcache_logging as mc_log
+import memory_cache_primitives
+import memory_cache_snapshot
+
+def file_records(path):
+    """ yield (key, value, flags, exptime) from a snapshot file """
+    return memory_cache_snapshot.records(path)
+
+def _metadump(reader):
+    """ yield (key, exptime) for each line of a metadump """
+    while True:
+        line = memory_cache_primitives.to_str(reader.readline())
+        if not line:
+            raise IOError("peer hung up during metadump")
+        if line == "END\r\n":
+            return
+        fields = dict(field.split("=", 1) for field in line.split())
+        exptime = int(fields["exp"])
+        yield unquote(fields["key"]), max(exptime, 0)
+
+def _get_values(sock, reader, keys):
+    """ yield (key, value, flags) for the keys the peer still has """
+    to_str = memory_cache_primitives.to_str
+    sock.sendall(memory_cache_primitives.to_bytes("get %s\r\n" % 
+                                                  " ".join(keys)))
+    while True:
+        line = to_str(reader.readline())
+        if line == "END\r\n":
+            return
+        if not line.startswith("VALUE "):
+            raise IOError("unexpected reply from peer: %r" % line)
+        _, key, flags, length = line.split()
+        value = to_str(reader.read(int(length) + 2)[:-2])
+        yield key, value, flags
+
+def peer_records(address, get_batch=100, timeout=30.0):
+    """
+    yield (key, value, flags, exptime) for everything a peer has
+
+    one connection streams the peer's metadump while the other gets
+    the values get_batch keys at a time
+    """
+    dump_sock = socket.create_connection(address, timeout)
+    get_sock = socket.create_connection(address, timeout)
+    try:
+        dump_sock.sendall(b"lru_crawler metadump all\r\n")
+        dump_reader = dump_sock.makefile("rb")
+        get_reader = get_sock.makefile("rb")
+        exptimes = {}
+        for dumped_key, exptime in _metadump(dump_reader):
+            exptimes[dumped_key] = exptime
+            if len(exptimes) >= get_batch:
+                for key, value, flags in _get_values(get_sock, get_reader,
+                                                     exptimes.keys()):
+                    yield key, value, flags, exptimes[key]
+                exptimes = {}
+        if exptimes:
+            for key, value, flags in _get_values(get_sock, get_reader,
+                                                 exptimes.keys()):
+                yield key, value, flags, exptimes[key]
+    finally:
+        dump_sock.close()
+        get_sock.close()
+
+class Warmup(object):
+    """
+    loads items from a source into the cache while the server runs
+
+    a thread reads the source and queues up batches, the event loop 
+    calls step() to insert them straight into the MemoryCache, 
+    skipping parsing and the per-command stats
+
+    keys that are already in the cache were set by clients since we
+    started, so those win, and so do the keys clients changed, deleted 
+    or touched since, which Memcached tells us about through the same 
+    stored/deleted/touched/flushed calls as the oplog, a flush_all 
+    means everything still to come is older, so it all gets skipped
+    """
+    # pylint: disable=R0913
+    def __init__(self, cache, stats, source, batch_size=1000, 
+                 step_seconds=0.005):
+        self.cache = cache
+        self.stats = stats
+        self.source = source
+        self.batch_size = batch_size
+        self.step_seconds = step_seconds
+        self.logger = mc_log.MemcachedLogger(("warmup", 0))
+        self.done = False
+        # keys clients changed since we started, what we have is older
+        self.changed = set()
+        self.flushed_all = False
+        self.batches = queue.Queue(maxsize=8)
+        self.thread = threading.Thread(target=self._read, name="warmup")
+        self.thread.daemon = True
+    # pylint: enable=R0913
+
+    def start(self):
+        """ start reading the source """
+        self.stats.warmup_start()
+        self.thread.start()
+
+    def _read(self):
+        """ the thread, batch up the source, None marks the end """
+        try:
+            batch = []
+            for record in self.source:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    self.batches.put(batch)
+                    batch = []
+            if batch:
+                self.batches.put(batch)
+        except Exception: # pylint: disable=W0703
+            self.logger.log_v("warmup source failed", exc_info=True)
+        finally:
+            self.batches.put(None)
+
+    def stored(self, item):
+        """ a client stored item """
+        if not self.done:
+            self.changed.add(item.key)
+
+    def deleted(self, key):
+        """ a client deleted key """
+        if not self.done:
+            self.changed.add(key)
+
+    def touched(self, item):
+        """ a client gave item a new exptime """
+        if not self.done:
+            self.changed.add(item.key)
+
+    def flushed(self, _):
+        """ a client flushed everything """
+        if not self.done:
+            self.flushed_all = True
+
+    def _insert(self, batch):
+        """ add a batch of items to the cache """
+        now = memory_cache_primitives.int_time()
+        the_cache = self.cache.the_cache
+        changed = self.changed
+        if self.flushed_all:
+            wanted = []
+        else:
+            wanted = [(key, value, flags, exptime) 
+                      for key, value, flags, exptime in batch
+                      if key not in the_cache and key not in changed and
+                      (exptime <= 0 or exptime > now)]
+        self.cache.set_multi(wanted)
+        self.stats.warmed(len(wanted), len(batch) - len(wanted),
+                          sum(len(record[1]) for record in wanted))
+
+    def step(self):
+        """ 
+        insert whatever batches are ready, for up to step_seconds, 
+        return False once everything has been loaded
+        """
+        deadline = time.time() + self.step_seconds
+        while not self.done and time.time() < deadline:
+            try:
+                batch = self.batches.get_nowait()
+            except queue.Empty:
+                break
+            if batch is None:
+                self.done = True
+                self.changed = set()
+                self.stats.warmup_finish()
+                self.logger.log_v("warmup done")
+            else:
+                self._insert(batch)
+        return not self.done
@@ -31,6 +31,8 @@ or implied, of James Yates Farrimond.
 """
 import sys
 
+import memory_cache_invalidation
+import memory_cache_leases
 import memory_cache_primitives
 
 class MemcachedStats(memory_cache_primitives.MemoryCacheStats):
@@ -52,8 +54,18 @@ class MemcachedStats(memory_cache_primitives.MemoryCacheStats):
         self.cas_misses = 0
         self.cas_hits = 0
         self.cas_badvals = 0
+        self.cmd_touch = 0
+        self.touch_hits = 0
+        self.touch_misses = 0
         self.auth_cmds = 0
         self.auth_errors = 0
+        self.lease_grants = 0
+        self.lease_stale_hits = 0
+        self.lease_waits = 0
+        self.lease_rejects = 0
+        self.loader_fetches = 0
+        self.loader_coalesced = 0
+        self.loader_misses = 0
     # pylint: enable=R0902
 
     def set(self):
@@ -89,6 +101,14 @@ class MemcachedStats(memory_cache_primitives.MemoryCacheStats):
         else:
             self.decr_misses += 1
 
+    def touch(self, hit):
+        """ touch command """
+        self.cmd_touch += 1
+        if hit:
+            self.touch_hits += 1
+        else:
+            self.touch_misses += 1
+
     def cas_miss(self):
         """ cas miss """
         self.cas_misses += 1
@@ -101,6 +121,33 @@ class MemcachedStats(memory_cache_primitives.MemoryCacheStats):
         """ cas badval """
         self.cas_badvals += 1
 
+    def lease_grant(self):
+        """ a lease get missed and got the lease """
+        self.lease_grants += 1
+
+    def lease_stale_hit(self):
+        """ a lease get missed and got a stale value instead """
+        self.lease_stale_hits += 1
+
+    def lease_wait(self):
+        """ a lease get missed and was told to wait """
+        self.lease_waits += 1
+
+    def lease_reject(self):
+        """ a lease set had a token that wasn't the lease """
+        self.lease_rejects += 1
+
+    def loader_fetch(self, coalesced):
+        """ a miss went to the loader, or joined a fetch under way """
+        if coalesced:
+            self.loader_coalesced += 1
+        else:
+            self.loader_fetches += 1
+
+    def loader_miss(self):
+        """ the loader's backend didn't have a key either """
+        self.loader_misses += 1
+
     def dump(self, command):
         """ dump the contents """
         ret_super = super(MemcachedStats, self).dump(command)
@@ -116,13 +163,25 @@ class MemcachedStats(memory_cache_primitives.MemoryCacheStats):
                ('decr_hits', self.decr_hits),
                ('cas_misses', self.cas_misses),
                ('cas_badvals', self.cas_badvals),
+               ('cmd_touch', self.cmd_touch),
+               ('touch_hits', self.touch_hits),
+               ('touch_misses', self.touch_misses),
                ('auth_cmds', self.auth_cmds),
-               ('auth_errors', self.auth_errors)]
+               ('auth_errors', self.auth_errors),
+               ('lease_grants', self.lease_grants),
+               ('lease_stale_hits', self.lease_stale_hits),
+               ('lease_waits', self.lease_waits),
+               ('lease_rejects', self.lease_rejects),
+               ('loader_fetches', self.loader_fetches),
+               ('loader_coalesced', self.loader_coalesced),
+               ('loader_misses', self.loader_misses)]
         ret_super.extend(ret)
         return ret_super
 
-DEFAULT_MAX_BYTES = sys.maxint
-DEFAULT_MAX_ITEMS = sys.maxint
+DEFAULT_MAX_BYTES = sys.maxsize
+DEFAULT_MAX_ITEMS = sys.maxsize
+DEFAULT_ITEM_SIZE_MAX = 1024*1024
+DEFAULT_LEASE_SECONDS = 10
 
 class Memcached(object):
     """
@@ -134,20 +193,93 @@ class Memcached(object):
     NOT_NUMBER = 3
     NOT_STORED = 4
     STORED = 5
+    TOUCHED = 6
+    TOO_LARGE = 7
 
+    # how many keys metadump looks at between yielding None
+    METADUMP_SCAN = 1000
+
+    # pylint: disable=R0913
     def __init__(self, stats, max_items=DEFAULT_MAX_ITEMS, 
-                 max_bytes=DEFAULT_MAX_BYTES):
+                 max_bytes=DEFAULT_MAX_BYTES, 
+                 item_size_max=DEFAULT_ITEM_SIZE_MAX, chunk_size=0, 
+                 disk=None, lease_seconds=DEFAULT_LEASE_SECONDS, 
+                 stale_seconds=0, loader=None):
         self._stats = stats
+        self.item_size_max = item_size_max
+        self.lease_seconds = lease_seconds
+        self.stale_seconds = stale_seconds
         self.cache = memory_cache_primitives.MemoryCache(
-            self._stats, max_items, max_bytes)
+            self._stats, max_items, max_bytes, chunk_size, disk)
+        # memory_cache_oplog.OperationLog to record changes in, if any
+        self.oplog = None
+        # memcache_replication.Replicator to send changes to, if any
+        self.replication = None
+        # memory_cache_invalidation.Invalidations once anyone watches
+        self.invalidations = None
+        # memory_cache_leases.Leases once anyone asks for a lease
+        self.leases = None
+        # memory_cache_loader.Loader to fetch misses with, if any
+        self.loader = loader
+        # memcache_warmup.Warmup loading while we serve, if any
+        self.warmup = None
+        if loader is not None:
+            loader.store = self._store_loaded
+    # pylint: enable=R0913
+
+    def _stored(self, item):
+        """ log an item that was just stored """
+        if self.oplog is not None:
+            self.oplog.stored(item)
+        if self.replication is not None:
+            self.replication.stored(item)
+        if self.invalidations is not None:
+            self.invalidations.stored(item)
+        if self.leases is not None:
+            self.leases.stored(item)
+        if self.loader is not None:
+            self.loader.stored(item)
+        if self.warmup is not None:
+            self.warmup.stored(item)
+
+    def _deleted(self, key):
+        """ log a key that was just deleted """
+        if self.oplog is not None:
+            self.oplog.deleted(key)
+        if self.replication is not None:
+            self.replication.deleted(key)
+        if self.invalidations is not None:
+            self.invalidations.deleted(key)
+        if self.leases is not None:
+            self.leases.deleted(key)
+        if self.loader is not None:
+            self.loader.deleted(key)
+        if self.warmup is not None:
+            self.warmup.deleted(key)
+
+    def _touched(self, item):
+        """ log an item that just got a new exptime """
+        if self.oplog is not None:
+            self.oplog.touched(item)
+        if self.replication is not None:
+            self.replication.touched(item)
+        if self.invalidations is not None:
+            self.invalidations.touched(item)
+        if self.leases is not None:
+            self.leases.touched(item)
+        if self.loader is not None:
+            self.loader.touched(item)
+        if self.warmup is not None:
+            self.warmup.touched(item)
 
     def set(self, key, flags, exptime, value):
         """ set command """
         item = self.cache.get(key)
         if item is not None:
-            self.cache.replace(item, value, flags, exptime)
+            item = self.cache.replace(item, value, flags, exptime)
         else:
-            self.cache.add(key, value, flags, exptime)
+            item = self.cache.add(key, value, flags, exptime)
+        self._stored(item)
         self._stats.set()
         return self.STORED
 
@@ -156,11 +288,11 @@ class Memcached(object):
         """ cas command """
         item = self.cache.get(key)
         if item is None:
-            self.cache.add(key, value, flags, exptime)
+            self._stored(self.cache.add(key, value, flags, exptime))
             self._stats.cas_miss()
             return self.NOT_FOUND
         elif item.casunique() == int(casunique):
-            self.cache.replace(item, value, flags, exptime)
+            self._stored(self.cache.replace(item, value, flags, exptime))
             self._stats.cas_hit()
             return self.STORED
         else:
@@ -175,36 +307,40 @@ class Memcached(object):
             self.cache.touch(item)
             return self.NOT_STORED
         else:
-            self.cache.add(key, value, flags, exptime)
+            self._stored(self.cache.add(key, value, flags, exptime))
             return self.STORED
 
     def replace(self, key, flags, exptime, value):
         """ replace command """
         item = self.cache.get(key)
         if item is not None:
-            self.cache.replace(item, value, flags, exptime)
+            self._stored(self.cache.replace(item, value, flags, exptime))
             return self.STORED
         else:
             return self.NOT_STORED
 
     def prepend(self, key, flags, exptime, value):
-        """ prepend command """
+        """ prepend command, TOO_LARGE if the result is over item_size_max """
         item = self.cache.get(key)
         if item is None:
             return self.NOT_STORED
+        elif len(item.value) + len(value) > self.item_size_max:
+            return self.TOO_LARGE
         else:
             value = value + item.value
-            self.cache.replace(item, value, flags, exptime)
+            self._stored(self.cache.replace(item, value, flags, exptime))
             return self.STORED
 
     def append(self, key, flags, exptime, value):
-        """ append command """
+        """ append command, TOO_LARGE if the result is over item_size_max """
         item = self.cache.get(key)
         if item is None:
             return self.NOT_STORED
+        elif len(item.value) + len(value) > self.item_size_max:
+            return self.TOO_LARGE
         else:
             value = item.value + value
-            self.cache.replace(item, value, flags, exptime)
+            self._stored(self.cache.replace(item, value, flags, exptime))
             return self.STORED
 
     def increment(self, key, value):
@@ -216,6 +352,7 @@ class Memcached(object):
             else:
                 value = str(int(item.value) + int(value))
                 item = self.cache.replace(item, value)
+                self._stored(item)
                 self._stats.incr(True)
                 return (self.STORED, item.value)
         else:
@@ -231,6 +368,7 @@ class Memcached(object):
             else:
                 value = str(int(item.value) - int(value))
                 item = self.cache.replace(item, value)
+                self._stored(item)
                 self._stats.decr(True)
                 return (self.STORED, item.value)
         else:
@@ -239,34 +377,239 @@ class Memcached(object):
 
     def get(self, keys):
         """ get command """
-        items = [(key, self.cache.get(key)) for key in keys]
-        items = [(key, item.value, item.flags) 
-                 for key, item in items if item is not None]
-        self._stats.get(bool(items))
-        return items
+        return list(self.get_multi(keys))
+
+    def get_multi(self, keys):
+        """ 
+        get several keys, yielding (key, value, flags) for the hits 
+
+        hits and misses are counted per key
+        """
+        stats_get = self._stats.get
+        for key, item in self.cache.get_multi(keys):
+            if item is not None:
+                stats_get(True)
+                yield key, item.value, item.flags
+            else:
+                stats_get(False)
 
     def gets(self, keys):
         """ gets command """
-        items = [(key, self.cache.get(key)) for key in keys]
-        items = [(key, item.value, item.flags, item.casunique()) 
-                  for key, item in items if item is not None]
-        self._stats.get(bool(items))
-        return items
+        return list(self.gets_multi(keys))
+
+    def gets_multi(self, keys):
+        """ 
+        get several keys, yielding (key, value, flags, casunique) 
+        for the hits 
+        """
+        stats_get = self._stats.get
+        for key, item in self.cache.get_multi(keys):
+            if item is not None:
+                stats_get(True)
+                yield key, item.value, item.flags, item.casunique()
+            else:
+                stats_get(False)
+
+    def _start_leases(self):
+        """ 
+        keep track of leases from now on, and of the values of the 
+        items that expire
+        """
+        if self.leases is None:
+            self.leases = memory_cache_leases.Leases(self.lease_seconds,
+                                                     self.stale_seconds)
+            self.cache.on_expire = self.leases.expired
+
+    def lease_get_multi(self, keys):
+        """ 
+        get several keys, yielding (key, state, value, flags, token) 
+        for each, see memory_cache_leases: state HIT for a hit, LEASED
+        with the token for the first miss, STALE for a later one 
+        while there's a stale value, WAIT if there isn't, value and 
+        flags are the stale ones (or None) for the misses
+        """
+        self._start_leases()
+        stats = self._stats
+        now = memory_cache_primitives.int_time()
+        for key, item in self.cache.get_multi(keys):
+            if item is not None:
+                stats.get(True)
+                yield key, memory_cache_leases.HIT, item.value, \
+                    item.flags, None
+                continue
+            stats.get(False)
+            state, token, stale = self.leases.miss(key, now)
+            if state == memory_cache_leases.LEASED:
+                stats.lease_grant()
+            elif state == memory_cache_leases.STALE:
+                stats.lease_stale_hit()
+            else:
+                stats.lease_wait()
+            value, flags = stale or (None, None)
+            yield key, state, value, flags, token
+
+    # pylint: disable=R0913
+    def lease_set(self, key, flags, exptime, token, value):
+        """ set, only if token is the lease on key """
+        self._start_leases()
+        if not self.leases.redeem(key, int(token), 
+                                  memory_cache_primitives.int_time()):
+            self._stats.lease_reject()
+            return self.NOT_STORED
+        return self.set(key, flags, exptime, value)
+    # pylint: enable=R0913
+
+    def load(self, keys, callback):
+        """ 
+        fetch the keys that miss through the loader, return True if 
+        that has to wait for the backend, then callback() is called 
+        once they're all in the cache, False if there's nothing to 
+        wait for
+
+        the keys aren't counted as gets, the get that follows is
+        """
+        cache = self.cache
+        # one for each key, and one until they've all been asked for
+        outstanding = [1]
+        def loaded():
+            """ one of the keys is in """
+            outstanding[0] -= 1
+            if not outstanding[0]:
+                callback()
+        for key in set(keys):
+            if cache.get(key) is None:
+                outstanding[0] += 1
+                self._stats.loader_fetch(not self.loader.load(key, loaded))
+        outstanding[0] -= 1
+        return outstanding[0] > 0
+
+    def _store_loaded(self, key, flags, exptime, value):
+        """ the loader fetched key, if the backend had it """
+        if value is None:
+            self._stats.loader_miss()
+        elif len(value) <= self.item_size_max:
+            self.set(key, flags, exptime, value)
+
+    def set_multi(self, items):
+        """ 
+        set several (key, flags, exptime, value) items, return 
+        (key, result) pairs 
+        """
+        stored = self.cache.set_multi([(key, value, flags, exptime)
+                                       for key, flags, exptime, value in items])
+        for item in stored:
+            self._stored(item)
+        results = []
+        for key, _, _, _ in items:
+            self._stats.set()
+            results.append((key, self.STORED))
+        return results
 
     def delete(self, key):
         """ delete command """
         item = self.cache.get(key)
         if item is not None:
             self.cache.delete(item)
+            self._deleted(key)
             self._stats.delete(True)
             return self.DELETED
         else:
+            # a fetch or warmup under way may be bringing back what 
+            # was deleted
+            if self.loader is not None:
+                self.loader.deleted(key)
+            if self.warmup is not None:
+                self.warmup.deleted(key)
             self._stats.delete(False)
             return self.NOT_FOUND
 
+    def delete_multi(self, keys):
+        """ delete several keys, return (key, result) pairs """
+        deleted = set(self.cache.delete_multi(keys))
+        results = []
+        for key in keys:
+            if key in deleted:
+                deleted.discard(key)
+                self._deleted(key)
+                self._stats.delete(True)
+                results.append((key, self.DELETED))
+            else:
+                if self.loader is not None:
+                    self.loader.deleted(key)
+                if self.warmup is not None:
+                    self.warmup.deleted(key)
+                self._stats.delete(False)
+                results.append((key, self.NOT_FOUND))
+        return results
+
+    def touch_multi(self, keys, exptime):
+        """ give several keys a new exptime, return (key, result) pairs """
+        touched = set(self.cache.touch_multi(keys, exptime))
+        results = []
+        for key in keys:
+            if key in touched:
+                self._touched(self.cache.the_cache[key])
+                self._stats.touch(True)
+                results.append((key, self.TOUCHED))
+            else:
+                self._stats.touch(False)
+                results.append((key, self.NOT_FOUND))
+        return results
+
+    def metadump(self, prefix=""):
+        """
+        yield (key, exptime, last_access, casunique, flags, size) for 
+        the live items whose keys start with prefix, and None every 
+        so often so a caller going a batch at a time can stop even 
+        if nothing matches
+
+        works from a copy of the keys, so the cache can change in 
+        between, items that go away in the meantime are skipped
+        """
+        the_cache = self.cache.the_cache
+        now = memory_cache_primitives.int_time()
+        for count, key in enumerate(list(the_cache.keys())):
+            if count and count % self.METADUMP_SCAN == 0:
+                yield None
+                now = memory_cache_primitives.int_time()
+            if not key.startswith(prefix):
+                continue
+            item = the_cache.get(key)
+            if item is None or item.has_expired(now):
+                continue
+            yield (key, item.exptime, item.last_access, item.casunique(),
+                   item.flags, item.bytes())
+
     def flush(self, delay):
         """ flush command """
         self.cache.flush(delay)
+        exptime = memory_cache_primitives.int_time() + int(delay)
+        if self.oplog is not None:
+            self.oplog.flushed(exptime)
+        if self.replication is not None:
+            self.replication.flushed(exptime)
+        if self.invalidations is not None:
+            self.invalidations.flushed(exptime)
+        if self.leases is not None:
+            self.leases.flushed(exptime)
+        if self.loader is not None:
+            self.loader.flushed(exptime)
+        if self.warmup is not None:
+            self.warmup.flushed(exptime)
+
+    def watch(self, subscriber, prefixes):
+        """ 
+        push an invalidation to subscriber whenever a key starting 
+        with one of prefixes changes, see memory_cache_invalidation
+        """
+        if self.invalidations is None:
+            self.invalidations = memory_cache_invalidation.Invalidations()
+        self.invalidations.subscribe(subscriber, prefixes)
+
+    def unwatch(self, subscriber):
+        """ stop pushing invalidations to subscriber """
+        if self.invalidations is not None:
+            self.invalidations.unsubscribe(subscriber)
 
     def stats(self, sub):
         """ stats command """
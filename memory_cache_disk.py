@@ -0,0 +1,290 @@
+"""
+Second storage tier on local disk, for the values of items pushed out
+of memory (like memcached's extstore).
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import errno
+import os
+
+import memory_cache_primitives
+
+class DiskCacheItem(memory_cache_primitives.CacheItem):
+    """
+    an item whose value has gone to disk, only the key, flags and 
+    where to find the value stay in memory
+    """
+    on_disk = True
+
+    # pylint: disable=W0231
+    def __init__(self, item, tier, segment, offset, length):
+        self.key = item.key
+        self.flags = item.flags
+        self.exptime = item.exptime
+        self.last_access = item.last_access
+        # a cas from before the move should still work
+        self.cas = item.casunique()
+        self.tier = tier
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+
+        self.prev = None
+        self.next = None
+    # pylint: enable=W0231
+
+    @property
+    def value(self):
+        """ read the value back """
+        return self.tier.read(self)
+
+    def casunique(self):
+        """ get the casunique value, the same as before the move """
+        return self.cas
+
+    def bytes(self):
+        """ byte count, of what's in memory """
+        return len(self.key) + len(self.flags)
+
+class Segment(object):
+    """ one append-only segment file, and the items with values in it """
+    def __init__(self, number, path):
+        self.number = number
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        self.size = 0
+        self.live_bytes = 0
+        self.items = set()
+
+    def write(self, value):
+        """ append a value, return its offset """
+        offset = self.size
+        value = memory_cache_primitives.to_bytes(value)
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        written = 0
+        while written < len(value):
+            written += os.write(self.fd, value[written:])
+        self.size += len(value)
+        return offset
+
+    def read(self, offset, length):
+        """ read a value back """
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        pieces = []
+        while length:
+            piece = os.read(self.fd, length)
+            if not piece:
+                raise IOError(errno.EIO, "segment truncated", self.path)
+            pieces.append(piece)
+            length -= len(piece)
+        return memory_cache_primitives.to_str(b"".join(pieces))
+
+    def reopen(self):
+        """ 
+        get a file offset of our own, for a forked child that 
+        would otherwise be moving its parent's around
+        """
+        self.fd = os.open(self.path, os.O_RDONLY)
+
+    def remove(self):
+        """ done with this segment """
+        os.close(self.fd)
+        os.unlink(self.path)
+
+class DiskTier(object):
+    """
+    values of items evicted from memory, in a ring of segment files
+
+    values are appended to the newest segment, when it fills a new 
+    one is started, and once there are max_segments the oldest has
+    to go: if no more than compact_ratio of it is in use the live
+    values are rescued into the new segment, otherwise its items are
+    evicted for good
+
+    rescues happen a few values at a time, each write rescues up to
+    rescue_factor times the bytes it wrote, so no one request pays 
+    for copying a whole segment, the rescued segment is still read
+    from until it's empty
+
+    values smaller than min_bytes aren't worth it, they're just 
+    evicted as usual
+    """
+    # pylint: disable=R0913
+    def __init__(self, stats, directory, max_bytes, 
+                 segment_bytes=64*1024*1024, min_bytes=512, 
+                 compact_ratio=0.5, rescue_factor=2):
+        self.stats = stats
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max(2, max_bytes // segment_bytes)
+        self.min_bytes = min_bytes
+        self.compact_ratio = compact_ratio
+        self.rescue_factor = rescue_factor
+
+        # called with each item evicted along with its segment
+        self.evict = None
+
+        self.segments = []
+        self.next_number = 0
+        self._new_segment()
+        # the retired segment being rescued, and its items left to go
+        self.rescuing = None
+        self.to_rescue = []
+    # pylint: enable=R0913
+
+    def _new_segment(self):
+        """ start writing to a new segment """
+        path = os.path.join(self.directory, 
+                            "segment.%d" % self.next_number)
+        self.segments.append(Segment(self.next_number, path))
+        self.next_number += 1
+
+    def wants(self, item):
+        """ is this item worth keeping on disk? """
+        return item.bytes() - len(item.key) - len(item.flags) >= self.min_bytes
+
+    def write(self, item):
+        """ write an item's value out, return the item to replace it with """
+        value = item.value
+        segment = self._segment_for(len(value))
+        disk_item = DiskCacheItem(item, self, segment, 
+                                  segment.write(value), len(value))
+        segment.items.add(disk_item)
+        segment.live_bytes += len(value)
+        self.stats.ext_write(len(value))
+        if self.rescuing is not None:
+            self._rescue(len(value) * self.rescue_factor)
+            self._trim()
+        return disk_item
+
+    def _segment_for(self, length, trim=True):
+        """ 
+        the segment to write length bytes to, starting a new one if 
+        it doesn't fit, and making room for it unless trim is false
+        """
+        segment = self.segments[-1]
+        while segment.size and segment.size + length > self.segment_bytes:
+            self._new_segment()
+            if trim:
+                # which can finish a rescue into the new segment, so 
+                # that one might not have room either
+                self._trim()
+                trim = False
+            segment = self.segments[-1]
+        return segment
+
+    def _trim(self):
+        """ retire the oldest segment if there are too many """
+        if len(self.segments) > self.max_segments:
+            self._retire(self.segments.pop(0))
+
+    def _retire(self, segment):
+        """ 
+        make the oldest segment go away, start rescuing its values if 
+        cheap
+        """
+        if self.rescuing is not None:
+            # the last one should be done by now, unless the writes 
+            # since were all tiny
+            self._rescue(None)
+        if segment.live_bytes <= segment.size * self.compact_ratio:
+            self.rescuing = segment
+            # in the order they were written, so the reads are sequential
+            self.to_rescue = sorted(segment.items, 
+                                    key=lambda item: item.offset, 
+                                    reverse=True)
+        else:
+            for item in list(segment.items):
+                self.evict(item)
+            segment.remove()
+
+    def _rescue(self, budget):
+        """ 
+        move about budget bytes of values from the segment being 
+        rescued into the newest one, all of them if budget is None,
+        and remove the rescued segment once it's empty
+        """
+        segment = self.rescuing
+        while self.to_rescue and (budget is None or budget > 0):
+            item = self.to_rescue.pop()
+            if item not in segment.items:
+                # deleted or replaced since
+                continue
+            value = segment.read(item.offset, item.length)
+            segment.items.discard(item)
+            # a rescue mustn't retire anything, that would be rescuing 
+            # from inside a rescue, the next write makes the room
+            current = self._segment_for(item.length, trim=False)
+            item.segment = current
+            item.offset = current.write(value)
+            current.items.add(item)
+            current.live_bytes += item.length
+            self.stats.ext_rescue()
+            if budget is not None:
+                budget -= item.length
+        if not self.to_rescue:
+            self.rescuing = None
+            segment.remove()
+
+    def read(self, item):
+        """ read an item's value back """
+        self.stats.ext_read()
+        return item.segment.read(item.offset, item.length)
+
+    def release(self, item):
+        """ an item on disk was deleted or replaced """
+        segment = item.segment
+        segment.items.discard(item)
+        segment.live_bytes -= item.length
+        self.stats.ext_del(item.length)
+
+    def items(self):
+        """ the items on disk, oldest first """
+        segments = self.segments
+        if self.rescuing is not None:
+            segments = [self.rescuing] + segments
+        for segment in segments:
+            for item in sorted(segment.items, key=lambda item: item.offset):
+                yield item
+
+    def reopen(self):
+        """ reopen the segments, for reading from a forked child """
+        for segment in self.segments:
+            segment.reopen()
+        if self.rescuing is not None:
+            self.rescuing.reopen()
+
+    def close(self):
+        """ remove all the segments """
+        while self.segments:
+            self.segments.pop().remove()
+        if self.rescuing is not None:
+            self.rescuing.remove()
+            self.rescuing = None
+            self.to_rescue = []
@@ -0,0 +1,81 @@
+"""
+Tell connections watching key prefixes when those keys change, so
+clients can keep near caches of them.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+
+INVALIDATE_ALL = "INVALIDATE_ALL\r\n"
+
+class Invalidations(object):
+    """
+    the connections watching for changes, and the key prefixes each 
+    one watches, memory_cache.Memcached calls stored, deleted, touched 
+    and flushed the same as it does an OperationLog
+
+    a subscriber is anything with a push(line) method, it gets an 
+    INVALIDATE <key> line for every change to a key it watches, and 
+    INVALIDATE_ALL for a flush_all
+    """
+    def __init__(self):
+        self.subscribers = {}
+
+    def subscribe(self, subscriber, prefixes):
+        """ watch keys starting with any of prefixes, or every key if none """
+        self.subscribers[subscriber] = tuple(prefixes) or ("",)
+
+    def unsubscribe(self, subscriber):
+        """ stop watching """
+        self.subscribers.pop(subscriber, None)
+
+    def _changed(self, key):
+        """ tell everyone watching key """
+        line = None
+        for subscriber, prefixes in self.subscribers.items():
+            if key.startswith(prefixes):
+                if line is None:
+                    line = "INVALIDATE %s\r\n" % key
+                subscriber.push(line)
+
+    def stored(self, item):
+        """ an item was set to what it is now """
+        self._changed(item.key)
+
+    def deleted(self, key):
+        """ a key was deleted """
+        self._changed(key)
+
+    def touched(self, item):
+        """ an item got a new exptime """
+        self._changed(item.key)
+
+    def flushed(self, _):
+        """ everything in the cache is going """
+        for subscriber in self.subscribers.keys():
+            subscriber.push(INVALIDATE_ALL)
@@ -0,0 +1,153 @@
+"""
+Leases against thundering herds: the first miss on a key gets a token
+to refill it, the rest get the stale value or are told to wait.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import collections
+import functools
+import itertools
+
+# what a lease get found for a key
+HIT = 0
+LEASED = 1
+STALE = 2
+WAIT = 3
+
+class Leases(object):
+    """
+    the outstanding leases, and the values of items that expired in 
+    the last stale_seconds
+
+    a lease get that misses hands out a token, good for lease_seconds,
+    and only a lease set with that token stores the new value, so a 
+    miss only goes to the backend once per key however many clients 
+    miss at the same moment, the others get the stale value if there
+    is one, or are told to wait and retry
+
+    memory_cache.Memcached calls stored, deleted, touched and flushed
+    the same as it does an OperationLog, any change to a key cancels 
+    its lease and drops its stale value, so a lease set can't put
+    back something older than what is there now
+
+    leases are kept in the order they were made, so the ones that 
+    run out are always at the front, stale values in the order their
+    items were found expired, which isn't the order they run out in, 
+    so miss checks each one's deadline as well, at most max_stale 
+    stale values
+    """
+    def __init__(self, lease_seconds, stale_seconds, max_stale=10000):
+        self.lease_seconds = lease_seconds
+        self.stale_seconds = stale_seconds
+        self.max_stale = max_stale
+        # key: (token, good until)
+        self.tokens = collections.OrderedDict()
+        # key: (value, flags, good until)
+        self.stale = collections.OrderedDict()
+        self.next_token = functools.partial(next, itertools.count(1))
+        # what flush_all set every exptime to, those aren't stale
+        self.flush_exptime = None
+
+    def _prune(self, now):
+        """ 
+        forget the leases and stale values at the front that have run 
+        out, stale values behind one that hasn't may have too
+        """
+        for entries, until in ((self.tokens, 1), (self.stale, 2)):
+            while entries:
+                key = next(iter(entries))
+                entry = entries[key]
+                if entry[until] > now:
+                    break
+                del entries[key]
+
+    def expired(self, item, now):
+        """ an item expired, keep its value for a while """
+        if (item.exptime + self.stale_seconds > now and 
+            item.exptime != self.flush_exptime):
+            self.stale.pop(item.key, None)
+            self.stale[item.key] = (item.value, item.flags, 
+                                    item.exptime + self.stale_seconds)
+            if len(self.stale) > self.max_stale:
+                self.stale.popitem(last=False)
+
+    def miss(self, key, now):
+        """ 
+        a lease get missed, return (LEASED, token, stale value or None),
+        or (STALE, None, stale value) or (WAIT, None, None) if someone 
+        already has the lease, a stale value is a (value, flags) pair
+        """
+        self._prune(now)
+        stale = self.stale.get(key)
+        if stale is not None:
+            if stale[2] > now:
+                stale = stale[:2]
+            else:
+                del self.stale[key]
+                stale = None
+        if key not in self.tokens:
+            token = self.next_token()
+            self.tokens[key] = (token, now + self.lease_seconds)
+            return LEASED, token, stale
+        elif stale is not None:
+            return STALE, None, stale
+        else:
+            return WAIT, None, None
+
+    def redeem(self, key, token, now):
+        """ is token the lease on key? if it is, it's used up """
+        self._prune(now)
+        lease = self.tokens.get(key)
+        if lease is None or lease[0] != token:
+            return False
+        del self.tokens[key]
+        return True
+
+    def _changed(self, key):
+        """ key changed, the lease and the stale value are out of date """
+        self.tokens.pop(key, None)
+        self.stale.pop(key, None)
+
+    def stored(self, item):
+        """ an item was set to what it is now """
+        self._changed(item.key)
+
+    def deleted(self, key):
+        """ a key was deleted """
+        self._changed(key)
+
+    def touched(self, item):
+        """ an item got a new exptime """
+        self._changed(item.key)
+
+    def flushed(self, exptime):
+        """ everything in the cache is going """
+        self.flush_exptime = exptime
+        self.tokens.clear()
+        self.stale.clear()
@@ -0,0 +1,194 @@
+"""
+Read-through for misses: a get that misses fetches the key from a backend,
+and concurrent misses on the same key share a single fetch.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import collections
+import threading
+
+try:
+    import Queue as queue
+    from urllib import quote
+    from urllib2 import HTTPError, urlopen
+except ImportError: # pragma: no cover
+    import queue
+    from urllib.error import HTTPError
+    from urllib.parse import quote
+    from urllib.request import urlopen
+
+import memcache_logging as mc_log
+
+class Loader(object):
+    """
+    the keys being fetched from the backend, and who is waiting for 
+    each
+
+    fetch(key, done) starts getting key from the backend, and calls 
+    done(value, flags) with what it got, or done(None) if the backend
+    doesn't have it, on the thread that runs the cache, either before
+    it returns or later, so a slow backend doesn't hold up the event
+    loop, see ThreadedFetch
+
+    memory_cache.Memcached calls stored, deleted, touched and flushed
+    the same as it does an OperationLog, a key that changes while it 
+    is being fetched keeps the change, what the backend sends is 
+    thrown away
+
+    store(key, flags, exptime, value) puts what was fetched in the 
+    cache with exptime, memory_cache.Memcached sets it
+    """
+    def __init__(self, fetch, exptime=0):
+        self.fetch = fetch
+        self.exptime = exptime
+        self.store = None
+        # key: [callback]
+        self.loading = {}
+        # the keys that changed while they were being fetched
+        self.changed = set()
+
+    def load(self, key, callback):
+        """ 
+        fetch key if nobody is already, callback() once it's stored, 
+        return True if this started a fetch, False if it joined one
+        """
+        waiting = self.loading.get(key)
+        if waiting is not None:
+            waiting.append(callback)
+            return False
+        self.loading[key] = [callback]
+        self.fetch(key, lambda value, flags="0": 
+                   self._fetched(key, value, flags))
+        return True
+
+    def _fetched(self, key, value, flags):
+        """ the backend answered, store it unless the key changed """
+        waiting = self.loading.pop(key)
+        if key in self.changed:
+            self.changed.discard(key)
+        else:
+            self.store(key, flags, self.exptime, value)
+        for callback in waiting:
+            callback()
+
+    def stored(self, item):
+        """ an item was set to what it is now """
+        if item.key in self.loading:
+            self.changed.add(item.key)
+
+    def deleted(self, key):
+        """ a key was deleted """
+        if key in self.loading:
+            self.changed.add(key)
+
+    def touched(self, item):
+        """ an item got a new exptime """
+        self.stored(item)
+
+    def flushed(self, _):
+        """ everything in the cache is going """
+        self.changed.update(self.loading)
+
+class ThreadedFetch(object):
+    """
+    a fetch for Loader that runs a blocking get(key), returning 
+    (value, flags) or None, on a pool of threads
+
+    the threads queue up what they got and call wake(deliver), which 
+    has to get deliver() called on the thread that runs the cache, 
+    asyncio's loop.call_soon_threadsafe does just that
+    """
+    def __init__(self, get, wake, threads=4):
+        self.get = get
+        self.wake = wake
+        self.logger = mc_log.MemcachedLogger(("loader", 0))
+        self.requests = queue.Queue()
+        self.results = collections.deque()
+        self.threads = [threading.Thread(target=self._work, name="loader")
+                        for _ in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def __call__(self, key, done):
+        """ start fetching key """
+        self.requests.put((key, done))
+
+    def _work(self):
+        """ a thread, fetch until None comes off the queue """
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            key, done = request
+            try:
+                result = self.get(key)
+            except Exception: # pylint: disable=W0703
+                self.logger.log_v("fetching %s failed", key, exc_info=True)
+                result = None
+            self.results.append((done, result))
+            self.wake(self.deliver)
+
+    def deliver(self):
+        """ hand what's been fetched to the cache """
+        results = self.results
+        while results:
+            done, result = results.popleft()
+            if result is None:
+                done(None)
+            else:
+                done(*result)
+
+    def close(self):
+        """ stop the threads, once they finish what they're fetching """
+        for _ in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+
+def http_get(url, timeout=5):
+    """ 
+    a get for ThreadedFetch from a web server, GET url with the 
+    quoted key on the end, anything but a 200 is a miss
+    """
+    def get(key):
+        """ GET the key """
+        try:
+            response = urlopen(url + quote(key, safe=""), timeout=timeout)
+        except HTTPError:
+            return None
+        try:
+            value = response.read()
+        finally:
+            response.close()
+        if not isinstance(value, str): # pragma: no cover
+            # python 3, the cache holds latin-1 strs like the protocol
+            value = value.decode('latin-1')
+        return value, "0"
+    return get
@@ -0,0 +1,246 @@
+"""
+Log changes to the cache as they happen, so a crash only loses the last
+few of them rather than everything since the last snapshot.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import errno
+import mmap
+import os
+import struct
+import threading
+
+import memory_cache_primitives
+
+MAGIC = "JMCOPLG1"
+
+SET = 0
+DELETE = 1
+TOUCH = 2
+FLUSH = 3
+
+# op, exptime, key length, flags length, value length, then the key, 
+# flags and value themselves, unused fields are empty
+RECORD = struct.Struct("!BqHBI")
+
+class OperationLog(object):
+    """
+    append-only log of the changes made through memory_cache.Memcached
+
+    records are the state each change left behind rather than the 
+    command that made it, so replaying one twice does no harm
+
+    records are buffered in memory and a background thread writes 
+    and fsyncs them every fsync_interval seconds, a crash loses at 
+    most that much
+    """
+    def __init__(self, path, fsync_interval=1.0, compact_bytes=64*1024*1024):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.compact_bytes = compact_bytes
+        # bytes logged since the last rotate
+        self.size = 0
+
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.log_file = self._open()
+
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, 
+                                       name="oplog fsync")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _open(self):
+        """ 
+        open the log for appending, starting it if it's new, at once
+        so a server taking over from us doesn't start it again
+        """
+        log_file = open(self.path, "ab")
+        log_file.seek(0, os.SEEK_END)
+        if not log_file.tell():
+            log_file.write(memory_cache_primitives.to_bytes(MAGIC))
+            log_file.flush()
+        return log_file
+
+    def _append(self, op, exptime, key, flags, value):
+        """ buffer up a record """
+        record = (RECORD.pack(op, exptime, len(key), len(flags), len(value)) +
+                  memory_cache_primitives.to_bytes(key + flags + value))
+        with self.pending_lock:
+            self.pending.append(record)
+        self.size += len(record)
+
+    def stored(self, item):
+        """ an item was set to what it is now """
+        self._append(SET, item.exptime, item.key, item.flags, item.value)
+
+    def deleted(self, key):
+        """ a key was deleted """
+        self._append(DELETE, 0, key, "", "")
+
+    def touched(self, item):
+        """ an item got a new exptime """
+        self._append(TOUCH, item.exptime, item.key, "", "")
+
+    def flushed(self, exptime):
+        """ everything in the cache expires at exptime """
+        self._append(FLUSH, exptime, "", "", "")
+
+    def _write(self):
+        """ write out and fsync whatever is buffered """
+        with self.file_lock:
+            with self.pending_lock:
+                pending, self.pending = self.pending, []
+            if pending:
+                self.log_file.write(b"".join(pending))
+                self.log_file.flush()
+                os.fsync(self.log_file.fileno())
+
+    def _run(self):
+        """ the background thread """
+        while not self.stopping.wait(self.fsync_interval):
+            self._write()
+
+    def rotate(self):
+        """
+        move the log aside to path.1, and start a new one, so a 
+        snapshot can be taken of everything logged so far
+
+        return the old log's path, to be removed once the snapshot 
+        is safely written
+        """
+        old_path = self.path + ".1"
+        with self.file_lock:
+            with self.pending_lock:
+                pending, self.pending = self.pending, []
+            self.log_file.write(b"".join(pending))
+            self.log_file.flush()
+            os.fsync(self.log_file.fileno())
+            self.log_file.close()
+            if os.path.exists(old_path):
+                # the last snapshot failed, so keep what it would have
+                # replaced
+                _append_log(self.path, old_path)
+                os.unlink(self.path)
+            else:
+                os.rename(self.path, old_path)
+            self.log_file = self._open()
+            self.size = 0
+        return old_path
+
+    def close(self):
+        """ write out anything buffered and stop the thread """
+        self.stopping.set()
+        self.thread.join()
+        self._write()
+        self.log_file.close()
+
+def _append_log(path, to_path):
+    """ add the records in the log at path to the log at to_path """
+    with open(path, "rb") as log_file:
+        log_file.seek(len(MAGIC))
+        with open(to_path, "ab") as to_file:
+            while True:
+                data = log_file.read(1024*1024)
+                if not data:
+                    break
+                to_file.write(data)
+            to_file.flush()
+            os.fsync(to_file.fileno())
+
+def _records(log):
+    """ yield (op, exptime, key, flags, value) for each record in a mapped log """
+    to_str = memory_cache_primitives.to_str
+    if to_str(log[:len(MAGIC)]) != MAGIC:
+        raise ValueError("not an operation log")
+    unpack_from = RECORD.unpack_from
+    header_size = RECORD.size
+    end = len(log)
+    offset = len(MAGIC)
+    while offset + header_size <= end:
+        op, exptime, key_len, flags_len, value_len = unpack_from(log, offset)
+        start = offset + header_size
+        flags_end = start + key_len + flags_len
+        value_end = flags_end + value_len
+        if value_end > end:
+            break
+        yield (op, exptime, to_str(log[start:start+key_len]), 
+               to_str(log[start+key_len:flags_end]), 
+               to_str(log[flags_end:value_end]))
+        offset = value_end
+    # anything left over is a record cut short by a crash, and 
+    # everything before it is good
+
+def replay(cache, path):
+    """
+    apply the records in the log at path to a MemoryCache, return 
+    how many there were, None if there was no log
+    """
+    try:
+        log_file = open(path, "rb")
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            return None
+        raise
+    with log_file:
+        if os.fstat(log_file.fileno()).st_size < len(MAGIC):
+            # crashed before the header got written
+            return 0
+        log = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _replay(cache, _records(log))
+        finally:
+            log.close()
+
+def _replay(cache, records):
+    """ apply records to a MemoryCache """
+    now = memory_cache_primitives.int_time()
+    count = 0
+    for op, exptime, key, flags, value in records:
+        count += 1
+        if op == FLUSH:
+            cache.flush(exptime - now)
+            continue
+        item = cache.get(key)
+        if op == SET:
+            if item is not None:
+                cache.delete(item)
+            if exptime <= 0 or exptime > now:
+                cache.add(key, value, flags, exptime)
+        elif op == DELETE:
+            if item is not None:
+                cache.delete(item)
+        elif op == TOUCH:
+            if item is not None:
+                item.set_exptime(exptime)
+        else:
+            raise ValueError("bad operation log record")
+    return count
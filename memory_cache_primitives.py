@@ -38,7 +38,30 @@ def unique_hash(item):
     
     not sure how unique this really is...
     """
-    return zlib.crc32(str(id(item))) & 0xffffffff
+    return zlib.crc32(str(id(item)).encode("ascii")) & 0xffffffff
+
+if bytes is str:
+    INTEGER_TYPES = (int, long)
+
+    def to_str(data):
+        """ bytes read from a socket or file as a str """
+        return data
+
+    def to_bytes(buf):
+        """ a str as bytes to write to a socket or file """
+        return buf
+else: # pragma: no cover
+    # python 3, keys and values are strs, latin-1 maps each byte to a 
+    # character and back again
+    INTEGER_TYPES = (int,)
+
+    def to_str(data):
+        """ bytes read from a socket or file as a str """
+        return data.decode('latin-1')
+
+    def to_bytes(buf):
+        """ a str as bytes to write to a socket or file """
+        return buf.encode('latin-1')
 
 def int_time():
     """ time seconds as an integer """
@@ -50,11 +73,15 @@ class CacheItem(object):
     """
     TIME_CUTOFF = 60*60*24*30 # this means things get weird in Jan. 1970
 
+    # see memory_cache_disk.DiskCacheItem
+    on_disk = False
+
     def __init__(self, key, value, flags, exptime):
         self.key = key
         self.value = value
         self.flags = flags
         self.exptime = self.prep_exptime(exptime)
+        self.last_access = int_time()
 
         self.prev = None
         self.next = None
@@ -77,14 +104,45 @@ class CacheItem(object):
         """ get the casunique value """
         return unique_hash(self)
 
-    def has_expired(self):
+    def has_expired(self, now=None):
         """ has this item gone past its expire time? """
-        return self.exptime > 0 and self.exptime <= int_time()
+        if now is None:
+            now = int_time()
+        return self.exptime > 0 and self.exptime <= now
 
     def bytes(self):
         """ byte count """
         return len(self.key) + len(self.value) + len(self.flags)
 
+class ChunkedCacheItem(CacheItem):
+    """
+    a cache item whose value is held as a list of fixed-size chunks
+
+    keeps large values from needing one big contiguous string
+    while they sit in the cache
+    """
+    def __init__(self, key, value, flags, exptime, chunk_size):
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.length = 0
+        super(ChunkedCacheItem, self).__init__(key, value, flags, exptime)
+
+    def _get_value(self):
+        """ put the chunks back together """
+        return "".join(self.chunks)
+
+    def _set_value(self, value):
+        """ split the value up into chunks """
+        self.chunks = [value[i:i+self.chunk_size]
+                       for i in range(0, len(value), self.chunk_size)]
+        self.length = len(value)
+
+    value = property(_get_value, _set_value)
+
+    def bytes(self):
+        """ byte count """
+        return len(self.key) + self.length + len(self.flags)
+
 class LRU(object):
     """
     least recently used list
@@ -141,6 +199,11 @@ class MemoryCacheStats(object):
         self.bytes = 0
         self.evictions = 0
         self.reclaimed = 0
+        self.ext_items = 0
+        self.ext_bytes = 0
+        self.ext_writes = 0
+        self.ext_reads = 0
+        self.ext_rescues = 0
 
     def set_maximums(self, max_items, max_bytes):
         """ maximums were set """
@@ -166,6 +229,25 @@ class MemoryCacheStats(object):
         """ item expired """
         self.reclaimed += 1
 
+    def ext_write(self, add_bytes):
+        """ value written to disk """
+        self.ext_items += 1
+        self.ext_bytes += add_bytes
+        self.ext_writes += 1
+
+    def ext_del(self, del_bytes):
+        """ value on disk no longer wanted """
+        self.ext_items -= 1
+        self.ext_bytes -= del_bytes
+
+    def ext_read(self):
+        """ value read from disk """
+        self.ext_reads += 1
+
+    def ext_rescue(self):
+        """ value moved out of a segment that was going away """
+        self.ext_rescues += 1
+
     def dump(self, _):
         """ dump the statistics """
         ret = [('limit_maxbytes', self.limit_maxbytes),
@@ -174,14 +256,20 @@ class MemoryCacheStats(object):
                ('total_items', self.total_items),
                ('bytes', self.bytes),
                ('evictions', self.evictions),
-               ('reclaimed', self.reclaimed)]
+               ('reclaimed', self.reclaimed),
+               ('ext_items', self.ext_items),
+               ('ext_bytes', self.ext_bytes),
+               ('ext_writes', self.ext_writes),
+               ('ext_reads', self.ext_reads),
+               ('ext_rescues', self.ext_rescues)]
         return ret
 
 class MemoryCache(object):
     """
     the basic elements needed to create memcached commands
     """
-    def __init__(self, stats, max_items, max_bytes):
+    # pylint: disable=R0913
+    def __init__(self, stats, max_items, max_bytes, chunk_size=0, disk=None):
         self.stats = stats
         self.stats.set_maximums(max_items, max_bytes)
 
@@ -194,39 +282,96 @@ class MemoryCache(object):
         self.item_count = 0
         self.max_items = max_items
 
+        self.chunk_size = chunk_size
+
+        # memory_cache_disk.DiskTier for values pushed out of memory
+        self.disk = disk
+        if disk is not None:
+            disk.evict = self._evict_from_disk
+
+        # called with each item that expires, and the time, if set
+        self.on_expire = None
+    # pylint: enable=R0913
+
     def _evict(self, added_bytes=0, added_items=1):
-        """ evict if too many items or too many bytes """
+        """ 
+        evict if too many items or too many bytes, values big enough 
+        to be worth it go to disk instead if there is a disk tier
+        """
         while self.byte_count + added_bytes > self.max_bytes:
-            self.delete(self.lru.least())
-            self.stats.evict()
+            item = self.lru.least()
+            if self.disk is not None and self.disk.wants(item):
+                self._remove(item)
+                self.the_cache[item.key] = self.disk.write(item)
+            else:
+                self.delete(item)
+                self.stats.evict()
 
         while self.item_count + added_items > self.max_items:
             self.delete(self.lru.least())
             self.stats.evict()
 
+    def _evict_from_disk(self, item):
+        """ the disk tier needs the space item's value is in """
+        self.delete(item)
+        self.stats.evict()
+
     def _remove(self, item):
         """ remove an item from the cache """
+        if item.on_disk:
+            self.disk.release(item)
+            return
         byte_count = item.bytes()
         self.byte_count -= byte_count
         self.item_count -= 1
         self.lru.remove(item)
         self.stats.del_item(byte_count)
 
+    def _expire(self, item, now):
+        """ delete an item that has expired, on_expire sees it first """
+        if self.on_expire is not None:
+            self.on_expire(item, now)
+        self.delete(item)
+        self.stats.expire()
+
     def get(self, key):
         """ get an item from the cache """
         if key in self.the_cache:
-            if self.the_cache[key].has_expired():
-                self.delete(self.the_cache[key])
-                self.stats.expire()
+            now = int_time()
+            if self.the_cache[key].has_expired(now):
+                self._expire(self.the_cache[key], now)
             else:
                 return self.the_cache[key]
         return None
 
+    def get_multi(self, keys):
+        """ 
+        get several items from the cache, yielding (key, item) pairs
+        with None for the misses
+
+        the clock is only read once for the whole batch
+        """
+        now = int_time()
+        the_cache = self.the_cache
+        for key in keys:
+            item = the_cache.get(key)
+            if item is not None:
+                if item.has_expired(now):
+                    self._expire(item, now)
+                    item = None
+                else:
+                    item.last_access = now
+            yield key, item
+
     def add(self, key, value, flags, exptime):
         """ add an item to the cache """
         self._evict(len(value))
 
-        new_item = CacheItem(key, value, flags, exptime)
+        if self.chunk_size and len(value) > self.chunk_size:
+            new_item = ChunkedCacheItem(key, value, flags, exptime, 
+                                        self.chunk_size)
+        else:
+            new_item = CacheItem(key, value, flags, exptime)
         new_bytes = new_item.bytes()
         self.the_cache[key] = new_item
         self.byte_count += new_bytes
@@ -247,11 +392,45 @@ class MemoryCache(object):
         self._remove(old_item)
         return self.add(key, value, flags, exptime)
 
+    def set_multi(self, items):
+        """ add or replace several (key, value, flags, exptime) items """
+        added = []
+        for key, value, flags, exptime in items:
+            old_item = self.the_cache.get(key)
+            if old_item is not None:
+                self._remove(old_item)
+            added.append(self.add(key, value, flags, exptime))
+        return added
+
     def delete(self, item):
         """ delete an item from the cache """
         self._remove(item)
         del self.the_cache[item.key]
 
+    def delete_multi(self, keys):
+        """ delete several items, return the keys that were there """
+        deleted = []
+        for key, item in self.get_multi(keys):
+            if item is not None:
+                self.delete(item)
+                deleted.append(key)
+        return deleted
+
+    def expire_multi(self, keys):
+        """ 
+        delete the items among keys that have expired, return how many,
+        without counting as an access to the rest
+        """
+        now = int_time()
+        the_cache = self.the_cache
+        expired = 0
+        for key in keys:
+            item = the_cache.get(key)
+            if item is not None and item.has_expired(now):
+                self._expire(item, now)
+                expired += 1
+        return expired
+
     def flush(self, delay):
         """ expire all the items in the cache """
         exp_time = int_time() + int(delay)
@@ -260,4 +439,15 @@ class MemoryCache(object):
 
     def touch(self, item):
         """ note item access """
-        self.lru.reset(item)
+        if not item.on_disk:
+            self.lru.reset(item)
+
+    def touch_multi(self, keys, exptime):
+        """ give several items a new exptime, return the keys that were there """
+        touched = []
+        for key, item in self.get_multi(keys):
+            if item is not None:
+                item.set_exptime(exptime)
+                self.touch(item)
+                touched.append(key)
+        return touched
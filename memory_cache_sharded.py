@@ -0,0 +1,349 @@
+"""
+A memcached engine split into shards by key, each with its own lock,
+LRU and memory budget, so several threads can use it at once.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import threading
+import time
+import zlib
+
+import memory_cache
+import memory_cache_primitives
+
+class Shard(object): # pylint: disable=R0903
+    """ one engine and the lock that guards it """
+    # pylint: disable=R0913
+    def __init__(self, max_items, max_bytes, item_size_max, chunk_size,
+                 lease_seconds=memory_cache.DEFAULT_LEASE_SECONDS, 
+                 stale_seconds=0):
+        self.stats = memory_cache.MemcachedStats()
+        self.engine = memory_cache.Memcached(
+            self.stats, max_items=max_items, max_bytes=max_bytes,
+            item_size_max=item_size_max, chunk_size=chunk_size,
+            lease_seconds=lease_seconds, stale_seconds=stale_seconds)
+        self.lock = threading.Lock()
+        # evictions as of the last rebalance
+        self.evictions = 0
+    # pylint: enable=R0913
+
+    def set_max_bytes(self, max_bytes):
+        """ give the shard a new budget, it must hold what's there """
+        with self.lock:
+            cache = self.engine.cache
+            cache.max_bytes = max_bytes
+            self.stats.set_maximums(cache.max_items, max_bytes)
+
+def _on_shard(method):
+    """ run a single key Memcached command on the key's shard """
+    def on_shard(self, key, *args):
+        """ method on key's shard, holding its lock """
+        shard = self.shard(key)
+        with shard.lock:
+            ret = method(shard.engine, key, *args)
+        self._pressure(shard)
+        return ret
+    on_shard.__name__ = method.__name__
+    on_shard.__doc__ = method.__doc__
+    return on_shard
+
+class ShardedMemcached(object):
+    """
+    the same commands as memory_cache.Memcached, spread over shards 
+    independent Memcached engines by a hash of the key, each command 
+    holding only its key's shard's lock, so threads working different 
+    keys mostly don't wait on each other
+
+    multi key commands take each shard's lock in turn, so they're 
+    atomic per shard, not across the whole batch
+
+    max_items and max_bytes are split evenly, rebalance() moves the 
+    byte budget over to the shards that are evicting, it runs when a 
+    command finds its shard has evicted, at most every 
+    REBALANCE_SECONDS
+
+    the oplog, replication, snapshot and read-through loader features
+    work on a single Memcached, they aren't available here
+    """
+    DELETED = memory_cache.Memcached.DELETED
+    EXISTS = memory_cache.Memcached.EXISTS
+    NOT_FOUND = memory_cache.Memcached.NOT_FOUND
+    NOT_NUMBER = memory_cache.Memcached.NOT_NUMBER
+    NOT_STORED = memory_cache.Memcached.NOT_STORED
+    STORED = memory_cache.Memcached.STORED
+    TOUCHED = memory_cache.Memcached.TOUCHED
+    TOO_LARGE = memory_cache.Memcached.TOO_LARGE
+
+    # no read-through loader, see the above
+    loader = None
+
+    DEFAULT_SHARDS = 16
+    REBALANCE_SECONDS = 1.0
+
+    # pylint: disable=R0913
+    def __init__(self, stats, shards=DEFAULT_SHARDS, 
+                 max_items=memory_cache.DEFAULT_MAX_ITEMS, 
+                 max_bytes=memory_cache.DEFAULT_MAX_BYTES, 
+                 item_size_max=memory_cache.DEFAULT_ITEM_SIZE_MAX, 
+                 chunk_size=0, lease_seconds=memory_cache.DEFAULT_LEASE_SECONDS,
+                 stale_seconds=0):
+        self._stats = stats
+        self.item_size_max = item_size_max
+        self.max_bytes = max_bytes
+        stats.set_maximums(max_items, max_bytes)
+        # the defaults mean no limit, keep them that way
+        if max_items != memory_cache.DEFAULT_MAX_ITEMS:
+            max_items //= shards
+        if max_bytes != memory_cache.DEFAULT_MAX_BYTES:
+            max_bytes //= shards
+        self.shards = [Shard(max_items, max_bytes, item_size_max, chunk_size,
+                             lease_seconds, stale_seconds)
+                       for _ in range(shards)]
+        self.lock = threading.Lock()
+        self.rebalanced = time.time()
+    # pylint: enable=R0913
+
+    def shard(self, key):
+        """ the shard key lives in """
+        crc = zlib.crc32(memory_cache_primitives.to_bytes(key))
+        return self.shards[crc % len(self.shards)]
+
+    def _grouped(self, keys):
+        """ (shard, [index into keys]) for each shard keys fall in """
+        groups = {}
+        for index, key in enumerate(keys):
+            groups.setdefault(self.shard(key), []).append(index)
+        return groups.items()
+
+    set = _on_shard(memory_cache.Memcached.set)
+    cas = _on_shard(memory_cache.Memcached.cas)
+    add = _on_shard(memory_cache.Memcached.add)
+    replace = _on_shard(memory_cache.Memcached.replace)
+    prepend = _on_shard(memory_cache.Memcached.prepend)
+    append = _on_shard(memory_cache.Memcached.append)
+    increment = _on_shard(memory_cache.Memcached.increment)
+    decrement = _on_shard(memory_cache.Memcached.decrement)
+    delete = _on_shard(memory_cache.Memcached.delete)
+    lease_set = _on_shard(memory_cache.Memcached.lease_set)
+
+    def get(self, keys):
+        """ get command """
+        return list(self.get_multi(keys))
+
+    def _found(self, keys, multi):
+        """ {key: hit} for the keys found, multi picks get or gets """
+        found = {}
+        for shard, indexes in self._grouped(keys):
+            with shard.lock:
+                for hit in multi(shard.engine, [keys[i] for i in indexes]):
+                    found[hit[0]] = hit
+        return found
+
+    def get_multi(self, keys):
+        """ 
+        get several keys, yielding (key, value, flags) for the hits 
+        in the order asked for
+        """
+        found = self._found(keys, memory_cache.Memcached.get_multi)
+        return (found[key] for key in keys if key in found)
+
+    def gets(self, keys):
+        """ gets command """
+        return list(self.gets_multi(keys))
+
+    def gets_multi(self, keys):
+        """ 
+        get several keys, yielding (key, value, flags, casunique) 
+        for the hits in the order asked for
+        """
+        found = self._found(keys, memory_cache.Memcached.gets_multi)
+        return (found[key] for key in keys if key in found)
+
+    def lease_get_multi(self, keys):
+        """ 
+        see Memcached.lease_get_multi, each shard hands out its own 
+        leases
+        """
+        return iter(self._multi(keys, lambda engine, indexes: list(
+            engine.lease_get_multi([keys[i] for i in indexes]))))
+
+    def _multi(self, keys, command):
+        """ 
+        run command(engine, indexes) on each shard, it returns one 
+        result per index, put them back in the order of keys
+        """
+        results = [None] * len(keys)
+        for shard, indexes in self._grouped(keys):
+            with shard.lock:
+                for index, result in zip(indexes, 
+                                         command(shard.engine, indexes)):
+                    results[index] = result
+            self._pressure(shard)
+        return results
+
+    def _pressure(self, shard):
+        """ 
+        shard ran a command, rebalance if it evicted since the last 
+        time and that was long enough ago
+        """
+        if shard.stats.evictions != shard.evictions:
+            now = time.time()
+            if now >= self.rebalanced + self.REBALANCE_SECONDS:
+                self.rebalanced = now
+                self.rebalance()
+
+    def set_multi(self, items):
+        """ 
+        set several (key, flags, exptime, value) items, return 
+        (key, result) pairs 
+        """
+        return self._multi([item[0] for item in items],
+                           lambda engine, indexes: engine.set_multi(
+                               [items[i] for i in indexes]))
+
+    def delete_multi(self, keys):
+        """ delete several keys, return (key, result) pairs """
+        return self._multi(keys, lambda engine, indexes: engine.delete_multi(
+            [keys[i] for i in indexes]))
+
+    def touch_multi(self, keys, exptime):
+        """ give several keys a new exptime, return (key, result) pairs """
+        return self._multi(keys, lambda engine, indexes: engine.touch_multi(
+            [keys[i] for i in indexes], exptime))
+
+    def metadump(self, prefix=""):
+        """ 
+        Memcached.metadump of each shard in turn, its lock held for 
+        a batch at a time
+        """
+        for shard in self.shards:
+            dump = shard.engine.metadump(prefix)
+            while True:
+                with shard.lock:
+                    entry = next(dump, False)
+                if entry is False:
+                    break
+                yield entry
+            yield None
+
+    def flush(self, delay):
+        """ flush command """
+        for shard in self.shards:
+            with shard.lock:
+                shard.engine.flush(delay)
+
+    def watch(self, subscriber, prefixes):
+        """ see Memcached.watch, subscriber hears from every shard """
+        for shard in self.shards:
+            with shard.lock:
+                shard.engine.watch(subscriber, prefixes)
+
+    def unwatch(self, subscriber):
+        """ stop pushing invalidations to subscriber """
+        for shard in self.shards:
+            with shard.lock:
+                shard.engine.unwatch(subscriber)
+
+    def item_count(self):
+        """ items across all the shards """
+        return sum(shard.engine.cache.item_count for shard in self.shards)
+
+    def keys(self):
+        """ a copy of the keys in all the shards """
+        keys = []
+        for shard in self.shards:
+            with shard.lock:
+                keys.extend(shard.engine.cache.the_cache.keys())
+        return keys
+
+    def expire_multi(self, keys):
+        """ 
+        delete the expired items among keys, a shard at a time, 
+        return how many went
+        """
+        count = 0
+        for shard, indexes in self._grouped(keys):
+            with shard.lock:
+                count += shard.engine.cache.expire_multi(
+                    [keys[i] for i in indexes])
+        return count
+
+    def rebalance(self, step=None):
+        """
+        move step bytes of budget (an eighth of an even share by 
+        default) to each shard that evicted since the last rebalance, 
+        from whichever shard has the most unused budget, never taking 
+        a shard below half an even share, return how many moved
+
+        commands call it when their shard evicts, see _pressure
+        """
+        if self.max_bytes == memory_cache.DEFAULT_MAX_BYTES:
+            return 0
+        share = self.max_bytes // len(self.shards)
+        if step is None:
+            step = max(share // 8, 1)
+        with self.lock:
+            evicting = []
+            for shard in self.shards:
+                evictions = shard.stats.evictions
+                if evictions > shard.evictions:
+                    evicting.append((evictions - shard.evictions, shard))
+                shard.evictions = evictions
+            moved = 0
+            for _, shard in sorted(evicting, reverse=True, 
+                                   key=lambda pressure: pressure[0]):
+                donors = [(other.engine.cache.max_bytes - 
+                           other.engine.cache.byte_count, other)
+                          for other in self.shards
+                          if other is not shard and 
+                          other.engine.cache.max_bytes - step >= share // 2]
+                if not donors:
+                    break
+                free, donor = max(donors, key=lambda donor: donor[0])
+                if free < step:
+                    break
+                donor.set_max_bytes(donor.engine.cache.max_bytes - step)
+                shard.set_max_bytes(shard.engine.cache.max_bytes + step)
+                moved += 1
+            return moved
+
+    def stats(self, sub):
+        """ 
+        stats command, the engine's counters summed over the shards, 
+        the limits and anything else, like connection counts, from 
+        stats
+        """
+        totals = {}
+        for shard in self.shards:
+            with shard.lock:
+                for name, value in shard.stats.dump(sub):
+                    if not name.startswith("limit_"):
+                        totals[name] = totals.get(name, 0) + value
+        return [(name, totals.get(name, value)) 
+                for name, value in self._stats.dump(sub)]
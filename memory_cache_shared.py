@@ -0,0 +1,706 @@
+"""
+A memcached engine kept in shared memory, so forked worker processes
+all serve the same items.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import bisect
+import collections
+import mmap
+import multiprocessing
+import struct
+import zlib
+
+import memory_cache
+import memory_cache_invalidation
+import memory_cache_primitives
+
+try:
+    xrange
+except NameError: # pragma: no cover
+    xrange = range # pylint: disable=W0622,C0103
+
+# a hash table slot: the key's hash, and the offset of the chunk the 
+# item is in, EMPTY if the slot was never used, TOMBSTONE if the item 
+# was deleted (lookups carry on past those)
+SLOT = struct.Struct("<II")
+EMPTY = 0
+TOMBSTONE = 0xffffffff
+# the start of a chunk: key length (0 if the chunk is free, and then 
+# flags is the next free chunk), flags, exptime, value length, casunique,
+# then the key and the value
+ITEM = struct.Struct("<HIiIQ")
+# per stripe: last casunique, bytes, items, total items, evictions, 
+# reclaimed, tombstones, the next page to take over for another class
+STRIPE = struct.Struct("<QQIIIIII")
+# per stripe and slab class: first free chunk, the page and chunk the 
+# eviction hand is at
+SLAB = struct.Struct("<IiI")
+# per page: the slab class it's carved up for, -1 if it isn't yet
+PAGE = struct.Struct("<h")
+
+MAX_KEY_LENGTH = 250
+DEFAULT_STRIPES = 64
+DEFAULT_PAGE_SIZE = 1024*1024
+
+# what the invalidation hook is told about, it only looks at the key
+SharedItem = collections.namedtuple("SharedItem", "key value flags exptime")
+
+def _hash(key):
+    """ the hash a key is filed under """
+    return zlib.crc32(memory_cache_primitives.to_bytes(key)) & 0xffffffff
+
+def prep_exptime(exptime):
+    """ an absolute exptime, as memory_cache_primitives.CacheItem has """
+    exptime = int(exptime)
+    if 0 < exptime <= memory_cache_primitives.CacheItem.TIME_CUTOFF:
+        return memory_cache_primitives.int_time() + exptime
+    return exptime
+
+class SharedMemcached(object):
+    """
+    the same commands as memory_cache.Memcached, with the items in an
+    anonymous shared mmap instead of Python objects, create it before
+    forking and every child works on the same items
+
+    keys hash to one of stripes stripes, each with a lock (a
+    multiprocessing.Lock, so it works across processes), a region of 
+    an open addressing hash table, and an even share of the pages 
+    of memory, so a command only ever takes the one lock; by default
+    there are as many stripes, up to DEFAULT_STRIPES, as leave each 
+    at least a page per slab class, so a mix of sizes fits without 
+    the classes taking pages off each other
+
+    a stripe's pages are carved into chunks of a slab class as they 
+    are needed, each class a growth factor bigger than the last, when
+    a class runs out of chunks and pages it evicts in the order of a 
+    clock hand going round its chunks, and when it has no chunks at 
+    all it takes a page over from another class, so there is no LRU,
+    no last_access in metadump, and the whole of max_bytes is in use
+    from the start
+
+    watch only hears about changes made through this process, and 
+    there is no read-through loader, and no leases (each process 
+    would hand out its own), see memcache_protocol_execute.lget
+    """
+    DELETED = memory_cache.Memcached.DELETED
+    EXISTS = memory_cache.Memcached.EXISTS
+    NOT_FOUND = memory_cache.Memcached.NOT_FOUND
+    NOT_NUMBER = memory_cache.Memcached.NOT_NUMBER
+    NOT_STORED = memory_cache.Memcached.NOT_STORED
+    STORED = memory_cache.Memcached.STORED
+    TOUCHED = memory_cache.Memcached.TOUCHED
+    TOO_LARGE = memory_cache.Memcached.TOO_LARGE
+
+    loader = None
+    lease_get_multi = None
+    lease_set = None
+
+    # pylint: disable=R0902,R0913
+    def __init__(self, stats, max_bytes=64*1024*1024, 
+                 item_size_max=memory_cache.DEFAULT_ITEM_SIZE_MAX, 
+                 stripes=None, page_size=DEFAULT_PAGE_SIZE, 
+                 min_chunk=64, growth=1.25):
+        self._stats = stats
+        self.item_size_max = item_size_max
+        # a page holds at least one of the biggest items
+        self.page_size = max(page_size, 
+                             ITEM.size + MAX_KEY_LENGTH + item_size_max)
+        self.sizes = []
+        size = min_chunk
+        while size < self.page_size:
+            self.sizes.append(size)
+            size = max(int(size * growth), size + 8) // 8 * 8
+        self.sizes.append(self.page_size)
+        self.pages = max_bytes // self.page_size
+        if not self.pages:
+            raise ValueError("max_bytes must be at least a page")
+        if stripes is None:
+            stripes = max(1, min(DEFAULT_STRIPES, 
+                                 self.pages // len(self.sizes)))
+        self.stripes = min(stripes, self.pages)
+        # as many slots as a stripe could have chunks, so live items 
+        # never fill a region
+        stripe_pages = -(-self.pages // self.stripes)
+        self.region = stripe_pages * self.page_size // min_chunk
+
+        self.slabs_at = self.stripes * STRIPE.size
+        self.pages_at = self.slabs_at + \
+            self.stripes * len(self.sizes) * SLAB.size
+        self.slots_at = self.pages_at + self.pages * PAGE.size
+        self.data_at = self.slots_at + self.stripes * self.region * SLOT.size
+        self.data_at = -(-self.data_at // mmap.PAGESIZE) * mmap.PAGESIZE
+        self.mem = mmap.mmap(-1, self.data_at + self.pages * self.page_size)
+        for page in xrange(self.pages):
+            PAGE.pack_into(self.mem, self.pages_at + page * PAGE.size, -1)
+        for stripe in xrange(self.stripes):
+            for slab in xrange(len(self.sizes)):
+                self._set_slab(stripe, slab, EMPTY, -1, 0)
+        self.locks = [multiprocessing.Lock() for _ in xrange(self.stripes)]
+        self.set_stats(stats)
+        # memory_cache_invalidation.Invalidations once anyone watches
+        self.invalidations = None
+    # pylint: enable=R0902,R0913
+
+    def set_stats(self, stats):
+        """ 
+        count into stats from here on, a forked child's server has 
+        its own
+        """
+        self._stats = stats
+        stats.set_maximums(self.stripes * self.region, 
+                           self.pages * self.page_size)
+
+    # layout
+
+    def _stripe(self, stripe):
+        """ the counters of a stripe, as a list """
+        return list(STRIPE.unpack_from(self.mem, stripe * STRIPE.size))
+
+    def _set_stripe(self, stripe, fields):
+        """ write back the counters of a stripe """
+        STRIPE.pack_into(self.mem, stripe * STRIPE.size, *fields)
+
+    def _count(self, stripe, field, delta):
+        """ add delta to one of a stripe's counters """
+        fields = self._stripe(stripe)
+        fields[field] += delta
+        self._set_stripe(stripe, fields)
+
+    def _slab(self, stripe, slab):
+        """ (first free chunk, hand page, hand chunk) """
+        return SLAB.unpack_from(self.mem, self.slabs_at + 
+                                (stripe * len(self.sizes) + slab) * SLAB.size)
+
+    def _set_slab(self, stripe, slab, free, hand_page, hand_chunk):
+        """ write back a slab class's state """
+        SLAB.pack_into(self.mem, self.slabs_at + 
+                       (stripe * len(self.sizes) + slab) * SLAB.size,
+                       free, hand_page, hand_chunk)
+
+    def _page_slab(self, page):
+        """ the slab class a page is carved up for, -1 if none """
+        return PAGE.unpack_from(self.mem, self.pages_at + page * PAGE.size)[0]
+
+    def _stripe_pages(self, stripe):
+        """ the pages that belong to a stripe """
+        return xrange(stripe, self.pages, self.stripes)
+
+    def _chunk_slab(self, chunk):
+        """ the slab class a chunk belongs to """
+        return self._page_slab((chunk - self.data_at) // self.page_size)
+
+    def _chunks(self, page):
+        """ the chunks in a page """
+        start = self.data_at + page * self.page_size
+        size = self.sizes[self._page_slab(page)]
+        return xrange(start, start + self.page_size // size * size, size)
+
+    def _key(self, chunk):
+        """ the key of the item in chunk """
+        start = chunk + ITEM.size
+        return memory_cache_primitives.to_str(
+            self.mem[start:start + ITEM.unpack_from(self.mem, chunk)[0]])
+
+    def _value(self, chunk, header):
+        """ the value of the item in chunk """
+        start = chunk + ITEM.size + header[0]
+        return memory_cache_primitives.to_str(
+            self.mem[start:start + header[3]])
+
+    # chunks
+
+    def _push_free(self, stripe, chunk):
+        """ put a chunk on its slab class's free list """
+        slab = self._chunk_slab(chunk)
+        free, hand_page, hand_chunk = self._slab(stripe, slab)
+        ITEM.pack_into(self.mem, chunk, 0, free, 0, 0, 0)
+        self._set_slab(stripe, slab, chunk, hand_page, hand_chunk)
+
+    def _carve(self, stripe, slab, page):
+        """ give a page to a slab class, all its chunks free """
+        PAGE.pack_into(self.mem, self.pages_at + page * PAGE.size, slab)
+        free, hand_page, hand_chunk = self._slab(stripe, slab)
+        chunks = self._chunks(page)
+        size = self.sizes[slab]
+        for chunk in xrange(chunks[0], chunks[-1], size):
+            ITEM.pack_into(self.mem, chunk, 0, chunk + size, 0, 0, 0)
+        ITEM.pack_into(self.mem, chunks[-1], 0, free, 0, 0, 0)
+        self._set_slab(stripe, slab, chunks[0], hand_page, hand_chunk)
+
+    def _evict_one(self, stripe, slab):
+        """ 
+        evict the item at the slab class's hand and move the hand on,
+        return False if the class has no pages
+        """
+        pages = [page for page in self._stripe_pages(stripe)
+                 if self._page_slab(page) == slab]
+        if not pages:
+            return False
+        free, hand_page, hand_chunk = self._slab(stripe, slab)
+        if hand_page not in pages:
+            hand_page, hand_chunk = pages[0], 0
+        chunks = self._chunks(hand_page)
+        chunk = chunks[hand_chunk % len(chunks)]
+        hand_chunk += 1
+        if hand_chunk >= len(chunks):
+            hand_page = pages[(pages.index(hand_page) + 1) % len(pages)]
+            hand_chunk = 0
+        self._set_slab(stripe, slab, free, hand_page, hand_chunk)
+        # the free list is empty, so every chunk is in use
+        self._unlink_chunk(stripe, chunk)
+        self._count(stripe, 4, 1)
+        return True
+
+    def _take_page(self, stripe):
+        """ 
+        the next page round the stripe, emptied of whatever class it 
+        was carved for, evicting its items
+        """
+        fields = self._stripe(stripe)
+        pages = self._stripe_pages(stripe)
+        page = pages[fields[7] % len(pages)]
+        fields[7] += 1
+        self._set_stripe(stripe, fields)
+        old_slab = self._page_slab(page)
+        chunks = self._chunks(page)
+        for chunk in chunks:
+            if ITEM.unpack_from(self.mem, chunk)[0]:
+                self._unlink_chunk(stripe, chunk)
+                self._count(stripe, 4, 1)
+        # take its chunks back off the old class's free list
+        free, hand_page, hand_chunk = self._slab(stripe, old_slab)
+        kept = []
+        while free != EMPTY:
+            if not chunks[0] <= free <= chunks[-1]:
+                kept.append(free)
+            free = ITEM.unpack_from(self.mem, free)[1]
+        if hand_page == page:
+            hand_page, hand_chunk = -1, 0
+        self._set_slab(stripe, old_slab, EMPTY, hand_page, hand_chunk)
+        for chunk in reversed(kept):
+            self._push_free(stripe, chunk)
+        return page
+
+    def _alloc(self, stripe, slab):
+        """ 
+        a free chunk of a slab class, from the free list, a page 
+        nobody has yet, evicting one of the class, or taking a page 
+        over from another class
+        """
+        if self._slab(stripe, slab)[0] == EMPTY:
+            unused = [page for page in self._stripe_pages(stripe) 
+                      if self._page_slab(page) == -1]
+            if unused:
+                self._carve(stripe, slab, unused[0])
+            elif not self._evict_one(stripe, slab):
+                self._carve(stripe, slab, self._take_page(stripe))
+        free, hand_page, hand_chunk = self._slab(stripe, slab)
+        self._set_slab(stripe, slab, ITEM.unpack_from(self.mem, free)[1],
+                       hand_page, hand_chunk)
+        return free
+
+    # the hash table
+
+    def _slot_at(self, stripe, index):
+        """ the offset of a slot in a stripe's region """
+        return self.slots_at + (stripe * self.region + index) * SLOT.size
+
+    def _find(self, stripe, key_hash, key):
+        """ 
+        (slot index, chunk) for key, or (the slot to put it in, EMPTY) 
+        if it isn't there, None for the slot if there's no room
+        """
+        start = key_hash // self.stripes
+        insert = None
+        for probe in xrange(self.region):
+            index = (start + probe) % self.region
+            slot_hash, chunk = SLOT.unpack_from(
+                self.mem, self._slot_at(stripe, index))
+            if chunk == EMPTY:
+                if insert is None:
+                    insert = index
+                return insert, EMPTY
+            elif chunk == TOMBSTONE:
+                if insert is None:
+                    insert = index
+            elif slot_hash == key_hash and self._key(chunk) == key:
+                return index, chunk
+        return insert, EMPTY
+
+    def _unlink(self, stripe, index, chunk):
+        """ delete the item in chunk, whose slot is index """
+        header = ITEM.unpack_from(self.mem, chunk)
+        SLOT.pack_into(self.mem, self._slot_at(stripe, index), 0, TOMBSTONE)
+        self._push_free(stripe, chunk)
+        fields = self._stripe(stripe)
+        fields[1] -= ITEM.size + header[0] + header[3]
+        fields[2] -= 1
+        fields[6] += 1
+        self._set_stripe(stripe, fields)
+        if fields[6] > self.region // 4:
+            self._compact(stripe)
+
+    def _unlink_chunk(self, stripe, chunk):
+        """ delete the item in chunk, looking its slot up by its key """
+        key = self._key(chunk)
+        index, _ = self._find(stripe, _hash(key), key)
+        self._unlink(stripe, index, chunk)
+
+    def _compact(self, stripe):
+        """ rebuild a stripe's region without the tombstones """
+        live = []
+        for index in xrange(self.region):
+            at = self._slot_at(stripe, index)
+            slot_hash, chunk = SLOT.unpack_from(self.mem, at)
+            if chunk not in (EMPTY, TOMBSTONE):
+                live.append((slot_hash, chunk))
+            SLOT.pack_into(self.mem, at, 0, EMPTY)
+        for slot_hash, chunk in live:
+            index, _ = self._find(stripe, slot_hash, None)
+            SLOT.pack_into(self.mem, self._slot_at(stripe, index), 
+                           slot_hash, chunk)
+        fields = self._stripe(stripe)
+        fields[6] = 0
+        self._set_stripe(stripe, fields)
+
+    # items
+
+    def _locate(self, key):
+        """ (stripe, key hash) """
+        key_hash = _hash(key)
+        return key_hash % self.stripes, key_hash
+
+    def _lookup(self, stripe, key_hash, key, now=None):
+        """ 
+        (slot index, chunk, header) for a live item, chunk EMPTY if 
+        there isn't one, deleting it if it has expired
+        """
+        index, chunk = self._find(stripe, key_hash, key)
+        if chunk == EMPTY:
+            return index, EMPTY, None
+        header = ITEM.unpack_from(self.mem, chunk)
+        if now is None:
+            now = memory_cache_primitives.int_time()
+        if header[2] > 0 and header[2] <= now:
+            self._unlink(stripe, index, chunk)
+            self._count(stripe, 5, 1)
+            self._stats.expire()
+            index, _ = self._find(stripe, key_hash, key)
+            return index, EMPTY, None
+        return index, chunk, header
+
+    # pylint: disable=R0913
+    def _store(self, stripe, key_hash, key, flags, exptime, value):
+        """ 
+        store an item, replacing whatever is there, return False if 
+        there was no room
+        """
+        index, chunk = self._find(stripe, key_hash, key)
+        if chunk != EMPTY:
+            self._unlink(stripe, index, chunk)
+        size = ITEM.size + len(key) + len(value)
+        if size > self.page_size:
+            return False
+        chunk = self._alloc(stripe, bisect.bisect_left(self.sizes, size))
+        # evicting may have moved the slots about
+        index, _ = self._find(stripe, key_hash, key)
+        if index is None:
+            self._push_free(stripe, chunk)
+            return False
+        at = self._slot_at(stripe, index)
+        fields = self._stripe(stripe)
+        if SLOT.unpack_from(self.mem, at)[1] == TOMBSTONE:
+            fields[6] -= 1
+        fields[0] += 1
+        fields[1] += size
+        fields[2] += 1
+        fields[3] += 1
+        self._set_stripe(stripe, fields)
+        ITEM.pack_into(self.mem, chunk, len(key), int(flags), 
+                       prep_exptime(exptime), len(value), 
+                       fields[0] * self.stripes + stripe)
+        start = chunk + ITEM.size
+        to_bytes = memory_cache_primitives.to_bytes
+        self.mem[start:start + len(key)] = to_bytes(key)
+        self.mem[start + len(key):start + len(key) + len(value)] = \
+            to_bytes(value)
+        SLOT.pack_into(self.mem, at, key_hash, chunk)
+        if self.invalidations is not None:
+            self.invalidations.stored(SharedItem(key, value, flags, exptime))
+        return True
+    # pylint: enable=R0913
+
+    def _deleted(self, key):
+        """ tell anyone watching """
+        if self.invalidations is not None:
+            self.invalidations.deleted(key)
+
+    # commands
+
+    def set(self, key, flags, exptime, value):
+        """ set command """
+        stripe, key_hash = self._locate(key)
+        with self.locks[stripe]:
+            stored = self._store(stripe, key_hash, key, flags, exptime, 
+                                 value)
+        self._stats.set()
+        return self.STORED if stored else self.NOT_STORED
+
+    # pylint: disable=R0913
+    def cas(self, key, flags, exptime, casunique, value):
+        """ cas command """
+        stripe, key_hash = self._locate(key)
+        with self.locks[stripe]:
+            _, chunk, header = self._lookup(stripe, key_hash, key)
+            if chunk == EMPTY:
+                self._store(stripe, key_hash, key, flags, exptime, value)
+                self._stats.cas_miss()
+                return self.NOT_FOUND
+            elif header[4] == int(casunique):
+                self._store(stripe, key_hash, key, flags, exptime, value)
+                self._stats.cas_hit()
+                return self.STORED
+            else:
+                self._stats.cas_badval()
+                return self.EXISTS
+    # pylint: enable=R0913
+
+    def _store_if(self, key, flags, exptime, value, exists, combine=None):
+        """ 
+        store only if the key is there (or isn't, if exists is False),
+        combine(old value, value) makes the value to store, TOO_LARGE
+        if that is over item_size_max
+        """
+        stripe, key_hash = self._locate(key)
+        with self.locks[stripe]:
+            _, chunk, header = self._lookup(stripe, key_hash, key)
+            if (chunk != EMPTY) != exists:
+                return self.NOT_STORED
+            if combine is not None:
+                value = combine(self._value(chunk, header), value)
+                if len(value) > self.item_size_max:
+                    return self.TOO_LARGE
+            if self._store(stripe, key_hash, key, flags, exptime, value):
+                return self.STORED
+            return self.NOT_STORED
+
+    def add(self, key, flags, exptime, value):
+        """ add command """
+        return self._store_if(key, flags, exptime, value, False)
+
+    def replace(self, key, flags, exptime, value):
+        """ replace command """
+        return self._store_if(key, flags, exptime, value, True)
+
+    def prepend(self, key, flags, exptime, value):
+        """ prepend command """
+        return self._store_if(key, flags, exptime, value, True,
+                              lambda old, new: new + old)
+
+    def append(self, key, flags, exptime, value):
+        """ append command """
+        return self._store_if(key, flags, exptime, value, True,
+                              lambda old, new: old + new)
+
+    def _arithmetic(self, key, delta, stats_count):
+        """ increment or decrement by delta, keeping flags and exptime """
+        stripe, key_hash = self._locate(key)
+        with self.locks[stripe]:
+            _, chunk, header = self._lookup(stripe, key_hash, key)
+            if chunk == EMPTY:
+                stats_count(False)
+                return (self.NOT_FOUND, None)
+            old = self._value(chunk, header)
+            if not old.isdigit():
+                return (self.NOT_NUMBER, None)
+            value = str(int(old) + delta)
+            self._store(stripe, key_hash, key, header[1], header[2], value)
+            stats_count(True)
+            return (self.STORED, value)
+
+    def increment(self, key, value):
+        """ increment command """
+        return self._arithmetic(key, int(value), self._stats.incr)
+
+    def decrement(self, key, value):
+        """ decrement command """
+        return self._arithmetic(key, -int(value), self._stats.decr)
+
+    def _get_multi(self, keys):
+        """ (key, value, flags, casunique) for the hits """
+        now = memory_cache_primitives.int_time()
+        stats_get = self._stats.get
+        hits = []
+        for key in keys:
+            stripe, key_hash = self._locate(key)
+            with self.locks[stripe]:
+                _, chunk, header = self._lookup(stripe, key_hash, key, now)
+                if chunk != EMPTY:
+                    hits.append((key, self._value(chunk, header), 
+                                 str(header[1]), header[4]))
+            stats_get(chunk != EMPTY)
+        return hits
+
+    def get(self, keys):
+        """ get command """
+        return list(self.get_multi(keys))
+
+    def get_multi(self, keys):
+        """ get several keys, yielding (key, value, flags) for the hits """
+        return (hit[:3] for hit in self._get_multi(keys))
+
+    def gets(self, keys):
+        """ gets command """
+        return list(self.gets_multi(keys))
+
+    def gets_multi(self, keys):
+        """ 
+        get several keys, yielding (key, value, flags, casunique) 
+        for the hits 
+        """
+        return iter(self._get_multi(keys))
+
+    def set_multi(self, items):
+        """ 
+        set several (key, flags, exptime, value) items, return 
+        (key, result) pairs 
+        """
+        return [(key, self.set(key, flags, exptime, value)) 
+                for key, flags, exptime, value in items]
+
+    def delete(self, key):
+        """ delete command """
+        stripe, key_hash = self._locate(key)
+        with self.locks[stripe]:
+            index, chunk, _ = self._lookup(stripe, key_hash, key)
+            if chunk != EMPTY:
+                self._unlink(stripe, index, chunk)
+        self._stats.delete(chunk != EMPTY)
+        if chunk == EMPTY:
+            return self.NOT_FOUND
+        self._deleted(key)
+        return self.DELETED
+
+    def delete_multi(self, keys):
+        """ delete several keys, return (key, result) pairs """
+        return [(key, self.delete(key)) for key in keys]
+
+    def touch_multi(self, keys, exptime):
+        """ give several keys a new exptime, return (key, result) pairs """
+        results = []
+        for key in keys:
+            stripe, key_hash = self._locate(key)
+            with self.locks[stripe]:
+                _, chunk, header = self._lookup(stripe, key_hash, key)
+                if chunk != EMPTY:
+                    ITEM.pack_into(self.mem, chunk, header[0], header[1],
+                                   prep_exptime(exptime), header[3], 
+                                   header[4])
+            self._stats.touch(chunk != EMPTY)
+            if chunk != EMPTY:
+                self._deleted(key)
+                results.append((key, self.TOUCHED))
+            else:
+                results.append((key, self.NOT_FOUND))
+        return results
+
+    def _live(self, stripe):
+        """ (chunk, header) for the items in a stripe, expired or not """
+        for index in xrange(self.region):
+            chunk = SLOT.unpack_from(self.mem, 
+                                     self._slot_at(stripe, index))[1]
+            if chunk not in (EMPTY, TOMBSTONE):
+                yield chunk, ITEM.unpack_from(self.mem, chunk)
+
+    def metadump(self, prefix=""):
+        """
+        yield (key, exptime, last_access, casunique, flags, size) for 
+        the live items whose keys start with prefix, a stripe at a 
+        time with None in between, last_access is always 0
+        """
+        for stripe in xrange(self.stripes):
+            entries = []
+            with self.locks[stripe]:
+                now = memory_cache_primitives.int_time()
+                for chunk, header in self._live(stripe):
+                    if header[2] > 0 and header[2] <= now:
+                        continue
+                    key = self._key(chunk)
+                    if key.startswith(prefix):
+                        entries.append((key, header[2], 0, header[4], 
+                                        str(header[1]), 
+                                        ITEM.size + header[0] + header[3]))
+            for entry in entries:
+                yield entry
+            yield None
+
+    def flush(self, delay):
+        """ flush command """
+        exptime = memory_cache_primitives.int_time() + int(delay)
+        for stripe in xrange(self.stripes):
+            with self.locks[stripe]:
+                for chunk, header in list(self._live(stripe)):
+                    ITEM.pack_into(self.mem, chunk, header[0], header[1],
+                                   exptime, header[3], header[4])
+        if self.invalidations is not None:
+            self.invalidations.flushed(exptime)
+
+    def watch(self, subscriber, prefixes):
+        """ see memory_cache.Memcached.watch, this process's changes only """
+        if self.invalidations is None:
+            self.invalidations = memory_cache_invalidation.Invalidations()
+        self.invalidations.subscribe(subscriber, prefixes)
+
+    def unwatch(self, subscriber):
+        """ stop pushing invalidations to subscriber """
+        if self.invalidations is not None:
+            self.invalidations.unsubscribe(subscriber)
+
+    def item_count(self):
+        """ items across all the stripes, and all the processes """
+        return sum(self._stripe(stripe)[2] for stripe in xrange(self.stripes))
+
+    def stats(self, sub):
+        """ 
+        stats command, the item counts from shared memory, so they 
+        cover every process, the command counts are this process's 
+        """
+        totals = dict(bytes=0, curr_items=0, total_items=0, evictions=0,
+                      reclaimed=0)
+        for stripe in xrange(self.stripes):
+            with self.locks[stripe]:
+                fields = self._stripe(stripe)
+            totals["bytes"] += fields[1]
+            totals["curr_items"] += fields[2]
+            totals["total_items"] += fields[3]
+            totals["evictions"] += fields[4]
+            totals["reclaimed"] += fields[5]
+        return [(name, totals.get(name, value)) 
+                for name, value in self._stats.dump(sub)]
@@ -0,0 +1,259 @@
+"""
+Save the cache to a file and load it back, so a restart starts warm.
+
+==========================================================================================
+
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import mmap
+import os
+import struct
+
+import memory_cache_oplog
+import memory_cache_primitives
+
+MAGIC = "JMCSNAP1"
+
+# exptime, key length, flags length, value length, then the key, 
+# flags and value themselves
+RECORD = struct.Struct("!qHBI")
+
+# how much to collect before each write
+WRITE_BYTES = 1024*1024
+
+def _oldest_first(cache):
+    """ all the items, those on disk and then the LRU from its tail """
+    if cache.disk is not None:
+        for item in cache.disk.items():
+            yield item
+    item = cache.lru.least()
+    while item is not None:
+        yield item
+        item = item.prev
+
+def save(cache, path):
+    """
+    write the live items in a MemoryCache to path, oldest first so 
+    loading them in order rebuilds the LRU
+
+    written to a temporary file and renamed into place, so path 
+    always holds a whole snapshot
+
+    cas uniques come from the items themselves, so they aren't kept,
+    a cas against a loaded item just gets EXISTS
+    """
+    now = memory_cache_primitives.int_time()
+    to_str = memory_cache_primitives.to_str
+    to_bytes = memory_cache_primitives.to_bytes
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as out:
+        pieces = [MAGIC]
+        size = 0
+        for item in _oldest_first(cache):
+            if not item.has_expired(now):
+                value = item.value
+                pieces.append(to_str(RECORD.pack(item.exptime, len(item.key),
+                                                 len(item.flags), 
+                                                 len(value))))
+                pieces.append(item.key)
+                pieces.append(item.flags)
+                pieces.append(value)
+                size += len(value)
+                if size >= WRITE_BYTES:
+                    out.write(to_bytes("".join(pieces)))
+                    pieces = []
+                    size = 0
+        out.write(to_bytes("".join(pieces)))
+        out.flush()
+        os.fsync(out.fileno())
+    os.rename(tmp_path, path)
+
+def save_in_background(cache, path):
+    """ 
+    fork and save the child's copy of the cache, so the parent can
+    go on serving, return the child's pid
+    """
+    pid = os.fork()
+    if pid == 0: # pragma: no cover
+        status = 1
+        try:
+            if cache.disk is not None:
+                cache.disk.reopen()
+            save(cache, path)
+            status = 0
+        finally:
+            os._exit(status) # pylint: disable=W0212
+    return pid
+
+def _records(snapshot):
+    """ 
+    yield (key, value, flags, exptime) for each record in a mapped 
+    snapshot
+    """
+    to_str = memory_cache_primitives.to_str
+    if to_str(snapshot[:len(MAGIC)]) != MAGIC:
+        raise ValueError("not a snapshot")
+    unpack_from = RECORD.unpack_from
+    header_size = RECORD.size
+    end = len(snapshot)
+    offset = len(MAGIC)
+    while offset < end:
+        if offset + header_size > end:
+            raise ValueError("snapshot truncated")
+        exptime, key_len, flags_len, value_len = unpack_from(snapshot, offset)
+        offset += header_size
+        flags_end = offset + key_len + flags_len
+        value_end = flags_end + value_len
+        if value_end > end:
+            raise ValueError("snapshot truncated")
+        yield (to_str(snapshot[offset:offset+key_len]), 
+               to_str(snapshot[flags_end:value_end]),
+               to_str(snapshot[offset+key_len:flags_end]), exptime)
+        offset = value_end
+
+def records(path):
+    """
+    yield (key, value, flags, exptime) for each record in the 
+    snapshot at path, expired or not
+
+    the file is mapped rather than read so big snapshots don't need 
+    a second copy in memory while loading
+    """
+    with open(path, "rb") as snapshot_file:
+        if not os.fstat(snapshot_file.fileno()).st_size:
+            raise ValueError("not a snapshot")
+        snapshot = mmap.mmap(snapshot_file.fileno(), 0, 
+                             access=mmap.ACCESS_READ)
+        try:
+            for record in _records(snapshot):
+                yield record
+        finally:
+            snapshot.close()
+
+def load(cache, path):
+    """
+    load a snapshot from path into a MemoryCache, skipping items that
+    expired in the meantime, return how many items were loaded, None 
+    if there was no snapshot
+    """
+    if not os.path.exists(path):
+        return None
+    now = memory_cache_primitives.int_time()
+    return len(cache.set_multi(record for record in records(path)
+                               if record[3] <= 0 or record[3] > now))
+
+class Snapshots(object):
+    """ 
+    the snapshot file for a server, at most one background save 
+    at a time
+
+    with an operation log, each save compacts the log into the 
+    snapshot, the log is moved aside when the save starts and 
+    removed once the save is done
+
+    once the server hands off to a replacement, the replacement owns
+    the snapshot and the log, so they are left alone from then on
+    """
+    def __init__(self, cache, path, oplog=None):
+        self.cache = cache
+        self.path = path
+        self.oplog = oplog
+        self.pid = None
+        self.rotated = None
+        self.handed_off = False
+
+    def load(self):
+        """ 
+        load the snapshot if there is one, then replay the log, 
+        including one left over from an unfinished save
+        """
+        count = load(self.cache, self.path)
+        if self.oplog is not None:
+            for path in (self.oplog.path + ".1", self.oplog.path):
+                memory_cache_oplog.replay(self.cache, path)
+        return count
+
+    def _rotate(self):
+        """ move the log aside before saving """
+        if self.oplog is not None:
+            self.rotated = self.oplog.rotate()
+
+    def _saved(self, status):
+        """ a save finished, drop the log it replaces if it worked """
+        if status == 0 and self.rotated is not None:
+            os.unlink(self.rotated)
+        self.rotated = None
+
+    def saving(self):
+        """ is a background save still running? """
+        if self.pid is not None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self.pid = None
+                self._saved(status)
+        return self.pid is not None
+
+    def save_in_background(self):
+        """ 
+        start a background save, unless one is already running or 
+        we handed off
+        """
+        if self.saving() or self.handed_off:
+            return False
+        self._rotate()
+        self.pid = save_in_background(self.cache, self.path)
+        return True
+
+    def maybe_compact(self):
+        """ start a background save if the log has grown big enough """
+        if (self.oplog is not None and 
+            self.oplog.size >= self.oplog.compact_bytes):
+            return self.save_in_background()
+        return False
+
+    def hand_off(self):
+        """ 
+        a replacement server took over, it saves and rotates from now 
+        on, anything this one still logs goes into its log
+        """
+        self.handed_off = True
+
+    def save(self):
+        """ 
+        for shutting down, wait for any background save, save (unless
+        we handed off), and close the log
+        """
+        if self.pid is not None:
+            _, status = os.waitpid(self.pid, 0)
+            self.pid = None
+            self._saved(status)
+        if not self.handed_off:
+            self._rotate()
+            save(self.cache, self.path)
+            self._saved(0)
+        if self.oplog is not None:
+            self.oplog.close()
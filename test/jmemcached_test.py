@@ -0,0 +1,119 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+if sys.version_info[0] >= 3:
+    PYTHON3 = sys.executable
+else:
+    import distutils.spawn
+    PYTHON3 = distutils.spawn.find_executable("python3")
+
+JMEMCACHED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                          os.pardir, "jmemcached.py")
+
+def free_port():
+    """ a port nobody is listening on, probably still free in a moment """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+@unittest.skipIf(PYTHON3 is None, "no python3 to run the server with")
+class TestPython3(unittest.TestCase):
+
+    def setUp(self):
+        self.port = free_port()
+        self.server = None
+
+    def start(self, *args):
+        """ run the server in the background """
+        self.server = subprocess.Popen([PYTHON3, JMEMCACHED, 
+                                        "--backend", "asyncio", 
+                                        "-I", "127.0.0.1", 
+                                        "-p", str(self.port)] + list(args))
+
+    def tearDown(self):
+        if self.server is None:
+            return
+        if self.server.poll() is None:
+            self.server.send_signal(signal.SIGTERM)
+        self.server.wait()
+
+    def connect(self):
+        """ wait for the server to start listening """
+        deadline = time.time() + 10
+        while True:
+            try:
+                return socket.create_connection(('127.0.0.1', self.port))
+            except socket.error:
+                if time.time() > deadline or self.server.poll() is not None:
+                    raise
+                time.sleep(0.05)
+
+    def test_set_get(self):
+        self.start()
+        sock = self.connect()
+        reader = sock.makefile("rb")
+        sock.sendall(b"set foo 0 0 3\r\nbar\r\n")
+        self.assertEqual(reader.readline(), b"STORED\r\n")
+        sock.sendall(b"get foo\r\n")
+        self.assertEqual(reader.readline(), b"VALUE foo 0 3\r\n")
+        self.assertEqual(reader.readline(), b"bar\r\n")
+        self.assertEqual(reader.readline(), b"END\r\n")
+        sock.close()
+        self.server.send_signal(signal.SIGTERM)
+        self.assertEqual(self.server.wait(), 0)
+
+    def test_workers(self):
+        self.start("--workers", "3")
+        socks = [self.connect() for _ in range(6)]
+        readers = [sock.makefile("rb") for sock in socks]
+        socks[0].sendall(b"set n 0 0 1\r\n0\r\n")
+        self.assertEqual(readers[0].readline(), b"STORED\r\n")
+        for sock, reader in zip(socks, readers):
+            sock.sendall(b"incr n 1\r\n")
+            reader.readline()
+        socks[0].sendall(b"get n\r\n")
+        self.assertEqual(readers[0].readline(), b"VALUE n 0 1\r\n")
+        self.assertEqual(readers[0].readline(), b"6\r\n")
+        self.assertEqual(readers[0].readline(), b"END\r\n")
+        for sock in socks:
+            sock.close()
+        self.server.send_signal(signal.SIGTERM)
+        self.assertEqual(self.server.wait(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,353 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memcache_asyncio
+import memcache_connection
+import memcache_protocol_execute
+import memcache_replication
+import memory_cache
+import memory_cache_loader
+import memory_cache_primitives
+import unittest
+
+class MockTransport(object):
+    def __init__(self):
+        self.written = []
+        self.closed = False
+        self.reading = True
+
+    def get_extra_info(self, name):
+        return ('127.0.0.1', 11211)
+
+    def write(self, buf):
+        # bytes on python 3, compare them as the protocol's strs
+        self.written.append(memory_cache_primitives.to_str(buf))
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+class MockLoop(object):
+    def __init__(self):
+        self.callbacks = []
+        self.later = []
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+    def call_soon(self, callback):
+        self.callbacks.append(callback)
+
+    def call_later(self, delay, callback):
+        self.later.append((delay, callback))
+
+    def run_once(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+class MockServer(object):
+    def __init__(self, max_connections=10, max_requests=20):
+        self.loop = MockLoop()
+        self.stats = memcache_connection.ConnectionStats()
+        self.cache = memory_cache.Memcached(self.stats)
+        self.max_connections = max_connections
+        self.max_requests = max_requests
+        self.conns = set()
+
+    def connection_made(self, conn):
+        self.conns.add(conn)
+
+    def connection_active(self, conn):
+        pass
+
+    def connection_lost(self, conn):
+        self.conns.discard(conn)
+
+class TestMemcachedProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockServer()
+        self.transport = MockTransport()
+        self.conn = memcache_asyncio.MemcachedProtocol(self.server)
+        self.conn.connection_made(self.transport)
+
+    def test_connect(self):
+        self.assertTrue(self.server.stats.curr_connections == 1)
+        self.assertTrue(self.conn in self.server.conns)
+
+    def test_disconnect(self):
+        self.conn.connection_lost(None)
+        self.assertTrue(self.server.stats.curr_connections == 0)
+        self.assertTrue(self.conn not in self.server.conns)
+
+    def test_command(self):
+        self.conn.data_received(b"set test_key 0 0 5\r\n12345\r\n")
+        self.assertTrue(self.transport.written == ["STORED\r\n"])
+
+    def test_noreply(self):
+        self.conn.data_received(b"set test_key 0 0 5 noreply\r\n12345\r\n")
+        self.assertTrue(self.transport.written == [])
+
+    def test_bad_command(self):
+        self.conn.data_received(b"flub\r\n")
+        self.assertTrue(self.transport.written == ["ERROR\r\n"])
+        self.assertTrue(not self.transport.closed)
+
+    def test_line_too_long(self):
+        self.conn.data_received(b"x" * 4096)
+        self.assertTrue(self.transport.written == ["CLIENT_ERROR line too long\r\n"])
+        self.assertTrue(self.transport.closed)
+
+    def test_quit(self):
+        self.conn.data_received(b"quit\r\n")
+        self.assertTrue(self.transport.closed)
+
+    def test_eof(self):
+        self.assertFalse(self.conn.eof_received())
+
+    def test_yield(self):
+        self.conn.protocol.max_requests = 1
+        self.conn.data_received(b"version\r\nversion\r\n")
+        self.assertTrue(len(self.transport.written) == 1)
+        self.server.loop.run_once()
+        self.assertTrue(len(self.transport.written) == 2)
+
+    def test_pause_writing(self):
+        self.conn.protocol.max_requests = 1
+        self.conn.pause_writing()
+        self.assertTrue(not self.transport.reading)
+        self.conn.data_received(b"version\r\nversion\r\n")
+        self.server.loop.run_once()
+        self.assertTrue(len(self.transport.written) == 1)
+        self.conn.resume_writing()
+        self.server.loop.run_once()
+        self.assertTrue(self.transport.reading)
+        self.assertTrue(len(self.transport.written) == 2)
+
+    def test_pending_stops_reading(self):
+        self.conn.protocol.max_requests = 1
+        self.conn.data_received(b"version\r\nversion\r\n")
+        self.assertTrue(not self.transport.reading)
+        self.server.loop.run_once()
+        self.assertTrue(len(self.transport.written) == 2)
+        self.assertTrue(self.transport.reading)
+
+    def test_stream_stops_reading(self):
+        self.server.cache.METADUMP_SCAN = 2
+        for key in ("a", "b", "c", "d"):
+            self.server.cache.set(key, "0", 0, "value")
+        self.conn.data_received(b"lru_crawler metadump all\r\n")
+        self.assertTrue(not self.transport.reading)
+        while self.conn.protocol.has_pending():
+            self.server.loop.run_once()
+        output = "".join(self.transport.written)
+        self.assertTrue(output.count("key=") == 4)
+        self.assertTrue(output.endswith("END\r\n"))
+        self.assertTrue(self.transport.reading)
+
+    def test_drain_idle(self):
+        self.conn.drain()
+        self.assertTrue(self.transport.closed)
+
+    def test_drain_pending(self):
+        self.conn.protocol.max_requests = 1
+        self.conn.data_received(b"version\r\nversion\r\n")
+        self.conn.drain()
+        self.assertTrue(not self.transport.closed)
+        self.assertTrue(not self.transport.reading)
+        self.server.loop.run_once()
+        self.assertTrue(len(self.transport.written) == 2)
+        self.assertTrue(self.transport.closed)
+
+    def test_read_through(self):
+        fetching = []
+        self.server.cache = memory_cache.Memcached(
+            self.server.stats, loader=memory_cache_loader.Loader(
+                lambda key, done: fetching.append(done)))
+        self.conn = memcache_asyncio.MemcachedProtocol(self.server)
+        self.conn.connection_made(self.transport)
+        self.conn.data_received(b"get key\r\nversion\r\n")
+        self.conn.drain()
+        self.assertTrue(not self.transport.closed)
+        fetching[0]('value')
+        self.server.loop.run_once()
+        self.assertTrue(self.transport.written[0] == 
+                        "VALUE key 0 5\r\nvalue\r\nEND\r\nVERSION " + 
+                        memcache_protocol_execute.VERSION + "\r\n")
+        self.assertTrue(self.transport.closed)
+
+    def test_read_through_stops_reading(self):
+        fetching = []
+        self.server.cache = memory_cache.Memcached(
+            self.server.stats, loader=memory_cache_loader.Loader(
+                lambda key, done: fetching.append(done)))
+        self.conn = memcache_asyncio.MemcachedProtocol(self.server)
+        self.conn.connection_made(self.transport)
+        self.conn.data_received(b"get key\r\n")
+        self.assertTrue(not self.transport.reading)
+        self.conn.pause_writing()
+        self.conn.resume_writing()
+        self.assertTrue(not self.transport.reading)
+        fetching[0]('value')
+        self.server.loop.run_once()
+        self.assertTrue(self.transport.written == 
+                        ["VALUE key 0 5\r\nvalue\r\nEND\r\n"])
+        self.assertTrue(self.transport.reading)
+
+    def test_too_many(self):
+        self.server.max_connections = 1
+        transport = MockTransport()
+        conn = memcache_asyncio.MemcachedProtocol(self.server)
+        conn.connection_made(transport)
+        self.assertTrue(transport.written == [memcache_asyncio.MemcachedProtocol.TOO_MANY])
+        self.assertTrue(transport.closed)
+        self.assertTrue(self.server.stats.rejected_connections == 1)
+
+class IdleServer(memcache_asyncio.AsyncioServer):
+    # pylint: disable=W0231
+    def __init__(self, idle_timeout):
+        self.loop = MockLoop()
+        self.stats = memcache_connection.ConnectionStats()
+        self.cache = memory_cache.Memcached(self.stats)
+        self.max_connections = 10
+        self.max_requests = 20
+        self.conns = set()
+        self.draining = False
+        self.idle_timeout = idle_timeout
+        self.idle_conns = memory_cache_primitives.LRU()
+        self.idle_timer = None
+    # pylint: enable=W0231
+
+class TestIdle(unittest.TestCase):
+
+    def setUp(self):
+        self.server = IdleServer(10)
+        self.conns = []
+        self.transports = []
+        for _ in range(2):
+            self.transports.append(MockTransport())
+            self.conns.append(memcache_asyncio.MemcachedProtocol(self.server))
+            self.conns[-1].connection_made(self.transports[-1])
+
+    def test_idle_kick(self):
+        self.server.loop.now = 10
+        self.server.idle_cb()
+        self.assertTrue(all(transport.closed for transport in self.transports))
+        self.assertTrue(self.server.stats.idle_kicks == 2)
+
+    def test_watching_not_idle(self):
+        self.conns[0].data_received(b"watch\r\n")
+        self.server.loop.now = 10
+        self.server.idle_cb()
+        self.assertTrue(not self.transports[0].closed)
+        self.assertTrue(self.transports[1].closed)
+        self.assertTrue(self.server.stats.idle_kicks == 1)
+        # and it's checked again later
+        self.assertTrue(self.server.loop.later[-1][0] == 10)
+
+    def test_loading_not_idle(self):
+        self.server.cache = memory_cache.Memcached(
+            self.server.stats, loader=memory_cache_loader.Loader(
+                lambda key, done: None))
+        conn = memcache_asyncio.MemcachedProtocol(self.server)
+        conn.connection_made(MockTransport())
+        conn.data_received(b"get key\r\n")
+        self.server.loop.now = 10
+        self.server.idle_cb()
+        self.assertTrue(not conn.transport.closed)
+        self.assertTrue(self.server.stats.idle_kicks == 2)
+
+class TestReplicaProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockServer()
+        self.replicator = memcache_replication.Replicator(
+            self.server.cache.cache, self.server.stats, 
+            [('127.0.0.1', 11212)])
+        self.server.cache.replication = self.replicator
+        self.follower = self.replicator.followers[0]
+        self.replica = memcache_asyncio.ReplicaProtocol(
+            self.server, self.replicator, self.follower)
+        self.transport = MockTransport()
+
+    def test_writes_once_per_iteration(self):
+        self.server.cache.set("foo", "0", 0, "bar")
+        self.replica.connection_made(self.transport)
+        self.server.cache.set("foo", "0", 0, "baz")
+        self.server.cache.delete("foo")
+        self.assertEqual(len(self.server.loop.callbacks), 1)
+        self.server.loop.run_once()
+        self.assertEqual(self.transport.written, 
+                         ["flush_all noreply\r\n"
+                          "set foo 0 0 3 noreply\r\nbaz\r\n"
+                          "delete foo noreply\r\n"])
+        self.replicator.step()
+        self.server.loop.run_once()
+        self.assertEqual(self.follower.backlog, 0)
+
+    def test_paused(self):
+        self.replica.connection_made(self.transport)
+        self.replica.pause_writing()
+        self.server.loop.run_once()
+        self.server.cache.set("foo", "0", 0, "bar")
+        self.assertFalse(self.server.loop.callbacks)
+        self.assertFalse(self.transport.written)
+        self.replica.resume_writing()
+        self.server.loop.run_once()
+        self.assertEqual(self.transport.written, 
+                         ["flush_all noreply\r\n"
+                          "set foo 0 0 3 noreply\r\nbar\r\n"])
+
+    def test_reconnects(self):
+        self.replica.connection_made(self.transport)
+        self.replica.connection_lost(None)
+        self.assertFalse(self.follower.connected)
+        self.assertEqual(self.server.loop.later, 
+                         [(self.replica.RETRY_SECONDS, self.replica.connect)])
+        self.server.loop.run_once()
+        self.assertFalse(self.transport.written)
+
+    def test_close(self):
+        self.replica.connection_made(self.transport)
+        self.replica.close()
+        self.assertTrue(self.transport.closed)
+        self.replica.connection_lost(None)
+        self.assertFalse(self.server.loop.later)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,345 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memcache_client
+import memcache_connection
+import memcache_protocol
+import memory_cache
+import memory_cache_primitives
+import socket
+import threading
+import time
+import unittest
+
+class FakeServer(object):
+    """ a real server, just simpler, a thread per connection """
+    def __init__(self):
+        self.memcached = memory_cache.Memcached(memory_cache.MemcachedStats())
+        self.stats = memcache_connection.ConnectionStats()
+        self.reads = []
+        self.accepted = 0
+        self.silent = False
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.address = self.sock.getsockname()
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        listener = self.sock
+        while True:
+            try:
+                sock, address = listener.accept()
+            except socket.error:
+                return
+            self.accepted += 1
+            thread = threading.Thread(target=self.serve, args=(sock, address))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, sock, address):
+        protocol = memcache_protocol.MCProtocol(self.stats, self.memcached,
+                                                address)
+        while True:
+            try:
+                buf = memory_cache_primitives.to_str(sock.recv(65536))
+            except socket.error:
+                break
+            if not buf:
+                break
+            self.reads.append(buf)
+            if self.silent:
+                continue
+            reply = protocol.got_input(buf)
+            while True:
+                if reply:
+                    sock.sendall(memory_cache_primitives.to_bytes(reply))
+                if not protocol.has_pending():
+                    break
+                reply = protocol.got_input("")
+        sock.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+            self.sock = None
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [FakeServer() for _ in range(3)]
+        self.client = memcache_client.Client(
+            [server.address for server in self.servers], timeout=2.0)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def server_for(self, key):
+        address = self.client.ring.get_server(key)
+        return [server for server in self.servers 
+                if server.address == address][0]
+
+    def test_set_get(self):
+        self.assertTrue(self.client.set("foo", "bar", flags=5))
+        self.assertEqual(self.client.get("foo"), "bar")
+        self.assertEqual(self.server_for("foo").memcached.get(["foo"]),
+                         [("foo", "bar", "5")])
+        self.assertEqual(self.client.get("nothere"), None)
+
+    def test_storage(self):
+        self.assertTrue(self.client.add("foo", "bar"))
+        self.assertFalse(self.client.add("foo", "baz"))
+        self.assertTrue(self.client.replace("foo", "baz"))
+        self.assertFalse(self.client.replace("nothere", "baz"))
+        self.assertTrue(self.client.append("foo", "!"))
+        self.assertTrue(self.client.prepend("foo", "!"))
+        self.assertEqual(self.client.get("foo"), "!baz!")
+
+    def test_cas(self):
+        self.client.set("foo", "bar")
+        value, casunique = self.client.gets("foo")
+        self.assertEqual(value, "bar")
+        self.assertTrue(self.client.cas("foo", "baz", casunique))
+        self.assertFalse(self.client.cas("foo", "qux", casunique))
+        self.assertEqual(self.client.get("foo"), "baz")
+        self.assertEqual(self.client.gets("nothere"), None)
+
+    def test_delete_incr(self):
+        self.client.set("n", "5")
+        self.assertEqual(self.client.incr("n", 3), 8)
+        self.assertEqual(self.client.decr("n"), 7)
+        self.assertEqual(self.client.incr("nothere"), None)
+        self.assertTrue(self.client.delete("n"))
+        self.assertFalse(self.client.delete("n"))
+
+    def test_bad_keys(self):
+        self.assertTrue(self.client.set("x"*250, "bar"))
+        bad = ["", "x"*251, "two words", "foo\r\nflush_all", "nul\x00", 5]
+        if not isinstance(u"unicode", str): # python 2
+            bad.append(u"unicode")
+        for key in bad:
+            self.assertRaises(ValueError, self.client.set, key, "bar")
+            self.assertRaises(ValueError, self.client.get_multi, ["ok", key])
+            self.assertRaises(ValueError, self.client.delete, key)
+            self.assertRaises(ValueError, self.client.incr, key)
+        # none of them got through, the flush_all included
+        self.assertEqual(self.client.get_multi(["foo", "x"*250]), 
+                         {"x"*250: "bar"})
+
+    def test_bad_flags_and_values(self):
+        for flags in (-1, 2**32, "1", None):
+            self.assertRaises(ValueError, self.client.set, "foo", "bar", 
+                              flags=flags)
+        for value in (b"bar" if bytes is not str else u"bar", 5, None):
+            self.assertRaises(ValueError, self.client.set, "foo", value)
+            self.assertRaises(ValueError, self.client.append, "foo", value,
+                              noreply=True)
+        self.assertTrue(self.client.set("foo", "", flags=2**32 - 1))
+        self.assertTrue(self.client.set("bar", "baz", noreply=True) is None)
+        self.assertEqual(self.client.get_multi(["foo", "bar"]), 
+                         {"foo": "", "bar": "baz"})
+
+    def test_stray_reply_drops_connection(self):
+        self.client.set("foo", "bar")
+        pool = self.client.pools[self.server_for("foo").address]
+        conn = pool.get()
+        conn.sock.sendall(b"version\r\n")
+        for _ in range(100):
+            if conn.stale():
+                break
+            time.sleep(0.01)
+        pool.put(conn)
+        self.assertTrue(self.client.set("foo", "baz"))
+        self.assertEqual(self.client.get("foo"), "baz")
+
+    def test_multiget_one_request_per_server(self):
+        keys = ["key%d" % i for i in range(50)]
+        for key in keys:
+            self.client.set(key, key)
+        for server in self.servers:
+            server.reads = []
+        self.assertEqual(self.client.get_multi(keys + ["nothere"]),
+                         dict((key, key) for key in keys))
+        for server in self.servers:
+            self.assertEqual(len(server.reads), 1)
+            self.assertTrue(server.reads[0].startswith("get "))
+            for key in server.reads[0].split()[1:]:
+                self.assertEqual(self.client.ring.get_server(key), 
+                                 server.address)
+
+    def test_noreply(self):
+        self.assertEqual(self.client.set("foo", "bar", noreply=True), None)
+        self.assertEqual(self.client.delete("nothere", noreply=True), None)
+        self.assertEqual(self.client.get("foo"), "bar")
+
+    def test_pipeline(self):
+        results = (self.client.pipeline()
+                   .set("foo", "bar")
+                   .set("n", "1", noreply=True)
+                   .incr("n", 2)
+                   .get_multi(["foo", "n"])
+                   .delete("foo")
+                   .execute())
+        self.assertEqual(results, [True, None, 3, 
+                                   {"foo": ("0", "bar", None), 
+                                    "n": ("0", "3", None)}, 
+                                   True])
+
+    def test_pipeline_batches(self):
+        self.client.max_requests = 7
+        pipeline = self.client.pipeline()
+        for i in range(100):
+            pipeline.set("key%d" % i, str(i))
+        self.assertEqual(pipeline.execute(), [True]*100)
+        self.assertEqual(len(self.client.get_multi(
+                    ["key%d" % i for i in range(100)])), 100)
+
+    def test_connections_reused(self):
+        server = self.servers[0]
+        for _ in range(10):
+            self.client.flush_all()
+        self.assertEqual(server.accepted, 1)
+
+    def test_flush_all_version(self):
+        self.client.set("foo", "bar")
+        self.assertEqual(self.client.flush_all(), 
+                         dict((server.address, True) 
+                              for server in self.servers))
+        self.assertEqual(self.client.get("foo"), None)
+        self.assertEqual(set(self.client.version()), 
+                         set(server.address for server in self.servers))
+
+    def test_server_error(self):
+        self.assertRaises(memcache_client.ClientException, self.client.set,
+                          "foo", "x"*(memory_cache.DEFAULT_ITEM_SIZE_MAX + 1))
+        # the connection is still good
+        self.assertTrue(self.client.set("foo", "bar"))
+
+    def test_timeout(self):
+        self.client = memcache_client.Client(
+            [server.address for server in self.servers], timeout=0.1)
+        self.server_for("foo").silent = True
+        start = time.time()
+        self.assertRaises(memcache_client.ConnectionException, 
+                          self.client.get, "foo")
+        self.assertTrue(time.time() - start < 1.0)
+
+    def test_server_down(self):
+        down = self.server_for("foo")
+        down.close()
+        self.client = memcache_client.Client(
+            [server.address for server in self.servers], timeout=0.5)
+        self.assertRaises(memcache_client.ConnectionException, 
+                          self.client.set, "foo", "bar")
+        # the other servers still work
+        other = [key for key in ("key%d" % i for i in range(100))
+                 if self.client.ring.get_server(key) != down.address][0]
+        self.assertTrue(self.client.set(other, "bar"))
+
+    def test_threads_share(self):
+        errors = []
+        def run(n):
+            try:
+                for i in range(50):
+                    key = "t%d-%d" % (n, i)
+                    self.client.set(key, key)
+                    if self.client.get(key) != key:
+                        errors.append(key)
+            except memcache_client.ClientException as err:
+                errors.append(err)
+        threads = [threading.Thread(target=run, args=(n,)) 
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        for server in self.servers:
+            self.assertTrue(server.accepted <= 4)
+
+class TestPool(unittest.TestCase):
+
+    def test_waits_for_a_connection(self):
+        server = FakeServer()
+        pool = memcache_client.ConnectionPool(server.address, 1, 0.1)
+        conn = pool.get()
+        self.assertRaises(memcache_client.ConnectionException, pool.get)
+        pool.put(conn)
+        self.assertTrue(pool.get() is conn)
+        server.close()
+
+class TestClientProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = memcache_client.ClientProtocol()
+        self.replies = []
+
+    def test_pipelined_split_replies(self):
+        self.protocol.send("set a 0 0 1\r\na\r\n", False, self.replies.append)
+        self.protocol.send("get a b\r\n", True, self.replies.append)
+        self.protocol.send("delete b\r\n", False, self.replies.append)
+        self.assertEqual(self.protocol.pop_output(), 
+                         "set a 0 0 1\r\na\r\nget a b\r\ndelete b\r\n")
+        self.assertEqual(self.protocol.pop_output(), "")
+        data = "STORED\r\nVALUE a 0 1\r\na\r\nEND\r\nNOT_FOUND\r\n"
+        for char in data:
+            self.protocol.got_input(char)
+        self.assertEqual(self.replies, 
+                         ["STORED\r\n", [("a", "VALUE a 0 1\r\na\r\n")], 
+                          "NOT_FOUND\r\n"])
+
+    def test_value_with_crlf(self):
+        self.protocol.send("get a\r\n", True, self.replies.append)
+        self.protocol.got_input("VALUE a 0 4\r\n\r\n\r\n\r\nEND\r\n")
+        self.assertEqual(self.replies, [[("a", "VALUE a 0 4\r\n\r\n\r\n\r\n")]])
+
+    def test_error_instead_of_values(self):
+        self.protocol.send("get a\r\n", True, self.replies.append)
+        self.protocol.got_input("SERVER_ERROR out of memory\r\n")
+        self.assertEqual(self.replies, [None])
+
+    def test_reply_nobody_asked_for(self):
+        self.protocol.send("delete a\r\n", False, self.replies.append)
+        self.assertRaises(socket.error, self.protocol.got_input, 
+                          "DELETED\r\nERROR\r\n")
+        self.assertEqual(self.replies, ["DELETED\r\n"])
+
+    def test_fail(self):
+        self.protocol.send("get a\r\n", True, self.replies.append)
+        self.protocol.send("delete a\r\n", False, self.replies.append)
+        self.protocol.got_input("VALUE a 0 1\r\n")
+        self.protocol.fail()
+        self.assertEqual(self.replies, [None, None])
+        self.assertEqual(self.protocol.pop_output(), "")
+
+if __name__ == '__main__':
+    unittest.main()
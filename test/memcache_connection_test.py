@@ -29,6 +29,7 @@ or implied, of James Yates Farrimond.
 import memcache_connection
 import memcache_protocol
 import memory_cache
+import memory_cache_loader
 import socket
 import unittest
 
@@ -58,6 +59,27 @@ class MockSock(object):
         else:
             return len(buf)
 
+class TestConnectionStats(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = memcache_connection.ConnectionStats()
+
+    def test_listen_disabled(self):
+        self.stats.listen_disabled()
+        self.assertTrue(('listen_disabled_num', 1) in self.stats.dump(""))
+
+    def test_idle_kick(self):
+        self.stats.idle_kick()
+        self.assertTrue(('idle_kicks', 1) in self.stats.dump(""))
+
+    def test_accepted(self):
+        self.stats.accepted(3, False)
+        self.stats.accepted(16, True)
+        self.stats.accepted(1, False)
+        self.assertTrue(self.stats.accept_events == 3)
+        self.assertTrue(self.stats.accepts_max_event == 16)
+        self.assertTrue(self.stats.accept_budget_hits == 1)
+
 class TestProtocolBase(unittest.TestCase):
 
     def setUp(self):
@@ -77,6 +99,20 @@ class TestProtocolBase(unittest.TestCase):
         self.sock.buf = "s\r\n"
         self.assertTrue(self.mcsock.handle_read() == self.mcsock.FINISHED)
 
+    def test_read_noreply(self):
+        self.sock.buf = "set test_noreply 0 0 5 noreply\r\n12345\r\n"
+        self.assertTrue(self.mcsock.handle_read() == self.mcsock.CONTINUE)
+        self.assertTrue(self.mcsock.reply == "")
+
+    def test_read_pipelined_yield(self):
+        self.mcsock.protocol.max_requests = 1
+        self.sock.buf = "version\r\nversion\r\n"
+        self.assertTrue(self.mcsock.handle_read() == self.mcsock.FINISHED)
+        self.assertTrue(self.mcsock.reply.count("VERSION") == 1)
+        self.assertTrue(self.mcsock.handle_write() == self.mcsock.OK)
+        self.assertTrue(self.mcsock.reply.count("VERSION") == 1)
+        self.assertTrue(self.mcsock.handle_write() == self.mcsock.FINISHED)
+
     def test_read_socket_error(self):
         self.sock.raise_on_access = True
         self.assertTrue(self.mcsock.handle_read() == self.mcsock.ERROR)
@@ -89,6 +125,12 @@ class TestProtocolBase(unittest.TestCase):
         self.sock.buf = "quit\r\n"
         self.assertTrue(self.mcsock.handle_read() == self.mcsock.QUIT)
 
+    def test_read_line_too_long(self):
+        self.sock.buf = "x" * 4096
+        self.assertTrue(self.mcsock.handle_read() == self.mcsock.FINISHED)
+        self.assertTrue(self.mcsock.reply == "CLIENT_ERROR line too long\r\n")
+        self.assertTrue(self.mcsock.handle_write() == self.mcsock.QUIT)
+
     def test_read_connection_closed(self):
         self.assertTrue(self.mcsock.handle_read() == self.mcsock.ERROR)
 
@@ -96,6 +138,87 @@ class TestProtocolBase(unittest.TestCase):
         self.mcsock.reply = "STORED\r\n"
         self.assertTrue(self.mcsock.handle_write() == self.mcsock.FINISHED)
 
+    def test_drain_idle(self):
+        self.assertTrue(not self.mcsock.drain())
+
+    def test_drain_pending(self):
+        self.mcsock.protocol.max_requests = 1
+        self.sock.buf = "version\r\nversion\r\n"
+        self.mcsock.handle_read()
+        self.assertTrue(self.mcsock.drain())
+        self.assertTrue(self.mcsock.handle_write() == self.mcsock.OK)
+        self.assertTrue(self.mcsock.reply.count("VERSION") == 1)
+        self.assertTrue(self.mcsock.handle_write() == self.mcsock.QUIT)
+        self.assertTrue(self.stats.curr_connections == 0)
+
+    def test_metadump_streamed(self):
+        self.mc.METADUMP_SCAN = 1
+        for key in ('key1', 'key2', 'key3'):
+            self.mc.set(key, '0', 0, 'value')
+        self.sock.buf = "lru_crawler metadump all\r\n"
+        self.assertTrue(self.mcsock.handle_read() == self.mcsock.FINISHED)
+        writes = 1
+        while self.mcsock.handle_write() == self.mcsock.OK:
+            writes += 1
+        self.assertTrue(writes > 2)
+        self.assertTrue(not self.mcsock.protocol.has_pending())
+
+    def test_watch_pushed(self):
+        self.sock.buf = "watch\r\n"
+        self.assertTrue(self.mcsock.handle_read() == self.mcsock.FINISHED)
+        self.mc.set('key1', '0', 0, 'value')
+        # the OK is still going out, so this waits
+        self.assertTrue(self.mcsock.push_ready() == self.mcsock.FINISHED)
+        self.assertTrue(self.mcsock.reply == "OK\r\n")
+        self.assertTrue(self.mcsock.handle_write() == self.mcsock.OK)
+        self.assertTrue(self.mcsock.reply == "INVALIDATE key1\r\n")
+        self.assertTrue(self.mcsock.handle_write() == self.mcsock.FINISHED)
+        self.mc.set('key2', '0', 0, 'value')
+        self.assertTrue(self.mcsock.push_ready() == self.mcsock.FINISHED)
+        self.assertTrue(self.mcsock.reply == "INVALIDATE key2\r\n")
+        self.mcsock.close()
+        self.assertTrue(self.mc.invalidations.subscribers == {})
+
+    def test_read_through(self):
+        fetching = []
+        self.mc = memory_cache.Memcached(
+            self.stats, loader=memory_cache_loader.Loader(
+                lambda key, done: fetching.append(done)))
+        self.mcsock = memcache_connection.MemcachedSocket(self.sock, 'address', self.stats, self.mc)
+        self.mcsock.protocol.on_push = self.mcsock.push_ready
+        self.sock.buf = "get key\r\n"
+        self.assertTrue(self.mcsock.handle_read() == self.mcsock.WAITING)
+        self.assertTrue(self.mcsock.drain())
+        self.assertTrue(self.mcsock.handle_write() == self.mcsock.WAITING)
+        self.assertTrue(not self.mcsock.closed)
+        fetching[0]('value')
+        self.assertTrue(self.mcsock.handle_write() == self.mcsock.OK)
+        self.assertTrue(self.mcsock.reply == 
+                        "VALUE key 0 5\r\nvalue\r\nEND\r\n")
+        self.assertTrue(self.mcsock.handle_write() == self.mcsock.QUIT)
+
+    def test_read_through_pipelined(self):
+        fetching = []
+        self.mc = memory_cache.Memcached(
+            self.stats, loader=memory_cache_loader.Loader(
+                lambda key, done: fetching.append(done)))
+        self.mcsock = memcache_connection.MemcachedSocket(self.sock, 'address', self.stats, self.mc)
+        self.mcsock.protocol.on_push = self.mcsock.push_ready
+        self.sock.buf = "version\r\nget key\r\n"
+        self.assertTrue(self.mcsock.handle_read() == self.mcsock.FINISHED)
+        self.assertTrue(self.mcsock.handle_write() == self.mcsock.WAITING)
+        fetching[0]('value')
+        self.assertTrue(self.mcsock.push_ready() == self.mcsock.FINISHED)
+        self.assertTrue(self.mcsock.handle_write() == self.mcsock.OK)
+        self.assertTrue(self.mcsock.reply == 
+                        "VALUE key 0 5\r\nvalue\r\nEND\r\n")
+        self.assertTrue(self.mcsock.handle_write() == self.mcsock.FINISHED)
+
+    def test_close_twice(self):
+        self.mcsock.close()
+        self.mcsock.close()
+        self.assertTrue(self.stats.curr_connections == 0)
+
     def test_write_socket_error(self):
         self.sock.raise_on_access = True
         self.assertTrue(self.mcsock.handle_write() == self.mcsock.ERROR)
@@ -0,0 +1,269 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memcache_client
+import memcache_embedded
+import socket
+import threading
+import time
+import unittest
+
+class TestCheckKey(unittest.TestCase):
+
+    def test_good(self):
+        memcache_embedded.check_key("foo")
+        memcache_embedded.check_key("x" * 250)
+
+    def test_bad(self):
+        if not isinstance(u"foo", str): # python 2
+            self.assertRaises(TypeError, memcache_embedded.check_key, u"foo")
+        self.assertRaises(TypeError, memcache_embedded.check_key, 1)
+        self.assertRaises(ValueError, memcache_embedded.check_key, "")
+        self.assertRaises(ValueError, memcache_embedded.check_key, "x" * 251)
+        self.assertRaises(ValueError, memcache_embedded.check_key, "a b")
+        self.assertRaises(ValueError, memcache_embedded.check_key, "a\r\n")
+
+class TestEmbeddedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = memcache_embedded.EmbeddedCache(item_size_max=100)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_set_get(self):
+        self.assertTrue(self.cache.set("foo", "bar", flags=5))
+        self.assertEqual(self.cache.get("foo"), "bar")
+        self.assertEqual(self.cache.get("nothere"), None)
+        self.assertEqual(self.cache.get("nothere", "default"), "default")
+        item = self.cache.gets("foo")
+        self.assertEqual((item.value, item.flags), ("bar", 5))
+        self.assertEqual(self.cache.gets("nothere"), None)
+        self.assertEqual(len(self.cache), 1)
+
+    def test_bad_arguments(self):
+        self.assertRaises(TypeError, self.cache.set, "foo", 1)
+        self.assertRaises(ValueError, self.cache.set, "foo", "x" * 101)
+        self.assertRaises(ValueError, self.cache.set, "foo", "bar", flags=-1)
+        self.assertRaises(ValueError, self.cache.set, "foo", "bar", 
+                          flags=2**32)
+        self.assertRaises(TypeError, self.cache.set, "foo", "bar", 
+                          flags="1")
+        self.assertRaises(ValueError, self.cache.get_multi, ["ok", "not ok"])
+        self.assertRaises(ValueError, self.cache.incr, "foo", -1)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_add_replace(self):
+        self.assertFalse(self.cache.replace("foo", "bar"))
+        self.assertTrue(self.cache.add("foo", "bar"))
+        self.assertFalse(self.cache.add("foo", "baz"))
+        self.assertTrue(self.cache.replace("foo", "baz"))
+        self.assertEqual(self.cache.get("foo"), "baz")
+
+    def test_append_prepend(self):
+        self.assertFalse(self.cache.append("foo", "bar"))
+        self.cache.set("foo", "b", flags=3)
+        self.assertTrue(self.cache.append("foo", "c"))
+        self.assertTrue(self.cache.prepend("foo", "a"))
+        self.assertEqual(self.cache.gets("foo")[:2], ("abc", 3))
+
+    def test_append_too_large(self):
+        self.cache.set("foo", "x" * 60)
+        self.assertTrue(self.cache.append("foo", "y" * 40))
+        self.assertRaises(ValueError, self.cache.append, "foo", "z")
+        self.assertRaises(ValueError, self.cache.prepend, "foo", "z")
+        self.assertEqual(len(self.cache.get("foo")), 100)
+
+    def test_cas(self):
+        self.cache.set("foo", "bar")
+        casunique = self.cache.gets("foo").casunique
+        self.assertTrue(self.cache.cas("foo", "baz", casunique))
+        self.assertFalse(self.cache.cas("foo", "qux", casunique))
+        self.assertEqual(self.cache.get("foo"), "baz")
+
+    def test_multi(self):
+        self.cache.set_multi({"a": "1", "b": "2"}, flags=7)
+        self.assertEqual(self.cache.get_multi(["a", "b", "c"]),
+                         {"a": "1", "b": "2"})
+        items = self.cache.gets_multi(["a", "c"])
+        self.assertEqual(list(items), ["a"])
+        self.assertEqual(items["a"].flags, 7)
+        self.assertEqual(self.cache.touch_multi(["a", "c"], 100), ["a"])
+        self.assertEqual(self.cache.delete_multi(["a", "c"]), ["a"])
+        self.assertEqual(self.cache.get_multi(["a", "b"]), {"b": "2"})
+
+    def test_delete_touch(self):
+        self.assertFalse(self.cache.delete("foo"))
+        self.assertFalse(self.cache.touch("foo", 100))
+        self.cache.set("foo", "bar")
+        self.assertTrue(self.cache.touch("foo", int(time.time()) - 10))
+        self.assertEqual(self.cache.get("foo"), None)
+        self.cache.set("foo", "bar")
+        self.assertTrue(self.cache.delete("foo"))
+        self.assertEqual(self.cache.get("foo"), None)
+
+    def test_incr_decr(self):
+        self.assertEqual(self.cache.incr("n"), None)
+        self.cache.set("n", "10")
+        self.assertEqual(self.cache.incr("n", 5), 15)
+        self.assertEqual(self.cache.decr("n"), 14)
+        self.cache.set("s", "abc")
+        self.assertRaises(ValueError, self.cache.incr, "s")
+
+    def test_flush_all(self):
+        self.cache.set("foo", "bar")
+        self.cache.flush_all()
+        self.assertEqual(self.cache.get("foo"), None)
+
+    def test_stats(self):
+        self.cache.set("foo", "bar")
+        self.cache.get("foo")
+        self.cache.get("nothere")
+        stats = self.cache.get_stats()
+        self.assertEqual((stats["cmd_set"], stats["get_hits"], 
+                          stats["get_misses"]), (1, 1, 1))
+
+    def test_expire(self):
+        self.cache.expire_batch = 2
+        self.cache.set("gone1", "x", exptime=int(time.time()) - 10)
+        self.cache.set("gone2", "x", exptime=int(time.time()) - 10)
+        self.cache.set("stays", "x")
+        self.assertEqual(self.cache.expire() + self.cache.expire(), 2)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.expire(), 0)
+
+    def test_expire_thread(self):
+        cache = memcache_embedded.EmbeddedCache(expire_interval=0.01)
+        cache.set("gone", "x", exptime=int(time.time()) - 10)
+        for _ in range(200):
+            if not len(cache):
+                break
+            time.sleep(0.01)
+        cache.close()
+        self.assertEqual(len(cache), 0)
+
+    def test_threads(self):
+        self.cache.set("n", "0")
+        def count():
+            for _ in range(500):
+                self.cache.incr("n")
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.cache.get("n"), "2000")
+
+class TestShardedEmbeddedCache(TestEmbeddedCache):
+    """ the same, with no lock but the shards' """
+
+    def setUp(self):
+        self.cache = memcache_embedded.EmbeddedCache(item_size_max=100, 
+                                                     shards=4)
+
+    def test_sharded(self):
+        self.assertTrue(self.cache.sharded)
+        for i in range(40):
+            self.cache.set("key%d" % i, "x")
+        self.assertEqual(len(self.cache), 40)
+        self.assertTrue(all(shard.engine.cache.item_count 
+                            for shard in self.cache.memcached.shards))
+
+class TestListener(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = memcache_embedded.EmbeddedCache()
+        self.address = self.cache.listen()
+        self.client = memcache_client.Client([self.address])
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_shared(self):
+        self.cache.set("foo", "bar")
+        self.assertEqual(self.client.get("foo"), "bar")
+        self.client.set("baz", "qux")
+        self.assertEqual(self.cache.get("baz"), "qux")
+        self.assertRaises(ValueError, self.cache.listen)
+
+    def test_connections(self):
+        self.client.get("foo")
+        self.assertEqual(self.cache.get_stats()["curr_connections"], 1)
+
+    def test_errors(self):
+        sock = socket.create_connection(self.address)
+        reader = sock.makefile("rb")
+        sock.sendall(b"bogus\r\n")
+        self.assertEqual(reader.readline(), b"ERROR\r\n")
+        sock.sendall(b"get foo\r\n")
+        self.assertEqual(reader.readline(), b"END\r\n")
+        sock.sendall(b"quit\r\n")
+        self.assertEqual(reader.readline(), b"")
+        sock.close()
+
+    def test_flags(self):
+        self.cache.set("foo", "bar", flags=12345)
+        sock = socket.create_connection(self.address)
+        reader = sock.makefile("rb")
+        sock.sendall(b"get foo\r\n")
+        self.assertEqual(reader.readline(), b"VALUE foo 12345 3\r\n")
+        self.assertEqual(reader.readline(), b"bar\r\n")
+        self.assertEqual(reader.readline(), b"END\r\n")
+        sock.sendall(("set baz %d 0 1\r\nx\r\n" %
+                      memcache_embedded.MAX_FLAGS).encode())
+        self.assertEqual(reader.readline(), b"STORED\r\n")
+        self.assertEqual(self.cache.gets("baz").flags, 
+                         memcache_embedded.MAX_FLAGS)
+        sock.close()
+
+    def test_watch(self):
+        sock = socket.create_connection(self.address)
+        sock.sendall(b"watch\r\n")
+        reader = sock.makefile("rb")
+        self.assertEqual(reader.readline(), b"OK\r\n")
+        self.cache.set("foo", "bar")
+        self.assertEqual(reader.readline(), b"INVALIDATE foo\r\n")
+        sock.close()
+
+    def test_close(self):
+        self.client.get("foo")
+        self.cache.close()
+        self.assertRaises(memcache_client.ConnectionException, 
+                          self.client.get, "foo")
+        self.assertRaises(socket.error, socket.create_connection, 
+                          self.address)
+
+class TestShardedListener(TestListener):
+
+    def setUp(self):
+        self.cache = memcache_embedded.EmbeddedCache(shards=4)
+        self.address = self.cache.listen()
+        self.client = memcache_client.Client([self.address])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memcache_handoff
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+class TestHandoff(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'handoff')
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+
+    def tearDown(self):
+        self.listener.close()
+        shutil.rmtree(self.dir)
+
+    def test_nobody_there(self):
+        self.assertTrue(memcache_handoff.take_listener(self.path) is None)
+
+    def test_stale_path(self):
+        handoff_sock = memcache_handoff.listen(self.path)
+        handoff_sock.close()
+        self.assertTrue(memcache_handoff.take_listener(self.path) is None)
+        handoff_sock = memcache_handoff.listen(self.path)
+        handoff_sock.close()
+
+    def test_nobody_connected(self):
+        handoff_sock = memcache_handoff.listen(self.path)
+        self.assertTrue(not memcache_handoff.send_listener(handoff_sock, 
+                                                           self.listener))
+        handoff_sock.close()
+
+    def test_handoff(self):
+        handoff_sock = memcache_handoff.listen(self.path)
+        taken = []
+        thread = threading.Thread(
+            target=lambda: taken.append(
+                memcache_handoff.take_listener(self.path)))
+        thread.start()
+        handoff_sock.setblocking(1)
+        self.assertTrue(memcache_handoff.send_listener(handoff_sock, 
+                                                       self.listener))
+        thread.join()
+        handoff_sock.close()
+        address = self.listener.getsockname()
+        self.listener.close()
+
+        # the old socket is gone, but clients still get through
+        listener = taken[0]
+        self.assertTrue(listener.getsockname() == address)
+        client = socket.create_connection(address)
+        sock, _ = listener.accept()
+        client.sendall(b"version\r\n")
+        self.assertTrue(sock.recv(100) == b"version\r\n")
+        sock.close()
+        client.close()
+        listener.close()
+
+if __name__ == "__main__":
+    unittest.main()
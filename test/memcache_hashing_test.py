@@ -0,0 +1,96 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memcache_hashing
+import unittest
+
+SERVERS = [('10.0.0.1', 11211), ('10.0.0.2', 11211), ('10.0.0.3', 11211)]
+
+class TestRing(unittest.TestCase):
+
+    def test_same_ring_same_server(self):
+        ring1 = memcache_hashing.Ring(SERVERS)
+        ring2 = memcache_hashing.Ring(reversed(SERVERS))
+        for i in range(1000):
+            key = "key%d" % i
+            self.assertEqual(ring1.get_server(key), ring2.get_server(key))
+
+    def test_points(self):
+        ring = memcache_hashing.Ring(SERVERS, 40)
+        self.assertEqual(len(ring.points), 120)
+        self.assertEqual(ring.points, sorted(ring.points))
+
+    def test_spread(self):
+        ring = memcache_hashing.Ring(SERVERS)
+        counts = dict((server, 0) for server in SERVERS)
+        for i in range(30000):
+            counts[ring.get_server("key%d" % i)] += 1
+        for count in counts.values():
+            self.assertTrue(7000 < count < 13000, counts)
+
+    def test_adding_a_server_moves_few_keys(self):
+        ring1 = memcache_hashing.Ring(SERVERS)
+        ring2 = memcache_hashing.Ring(SERVERS + [('10.0.0.4', 11211)])
+        moved = 0
+        for i in range(10000):
+            key = "key%d" % i
+            server = ring2.get_server(key)
+            if server != ring1.get_server(key):
+                self.assertEqual(server, ('10.0.0.4', 11211))
+                moved += 1
+        self.assertTrue(1500 < moved < 3500, moved)
+
+    def test_wraparound(self):
+        ring = memcache_hashing.Ring(SERVERS)
+        # squeeze the points into the bottom half of the ring, a key 
+        # past the last point belongs to the first
+        ring.points = [point // 2 for point in ring.points]
+        key = "key0"
+        while memcache_hashing.key_hash(key) < 2**31:
+            key += "x"
+        self.assertEqual(ring.get_server(key), ring.point_servers[0])
+
+    def test_split(self):
+        ring = memcache_hashing.Ring(SERVERS)
+        keys = ["key%d" % i for i in range(100)]
+        parts = ring.split(keys)
+        self.assertEqual(len(parts), 3)
+        self.assertEqual(parts[0][0], ring.get_server(keys[0]))
+        regrouped = []
+        for server, server_keys in parts:
+            for key in server_keys:
+                self.assertEqual(ring.get_server(key), server)
+            regrouped.extend(server_keys)
+        self.assertEqual(sorted(regrouped), sorted(keys))
+        for server, server_keys in parts:
+            self.assertEqual(server_keys, 
+                             [key for key in keys 
+                              if ring.get_server(key) == server])
+
+if __name__ == '__main__':
+    unittest.main()
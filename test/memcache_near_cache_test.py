@@ -0,0 +1,217 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memcache_client
+import memcache_connection
+import memcache_near_cache
+import memcache_protocol
+import memory_cache
+import memory_cache_primitives
+import socket
+import threading
+import time
+import unittest
+
+class FakeServer(object):
+    """ a real server, just simpler, a thread per connection """
+    def __init__(self):
+        self.memcached = memory_cache.Memcached(memory_cache.MemcachedStats())
+        self.stats = memcache_connection.ConnectionStats()
+        self.watchers = []
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.address = self.sock.getsockname()
+        self.thread = threading.Thread(target=self.accept)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def accept(self):
+        listener = self.sock
+        while True:
+            try:
+                sock, address = listener.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self.serve, args=(sock, address))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, sock, address):
+        protocol = memcache_protocol.MCProtocol(self.stats, self.memcached,
+                                                address)
+        lock = threading.Lock()
+        def send(data):
+            with lock:
+                sock.sendall(memory_cache_primitives.to_bytes(data))
+        protocol.on_push = lambda: send(protocol.pop_pushed())
+        while True:
+            try:
+                buf = memory_cache_primitives.to_str(sock.recv(65536))
+            except socket.error:
+                break
+            if not buf:
+                break
+            reply = protocol.got_input(buf)
+            if protocol.watching and sock not in self.watchers:
+                self.watchers.append(sock)
+            while True:
+                if reply:
+                    send(reply)
+                if not protocol.has_pending():
+                    break
+                reply = protocol.got_input("")
+        protocol.close()
+        sock.close()
+
+    def hang_up(self):
+        """ drop the watch connections """
+        for sock in self.watchers:
+            sock.shutdown(socket.SHUT_RDWR)
+        self.watchers = []
+
+    def close(self):
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+        self.thread.join()
+
+def wait_for(condition):
+    """ wait for the watcher threads to catch up """
+    for _ in range(200):
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+class TestNearCache(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [FakeServer() for _ in range(2)]
+        self.client = memcache_client.Client(
+            [server.address for server in self.servers])
+        self.near = memcache_near_cache.NearCache(self.client, max_items=10,
+                                                  ttl=60, retry_seconds=0.05)
+        self.assertTrue(wait_for(self.near.watching))
+        # another client, changing things behind the near cache's back
+        self.other = memcache_client.Client(
+            [server.address for server in self.servers])
+
+    def set(self, key, value):
+        """ set key, and wait for its invalidation to come back """
+        invalidations = self.near.invalidations
+        self.client.set(key, value)
+        self.assertTrue(wait_for(
+            lambda: self.near.invalidations > invalidations))
+
+    def tearDown(self):
+        self.near.close()
+        for server in self.servers:
+            server.close()
+
+    def test_hits(self):
+        self.set("foo", "bar")
+        self.assertEqual(self.near.get("foo"), "bar")
+        self.assertEqual(self.near.get("foo"), "bar")
+        self.assertEqual(self.near.get("nothere"), None)
+        self.assertEqual(self.near.get("nothere"), None)
+        self.assertEqual((self.near.hits, self.near.misses), (2, 2))
+
+    def test_get_multi(self):
+        for key in ("a", "b", "c"):
+            self.set(key, key)
+        self.assertEqual(self.near.get_multi(["a", "b"]), 
+                         {"a": "a", "b": "b"})
+        self.assertEqual(self.near.get_multi(["a", "b", "c", "d"]), 
+                         {"a": "a", "b": "b", "c": "c"})
+        self.assertEqual((self.near.hits, self.near.misses), (2, 4))
+
+    def test_invalidated_by_other_clients(self):
+        self.set("foo", "bar")
+        self.assertEqual(self.near.get("foo"), "bar")
+        self.other.set("foo", "baz")
+        self.assertTrue(wait_for(lambda: self.near.get("foo") == "baz"))
+        self.other.delete("foo")
+        self.assertTrue(wait_for(lambda: self.near.get("foo") is None))
+        self.near.get("nothere")
+        self.other.set("nothere", "now")
+        self.assertTrue(wait_for(lambda: self.near.get("nothere") == "now"))
+
+    def test_flush_all(self):
+        self.set("foo", "bar")
+        self.near.get("foo")
+        self.other.flush_all()
+        self.assertTrue(wait_for(lambda: self.near.get("foo") is None))
+
+    def test_own_writes(self):
+        self.near.set("foo", "bar")
+        self.assertEqual(self.near.get("foo"), "bar")
+        self.near.set("foo", "baz")
+        self.assertEqual(self.near.get("foo"), "baz")
+        self.near.delete("foo")
+        self.assertEqual(self.near.get("foo"), None)
+
+    def test_bounded(self):
+        for i in range(20):
+            self.near.get("key%d" % i)
+        self.assertEqual(len(self.near.items), 10)
+        self.assertEqual(list(self.near.items)[0], "key10")
+
+    def test_ttl(self):
+        self.near.ttl = 0.01
+        self.set("foo", "bar")
+        self.near.get("foo")
+        time.sleep(0.02)
+        self.near.get("foo")
+        self.assertEqual(self.near.misses, 2)
+
+    def test_prefixes(self):
+        self.near.close()
+        self.near = memcache_near_cache.NearCache(self.client, ttl=60,
+                                                  prefixes=["hot/"])
+        self.assertTrue(wait_for(self.near.watching))
+        self.near.get("hot/1")
+        self.near.get("cold/1")
+        self.assertEqual(list(self.near.items), ["hot/1"])
+
+    def test_stale_fetch_not_kept(self):
+        version = self.near.version
+        self.near.invalidate("foo")
+        self.near._fill({"foo": "old"}, version)
+        self.assertEqual(self.near.items, {})
+
+    def test_reconnect(self):
+        self.set("foo", "bar")
+        self.near.get("foo")
+        self.servers[0].hang_up()
+        self.assertTrue(wait_for(lambda: not self.near.items))
+        self.assertTrue(wait_for(self.near.watching))
+        self.near.get("foo")
+        self.assertEqual(list(self.near.items), ["foo"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -27,9 +27,11 @@ authors and should not be interpreted as representing official policies, either
 or implied, of James Yates Farrimond.
 """
 import memory_cache
+import memory_cache_loader
 import memcache_protocol
 import memcache_protocol_execute
 import memcache_protocol_parse
+import time
 import unittest
 
 class TestProtocolBase(unittest.TestCase):
@@ -119,6 +121,229 @@ class TestMCProtocol_Parsing_Partial(unittest.TestCase):
         output = self.mc.got_input("\n")
         self.assertTrue(output == "STORED\r\n")
 
+class TestMCProtocol_Pipelining(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = memcache_protocol.ProtocolStats()
+        self.mc = memcache_protocol.MCProtocol(self.stats, 
+                                               memory_cache.Memcached(self.stats),
+                                               ('127.0.0.1', 11211), 2)
+
+    def test_pipelined(self):
+        output = self.mc.got_input("set test_pipe 0 0 5\r\n12345\r\nget test_pipe\r\n")
+        self.assertTrue(output == "STORED\r\nVALUE test_pipe 0 5\r\n12345\r\nEND\r\n")
+        self.assertTrue(self.mc.pending == "")
+
+    def test_pipelined_partial(self):
+        output = self.mc.got_input("set test_pipe 0 0 5\r\n12345\r\nget test_")
+        self.assertTrue(output == "STORED\r\n")
+        output = self.mc.got_input("pipe\r\n")
+        self.assertTrue(output == "VALUE test_pipe 0 5\r\n12345\r\nEND\r\n")
+
+    def test_yield(self):
+        output = self.mc.got_input("version\r\nversion\r\nversion\r\n")
+        self.assertTrue(output.count("VERSION") == 2)
+        self.assertTrue(self.mc.pending == "version\r\n")
+        self.assertTrue(self.stats.conn_yields == 1)
+        output = self.mc.got_input("")
+        self.assertTrue(output.count("VERSION") == 1)
+        self.assertTrue(self.mc.pending == "")
+
+    def test_error_keeps_replies(self):
+        with self.assertRaises(memcache_protocol_parse.ProtocolException) as ctx:
+            self.mc.got_input("version\r\nflub\r\n")
+        self.assertTrue(ctx.exception.msg.startswith("VERSION "))
+        self.assertTrue(ctx.exception.msg.endswith("ERROR\r\n"))
+        output = self.mc.got_input("version\r\n")
+        self.assertTrue(output.startswith("VERSION "))
+
+class TestMCProtocol_Metadump(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = memcache_protocol.ProtocolStats()
+        self.memcached = memory_cache.Memcached(self.stats)
+        self.memcached.METADUMP_SCAN = 2
+        self.mc = memcache_protocol.MCProtocol(self.stats, self.memcached,
+                                               ('127.0.0.1', 11211))
+        for key in ('a/1', 'a/2', 'b/1', 'b/2', 'a/3'):
+            self.memcached.set(key, '3', 0, 'value')
+
+    def dump(self, command):
+        outputs = [self.mc.got_input(command)]
+        while self.mc.has_pending():
+            outputs.append(self.mc.got_input(""))
+        return outputs
+
+    def test_streamed(self):
+        outputs = self.dump("lru_crawler metadump all\r\n")
+        self.assertTrue(len(outputs) > 2)
+        output = "".join(outputs)
+        self.assertTrue(output.endswith("END\r\n"))
+        self.assertTrue(output.count("key=") == 5)
+        self.assertTrue("key=a%2F1 exp=-1 la=" in output)
+        self.assertTrue(" flags=3 size=9\r\n" in output)
+
+    def test_prefix(self):
+        output = "".join(self.dump("lru_crawler metadump all b/\r\n"))
+        self.assertTrue(output.count("key=") == 2)
+        self.assertTrue(output.count("key=b%2F") == 2)
+
+    def test_commands_wait(self):
+        outputs = self.dump("lru_crawler metadump all\r\nversion\r\n")
+        self.assertTrue(outputs[-1].startswith("VERSION "))
+        self.assertTrue("".join(outputs).count("END\r\n") == 1)
+
+    def test_changed_while_streaming(self):
+        self.mc.got_input("lru_crawler metadump all\r\n")
+        for key in list(self.memcached.cache.the_cache.keys()):
+            self.memcached.delete(key)
+        self.memcached.set('new', '0', 0, 'value')
+        outputs = []
+        while self.mc.has_pending():
+            outputs.append(self.mc.got_input(""))
+        self.assertTrue("".join(outputs).endswith("END\r\n"))
+
+    def test_bad(self):
+        for command in ("lru_crawler metadump\r\n", 
+                        "lru_crawler crawl all\r\n",
+                        "lru_crawler metadump 1\r\n"):
+            self.assertRaises(memcache_protocol_parse.ProtocolException,
+                              self.mc.got_input, command)
+
+class TestMCProtocol_Watch(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = memcache_protocol.ProtocolStats()
+        self.memcached = memory_cache.Memcached(self.stats)
+        self.mc = memcache_protocol.MCProtocol(self.stats, self.memcached,
+                                               ('127.0.0.1', 11211))
+        self.pushes = []
+        self.mc.on_push = lambda: self.pushes.append(True)
+
+    def test_watch(self):
+        self.assertTrue(self.mc.got_input("watch a/ b/\r\n") == "OK\r\n")
+        self.memcached.set('a/1', '0', 0, 'value')
+        self.memcached.set('c/1', '0', 0, 'value')
+        self.memcached.delete('a/1')
+        self.memcached.set('b/1', '0', 0, 'value')
+        self.assertTrue(self.pushes == [True])
+        self.assertTrue(self.mc.pop_pushed() == 
+                        "INVALIDATE a/1\r\nINVALIDATE a/1\r\n"
+                        "INVALIDATE b/1\r\n")
+        self.memcached.flush(0)
+        self.assertTrue(self.mc.pop_pushed() == "INVALIDATE_ALL\r\n")
+        self.assertTrue(self.pushes == [True, True])
+
+    def test_watch_everything(self):
+        self.mc.got_input("watch\r\n")
+        self.memcached.set('anything', '0', 0, 'value')
+        self.assertTrue(self.mc.pop_pushed() == "INVALIDATE anything\r\n")
+
+    def test_too_far_behind(self):
+        self.mc.MAX_PUSHED = 3
+        self.mc.got_input("watch\r\n")
+        for i in range(10):
+            self.memcached.set('key%d' % i, '0', 0, 'value')
+        self.assertTrue(self.mc.pop_pushed() == "INVALIDATE_ALL\r\n")
+        self.memcached.set('key', '0', 0, 'value')
+        self.assertTrue(self.mc.pop_pushed() == "INVALIDATE key\r\n")
+
+    def test_close_unwatches(self):
+        self.mc.got_input("watch\r\n")
+        self.mc.close()
+        self.memcached.set('key', '0', 0, 'value')
+        self.assertTrue(self.mc.pushed == [])
+        self.assertTrue(self.memcached.invalidations.subscribers == {})
+
+class TestMCProtocol_Leases(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = memcache_protocol.ProtocolStats()
+        self.memcached = memory_cache.Memcached(self.stats, stale_seconds=60)
+        self.mc = memcache_protocol.MCProtocol(self.stats, self.memcached,
+                                               ('127.0.0.1', 11211))
+
+    def test_lget(self):
+        self.mc.got_input("set hit 3 0 5\r\nvalue\r\n")
+        self.assertTrue(self.mc.got_input("lget hit miss\r\n") == 
+                        "VALUE hit 3 5\r\nvalue\r\nLEASE miss 1\r\nEND\r\n")
+        self.assertTrue(self.mc.got_input("lget miss\r\n") == 
+                        "WAIT miss\r\nEND\r\n")
+
+    def test_lset(self):
+        self.mc.got_input("lget key\r\n")
+        self.assertTrue(self.mc.got_input("lset key 0 0 3 2\r\nbad\r\n") ==
+                        "NOT_STORED\r\n")
+        self.assertTrue(self.mc.got_input("lset key 0 0 3 1\r\nnew\r\n") ==
+                        "STORED\r\n")
+        self.assertTrue(self.mc.got_input("get key\r\n") == 
+                        "VALUE key 0 3\r\nnew\r\nEND\r\n")
+        self.assertTrue(self.mc.got_input(
+                "lset key 0 0 3 1 noreply\r\nold\r\n") == "")
+        self.assertTrue(self.memcached.get(["key"])[0][1] == "new")
+
+    def test_stale(self):
+        self.memcached.set("key", "4", int(time.time()) - 10, "old")
+        self.assertTrue(self.mc.got_input("lget key\r\n") == 
+                        "LEASE key 1\r\nSTALE key 4 3\r\nold\r\nEND\r\n")
+        self.assertTrue(self.mc.got_input("lget key\r\n") == 
+                        "STALE key 4 3\r\nold\r\nEND\r\n")
+
+    def test_lset_bad(self):
+        self.assertRaises(memcache_protocol_parse.ProtocolException,
+                          self.mc.got_input, "lset key 0 0 3\r\nnew\r\n")
+
+class TestMCProtocol_Loader(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = memcache_protocol.ProtocolStats()
+        self.fetching = []
+        self.memcached = memory_cache.Memcached(
+            self.stats, loader=memory_cache_loader.Loader(
+                lambda key, done: self.fetching.append(done)))
+        self.ready = []
+        self.mc = self.protocol()
+        self.other = self.protocol()
+
+    def protocol(self):
+        mc = memcache_protocol.MCProtocol(self.stats, self.memcached,
+                                          ('127.0.0.1', 11211))
+        mc.on_push = lambda: self.ready.append(mc)
+        return mc
+
+    def test_read_through(self):
+        self.assertTrue(self.mc.got_input("get key\r\nversion\r\n") == "")
+        self.assertTrue(self.mc.waiting() and not self.mc.has_pending())
+        self.assertTrue(self.mc.blocked())
+        self.assertTrue(self.mc.got_input("gets key\r\n") is None)
+        self.assertTrue(self.other.got_input("get key\r\n") == "")
+        self.assertTrue(len(self.fetching) == 1)
+        self.fetching[0]('value', '2')
+        self.assertTrue(self.ready == [self.mc, self.other])
+        self.assertTrue(self.mc.has_pending() and not self.mc.blocked())
+        output = self.mc.got_input("")
+        self.assertTrue(output.startswith("VALUE key 2 5\r\nvalue\r\nEND\r\n"
+                                          "VERSION "))
+        self.assertTrue(output.endswith("END\r\n"))
+        self.assertTrue(self.other.got_input("") == 
+                        "VALUE key 2 5\r\nvalue\r\nEND\r\n")
+        self.assertTrue(self.stats.get_hits == 3)
+        self.assertTrue(self.mc.got_input("get key\r\n") == 
+                        "VALUE key 2 5\r\nvalue\r\nEND\r\n")
+
+    def test_backend_miss(self):
+        self.mc.got_input("get key\r\n")
+        self.fetching[0](None)
+        self.assertTrue(self.mc.got_input("") == "END\r\n")
+        self.assertTrue(not self.mc.waiting())
+        self.assertTrue(self.stats.loader_misses == 1)
+
+    def test_hit(self):
+        self.memcached.set('key', '0', 0, 'value')
+        self.assertTrue(self.mc.got_input("get key\r\n") == 
+                        "VALUE key 0 5\r\nvalue\r\nEND\r\n")
+        self.assertTrue(self.fetching == [])
+
 class TestMCProtocol_Output(unittest.TestCase):
 
     def setUp(self):
@@ -131,11 +356,99 @@ class TestMCProtocol_Output(unittest.TestCase):
         output = self.mc.got_input("set test_cas 0 0 5 noreply\r\n12345\r\n")
         self.assertTrue(output == "")
 
+    def test_noreply_incr(self):
+        self.mc.got_input("set test_incr 0 0 1 noreply\r\n1\r\n")
+        output = self.mc.got_input("incr test_incr 5 noreply\r\n")
+        self.assertTrue(output == "")
+        self.assertTrue(self.stats.bytes_written == 0)
+        self.assertTrue(self.mc.memcached.get( ("test_incr",) )[0][1] == "6")
+
+    def test_noreply_delete(self):
+        self.mc.got_input("set test_delete 0 0 1\r\n1\r\n")
+        output = self.mc.got_input("delete test_delete noreply\r\n")
+        self.assertTrue(output == "")
+        self.assertTrue(not self.mc.memcached.get( ("test_delete",) ))
+
+class TestMCProtocol_ItemSize(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = memcache_protocol.ProtocolStats()
+        self.mc = memcache_protocol.MCProtocol(self.stats, 
+                                               memory_cache.Memcached(self.stats,
+                                                                      item_size_max=10),
+                                               ('127.0.0.1', 11211))
+
+    def test_too_large(self):
+        output = self.mc.got_input("set test_too_large 0 0 11\r\n12345678901\r\n")
+        self.assertTrue(output == memcache_protocol.MCProtocol.TOO_LARGE)
+        self.assertTrue(not self.mc.memcached.get( ("test_too_large",) ))
+
+    def test_too_large_partial(self):
+        self.assertTrue(self.mc.got_input("set test_too_large 0 0 11\r\n123") is None)
+        self.assertTrue(self.mc.buf == "")
+        self.assertTrue(self.mc.got_input("45678901\r") is None)
+        output = self.mc.got_input("\n")
+        self.assertTrue(output == memcache_protocol.MCProtocol.TOO_LARGE)
+
+    def test_too_large_noreply(self):
+        output = self.mc.got_input("set test_too_large 0 0 11 noreply\r\n12345678901\r\n")
+        self.assertTrue(output == "")
+
+    def test_next_command(self):
+        self.mc.got_input("set test_too_large 0 0 11\r\n12345678901\r\n")
+        output = self.mc.got_input("set test_too_large 0 0 10\r\n1234567890\r\n")
+        self.assertTrue(output == "STORED\r\n")
+
+    def test_append_too_large(self):
+        self.mc.got_input("set key 0 0 6\r\n123456\r\n")
+        output = self.mc.got_input("append key 0 0 5\r\n78901\r\n")
+        self.assertTrue(output == memcache_protocol.MCProtocol.TOO_LARGE)
+        output = self.mc.got_input("prepend key 0 0 4\r\n0000\r\n")
+        self.assertTrue(output == "STORED\r\n")
+        self.assertTrue(self.mc.memcached.get( ("key",) )[0][1] == 
+                        "0000123456")
+
+class TestMCProtocol_LineLength(TestProtocolBase):
+
+    def test_line_too_long(self):
+        self.mc_except([("set " + "x" * 2048, "")],
+                       memcache_protocol_parse.FatalProtocolException)
+
+    def test_line_too_long_partial(self):
+        self.mc_except([("x" * 1024, None), ("x" * 1024, None), ("x", None)],
+                       memcache_protocol_parse.FatalProtocolException)
+
+    def test_line_too_long_delimited(self):
+        self.mc_except([("set " + "x" * 2048 + " 0 0 5\r\n12345\r\n", "")],
+                       memcache_protocol_parse.FatalProtocolException)
+
+    def test_long_multiget(self):
+        keys = " ".join("key%d" % i for i in range(1000))
+        output = self.mc.got_input("get %s\r\n" % keys)
+        self.assertTrue(output == "END\r\n")
+
+    def test_multiget_too_long(self):
+        keys = " ".join("key%d" % i for i in range(20000))
+        self.mc_except([("get %s\r\n" % keys, "")],
+                       memcache_protocol_parse.FatalProtocolException)
+
 class TestMCProtocol_Commands(TestProtocolBase):
 
     def test_set(self):
         self.mc_caller([("set test_set 0 0 5\r\n12345\r\n", "STORED\r\n")])
 
+    def test_set_empty(self):
+        self.mc_caller([("set test_set 0 0 0\r\n\r\nget test_set\r\n", 
+                         "STORED\r\nVALUE test_set 0 0\r\n\r\nEND\r\n")])
+
+    def test_set_flags(self):
+        self.mc_caller([("set test_set 4294967295 0 1\r\nx\r\n", "STORED\r\n"),
+                        ("get test_set\r\n", 
+                         "VALUE test_set 4294967295 1\r\nx\r\nEND\r\n"),
+                        ("set test_set 007 0 1\r\nx\r\n", "STORED\r\n"),
+                        ("get test_set\r\n", 
+                         "VALUE test_set 7 1\r\nx\r\nEND\r\n")])
+
     def test_cas(self):
         self.mc.got_input("set test_cas 0 0 5\r\n12345\r\n")
 
@@ -263,6 +576,9 @@ class TestMCProtocol_Commands(TestProtocolBase):
         output = self.mc.got_input("stats slabs\r\n")
         self.assertTrue(output is not None)
 
+    def test_verbosity(self):
+        self.mc_caller([("verbosity 1\r\n", "OK\r\n")])
+
     def test_quit(self):
         self.mc_except([("quit\r\n","")], memcache_protocol_execute.QuitException)
 
@@ -292,6 +608,31 @@ class TestMCProtocol_BadCommands(TestProtocolBase):
         self.mc_except([("set test_set 0 0 5\r\n12345get test_set\r\n","")], 
                        memcache_protocol_parse.ProtocolException)
 
+    def test_commands_after_error(self):
+        with self.assertRaises(
+            memcache_protocol_parse.ProtocolException) as caught:
+            self.mc.got_input("set a 0 0 1\r\nx\r\nbogus\r\nget a\r\n")
+        self.assertTrue(caught.exception.msg == "STORED\r\nERROR\r\n")
+        self.assertTrue(self.mc.has_pending())
+        self.assertTrue(self.mc.got_input("") == 
+                        "VALUE a 0 1\r\nx\r\nEND\r\n")
+
+    def test_bad_set_data_swallowed(self):
+        with self.assertRaises(
+            memcache_protocol_parse.ProtocolException) as caught:
+            self.mc.got_input("set a x 0 5\r\nget b\r\nget a\r\n")
+        self.assertTrue(caught.exception.msg == 
+                        "CLIENT_ERROR bad argument\r\n")
+        self.assertTrue(self.mc.got_input("") == "END\r\n")
+
+    def test_bad_ending_then_command(self):
+        with self.assertRaises(
+            memcache_protocol_parse.ProtocolException) as caught:
+            self.mc.got_input("set a 0 0 1\r\nxx\r\nget a\r\n")
+        self.assertTrue(caught.exception.msg == 
+                        "CLIENT_ERROR bad data chunk\r\n")
+        self.assertTrue(self.mc.got_input("") == "END\r\n")
+
     def test_bad_set_args(self):
         self.mc_except([("set test_set 0 0\r\n12345\r\n","")], 
                        memcache_protocol_parse.ProtocolException)
@@ -301,7 +642,7 @@ class TestMCProtocol_BadCommands(TestProtocolBase):
                        memcache_protocol_parse.ProtocolException)
 
     def test_bad_set_flags_length(self):
-        self.mc_except([("set test_set aaa 0 5\r\n12345\r\n","")], 
+        self.mc_except([("set test_set 4294967296 0 5\r\n12345\r\n","")], 
                        memcache_protocol_parse.ProtocolException)
 
     def test_bad_set_exptime(self):
@@ -321,7 +662,7 @@ class TestMCProtocol_BadCommands(TestProtocolBase):
                        memcache_protocol_parse.ProtocolException)
 
     def test_bad_cas_flags_length(self):
-        self.mc_except([("cas test_cas 00 0 0 5\r\n12345\r\n","")], 
+        self.mc_except([("cas test_cas 4294967296 0 5 1\r\n12345\r\n","")], 
                        memcache_protocol_parse.ProtocolException)
 
     def test_bad_cas_exptime(self):
@@ -332,6 +673,14 @@ class TestMCProtocol_BadCommands(TestProtocolBase):
         self.mc_except([("cas test_cas 0 0 a 100\r\n12345\r\n","")], 
                        memcache_protocol_parse.ProtocolException)
 
+    def test_bad_cas_unique(self):
+        self.mc_except([("cas test_cas 0 0 5 a\r\n12345\r\n","")], 
+                       memcache_protocol_parse.ProtocolException)
+
+    def test_bad_empty_line(self):
+        self.mc_except([("\r\n","")], 
+                       memcache_protocol_parse.ProtocolException)
+
     def test_bad_get_args(self):
         self.mc_except([("get\r\n","")], 
                        memcache_protocol_parse.ProtocolException)
@@ -376,11 +725,23 @@ class TestMCProtocol_BadCommands(TestProtocolBase):
         self.mc_except([("stats flub\r\n","")], 
                        memcache_protocol_parse.ProtocolException)
 
-class TestExecute(unittest.TestCase):
+class TestParse(unittest.TestCase):
+    def test_numbers_converted(self):
+        cmd = memcache_protocol.parse_command("cas test_cas 0 10 5 100 noreply")
+        self.assertTrue(cmd.exptime == 10)
+        self.assertTrue(cmd.bytes == 5)
+        self.assertTrue(cmd.casunique == 100)
+        self.assertTrue(cmd.flags == "0")
+        self.assertTrue(cmd.noreply)
+
+    def test_handler_attached(self):
+        cmd = memcache_protocol.parse_command("get test_get")
+        self.assertTrue(cmd.handler is memcache_protocol_execute.get)
+
     def test_bad_command(self):
-        cmd = memcache_protocol_parse.MCCommand(command='flub')
-        with self.assertRaises(memcache_protocol_execute.ExecuteException):
-            memcache_protocol_execute.execute_command(cmd, None, '')
+        for command_string in ("flub", ""):
+            with self.assertRaises(memcache_protocol_parse.ProtocolException):
+                memcache_protocol.parse_command(command_string)
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,294 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memcache_client
+import memcache_connection
+import memcache_protocol
+import memcache_protocol_execute
+import memcache_protocol_parse
+import memcache_proxy
+import memory_cache
+import unittest
+
+SERVERS = [('10.0.0.1', 11211), ('10.0.0.2', 11211), ('10.0.0.3', 11211)]
+
+class Loopback(object):
+    """ 
+    a backend connection wired straight to an engine, replies come 
+    back right away unless held
+    """
+    def __init__(self, memcached):
+        self.protocol = memcache_client.ClientProtocol()
+        self.server = memcache_protocol.MCProtocol(
+            memcache_connection.ConnectionStats(), memcached, 'backend', 
+            1000)
+        self.held = False
+        self.down = False
+        self.sent = []
+
+    def send(self, data, multi, callback):
+        self.protocol.send(data, multi, callback)
+        if self.down:
+            self.protocol.fail()
+        elif not self.held:
+            self.deliver()
+
+    def queued(self):
+        return self.protocol.output_bytes
+
+    def deliver(self):
+        data = self.protocol.pop_output()
+        self.sent.append(data)
+        self.protocol.got_input(self.server.got_input(data))
+
+class MockSock(object):
+    def __init__(self):
+        self.input = []
+        self.output = []
+
+    def setblocking(self, blocking):
+        pass
+
+    def recv(self, bytes):
+        return self.input.pop(0)
+
+    def send(self, buf):
+        if buf:
+            self.output.append(buf)
+        return len(buf)
+
+class TestProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.engines = dict((server, memory_cache.Memcached(
+                    memory_cache.MemcachedStats()))
+                            for server in SERVERS)
+        self.backends = {}
+        self.stats = memcache_connection.ConnectionStats()
+        self.router = memcache_proxy.Router(self.stats, SERVERS, 
+                                            self.connect, pool_size=1)
+        self.protocol = memcache_proxy.ProxyProtocol(self.stats, 
+                                                     self.router, 'client')
+        self.ready = []
+        self.protocol.on_ready = lambda: self.ready.append(
+            self.protocol.output())
+
+    def connect(self, server):
+        backend = Loopback(self.engines[server])
+        self.backends[server] = backend
+        return backend
+
+    def engine_for(self, key):
+        return self.engines[self.router.ring.get_server(key)]
+
+    def test_set_get(self):
+        self.assertEqual(self.protocol.got_input("set foo 5 0 3\r\nbar\r\n"),
+                         "STORED\r\n")
+        self.assertEqual(self.engine_for("foo").get(["foo"]), 
+                         [("foo", "bar", "5")])
+        self.assertEqual(self.protocol.got_input("get foo\r\n"),
+                         "VALUE foo 5 3\r\nbar\r\nEND\r\n")
+
+    def test_keys_spread(self):
+        for i in range(30):
+            self.protocol.got_input("set key%d 0 0 1\r\nx\r\n" % i)
+        for server, engine in self.engines.items():
+            keys = engine.cache.the_cache.keys()
+            self.assertTrue(keys)
+            for key in keys:
+                self.assertEqual(self.router.ring.get_server(key), server)
+
+    def test_multiget_in_key_order(self):
+        keys = ["key%d" % i for i in range(20)]
+        for key in keys[::2]:
+            self.protocol.got_input("set %s 0 0 %d\r\n%s\r\n" % 
+                                    (key, len(key), key))
+        for backend in self.backends.values():
+            backend.sent = []
+        reply = self.protocol.got_input("get %s key0\r\n" % " ".join(keys))
+        expected = ["VALUE %s 0 %d\r\n%s\r\n" % (key, len(key), key) 
+                    for key in keys[::2] + ["key0"]]
+        self.assertEqual(reply, "".join(expected) + "END\r\n")
+        # one request per backend
+        for backend in self.backends.values():
+            self.assertEqual(len(backend.sent), 1)
+            self.assertTrue(backend.sent[0].startswith("get "))
+
+    def test_gets(self):
+        self.protocol.got_input("set foo 0 0 3\r\nbar\r\n")
+        reply = self.protocol.got_input("gets foo\r\n")
+        self.assertTrue(reply.startswith("VALUE foo 0 3 "))
+        casunique = reply.split()[4]
+        self.assertEqual(
+            self.protocol.got_input("cas foo 0 0 3 %s\r\nbaz\r\n" % 
+                                    casunique), "STORED\r\n")
+        self.assertEqual(
+            self.protocol.got_input("cas foo 0 0 3 %s\r\nbaz\r\n" % 
+                                    casunique), "EXISTS\r\n")
+
+    def test_noreply(self):
+        self.assertEqual(
+            self.protocol.got_input("set foo 0 0 3 noreply\r\nbar\r\n"
+                                    "delete nothere noreply\r\n"
+                                    "get foo\r\n"),
+            "VALUE foo 0 3\r\nbar\r\nEND\r\n")
+        backend = self.backends[self.router.ring.get_server("foo")]
+        self.assertFalse("noreply" in "".join(backend.sent))
+
+    def test_incr_delete(self):
+        self.protocol.got_input("set n 0 0 1\r\n5\r\n")
+        self.assertEqual(self.protocol.got_input("incr n 3\r\n"), "8\r\n")
+        self.assertEqual(self.protocol.got_input("decr n 2\r\n"), "6\r\n")
+        self.assertEqual(self.protocol.got_input("delete n\r\n"), 
+                         "DELETED\r\n")
+        self.assertEqual(self.protocol.got_input("delete n\r\n"), 
+                         "NOT_FOUND\r\n")
+
+    def test_flush_all(self):
+        for i in range(30):
+            self.protocol.got_input("set key%d 0 0 1\r\nx\r\n" % i)
+        self.assertEqual(self.protocol.got_input("flush_all\r\n"), "OK\r\n")
+        self.assertEqual(self.protocol.got_input(
+                "get %s\r\n" % " ".join("key%d" % i for i in range(30))),
+                         "END\r\n")
+
+    def test_local_commands(self):
+        self.assertEqual(self.protocol.got_input("version\r\n"),
+                         "VERSION %s\r\n" % memcache_protocol_execute.VERSION)
+        self.assertTrue(self.protocol.got_input("stats\r\n").endswith(
+                "END\r\n"))
+        self.assertEqual(self.protocol.got_input("lru_crawler metadump all"
+                                                 "\r\n"),
+                         memcache_proxy.NOT_SUPPORTED)
+        self.assertRaises(memcache_protocol_execute.QuitException,
+                          self.protocol.got_input, "quit\r\n")
+
+    def test_too_large(self):
+        self.assertEqual(self.protocol.got_input(
+                "set foo 0 0 %d\r\n%s\r\n" % (
+                    memory_cache.DEFAULT_ITEM_SIZE_MAX + 1, 
+                    "x"*(memory_cache.DEFAULT_ITEM_SIZE_MAX + 1))),
+                         memcache_protocol.MCProtocol.TOO_LARGE)
+        for backend in self.backends.values():
+            self.assertFalse(backend.sent)
+
+    def test_replies_in_order(self):
+        for key in ["a", "b", "c", "d", "e", "f"]:
+            self.protocol.got_input("set %s 0 0 1\r\n%s\r\n" % (key, key))
+        slow = self.router.ring.get_server("a")
+        fast = [key for key in "bcdef" 
+                if self.router.ring.get_server(key) != slow][0]
+        self.backends[slow].held = True
+        self.assertEqual(self.protocol.got_input("get a\r\nget %s\r\n" % 
+                                                 fast), "")
+        self.assertTrue(self.protocol.waiting())
+        self.backends[slow].deliver()
+        self.assertEqual(self.ready, 
+                         ["VALUE a 0 1\r\na\r\nEND\r\n"
+                          "VALUE %s 0 1\r\n%s\r\nEND\r\n" % (fast, fast)])
+        self.assertFalse(self.protocol.waiting())
+
+    def test_error_in_order(self):
+        slow = self.router.ring.get_server("a")
+        self.backends[slow].held = True
+        self.assertEqual(self.protocol.got_input("get a\r\nbogus\r\n"), "")
+        self.backends[slow].deliver()
+        self.assertEqual(self.ready, ["END\r\nERROR\r\n"])
+
+    def test_backend_down(self):
+        self.protocol.got_input("set a 0 0 1\r\na\r\n")
+        down = self.router.ring.get_server("a")
+        self.backends[down].down = True
+        self.assertEqual(self.protocol.got_input("set a 0 0 1\r\na\r\n"), 
+                         memcache_proxy.BACKEND_ERROR)
+        self.assertEqual(self.protocol.got_input("get a\r\n"), "END\r\n")
+        self.assertEqual(self.protocol.got_input("flush_all\r\n"), 
+                         memcache_proxy.BACKEND_ERROR)
+
+    def test_too_many_outstanding(self):
+        self.router.max_slots = 2
+        slow = self.router.ring.get_server("a")
+        self.backends[slow].held = True
+        self.assertEqual(self.protocol.got_input(
+                "get a\r\nget a\r\nget a\r\n"), "")
+        self.assertEqual(len(self.protocol.slots), 2)
+        self.assertTrue(self.protocol.blocked())
+        self.assertFalse(self.protocol.has_pending())
+        # more input waits with the rest
+        self.assertEqual(self.protocol.got_input("version\r\n"), "")
+        self.assertEqual(len(self.protocol.slots), 2)
+        self.backends[slow].deliver()
+        self.assertEqual(self.ready, ["END\r\n", "END\r\n"])
+        self.assertFalse(self.protocol.blocked())
+        self.assertTrue(self.protocol.has_pending())
+        self.assertEqual(self.protocol.got_input(""), "")
+        self.backends[slow].deliver()
+        self.assertTrue(self.ready[-1].startswith("END\r\nVERSION "))
+        self.assertFalse(self.protocol.has_pending())
+
+    def test_backend_congested(self):
+        self.router.max_unsent = 10
+        slow = self.router.ring.get_server("a")
+        self.backends[slow].held = True
+        self.assertEqual(self.protocol.got_input(
+                "set a 0 0 20\r\n%s\r\nversion\r\n" % ("x" * 20)), "")
+        self.assertTrue(self.router.congested())
+        self.assertTrue(self.protocol.blocked())
+        self.assertTrue(self.protocol.pending.startswith("version"))
+        self.backends[slow].deliver()
+        self.assertFalse(self.router.congested())
+        self.assertEqual(self.ready, ["STORED\r\n"])
+        self.assertTrue(self.protocol.got_input("").startswith("VERSION "))
+
+    def test_ready_after_blocked(self):
+        self.router.max_slots = 1
+        sock = MockSock()
+        proxy_socket = memcache_proxy.ProxySocket(sock, 'client', 
+                                                  self.stats, self.router)
+        slow = self.router.ring.get_server("a")
+        self.backends[slow].held = True
+        sock.input.append("get a\r\nget a\r\n")
+        self.assertEqual(proxy_socket.handle_read(), proxy_socket.WAITING)
+        self.backends[slow].deliver()
+        self.assertEqual(proxy_socket.ready(), proxy_socket.FINISHED)
+        self.assertEqual(proxy_socket.handle_write(), proxy_socket.WAITING)
+        self.backends[slow].deliver()
+        self.assertEqual(proxy_socket.ready(), proxy_socket.FINISHED)
+        self.assertEqual(proxy_socket.handle_write(), proxy_socket.FINISHED)
+        self.assertEqual(sock.output, ["END\r\n", "END\r\n"])
+
+    def test_pool_round_robin(self):
+        router = memcache_proxy.Router(self.stats, SERVERS[:1], 
+                                       lambda server: object(), 
+                                       pool_size=3)
+        pool = router.pools[SERVERS[0]]
+        self.assertEqual([router.backend(SERVERS[0]) for _ in range(4)],
+                         pool + pool[:1])
+
+if __name__ == '__main__':
+    unittest.main()
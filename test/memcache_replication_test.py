@@ -0,0 +1,244 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memcache_connection
+import memcache_protocol
+import memcache_replication
+import memory_cache
+import memory_cache_primitives
+import unittest
+
+FOLLOWERS = [('10.0.0.1', 11211), ('10.0.0.2', 11211)]
+
+class TestFollower(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = memcache_connection.ConnectionStats()
+        self.follower = memcache_replication.Follower(FOLLOWERS[0], 
+                                                      self.stats)
+        self.woken = []
+        self.follower.on_output = lambda: self.woken.append(True)
+
+    def test_joins_small_commands(self):
+        for i in range(10):
+            self.follower.queue("delete key%d noreply\r\n" % i)
+        self.assertEqual(len(self.woken), 10)
+        data = self.follower.data()
+        self.assertEqual(data, "".join("delete key%d noreply\r\n" % i 
+                                       for i in range(10)))
+        self.assertEqual(self.follower.backlog, len(data))
+        self.follower.sent(len(data))
+        self.assertEqual(self.follower.data(), "")
+        self.assertEqual(self.follower.backlog, 0)
+        self.assertEqual(self.stats.repl_bytes, len(data))
+
+    def test_chunks(self):
+        self.follower.WRITE_BYTES = 100
+        for i in range(10):
+            self.follower.queue("x"*40)
+        self.assertEqual(len(self.follower.data()), 120)
+        self.follower.sent(120)
+        self.assertEqual(len(self.follower.data()), 120)
+
+    def test_partial_write_kept(self):
+        self.follower.queue("delete foo noreply\r\n")
+        self.follower.sent(len(self.follower.data()) - 5)
+        self.follower.queue("delete bar noreply\r\n")
+        self.follower.clear()
+        # the rest of the started command can't be dropped
+        self.assertEqual(self.follower.data(), "ply\r\n")
+        self.assertEqual(self.follower.backlog, 5)
+
+    def test_disconnected(self):
+        self.follower.connected = True
+        self.follower.queue("delete foo noreply\r\n")
+        self.follower.sent(5)
+        self.follower.disconnected()
+        self.assertFalse(self.follower.connected)
+        self.assertEqual(self.follower.data(), "")
+        self.assertEqual(self.follower.backlog, 0)
+
+class TestReplicator(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = memcache_connection.ConnectionStats()
+        self.primary = memory_cache.Memcached(self.stats)
+        self.replicator = memcache_replication.Replicator(
+            self.primary.cache, self.stats, FOLLOWERS, 64*1024)
+        self.primary.replication = self.replicator
+        self.engines = {}
+        self.protocols = {}
+        for follower in self.replicator.followers:
+            engine = memory_cache.Memcached(memory_cache.MemcachedStats())
+            self.engines[follower.address] = engine
+            self.protocols[follower.address] = memcache_protocol.MCProtocol(
+                memcache_connection.ConnectionStats(), engine, 
+                follower.address, 1000000)
+
+    def deliver(self, follower, max_bytes=None):
+        """ write what the follower has to its engine """
+        while True:
+            data = follower.data()[:max_bytes]
+            if not data:
+                return
+            reply = self.protocols[follower.address].got_input(data)
+            self.assertFalse(reply)
+            follower.sent(len(data))
+            if max_bytes is not None:
+                return
+
+    def deliver_all(self):
+        while True:
+            resyncing = self.replicator.step()
+            for follower in self.replicator.followers:
+                self.deliver(follower)
+            if not resyncing:
+                return
+
+    def connect_all(self):
+        for follower in self.replicator.followers:
+            self.replicator.connected(follower)
+        self.deliver_all()
+
+    def contents(self, engine):
+        cache = engine.cache.the_cache
+        return dict((key, (item.value, item.flags, item.exptime))
+                    for key, item in cache.items() 
+                    if not item.has_expired())
+
+    def assertInSync(self):
+        expected = self.contents(self.primary)
+        for engine in self.engines.values():
+            self.assertEqual(self.contents(engine), expected)
+
+    def test_not_connected(self):
+        self.primary.set("foo", "0", 0, "bar")
+        for follower in self.replicator.followers:
+            self.assertEqual(follower.data(), "")
+
+    def test_changes(self):
+        self.connect_all()
+        self.primary.set("foo", "5", 0, "bar")
+        self.primary.set("exp", "0", 1000, "soon")
+        self.primary.add("add", "0", 0, "1")
+        self.primary.append("foo", "5", 0, "baz")
+        self.primary.increment("add", 41)
+        self.primary.set_multi([("m1", "1", 0, "a"), ("m2", "2", 0, "b")])
+        self.primary.delete("m1")
+        self.primary.delete_multi(["m2", "nothere"])
+        self.primary.set("touch", "0", 0, "me")
+        self.primary.touch_multi(["touch"], 500)
+        cas = self.primary.gets(["foo"])[0][3]
+        self.primary.cas("foo", "6", 0, cas, "new")
+        self.deliver_all()
+        self.assertInSync()
+        self.assertEqual(self.engines[FOLLOWERS[0]].get(["foo", "add"]),
+                         [("foo", "new", "6"), ("add", "42", "0")])
+        self.assertEqual(self.stats.repl_bytes, 
+                         sum(protocol.stats.bytes_read 
+                             for protocol in self.protocols.values()))
+
+    def test_flush(self):
+        self.connect_all()
+        self.primary.set("foo", "0", 0, "bar")
+        self.primary.flush(0)
+        self.deliver_all()
+        self.assertInSync()
+        self.assertEqual(self.engines[FOLLOWERS[1]].get(["foo"]), [])
+
+    def test_initial_sync(self):
+        for i in range(1000):
+            self.primary.set("key%d" % i, "0", 0, "value%d" % i)
+        self.primary.set("gone", "0", 0, "x")
+        self.primary.cache.the_cache["gone"].exptime = 1
+        follower = self.replicator.followers[0]
+        self.engines[follower.address].set("stale", "0", 0, "old")
+        self.replicator.connected(follower)
+        self.assertTrue(self.replicator.step())
+        self.deliver_all()
+        self.assertEqual(self.contents(self.engines[follower.address]),
+                         self.contents(self.primary))
+        self.assertEqual(self.stats.repl_resyncs, 1)
+
+    def test_changes_during_sync(self):
+        for i in range(1000):
+            self.primary.set("key%d" % i, "0", 0, "value%d" % i)
+        for follower in self.replicator.followers:
+            self.replicator.connected(follower)
+        self.replicator.step()
+        for i in range(0, 1000, 3):
+            self.primary.set("key%d" % i, "0", 0, "changed")
+        for i in range(1, 1000, 3):
+            self.primary.delete("key%d" % i)
+        self.primary.set("new", "0", 0, "value")
+        self.deliver_all()
+        self.assertInSync()
+
+    def test_backlog_paces_resync(self):
+        for i in range(1000):
+            self.primary.set("key%d" % i, "0", 0, "x"*100)
+        follower = self.replicator.followers[0]
+        self.replicator.connected(follower)
+        self.replicator.step()
+        self.replicator.step()
+        # over half the backlog queued, wait for the follower
+        backlog = follower.backlog
+        self.assertTrue(backlog > 32*1024)
+        self.assertTrue(self.replicator.step())
+        self.assertEqual(follower.backlog, backlog)
+        self.deliver_all()
+        self.assertEqual(self.contents(self.engines[follower.address]),
+                         self.contents(self.primary))
+
+    def test_overflow_resyncs(self):
+        self.connect_all()
+        follower, other = self.replicator.followers
+        other.disconnected()
+        # a follower that isn't taking anything
+        self.primary.set("foo", "0", 0, "bar")
+        self.deliver(follower, 10)
+        for i in range(600):
+            self.primary.set("key%d" % i, "0", 0, "x"*100)
+        self.assertEqual(self.stats.repl_overflows, 1)
+        self.assertTrue(follower.backlog < 64*1024)
+        self.replicator.connected(other)
+        self.deliver_all()
+        self.assertInSync()
+
+    def test_reconnect_resyncs(self):
+        self.connect_all()
+        follower = self.replicator.followers[0]
+        follower.disconnected()
+        self.primary.set("missed", "0", 0, "x")
+        self.replicator.connected(follower)
+        self.deliver_all()
+        self.assertInSync()
+        self.assertEqual(self.stats.repl_resyncs, 3)
+
+if __name__ == '__main__':
+    unittest.main()
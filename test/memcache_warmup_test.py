@@ -0,0 +1,194 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memcache_connection
+import memcache_protocol
+import memcache_warmup
+import memory_cache
+import memory_cache_primitives
+import memory_cache_snapshot
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+class FakePeer(object):
+    """ just enough of a server to warm up from, a thread per connection """
+    def __init__(self, memcached):
+        self.memcached = memcached
+        self.stats = memcache_connection.ConnectionStats()
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.address = self.sock.getsockname()
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self.serve, args=(sock, address))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, sock, address):
+        protocol = memcache_protocol.MCProtocol(self.stats, self.memcached,
+                                                address)
+        while True:
+            buf = sock.recv(4096)
+            if not buf:
+                break
+            reply = protocol.got_input(memory_cache_primitives.to_str(buf))
+            while True:
+                if reply:
+                    sock.sendall(memory_cache_primitives.to_bytes(reply))
+                if not protocol.has_pending():
+                    break
+                reply = protocol.got_input("")
+        sock.close()
+
+    def close(self):
+        self.sock.close()
+
+class TestWarmup(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = memcache_connection.ConnectionStats()
+        self.mc = memory_cache.Memcached(self.stats)
+
+    def warm(self, source, batch_size=2):
+        warmup = memcache_warmup.Warmup(self.mc.cache, self.stats, source,
+                                        batch_size)
+        warmup.start()
+        deadline = time.time() + 5
+        while warmup.step():
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.001)
+        return warmup
+
+    def test_records(self):
+        now = int(time.time())
+        self.mc.set('key2', '0', 0, 'client')
+        self.warm([('key1', 'value1', '1', 0),
+                   ('key2', 'value2', '2', 0),
+                   ('key3', 'value3', '3', now + 100),
+                   ('key4', 'value4', '4', now - 100)])
+        self.assertTrue(self.mc.get(['key1', 'key2', 'key3', 'key4']) == 
+                        [('key1', 'value1', '1'), ('key2', 'client', '0'),
+                         ('key3', 'value3', '3')])
+        self.assertTrue(self.stats.warmup_items == 2)
+        self.assertTrue(self.stats.warmup_skipped == 2)
+        self.assertTrue(self.stats.warmup_bytes == 12)
+        # loading doesn't count as clients setting things
+        self.assertTrue(self.stats.cmd_set == 1)
+        stats = dict(self.stats.dump(""))
+        self.assertTrue(stats['warmup_items'] == 2)
+        self.assertTrue(float(stats['warmup_seconds']) >= 0)
+        self.assertTrue(self.stats.warmup_finished >= 
+                        self.stats.warmup_started > 0)
+
+    def test_changed_while_warming(self):
+        now = int(time.time())
+        self.mc.set('key1', '0', 0, 'old')
+        source = [('key1', 'value1', '1', 0),
+                  ('key2', 'value2', '2', 0),
+                  ('key3', 'value3', '3', 0),
+                  ('key4', 'value4', '4', 0)]
+        warmup = memcache_warmup.Warmup(self.mc.cache, self.stats, source, 2)
+        self.mc.warmup = warmup
+        # key1 changed and then expired, key2 deleted before it loaded
+        self.mc.set('key1', '0', now - 1, 'client')
+        self.mc.delete('key2')
+        self.mc.touch_multi(['key1'], now - 1)
+        warmup.start()
+        while warmup.step():
+            time.sleep(0.001)
+        self.assertTrue(self.mc.get(['key1', 'key2', 'key3', 'key4']) == 
+                        [('key3', 'value3', '3'), ('key4', 'value4', '4')])
+        self.assertTrue(self.stats.warmup_skipped == 2)
+        self.assertTrue(not warmup.changed)
+        # nothing is kept once done
+        self.mc.delete('key3')
+        self.assertTrue(not warmup.changed)
+
+    def test_flushed_while_warming(self):
+        warmup = memcache_warmup.Warmup(self.mc.cache, self.stats, 
+                                        [('key1', 'value1', '1', 0)])
+        self.mc.warmup = warmup
+        self.mc.flush(0)
+        warmup.start()
+        while warmup.step():
+            time.sleep(0.001)
+        self.assertTrue(self.mc.get(['key1']) == [])
+        self.assertTrue(self.stats.warmup_skipped == 1)
+
+    def test_source_fails(self):
+        def source():
+            yield ('key1', 'value1', '0', 0)
+            raise IOError("gone")
+        self.warm(source(), 1)
+        self.assertTrue(self.mc.get(['key1']) == [('key1', 'value1', '0')])
+
+    def test_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'snapshot')
+            other = memory_cache.Memcached(memory_cache.MemcachedStats())
+            for key in ('key1', 'key2', 'key3'):
+                other.set(key, '0', 0, 'value')
+            memory_cache_snapshot.save(other.cache, path)
+            self.warm(memcache_warmup.file_records(path))
+        finally:
+            shutil.rmtree(directory)
+        self.assertTrue(len(self.mc.get(['key1', 'key2', 'key3'])) == 3)
+
+    def test_peer(self):
+        other = memory_cache.Memcached(memory_cache.MemcachedStats())
+        keys = ['key %d' % i for i in range(250)]
+        for key in keys:
+            other.set(key.replace(' ', '/'), '1', 100, 'value\r\n')
+        peer = FakePeer(other)
+        try:
+            self.warm(memcache_warmup.peer_records(peer.address), 50)
+        finally:
+            peer.close()
+        self.assertTrue(self.stats.warmup_items == 250)
+        item = self.mc.cache.get('key/7')
+        self.assertTrue(item.value == 'value\r\n')
+        self.assertTrue(item.flags == '1')
+        self.assertTrue(item.exptime == other.cache.get('key/7').exptime)
+
+if __name__ == "__main__":
+    unittest.main()
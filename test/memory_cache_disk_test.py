@@ -0,0 +1,197 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memory_cache
+import memory_cache_disk
+import memory_cache_snapshot
+import os
+import shutil
+import tempfile
+import unittest
+
+class TestDiskTier(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.stats = memory_cache.MemcachedStats()
+        # room for two 100 byte values in memory, and four segments of 
+        # two on disk
+        self.disk = memory_cache_disk.DiskTier(self.stats, self.dir, 800, 
+                                               segment_bytes=200, 
+                                               min_bytes=50)
+        self.mc = memory_cache.Memcached(self.stats, max_bytes=250, 
+                                         disk=self.disk)
+        self.cache = self.mc.cache
+
+    def tearDown(self):
+        self.disk.close()
+        shutil.rmtree(self.dir)
+
+    def set(self, key, value=None):
+        self.mc.set(key, '0', '0', value or key*50)
+
+    def test_spill(self):
+        for key in ('aa', 'bb', 'cc'):
+            self.set(key)
+        self.assertTrue(self.cache.the_cache['aa'].on_disk)
+        self.assertTrue(not self.cache.the_cache['cc'].on_disk)
+        self.assertTrue(self.stats.curr_items == 2)
+        self.assertTrue(self.stats.ext_items == 1)
+        self.assertTrue(self.stats.ext_bytes == 100)
+        self.assertTrue(self.stats.evictions == 0)
+        self.assertTrue(self.mc.get(['aa']) == [('aa', 'aa'*50, '0')])
+        self.assertTrue(self.stats.ext_reads == 1)
+
+    def test_small_values_evicted(self):
+        self.set('a', 'a'*10)
+        for key in ('bb', 'cc', 'dd'):
+            self.set(key)
+        self.assertTrue(self.mc.get(['a']) == [])
+        self.assertTrue(self.stats.evictions == 1)
+        self.assertTrue(self.stats.ext_items == 1)
+
+    def test_delete(self):
+        for key in ('aa', 'bb', 'cc'):
+            self.set(key)
+        self.assertTrue(self.mc.delete('aa') == self.mc.DELETED)
+        self.assertTrue(self.mc.get(['aa']) == [])
+        self.assertTrue(self.stats.ext_items == 0)
+        self.assertTrue(self.disk.segments[0].live_bytes == 0)
+
+    def test_replace(self):
+        for key in ('aa', 'bb', 'cc'):
+            self.set(key)
+        self.mc.append('aa', '0', '0', 'more')
+        self.assertTrue(self.mc.get(['aa']) == [('aa', 'aa'*50 + 'more', '0')])
+        self.assertTrue(self.stats.ext_bytes == 100)
+
+    def test_cas(self):
+        self.set('aa')
+        casunique = self.mc.gets(['aa'])[0][3]
+        for key in ('bb', 'cc'):
+            self.set(key)
+        self.assertTrue(self.cache.the_cache['aa'].on_disk)
+        self.assertTrue(self.mc.cas('aa', '0', '0', casunique, 'new') == 
+                        self.mc.STORED)
+
+    def test_touch(self):
+        for key in ('aa', 'bb', 'cc'):
+            self.set(key)
+        self.assertTrue(self.mc.touch_multi(['aa'], '100') == 
+                        [('aa', self.mc.TOUCHED)])
+        self.assertTrue(self.cache.lru.least().key == 'bb')
+        self.assertTrue(self.mc.add('aa', '0', '0', 'x') == self.mc.NOT_STORED)
+
+    def test_oldest_segment_evicted(self):
+        for key in ('aa', 'bb', 'cc', 'dd', 'ee', 'ff', 'gg', 'hh', 'ii', 
+                    'jj', 'kk'):
+            self.set(key)
+        # aa and bb were in the first segment, which had to go
+        self.assertTrue(len(self.disk.segments) == 4)
+        self.assertTrue(self.mc.get(['aa', 'bb', 'cc']) == 
+                        [('cc', 'cc'*50, '0')])
+        self.assertTrue(self.stats.evictions == 2)
+        self.assertTrue(self.stats.ext_items == 7)
+        self.assertTrue(not os.path.exists(os.path.join(self.dir, 
+                                                        'segment.0')))
+
+    def test_oldest_segment_rescued(self):
+        for key in ('aa', 'bb', 'cc', 'dd', 'ee', 'ff', 'gg', 'hh', 'ii', 
+                    'jj'):
+            self.set(key)
+        self.mc.delete('aa')
+        self.set('kk')
+        self.assertTrue(self.mc.get(['bb']) == [('bb', 'bb'*50, '0')])
+        self.assertTrue(self.stats.ext_rescues == 1)
+        self.assertTrue(self.stats.evictions == 0)
+
+    def test_rescue_spread_over_writes(self):
+        self.disk.close()
+        # ten values to a segment, and no rescuing more than one value 
+        # per write
+        self.disk = memory_cache_disk.DiskTier(self.stats, self.dir, 2000, 
+                                               segment_bytes=1000, 
+                                               min_bytes=50, 
+                                               rescue_factor=1)
+        self.mc = memory_cache.Memcached(self.stats, max_bytes=250, 
+                                         disk=self.disk)
+        keys = ['%02d' % i for i in range(23)]
+        for key in keys[:22]:
+            self.set(key)
+        for key in keys[:6]:
+            self.mc.delete(key)
+        # the first segment gets retired, but only one value rescued
+        self.set(keys[22])
+        self.assertTrue(self.stats.ext_rescues == 1)
+        self.assertTrue(self.disk.rescuing is not None)
+        self.assertTrue(self.mc.get(['09']) == [('09', '09'*50, '0')])
+        self.mc.delete('08')
+        for key in ('xa', 'xb'):
+            self.set(key)
+        self.assertTrue(self.stats.ext_rescues == 3)
+        self.assertTrue(self.disk.rescuing is None)
+        self.assertTrue(not os.path.exists(os.path.join(self.dir, 
+                                                        'segment.0')))
+        self.assertTrue(self.mc.get(keys[6:10]) == 
+                        [(key, key*50, '0') for key in ('06', '07', '09')])
+        self.assertTrue(self.stats.evictions == 0)
+
+    def test_rescue_rolls_segment(self):
+        self.disk.close()
+        # rescue full segments, so a rescue won't fit in what's left of 
+        # the newest one
+        self.disk = memory_cache_disk.DiskTier(self.stats, self.dir, 800, 
+                                               segment_bytes=200, 
+                                               min_bytes=50, 
+                                               compact_ratio=1.0)
+        self.mc = memory_cache.Memcached(self.stats, max_bytes=250, 
+                                         disk=self.disk)
+        keys = ['aa', 'bb', 'cc', 'dd', 'ee', 'ff', 'gg', 'hh', 'ii', 'jj', 
+                'kk']
+        for key in keys:
+            self.set(key)
+        # aa and bb didn't both fit after ii
+        for segment in self.disk.segments:
+            self.assertTrue(segment.size <= 200)
+        self.assertTrue(self.stats.ext_rescues == 2)
+        self.assertTrue(self.stats.evictions == 0)
+        self.assertTrue(self.mc.get(keys) == 
+                        [(key, key*50, '0') for key in keys])
+
+    def test_snapshot(self):
+        for key in ('aa', 'bb', 'cc'):
+            self.set(key)
+        path = os.path.join(self.dir, 'snapshot')
+        memory_cache_snapshot.save(self.cache, path)
+        mc = memory_cache.Memcached(memory_cache.MemcachedStats())
+        memory_cache_snapshot.load(mc.cache, path)
+        keys = ['aa', 'bb', 'cc']
+        self.assertTrue(mc.get(keys) == self.mc.get(keys))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memory_cache
+import memory_cache_loader
+import threading
+import unittest
+
+try:
+    import BaseHTTPServer as http_server
+    import Queue as queue
+    import SocketServer as socketserver
+    from urllib import unquote
+except ImportError:
+    import http.server as http_server
+    import queue
+    import socketserver
+    from urllib.parse import unquote
+
+class StubFetch(object):
+    """ a backend that answers when the test says so """
+    def __init__(self, values):
+        self.values = values
+        self.fetching = []
+
+    def __call__(self, key, done):
+        self.fetching.append((key, done))
+
+    def finish(self):
+        fetching, self.fetching = self.fetching, []
+        for key, done in fetching:
+            if key in self.values:
+                done(self.values[key], "3")
+            else:
+                done(None)
+
+class TestLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.fetch = StubFetch({'key': 'value', 'other': 'thing'})
+        self.stats = memory_cache.MemcachedStats()
+        self.mc = memory_cache.Memcached(
+            self.stats, loader=memory_cache_loader.Loader(self.fetch, 60))
+        self.called = []
+
+    def callback(self):
+        self.called.append(True)
+
+    def test_coalesced(self):
+        self.assertTrue(self.mc.load(['key', 'other'], self.callback))
+        self.assertTrue(self.mc.load(['key'], self.callback))
+        self.assertTrue(sorted(key for key, _ in self.fetch.fetching) == 
+                        ['key', 'other'])
+        self.assertTrue(self.stats.loader_fetches == 2)
+        self.assertTrue(self.stats.loader_coalesced == 1)
+        self.fetch.finish()
+        self.assertTrue(self.called == [True, True])
+        self.assertTrue(self.mc.get(['key']) == [('key', 'value', '3')])
+        self.assertTrue(self.mc.cache.get('key').exptime > 0)
+        self.assertTrue(not self.mc.load(['key', 'other'], self.callback))
+        self.assertTrue(self.fetch.fetching == [])
+
+    def test_synchronous(self):
+        def fetch(key, done):
+            done('now')
+        self.mc.loader.fetch = fetch
+        self.assertTrue(not self.mc.load(['key', 'key'], self.callback))
+        self.assertTrue(self.called == [])
+        self.assertTrue(self.mc.get(['key']) == [('key', 'now', '0')])
+
+    def test_backend_miss(self):
+        self.assertTrue(self.mc.load(['missing'], self.callback))
+        self.fetch.finish()
+        self.assertTrue(self.called == [True])
+        self.assertTrue(self.mc.get(['missing']) == [])
+        self.assertTrue(self.stats.loader_misses == 1)
+
+    def test_too_large(self):
+        self.mc.item_size_max = 3
+        self.mc.load(['key'], self.callback)
+        self.fetch.finish()
+        self.assertTrue(self.called == [True])
+        self.assertTrue(self.mc.get(['key']) == [])
+
+    def test_changed_while_fetching(self):
+        self.mc.load(['key', 'other'], self.callback)
+        self.mc.set('key', '0', 0, 'newer')
+        self.mc.delete('other')
+        self.fetch.finish()
+        self.assertTrue(self.mc.get(['key', 'other']) == 
+                        [('key', 'newer', '0')])
+        self.assertTrue(self.mc.loader.changed == set())
+
+    def test_flushed_while_fetching(self):
+        self.mc.load(['key'], self.callback)
+        self.mc.flush(0)
+        self.fetch.finish()
+        self.assertTrue(self.called == [True])
+        self.assertTrue(self.mc.get(['key']) == [])
+
+class Backend(http_server.BaseHTTPRequestHandler):
+    """ /items/<key> has the key backwards """
+    def do_GET(self):
+        if self.path == '/items/slow%20key':
+            self.server.slow.wait(5)
+        if self.path.startswith('/items/') and 'missing' not in self.path:
+            body = unquote(self.path[len('/items/'):])[::-1]
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body.encode("latin-1"))
+        else:
+            self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
+class BackendServer(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    daemon_threads = True
+
+class TestThreadedFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BackendServer(('127.0.0.1', 0), Backend)
+        self.server.slow = threading.Event()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.wakes = queue.Queue()
+        self.fetch = memory_cache_loader.ThreadedFetch(
+            memory_cache_loader.http_get('http://127.0.0.1:%d/items/' % 
+                                         self.server.server_address[1]),
+            self.wakes.put, threads=2)
+        self.got = {}
+
+    def tearDown(self):
+        self.server.slow.set()
+        self.fetch.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def done(self, key):
+        def done(value, flags="0"):
+            self.got[key] = (value, flags)
+        return done
+
+    def deliver(self, count):
+        while len(self.got) < count:
+            self.wakes.get(timeout=5)()
+
+    def test_fetch(self):
+        self.fetch('abc', self.done('abc'))
+        self.fetch('missing', self.done('missing'))
+        self.deliver(2)
+        self.assertTrue(self.got == {'abc': ('cba', '0'), 
+                                     'missing': (None, '0')})
+
+    def test_slow_fetch_doesnt_block(self):
+        self.fetch('slow key', self.done('slow key'))
+        self.fetch('quick', self.done('quick'))
+        self.deliver(1)
+        self.assertTrue(self.got == {'quick': ('kciuq', '0')})
+        self.server.slow.set()
+        self.deliver(2)
+        self.assertTrue(self.got['slow key'] == ('yek wols', '0'))
+
+    def test_backend_down(self):
+        fetch = memory_cache_loader.ThreadedFetch(
+            memory_cache_loader.http_get('http://127.0.0.1:1/'), 
+            self.wakes.put, threads=1)
+        fetch('key', self.done('key'))
+        self.deliver(1)
+        fetch.close()
+        self.assertTrue(self.got == {'key': (None, '0')})
+
+if __name__ == "__main__":
+    unittest.main()
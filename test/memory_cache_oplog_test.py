@@ -0,0 +1,193 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memory_cache
+import memory_cache_oplog
+import memory_cache_snapshot
+import os
+import shutil
+import tempfile
+import unittest
+
+class TestOperationLog(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'oplog')
+        self.mc = self.new_memcached()
+        self.mc.oplog = memory_cache_oplog.OperationLog(self.path, 60)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def new_memcached(self):
+        return memory_cache.Memcached(memory_cache.MemcachedStats())
+
+    def replayed(self):
+        self.mc.oplog.close()
+        mc = self.new_memcached()
+        memory_cache_oplog.replay(mc.cache, self.path)
+        return mc
+
+    def test_stores(self):
+        self.mc.set('set', '1', '0', 'value')
+        self.mc.add('add', '2', '100', 'value')
+        self.mc.replace('add', '3', '100', 'replaced')
+        self.mc.append('set', '1', '0', '+after')
+        self.mc.prepend('set', '1', '0', 'before+')
+        self.mc.set('num', '0', '0', '10')
+        self.mc.increment('num', '5')
+        self.mc.decrement('num', '3')
+        casunique = self.mc.gets(['set'])[0][3]
+        self.mc.cas('set', '4', '0', casunique, 'cas')
+        self.mc.set_multi([('multi', '0', '0', 'value')])
+        mc = self.replayed()
+        self.assertTrue(mc.get(['set', 'add', 'num', 'multi']) == 
+                        [('set', 'cas', '4'), ('add', 'replaced', '3'),
+                         ('num', '12', '0'), ('multi', 'value', '0')])
+        self.assertTrue(mc.cache.get('add').exptime == 
+                        self.mc.cache.get('add').exptime)
+
+    def test_not_stored(self):
+        self.mc.add('key', '0', '0', 'value')
+        self.mc.add('key', '0', '0', 'again')
+        self.mc.replace('missing', '0', '0', 'value')
+        mc = self.replayed()
+        self.assertTrue(mc.get(['key', 'missing']) == [('key', 'value', '0')])
+
+    def test_deletes(self):
+        for key in ('key1', 'key2', 'key3'):
+            self.mc.set(key, '0', '0', 'value')
+        self.mc.delete('key1')
+        self.mc.delete_multi(['key2', 'missing'])
+        mc = self.replayed()
+        self.assertTrue(mc.get(['key1', 'key2', 'key3']) == 
+                        [('key3', 'value', '0')])
+
+    def test_touch(self):
+        self.mc.set('key', '0', '0', 'value')
+        self.mc.touch_multi(['key'], '100')
+        mc = self.replayed()
+        self.assertTrue(mc.cache.get('key').exptime == 
+                        self.mc.cache.get('key').exptime)
+
+    def test_flush(self):
+        self.mc.set('key1', '0', '0', 'value')
+        self.mc.flush('0')
+        self.mc.set('key2', '0', '0', 'value')
+        mc = self.replayed()
+        self.assertTrue(mc.get(['key1', 'key2']) == [('key2', 'value', '0')])
+
+    def test_written_in_background(self):
+        self.mc.oplog.close()
+        self.mc.oplog = memory_cache_oplog.OperationLog(self.path, 0.01)
+        self.mc.set('key', '0', '0', 'value')
+        self.mc.oplog.stopping.wait(0.1)
+        self.assertTrue(os.path.getsize(self.path) > 
+                        len(memory_cache_oplog.MAGIC))
+        self.assertTrue(self.replayed().get(['key']) == 
+                        [('key', 'value', '0')])
+
+    def test_truncated(self):
+        self.mc.set('key1', '0', '0', 'value')
+        self.mc.set('key2', '0', '0', 'value')
+        self.mc.oplog.close()
+        with open(self.path, 'rb+') as log_file:
+            log_file.truncate(os.path.getsize(self.path) - 1)
+        mc = self.new_memcached()
+        self.assertTrue(memory_cache_oplog.replay(mc.cache, self.path) == 1)
+        self.assertTrue(mc.get(['key1', 'key2']) == [('key1', 'value', '0')])
+
+    def test_no_log(self):
+        self.mc.oplog.close()
+        mc = self.new_memcached()
+        self.assertTrue(memory_cache_oplog.replay(mc.cache, self.path + 'x')
+                        is None)
+
+    def test_compact(self):
+        snapshot_path = os.path.join(self.dir, 'snapshot')
+        snapshots = memory_cache_snapshot.Snapshots(self.mc.cache, 
+                                                    snapshot_path,
+                                                    self.mc.oplog)
+        self.mc.set('key1', '0', '0', 'value')
+        self.mc.oplog.compact_bytes = 1
+        self.assertTrue(snapshots.maybe_compact())
+        self.assertTrue(self.mc.oplog.size == 0)
+        self.assertTrue(not snapshots.maybe_compact())
+        self.mc.delete('key1')
+        self.mc.set('key2', '0', '0', 'value')
+        snapshots.save()
+        self.assertTrue(not os.path.exists(self.path + '.1'))
+
+        mc = self.new_memcached()
+        mc.oplog = memory_cache_oplog.OperationLog(self.path, 60)
+        loaded = memory_cache_snapshot.Snapshots(mc.cache, snapshot_path,
+                                                 mc.oplog)
+        loaded.load()
+        mc.oplog.close()
+        self.assertTrue(mc.get(['key1', 'key2']) == [('key2', 'value', '0')])
+
+    def test_handed_off(self):
+        snapshot_path = os.path.join(self.dir, 'snapshot')
+        snapshots = memory_cache_snapshot.Snapshots(self.mc.cache, 
+                                                    snapshot_path,
+                                                    self.mc.oplog)
+        self.mc.set('key1', '0', '0', 'value')
+        snapshots.save_in_background()
+        snapshots.hand_off()
+        # the replacement logs to the same file from here on
+        replacement = memory_cache_oplog.OperationLog(self.path, 60)
+        replacement.deleted('key1')
+        replacement.close()
+        self.assertTrue(not snapshots.save_in_background())
+        self.mc.oplog.compact_bytes = 1
+        self.assertTrue(not snapshots.maybe_compact())
+        self.mc.set('key2', '0', '0', 'value')
+        snapshots.save()
+
+        mc = self.new_memcached()
+        mc.oplog = memory_cache_oplog.OperationLog(self.path, 60)
+        loaded = memory_cache_snapshot.Snapshots(mc.cache, snapshot_path,
+                                                 mc.oplog)
+        self.assertTrue(loaded.load() == 1)
+        mc.oplog.close()
+        self.assertTrue(mc.get(['key1', 'key2']) == [('key2', 'value', '0')])
+
+    def test_failed_compact(self):
+        self.mc.set('key1', '0', '0', 'value')
+        self.mc.oplog.rotate()
+        self.mc.set('key2', '0', '0', 'value')
+        self.mc.oplog.rotate()
+        self.mc.oplog.close()
+        mc = self.new_memcached()
+        memory_cache_oplog.replay(mc.cache, self.path + '.1')
+        self.assertTrue(mc.get(['key1', 'key2']) == 
+                        [('key1', 'value', '0'), ('key2', 'value', '0')])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -54,6 +54,17 @@ class TestCacheItem(unittest.TestCase):
         item2 = memory_cache_primitives.CacheItem('key', 'value', '0', '0')
         self.assertTrue(item1.casunique() != item2.casunique())
 
+class TestChunkedCacheItem(unittest.TestCase):
+
+    def test_chunks(self):
+        item = memory_cache_primitives.ChunkedCacheItem('key', '1234567', '0', '0', 3)
+        self.assertTrue(item.chunks == ['123', '456', '7'])
+        self.assertTrue(item.value == '1234567')
+
+    def test_bytes(self):
+        item = memory_cache_primitives.ChunkedCacheItem('key', '1234567', '0', '0', 3)
+        self.assertTrue(item.bytes() == 11)
+
 class TestLRU(unittest.TestCase):
 
     def setUp(self):
@@ -322,6 +333,31 @@ class TestMemoryCache(unittest.TestCase):
         item = self.mc.get('key')
         self.assertTrue(item.value == 'value')
 
+    def test_add_chunked(self):
+        self.mc = memory_cache_primitives.MemoryCache(self.stats, 1000, 100000, 4)
+
+        self.mc.add('key1', '1234', '0', '0')
+        self.mc.add('key2', '123456789', '0', '0')
+
+        item = self.mc.get('key1')
+        self.assertTrue(not isinstance(item, memory_cache_primitives.ChunkedCacheItem))
+
+        item = self.mc.get('key2')
+        self.assertTrue(item.chunks == ['1234', '5678', '9'])
+        self.assertTrue(item.value == '123456789')
+
+    def test_get_multi(self):
+        exp_time = int(time.time()) - 10
+
+        self.mc.add('key1', 'value1', '0', '0')
+        self.mc.add('key2', 'value2', '0', str(exp_time))
+        items = list(self.mc.get_multi(['key1', 'key2', 'key3']))
+        self.assertTrue([key for key, item in items] == ['key1', 'key2', 'key3'])
+        self.assertTrue(items[0][1].value == 'value1')
+        self.assertTrue(items[1][1] is None)
+        self.assertTrue(items[2][1] is None)
+        self.assertTrue(self.stats.reclaimed == 1)
+
     def test_get_expired(self):
         exp_time = int(time.time()) - 10
 
@@ -329,5 +365,15 @@ class TestMemoryCache(unittest.TestCase):
         item = self.mc.get('key')
         self.assertTrue(item is None)
 
+    def test_expire_multi(self):
+        exp_time = int(time.time()) - 10
+
+        self.mc.add('key1', 'value1', '0', '0')
+        self.mc.add('key2', 'value2', '0', str(exp_time))
+        self.assertTrue(self.mc.expire_multi(['key1', 'key2', 'key3']) == 1)
+        self.assertTrue(list(self.mc.the_cache.keys()) == ['key1'])
+        self.assertTrue(self.mc.item_count == 1)
+        self.assertTrue(self.stats.reclaimed == 1)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,190 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memcache_protocol
+import memory_cache
+import memory_cache_leases
+import memory_cache_sharded
+import threading
+import unittest
+
+class TestShardedMemcached(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = memory_cache.MemcachedStats()
+        self.mc = memory_cache_sharded.ShardedMemcached(self.stats, shards=4)
+
+    def test_spread(self):
+        for i in range(100):
+            self.mc.set("key%d" % i, "0", 0, "value")
+        self.assertEqual(self.mc.item_count(), 100)
+        for shard in self.mc.shards:
+            self.assertTrue(shard.engine.cache.item_count > 0)
+            for key in shard.engine.cache.the_cache:
+                self.assertTrue(self.mc.shard(key) is shard)
+
+    def test_single_key(self):
+        self.assertEqual(self.mc.add("foo", "1", 0, "bar"), self.mc.STORED)
+        self.assertEqual(self.mc.add("foo", "1", 0, "bar"), 
+                         self.mc.NOT_STORED)
+        self.assertEqual(self.mc.append("foo", "1", 0, "!"), self.mc.STORED)
+        self.assertEqual(self.mc.get(["foo"]), [("foo", "bar!", "1")])
+        self.mc.set("n", "0", 0, "1")
+        self.assertEqual(self.mc.increment("n", "5"), (self.mc.STORED, "6"))
+        self.assertEqual(self.mc.delete("foo"), self.mc.DELETED)
+        self.assertEqual(self.mc.delete("foo"), self.mc.NOT_FOUND)
+
+    def test_multi_order(self):
+        keys = ["key%d" % i for i in range(20)]
+        results = self.mc.set_multi([(key, "0", 0, key) for key in keys])
+        self.assertEqual(results, [(key, self.mc.STORED) for key in keys])
+        asked = list(reversed(keys)) + ["nothere"]
+        self.assertEqual([hit[0] for hit in self.mc.get_multi(asked)],
+                         list(reversed(keys)))
+        self.assertEqual([hit[0] for hit in self.mc.gets(asked)],
+                         list(reversed(keys)))
+        self.assertEqual(self.mc.touch_multi(["key1", "nothere"], 100),
+                         [("key1", self.mc.TOUCHED), 
+                          ("nothere", self.mc.NOT_FOUND)])
+        self.assertEqual(self.mc.delete_multi(["nothere", "key1"]),
+                         [("nothere", self.mc.NOT_FOUND), 
+                          ("key1", self.mc.DELETED)])
+        self.assertEqual(self.mc.item_count(), 19)
+
+    def test_leases(self):
+        self.mc.set("hit", "0", 0, "value")
+        keys = ["miss%d" % i for i in range(10)] + ["hit"]
+        results = list(self.mc.lease_get_multi(keys))
+        self.assertEqual([key for key, _, _, _, _ in results], keys)
+        self.assertEqual(results[-1][1], memory_cache_leases.HIT)
+        for key, state, _, _, token in results[:-1]:
+            self.assertEqual(state, memory_cache_leases.LEASED)
+            self.assertEqual(self.mc.lease_set(key, "0", 0, token, "v"),
+                             self.mc.STORED)
+        self.assertEqual(len(self.mc.get(keys)), 11)
+
+    def test_metadump_flush(self):
+        for i in range(10):
+            self.mc.set("key%d" % i, "0", 0, "value")
+        dumped = [entry[0] for entry in self.mc.metadump() 
+                  if entry is not None]
+        self.assertEqual(sorted(dumped), sorted("key%d" % i 
+                                                for i in range(10)))
+        self.mc.flush(0)
+        self.assertEqual(self.mc.get(["key%d" % i for i in range(10)]), [])
+
+    def test_stats(self):
+        for i in range(10):
+            self.mc.set("key%d" % i, "0", 0, "value")
+        self.mc.get(["key0", "nothere"])
+        stats = dict(self.mc.stats(""))
+        self.assertEqual(stats["curr_items"], 10)
+        self.assertEqual(stats["cmd_set"], 10)
+        self.assertEqual((stats["get_hits"], stats["get_misses"]), (1, 1))
+        self.assertEqual(stats["limit_maxitems"], 
+                         memory_cache.DEFAULT_MAX_ITEMS)
+
+    def test_budgets(self):
+        mc = memory_cache_sharded.ShardedMemcached(self.stats, shards=4, 
+                                                   max_bytes=4000)
+        self.assertEqual([shard.engine.cache.max_bytes 
+                          for shard in mc.shards], [1000] * 4)
+        self.assertEqual(dict(mc.stats(""))["limit_maxbytes"], 4000)
+
+    def test_rebalance(self):
+        mc = memory_cache_sharded.ShardedMemcached(self.stats, shards=4, 
+                                                   max_bytes=4000)
+        # only when asked
+        mc.REBALANCE_SECONDS = 3600
+        self.assertEqual(mc.rebalance(), 0)
+        hot = mc.shards[0]
+        keys = [key for key in ("key%d" % i for i in range(1000))
+                if mc.shard(key) is hot]
+        for key in keys[:30]:
+            mc.set(key, "0", 0, "x" * 90)
+        self.assertTrue(hot.stats.evictions > 0)
+        self.assertEqual(mc.rebalance(), 1)
+        self.assertEqual(hot.engine.cache.max_bytes, 1125)
+        self.assertEqual(sum(shard.engine.cache.max_bytes 
+                             for shard in mc.shards), 4000)
+        self.assertEqual(hot.stats.limit_maxbytes, 1125)
+        # nothing new evicted
+        self.assertEqual(mc.rebalance(), 0)
+        # the others only give down to half a share
+        for _ in range(100):
+            for key in keys[:30]:
+                mc.set(key, "0", 0, "x" * 90)
+            mc.rebalance()
+        for shard in mc.shards[1:]:
+            self.assertTrue(shard.engine.cache.max_bytes >= 500)
+        self.assertEqual(hot.engine.cache.max_bytes, 2500)
+
+    def test_rebalance_on_evictions(self):
+        mc = memory_cache_sharded.ShardedMemcached(self.stats, shards=4, 
+                                                   max_bytes=4000)
+        mc.REBALANCE_SECONDS = 0
+        hot = mc.shards[0]
+        keys = [key for key in ("key%d" % i for i in range(1000))
+                if mc.shard(key) is hot]
+        for key in keys[:30]:
+            mc.set(key, "0", 0, "x" * 90)
+        self.assertTrue(hot.engine.cache.max_bytes > 1000)
+        before = hot.engine.cache.max_bytes
+        mc.set_multi([(key, "0", 0, "x" * 90) for key in keys[30:60]])
+        self.assertTrue(hot.engine.cache.max_bytes > before)
+        self.assertEqual(sum(shard.engine.cache.max_bytes 
+                             for shard in mc.shards), 4000)
+
+    def test_threads(self):
+        self.mc.set("n", "0", 0, "0")
+        def count(prefix):
+            for i in range(200):
+                self.mc.increment("n", "1")
+                self.mc.set("%s%d" % (prefix, i), "0", 0, "value")
+        threads = [threading.Thread(target=count, args=(str(i),)) 
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.mc.get(["n"]), [("n", "800", "0")])
+        self.assertEqual(self.mc.item_count(), 801)
+
+    def test_protocol(self):
+        stats = memcache_protocol.ProtocolStats()
+        mc = memory_cache_sharded.ShardedMemcached(stats)
+        protocol = memcache_protocol.MCProtocol(stats, mc, ("127.0.0.1", 0))
+        self.assertEqual(protocol.got_input("set foo 0 0 3\r\nbar\r\n"),
+                         "STORED\r\n")
+        self.assertEqual(protocol.got_input("get foo\r\n"),
+                         "VALUE foo 0 3\r\nbar\r\nEND\r\n")
+        self.assertTrue("STAT cmd_set 1\r\n" in 
+                        protocol.got_input("stats\r\n"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,247 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memcache_protocol
+import memcache_protocol_execute
+import memory_cache
+import memory_cache_shared
+import multiprocessing
+import random
+import time
+import unittest
+
+class TestSharedMemcached(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = memory_cache.MemcachedStats()
+        self.mc = memory_cache_shared.SharedMemcached(
+            self.stats, max_bytes=4*4096, item_size_max=1000, stripes=2, 
+            page_size=4096)
+
+    def test_layout(self):
+        self.assertEqual((self.mc.pages, self.mc.stripes), (4, 2))
+        self.assertEqual(self.mc.sizes[0], 64)
+        self.assertEqual(self.mc.sizes[-1], 4096)
+        self.assertEqual(self.mc.sizes, sorted(set(self.mc.sizes)))
+        self.assertRaises(ValueError, memory_cache_shared.SharedMemcached,
+                          self.stats, max_bytes=4095, page_size=4096)
+
+    def test_set_get(self):
+        self.assertEqual(self.mc.set("foo", "3", 0, "bar"), self.mc.STORED)
+        self.assertEqual(self.mc.get(["foo", "nothere"]), 
+                         [("foo", "bar", "3")])
+        self.assertEqual(self.mc.set("foo", "4", 0, "baz" * 10), 
+                         self.mc.STORED)
+        self.assertEqual(self.mc.get(["foo"]), [("foo", "baz" * 10, "4")])
+        self.assertEqual(self.mc.item_count(), 1)
+        self.assertEqual((self.stats.get_hits, self.stats.get_misses), 
+                         (2, 1))
+
+    def test_add_replace_append(self):
+        self.assertEqual(self.mc.replace("foo", "0", 0, "bar"), 
+                         self.mc.NOT_STORED)
+        self.assertEqual(self.mc.add("foo", "0", 0, "bar"), self.mc.STORED)
+        self.assertEqual(self.mc.add("foo", "0", 0, "bar"), 
+                         self.mc.NOT_STORED)
+        self.assertEqual(self.mc.append("foo", "0", 0, "!"), self.mc.STORED)
+        self.assertEqual(self.mc.prepend("foo", "0", 0, "<"), self.mc.STORED)
+        self.assertEqual(self.mc.get(["foo"]), [("foo", "<bar!", "0")])
+        self.assertEqual(self.mc.append("nothere", "0", 0, "!"), 
+                         self.mc.NOT_STORED)
+        self.mc.set("big", "0", 0, "x" * 1000)
+        self.assertEqual(self.mc.append("big", "0", 0, "!"), 
+                         self.mc.TOO_LARGE)
+        self.assertEqual(len(self.mc.get(["big"])[0][1]), 1000)
+
+    def test_cas(self):
+        self.mc.set("foo", "0", 0, "bar")
+        casunique = self.mc.gets(["foo"])[0][3]
+        self.assertEqual(self.mc.cas("foo", "0", 0, casunique, "baz"),
+                         self.mc.STORED)
+        self.assertEqual(self.mc.cas("foo", "0", 0, casunique, "qux"),
+                         self.mc.EXISTS)
+        self.assertNotEqual(self.mc.gets(["foo"])[0][3], casunique)
+        self.assertEqual(self.mc.get(["foo"]), [("foo", "baz", "0")])
+
+    def test_incr_decr(self):
+        self.assertEqual(self.mc.increment("n", "1"), 
+                         (self.mc.NOT_FOUND, None))
+        self.mc.set("n", "7", 0, "10")
+        self.assertEqual(self.mc.increment("n", "5"), (self.mc.STORED, "15"))
+        self.assertEqual(self.mc.decrement("n", "3"), (self.mc.STORED, "12"))
+        self.assertEqual(self.mc.get(["n"]), [("n", "12", "7")])
+        self.mc.set("s", "0", 0, "abc")
+        self.assertEqual(self.mc.increment("s", "1"), 
+                         (self.mc.NOT_NUMBER, None))
+
+    def test_delete(self):
+        self.mc.set("foo", "0", 0, "bar")
+        self.assertEqual(self.mc.delete_multi(["foo", "foo"]),
+                         [("foo", self.mc.DELETED), 
+                          ("foo", self.mc.NOT_FOUND)])
+        self.assertEqual(self.mc.get(["foo"]), [])
+        self.assertEqual(self.mc.item_count(), 0)
+
+    def test_expiry(self):
+        past = int(time.time()) - 10
+        self.mc.set("gone", "0", past, "bar")
+        self.mc.set("touched", "0", 0, "bar")
+        self.assertEqual(self.mc.touch_multi(["touched", "nothere"], past),
+                         [("touched", self.mc.TOUCHED), 
+                          ("nothere", self.mc.NOT_FOUND)])
+        self.mc.set("stays", "0", 100, "bar")
+        self.assertEqual(self.mc.get(["gone", "touched", "stays"]), 
+                         [("stays", "bar", "0")])
+        self.assertEqual(dict(self.mc.stats(""))["reclaimed"], 2)
+
+    def test_flush(self):
+        self.mc.set_multi([("key%d" % i, "0", 0, "bar") for i in range(5)])
+        self.mc.flush(0)
+        self.assertEqual(self.mc.get(["key%d" % i for i in range(5)]), [])
+
+    def test_metadump(self):
+        self.mc.set("foo1", "5", 0, "bar")
+        self.mc.set("foo2", "0", 0, "bar")
+        self.mc.set("other", "0", 0, "bar")
+        entries = [entry for entry in self.mc.metadump("foo") 
+                   if entry is not None]
+        self.assertEqual(sorted(entry[0] for entry in entries), 
+                         ["foo1", "foo2"])
+        self.assertTrue(("5", memory_cache_shared.ITEM.size + 7) in 
+                        [entry[4:] for entry in entries])
+
+    def test_evict_same_class(self):
+        # 4 pages of 64 byte chunks between the 2 stripes
+        keys = ["key%03d" % i for i in range(400)]
+        for key in keys:
+            self.assertEqual(self.mc.set(key, "0", 0, "x" * 20), 
+                             self.mc.STORED)
+        stats = dict(self.mc.stats(""))
+        self.assertEqual(stats["curr_items"], 256)
+        self.assertEqual(stats["evictions"], 144)
+        self.assertEqual(stats["total_items"], 400)
+        # the most recent ones are still there, the hand goes in order
+        self.assertEqual(len(self.mc.get(keys[-20:])), 20)
+
+    def test_take_page(self):
+        # fill every page with small items, then ask for a big one
+        for i in range(200):
+            self.mc.set("key%03d" % i, "0", 0, "x" * 20)
+        self.assertEqual(self.mc.set("big", "0", 0, "x" * 1000), 
+                         self.mc.STORED)
+        self.assertEqual(self.mc.get(["big"]), [("big", "x" * 1000, "0")])
+        small = [key for key, _, _ in 
+                 self.mc.get(["key%03d" % i for i in range(200)])]
+        self.assertEqual(len(small), self.mc.item_count() - 1)
+        # the small class still works, with a page fewer
+        for i in range(200):
+            self.mc.set("again%03d" % i, "0", 0, "x" * 20)
+        self.assertEqual(self.mc.get(["big"]), [("big", "x" * 1000, "0")])
+
+    def test_default_stripes(self):
+        # 63 pages of a little over a megabyte, not enough for a page 
+        # per slab class in more than one stripe
+        mc = memory_cache_shared.SharedMemcached(self.stats)
+        self.assertEqual((mc.pages, mc.stripes), (63, 1))
+        mc = memory_cache_shared.SharedMemcached(
+            self.stats, max_bytes=1024*1024*1024)
+        self.assertEqual(mc.stripes, mc.pages // len(mc.sizes))
+        sizes = [10, 100, 500, 1000, 2000, 5000]
+        keys = ["key%05d" % i for i in range(20000)]
+        for i, key in enumerate(keys):
+            self.assertEqual(mc.set(key, "0", 0, "x" * sizes[i % 6]), 
+                             mc.STORED)
+        self.assertEqual(len(mc.get(keys)), len(keys))
+        self.assertEqual(dict(mc.stats(""))["evictions"], 0)
+
+    def test_tombstones(self):
+        for _ in range(10):
+            for i in range(50):
+                self.mc.set("key%d" % i, "0", 0, "bar")
+            for i in range(50):
+                self.mc.delete("key%d" % i)
+        self.mc.set("foo", "0", 0, "bar")
+        self.assertEqual(self.mc.get(["foo"]), [("foo", "bar", "0")])
+        for stripe in range(self.mc.stripes):
+            self.assertTrue(self.mc._stripe(stripe)[6] <= self.mc.region // 4)
+
+    def test_processes(self):
+        self.mc.set("n", "0", 0, "0")
+        def work(worker):
+            for i in range(100):
+                self.mc.increment("n", "1")
+            self.mc.set("from%d" % worker, "0", 0, str(worker))
+        workers = [multiprocessing.Process(target=work, args=(i,))
+                   for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(self.mc.get(["n"]), [("n", "400", "0")])
+        self.assertEqual(len(self.mc.get(["from%d" % i for i in range(4)])),
+                         4)
+        self.assertEqual(dict(self.mc.stats(""))["curr_items"], 5)
+
+    def test_mixed_sizes_processes(self):
+        # about a third full, nothing should be evicted
+        mc = memory_cache_shared.SharedMemcached(self.stats)
+        def work(worker):
+            sizes = random.Random(worker)
+            for i in range(5000):
+                mc.set("w%d-%d" % (worker, i), "0", 0, 
+                       "x" * sizes.randint(1, 2000))
+        workers = [multiprocessing.Process(target=work, args=(i,))
+                   for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        stats = dict(mc.stats(""))
+        self.assertEqual(stats["evictions"], 0)
+        self.assertEqual(stats["curr_items"], 20000)
+
+    def test_protocol(self):
+        stats = memcache_protocol.ProtocolStats()
+        mc = memory_cache_shared.SharedMemcached(
+            stats, max_bytes=4*4096, item_size_max=1000, page_size=4096)
+        protocol = memcache_protocol.MCProtocol(stats, mc, ("127.0.0.1", 0))
+        self.assertEqual(protocol.got_input("set foo 5 0 3\r\nbar\r\n"),
+                         "STORED\r\n")
+        self.assertEqual(protocol.got_input("get foo\r\n"),
+                         "VALUE foo 5 3\r\nbar\r\nEND\r\n")
+        # no leases, but the connection carries on
+        self.assertEqual(protocol.got_input("lget foo\r\n"),
+                         memcache_protocol_execute.NO_LEASES)
+        self.assertEqual(protocol.got_input("lset foo 0 0 3 1\r\nbaz\r\n"
+                                            "lset foo 0 0 3 1 noreply\r\n"
+                                            "baz\r\nget foo\r\n"),
+                         memcache_protocol_execute.NO_LEASES + 
+                         "VALUE foo 5 3\r\nbar\r\nEND\r\n")
+
+if __name__ == "__main__":
+    unittest.main()
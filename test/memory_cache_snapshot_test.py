@@ -0,0 +1,151 @@
+#!/usr/local/bin/python
+"""
+Copyright 2011 James Yates Farrimond. All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are
+permitted provided that the following conditions are met:
+
+   1. Redistributions of source code must retain the above copyright notice, this list of
+      conditions and the following disclaimer.
+
+   2. Redistributions in binary form must reproduce the above copyright notice, this list
+      of conditions and the following disclaimer in the documentation and/or other materials
+      provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS OR IMPLIED
+WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL JAMES YATES FARRIMOND OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those of the
+authors and should not be interpreted as representing official policies, either expressed
+or implied, of James Yates Farrimond.
+"""
+import memory_cache_primitives
+import memory_cache_snapshot
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+def new_cache(chunk_size=0):
+    stats = memory_cache_primitives.MemoryCacheStats()
+    return memory_cache_primitives.MemoryCache(stats, sys.maxsize, sys.maxsize,
+                                               chunk_size)
+
+def keys_by_age(cache):
+    keys = []
+    item = cache.lru.least()
+    while item is not None:
+        keys.append(item.key)
+        item = item.prev
+    return keys
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot')
+        self.cache = new_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        self.cache.add('key1', 'value1', '1', '0')
+        self.cache.add('key2', '', '0', '100')
+        self.cache.add('key3', 'value3\r\n', '4294967295', '0')
+        memory_cache_snapshot.save(self.cache, self.path)
+        loaded = new_cache()
+        self.assertTrue(memory_cache_snapshot.load(loaded, self.path) == 3)
+        for key in ('key1', 'key2', 'key3'):
+            item = self.cache.get(key)
+            loaded_item = loaded.get(key)
+            self.assertTrue(loaded_item.value == item.value)
+            self.assertTrue(loaded_item.flags == item.flags)
+            self.assertTrue(loaded_item.exptime == item.exptime)
+        self.assertTrue(loaded.stats.curr_items == 3)
+        self.assertTrue(loaded.byte_count == self.cache.byte_count)
+
+    def test_lru_order(self):
+        for key in ('key1', 'key2', 'key3'):
+            self.cache.add(key, 'value', '0', '0')
+        self.cache.touch(self.cache.get('key1'))
+        memory_cache_snapshot.save(self.cache, self.path)
+        loaded = new_cache()
+        memory_cache_snapshot.load(loaded, self.path)
+        self.assertTrue(keys_by_age(loaded) == ['key2', 'key3', 'key1'])
+
+    def test_expired_skipped(self):
+        self.cache.add('key1', 'value1', '0', '0')
+        self.cache.add('key2', 'value2', '0', '0')
+        self.cache.get('key2').exptime = int(time.time()) - 1
+        memory_cache_snapshot.save(self.cache, self.path)
+        loaded = new_cache()
+        self.assertTrue(memory_cache_snapshot.load(loaded, self.path) == 1)
+        self.assertTrue(loaded.get('key2') is None)
+
+    def test_expired_while_saved(self):
+        self.cache.add('key1', 'value1', '0', '100')
+        memory_cache_snapshot.save(self.cache, self.path)
+        int_time = memory_cache_primitives.int_time
+        memory_cache_primitives.int_time = lambda: int_time() + 200
+        try:
+            loaded = new_cache()
+            self.assertTrue(memory_cache_snapshot.load(loaded, self.path) == 0)
+        finally:
+            memory_cache_primitives.int_time = int_time
+
+    def test_chunked(self):
+        cache = new_cache(4)
+        cache.add('key', '1234567890', '0', '0')
+        memory_cache_snapshot.save(cache, self.path)
+        loaded = new_cache(4)
+        memory_cache_snapshot.load(loaded, self.path)
+        self.assertTrue(loaded.get('key').chunks == ['1234', '5678', '90'])
+
+    def test_empty_cache(self):
+        memory_cache_snapshot.save(self.cache, self.path)
+        self.assertTrue(memory_cache_snapshot.load(new_cache(), self.path) == 0)
+
+    def test_no_snapshot(self):
+        self.assertTrue(memory_cache_snapshot.load(self.cache, self.path) 
+                        is None)
+
+    def test_not_a_snapshot(self):
+        for contents in (b'', b'garbage!'):
+            with open(self.path, 'wb') as out:
+                out.write(contents)
+            self.assertRaises(ValueError, memory_cache_snapshot.load, 
+                              self.cache, self.path)
+
+    def test_truncated(self):
+        self.cache.add('key1', 'value1', '0', '0')
+        memory_cache_snapshot.save(self.cache, self.path)
+        with open(self.path, 'rb') as snapshot:
+            contents = snapshot.read()
+        for end in (len(contents) - 1, len(memory_cache_snapshot.MAGIC) + 1):
+            with open(self.path, 'wb') as out:
+                out.write(contents[:end])
+            self.assertRaises(ValueError, memory_cache_snapshot.load, 
+                              new_cache(), self.path)
+
+    def test_background(self):
+        self.cache.add('key1', 'value1', '0', '0')
+        snapshots = memory_cache_snapshot.Snapshots(self.cache, self.path)
+        self.assertTrue(snapshots.save_in_background())
+        self.cache.add('key2', 'value2', '0', '0')
+        snapshots.save()
+        self.assertTrue(not snapshots.saving())
+        loaded = memory_cache_snapshot.Snapshots(new_cache(), self.path)
+        self.assertTrue(loaded.load() == 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -27,6 +27,8 @@ authors and should not be interpreted as representing official policies, either
 or implied, of James Yates Farrimond.
 """
 import memory_cache
+import memory_cache_leases
+import memory_cache_primitives
 import time
 import unittest
 
@@ -57,11 +59,32 @@ class TestMemcachedStats(unittest.TestCase):
         self.assertTrue(self.stats.cmd_get == 1)
         self.assertTrue(self.stats.get_hits == 1)
 
+    def test_get_multi(self):
+        self.mc.set("test_get1", "0", "0", "12345")
+        self.mc.set("test_get2", "0", "0", "12345")
+        list(self.mc.get_multi( ("test_get1", "test_get2", "test_get3") ))
+        self.assertTrue(self.stats.cmd_get == 3)
+        self.assertTrue(self.stats.get_hits == 2)
+        self.assertTrue(self.stats.get_misses == 1)
+
     def test_delete(self):
         self.mc.set("test_delete", "0", "0", "12345")
         self.mc.delete("test_delete")
         self.assertTrue(self.stats.delete_hits == 1)
 
+    def test_delete_multi(self):
+        self.mc.set("test_delete", "0", "0", "12345")
+        self.mc.delete_multi( ("test_delete", "test_delete") )
+        self.assertTrue(self.stats.delete_hits == 1)
+        self.assertTrue(self.stats.delete_misses == 1)
+
+    def test_touch_multi(self):
+        self.mc.set("test_touch", "0", "0", "12345")
+        self.mc.touch_multi( ("test_touch", "test_none"), 100 )
+        self.assertTrue(self.stats.cmd_touch == 2)
+        self.assertTrue(self.stats.touch_hits == 1)
+        self.assertTrue(self.stats.touch_misses == 1)
+
     def test_delete_not_exist(self):
         self.mc.delete("test_delete")
         self.assertTrue(self.stats.delete_misses == 1)
@@ -204,6 +227,14 @@ class TestMemcached(unittest.TestCase):
     def test_append_not_exist(self):
         self.assertTrue(self.mc.append("test_append", "0", "0", "6") == self.mc.NOT_STORED)
 
+    def test_append_too_large(self):
+        self.mc.item_size_max = 6
+        self.mc.set("test_append", "0", "0", "12345")
+        self.assertTrue(self.mc.append("test_append", "0", "0", "6") == self.mc.STORED)
+        self.assertTrue(self.mc.append("test_append", "0", "0", "7") == self.mc.TOO_LARGE)
+        self.assertTrue(self.mc.prepend("test_append", "0", "0", "0") == self.mc.TOO_LARGE)
+        self.assertTrue(self.mc.get( ("test_append",) )[0][1] == "123456")
+
     def test_increment(self):
         self.mc.set("test_increment", "0", "0", "12345")
         self.mc.increment("test_increment", "1")
@@ -246,6 +277,44 @@ class TestMemcached(unittest.TestCase):
         self.mc.delete("test_delete")
         self.assertTrue(not self.mc.get( ("test_delete",) ))
 
+    def test_get_multi(self):
+        self.mc.set("test_get1", "1", "0", "12345")
+        self.mc.set("test_get3", "3", "0", "345")
+        items = self.mc.get_multi( ("test_get1", "test_get2", "test_get3") )
+        self.assertTrue(list(items) == [("test_get1", "12345", "1"),
+                                        ("test_get3", "345", "3")])
+
+    def test_gets_multi(self):
+        self.mc.set("test_gets1", "0", "0", "12345")
+        self.mc.set("test_gets2", "0", "0", "345")
+        items = list(self.mc.gets_multi( ("test_gets1", "test_gets2") ))
+        self.assertTrue(len(items) == 2)
+        self.assertTrue(items[0][3] != items[1][3])
+
+    def test_set_multi(self):
+        self.mc.set("test_set1", "0", "0", "00000")
+        results = self.mc.set_multi( [("test_set1", "0", "0", "12345"),
+                                      ("test_set2", "0", "0", "345")] )
+        self.assertTrue(results == [("test_set1", self.mc.STORED),
+                                    ("test_set2", self.mc.STORED)])
+        self.assertTrue(self.mc.get( ("test_set1",) )[0][1] == "12345")
+        self.assertTrue(self.mc.get( ("test_set2",) )[0][1] == "345")
+        self.assertTrue(self.stats.curr_items == 2)
+
+    def test_delete_multi(self):
+        self.mc.set("test_delete", "0", "0", "12345")
+        results = self.mc.delete_multi( ("test_delete", "test_none") )
+        self.assertTrue(results == [("test_delete", self.mc.DELETED),
+                                    ("test_none", self.mc.NOT_FOUND)])
+        self.assertTrue(not self.mc.get( ("test_delete",) ))
+
+    def test_touch_multi(self):
+        self.mc.set("test_touch", "0", "0", "12345")
+        results = self.mc.touch_multi( ("test_touch", "test_none"), 1 )
+        self.assertTrue(results == [("test_touch", self.mc.TOUCHED),
+                                    ("test_none", self.mc.NOT_FOUND)])
+        self.assertTrue(self.mc.cache.get("test_touch").exptime > 1)
+
     def test_flush(self):
         self.mc.flush(0)
 
@@ -253,5 +322,106 @@ class TestMemcached(unittest.TestCase):
         stats = self.mc.stats("")
         self.assertTrue(stats is not None)
 
+class TestMemcachedLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = memory_cache.MemcachedStats()
+        self.mc = memory_cache.Memcached(self.stats, stale_seconds=60)
+
+    def lease_get(self, key):
+        return list(self.mc.lease_get_multi([key]))[0]
+
+    def expired(self, key, value):
+        self.mc.set(key, "5", int(time.time()) - 10, value)
+
+    def test_hit(self):
+        self.mc.set("key", "5", 0, "value")
+        self.assertTrue(self.lease_get("key") == 
+                        ("key", memory_cache_leases.HIT, "value", "5", None))
+
+    def test_lease_then_wait(self):
+        key, state, value, _, token = self.lease_get("key")
+        self.assertTrue(state == memory_cache_leases.LEASED)
+        self.assertTrue(value is None and token is not None)
+        self.assertTrue(self.lease_get("key")[1] == memory_cache_leases.WAIT)
+        self.assertTrue(self.mc.lease_set(key, "0", 0, token, "new") == 
+                        self.mc.STORED)
+        self.assertTrue(self.lease_get("key")[2] == "new")
+        self.assertTrue(self.stats.lease_grants == 1)
+        self.assertTrue(self.stats.lease_waits == 1)
+
+    def test_stale(self):
+        self.expired("key", "old")
+        _, state, value, flags, token = self.lease_get("key")
+        self.assertTrue((state, value, flags) == 
+                        (memory_cache_leases.LEASED, "old", "5"))
+        _, state, value, _, _ = self.lease_get("key")
+        self.assertTrue((state, value) == (memory_cache_leases.STALE, "old"))
+        self.assertTrue(self.stats.lease_stale_hits == 1)
+        self.mc.lease_set("key", "0", 0, token, "new")
+        self.assertTrue(self.lease_get("key")[1] == memory_cache_leases.HIT)
+
+    def test_stale_window(self):
+        self.mc.stale_seconds = 5
+        self.expired("key", "old")
+        self.assertTrue(self.lease_get("key")[2] is None)
+
+    def test_stale_deadlines(self):
+        leases = memory_cache_leases.Leases(10, 60)
+        now = 2000000000
+        # found in one order, but running out in the other
+        leases.expired(memory_cache_primitives.CacheItem(
+                "later", "a", "0", now - 10), now)
+        leases.expired(memory_cache_primitives.CacheItem(
+                "sooner", "b", "0", now - 50), now)
+        self.assertTrue(leases.miss("sooner", now + 20) == 
+                        (memory_cache_leases.LEASED, 1, None))
+        self.assertTrue("sooner" not in leases.stale)
+        self.assertTrue(leases.miss("later", now + 20) == 
+                        (memory_cache_leases.LEASED, 2, ("a", "0")))
+
+    def test_bad_token(self):
+        token = self.lease_get("key")[4]
+        self.assertTrue(self.mc.lease_set("key", "0", 0, token + 1, "bad") == 
+                        self.mc.NOT_STORED)
+        self.assertTrue(self.mc.lease_set("other", "0", 0, token, "bad") == 
+                        self.mc.NOT_STORED)
+        self.assertTrue(self.stats.lease_rejects == 2)
+        self.assertTrue(self.mc.lease_set("key", "0", 0, token, "good") == 
+                        self.mc.STORED)
+        self.assertTrue(self.mc.lease_set("key", "0", 0, token, "again") == 
+                        self.mc.NOT_STORED)
+
+    def test_set_cancels_lease(self):
+        token = self.lease_get("key")[4]
+        self.mc.set("key", "0", 0, "newer")
+        self.mc.delete("key")
+        self.assertTrue(self.mc.lease_set("key", "0", 0, token, "older") == 
+                        self.mc.NOT_STORED)
+        self.assertTrue(self.lease_get("key")[1] == 
+                        memory_cache_leases.LEASED)
+
+    def test_lease_runs_out(self):
+        self.mc.lease_seconds = -1
+        token = self.lease_get("key")[4]
+        self.assertTrue(self.lease_get("key")[1] == 
+                        memory_cache_leases.LEASED)
+        self.assertTrue(self.mc.lease_set("key", "0", 0, token, "late") == 
+                        self.mc.NOT_STORED)
+
+    def test_flush(self):
+        self.expired("key", "old")
+        self.lease_get("key")
+        self.mc.set("flushed", "0", 0, "value")
+        self.mc.flush(0)
+        _, state, value, _, _ = self.lease_get("key")
+        self.assertTrue((state, value) == (memory_cache_leases.LEASED, None))
+        self.assertTrue(self.lease_get("flushed")[2] is None)
+
+    def test_stats(self):
+        self.lease_get("key")
+        names = [name for name, _ in self.stats.dump("")]
+        self.assertTrue("lease_grants" in names)
+
 if __name__ == "__main__":
     unittest.main()